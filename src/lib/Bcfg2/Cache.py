@@ -2,6 +2,9 @@
 doesn't provide many features, but more (time-based expiration, etc.)
 can be added as necessary. """
 
+import os
+import threading
+
 
 class Cache(dict):
     """ an implementation of a simple memory-backed cache """
@@ -12,3 +15,206 @@ class Cache(dict):
             self.clear()
         elif key in self:
             del self[key]
+
+
+class DependencyCache(Cache):
+    """ a memory-backed cache whose items can be expired by the
+    filesystem paths they were built from.  Each cached item can
+    register any number of paths it depends on; a change to one of
+    those paths (or to anything beneath it, if it is a directory)
+    expires only the items that depend on it.
+
+    Paths that nobody has declared responsibility for with
+    :func:`track_path` are assumed to affect every item, so changes
+    to them expire the whole cache.  Paths declared with
+    :func:`ignore_path` (e.g., data files that a plugin writes
+    itself) are assumed to affect no item at all. """
+
+    def __init__(self, *args, **kwargs):
+        Cache.__init__(self, *args, **kwargs)
+        self.lock = threading.Lock()
+        #: dict of path -> set of keys that depend on that path
+        self.dependents = dict()
+        #: dict of key -> set of paths that key depends on
+        self.dependencies = dict()
+        #: paths for which dependencies are registered explicitly
+        self.tracked = set()
+        #: paths whose changes never affect any cached item
+        self.ignored = set()
+        #: incremented every time items are expired because something
+        #: they depend on changed.  callers can use this to detect
+        #: that the data an item was built from changed while it was
+        #: being built.
+        self.generation = 0
+
+    def track_path(self, path):
+        """ declare that every dependency on a file at or beneath
+        ``path`` will be registered with :func:`add_dependency` """
+        self.tracked.add(os.path.normpath(path))
+
+    def ignore_path(self, path):
+        """ declare that changes to ``path``, or to anything beneath
+        it, never affect any cached item """
+        self.ignored.add(os.path.normpath(path))
+
+    def add_dependency(self, key, path):
+        """ record that the cached item ``key`` depends on ``path`` """
+        path = os.path.normpath(path)
+        self.lock.acquire()
+        try:
+            self.dependents.setdefault(path, set()).add(key)
+            self.dependencies.setdefault(key, set()).add(path)
+        finally:
+            self.lock.release()
+
+    def _forget(self, key):
+        """ remove all dependency records for ``key``.  the lock must
+        be held by the caller. """
+        for path in self.dependencies.pop(key, []):
+            keys = self.dependents.get(path)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.dependents[path]
+
+    def expire(self, key=None):
+        self.lock.acquire()
+        try:
+            if key is None:
+                self.generation += 1
+                self.dependents.clear()
+                self.dependencies.clear()
+            else:
+                self._forget(key)
+            Cache.expire(self, key=key)
+        finally:
+            self.lock.release()
+    expire.__doc__ = Cache.expire.__doc__
+
+    def _is_beneath(self, path, paths):
+        """ return True if ``path`` is one of ``paths``, or is
+        beneath one of them """
+        path = os.path.normpath(path)
+        for candidate in paths:
+            if path == candidate or path.startswith(candidate + os.path.sep):
+                return True
+        return False
+
+    def is_tracked(self, path):
+        """ return True if dependencies on ``path`` are registered
+        explicitly """
+        return self._is_beneath(path, self.tracked)
+
+    def is_ignored(self, path):
+        """ return True if changes to ``path`` never affect any
+        cached item """
+        return self._is_beneath(path, self.ignored)
+
+    def expire_path(self, path):
+        """ expire all items that depend on ``path``, or on a
+        directory that contains ``path``.  If ``path`` is ignored,
+        nothing is expired; if it is not tracked, the entire cache is
+        expired.
+
+        :returns: list of expired keys, or None if the whole cache
+                  was expired """
+        path = os.path.normpath(path)
+        if self.is_ignored(path):
+            return []
+        if not self.is_tracked(path):
+            self.expire()
+            return None
+        self.lock.acquire()
+        try:
+            expired = set()
+            candidate = path
+            while True:
+                expired.update(self.dependents.get(candidate, []))
+                parent = os.path.dirname(candidate)
+                if parent == candidate:
+                    break
+                candidate = parent
+            # a change to a directory affects everything beneath it
+            prefix = path + os.path.sep
+            for dep, keys in self.dependents.items():
+                if dep.startswith(prefix):
+                    expired.update(keys)
+            if expired:
+                self.generation += 1
+            for key in expired:
+                self._forget(key)
+                Cache.expire(self, key=key)
+            return list(expired)
+        finally:
+            self.lock.release()
+
+
+class LRUCache(Cache):
+    """ a memory-backed cache that holds at most ``maxsize`` items.
+    When it is full, the least recently used item is discarded to
+    make room for a new one.  Lookups made with :func:`get` are
+    counted as cache hits or misses. """
+
+    def __init__(self, maxsize=128):
+        Cache.__init__(self)
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        #: The number of :func:`get` calls that found an item
+        self.hits = 0
+        #: The number of :func:`get` calls that did not find an item
+        self.misses = 0
+        #: dict of key -> tick of the last time the item was used
+        self.used = dict()
+        self.tick = 0
+
+    def _touch(self, key):
+        """ mark ``key`` as most recently used.  the lock must be
+        held by the caller. """
+        self.tick += 1
+        self.used[key] = self.tick
+
+    def get(self, key, default=None):
+        """ get an item from the cache, recording a hit or a miss """
+        self.lock.acquire()
+        try:
+            if key in self:
+                self.hits += 1
+                self._touch(key)
+                return dict.__getitem__(self, key)
+            self.misses += 1
+            return default
+        finally:
+            self.lock.release()
+
+    def __setitem__(self, key, value):
+        self.lock.acquire()
+        try:
+            dict.__setitem__(self, key, value)
+            self._touch(key)
+            while len(self) > self.maxsize:
+                oldest = min([(tick, k) for k, tick in self.used.items()])[1]
+                dict.__delitem__(self, oldest)
+                del self.used[oldest]
+        finally:
+            self.lock.release()
+
+    def __delitem__(self, key):
+        self.lock.acquire()
+        try:
+            dict.__delitem__(self, key)
+            del self.used[key]
+        finally:
+            self.lock.release()
+
+    def expire(self, key=None):
+        self.lock.acquire()
+        try:
+            if key is None:
+                dict.clear(self)
+                self.used.clear()
+            elif key in self:
+                dict.__delitem__(self, key)
+                del self.used[key]
+        finally:
+            self.lock.release()
+    expire.__doc__ = Cache.expire.__doc__
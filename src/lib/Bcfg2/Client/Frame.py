@@ -48,7 +48,8 @@ def passes_black_list(entry, blacklist):
 class Frame(object):
     """Frame is the container for all Tool objects and state information."""
 
-    def __init__(self, config, setup, times, drivers, dryrun):
+    def __init__(self, config, setup, times, drivers, dryrun,
+                 verification_cache=None):
         self.config = config
         self.times = times
         self.dryrun = dryrun
@@ -90,6 +91,9 @@ class Frame(object):
                 self.logger.error("Failed to instantiate tool %s" % tool,
                                   exc_info=1)
 
+        for tool in self.tools:
+            tool.verification_cache = verification_cache
+
         for tool in self.tools[:]:
             for conflict in getattr(tool, 'conflicts', []):
                 for item in self.tools:
@@ -6,7 +6,12 @@ warnings.filterwarnings("ignore", "apt API not stable yet",
                         FutureWarning)
 import apt.cache
 import os
+import sys
+import glob
+import errno
 import Bcfg2.Client.Tools
+from Bcfg2.Compat import md5, cPickle
+from Bcfg2.Utils import WorkerPool
 
 class APT(Bcfg2.Client.Tools.Tool):
     """The Debian toolset implements package and service operations and inherits
@@ -28,6 +33,22 @@ class APT(Bcfg2.Client.Tools.Tool):
         self.aptget = '%s/bin/apt-get' % self.install_path
         self.dpkg = '%s/bin/dpkg' % self.install_path
         self.__execs__ = [self.debsums, self.aptget, self.dpkg]
+        self.dpkg_path = '%s/lib/dpkg' % self.var_path
+
+        #: The pool of threads that checksums are computed in
+        self.debsums_pool = WorkerPool(setup.get('apt_debsums_threads', 4),
+                                       name="APT-debsums")
+
+        #: The file that checksums are cached in between runs, keyed
+        #: by the size and mtime of each file, or None to not cache
+        #: checksums
+        self.debsums_cache = setup.get('apt_debsums_cache', None)
+
+        #: A dict of <package name>: <list of (problem, filename)
+        #: tuples>, or None if the package has no md5sums.  This is
+        #: gathered for all packages at once by
+        #: :func:`BatchDebsums` during :func:`Inventory`.
+        self.debsums_results = dict()
 
         path_entries = os.environ['PATH'].split(':')
         for reqdir in ['/sbin', '/usr/sbin']:
@@ -87,35 +108,250 @@ class APT(Bcfg2.Client.Tools.Tool):
                                          type='deb', version=version) \
                                          for (name, version) in extras]
 
-    def VerifyDebsums(self, entry, modlist):
-        output = self.cmd.run("%s -as %s" % (self.debsums,
-                                             entry.get('name')))[1]
+    def Inventory(self, states, structures=None):
+        """Checksum the files of all packages at once, then verify
+        each entry."""
+        if not structures:
+            structures = self.config.getchildren()
+        if not self.setup['quick']:
+            packages = [entry.get('name') for struct in structures
+                        for entry in struct.getchildren()
+                        if (entry.tag == 'Package' and
+                            self.handlesEntry(entry) and
+                            entry.get('verify', 'true') == 'true' and
+                            self._is_installed(entry.get('name')))]
+            if packages:
+                try:
+                    self.debsums_results = self.BatchDebsums(packages)
+                except:  # pylint: disable=W0702
+                    self.logger.error("Failed to checksum package files, "
+                                      "running debsums on each package",
+                                      exc_info=1)
+        try:
+            Bcfg2.Client.Tools.Tool.Inventory(self, states, structures)
+        finally:
+            # packages may be reinstalled by Install, so don't let the
+            # results outlive this inventory
+            self.debsums_results = dict()
+
+    def _is_installed(self, pkgname):
+        """ return True if the named package is installed """
+        if not self.pkg_cache.has_key(pkgname):
+            return False
+        if self._newapi:
+            return self.pkg_cache[pkgname].is_installed
+        else:
+            return self.pkg_cache[pkgname].isInstalled
+
+    def _read_diversions(self):
+        """ read the dpkg diversions database into a dict of <diverted
+        path>: (<diverted to>, <diverting package>) """
+        rv = dict()
+        try:
+            lines = open(os.path.join(self.dpkg_path,
+                                      'diversions')).read().splitlines()
+        except IOError:
+            return rv
+        for i in range(0, len(lines) - 2, 3):
+            rv[lines[i]] = (lines[i + 1], lines[i + 2])
+        return rv
+
+    def _read_conffiles(self, packages):
+        """ read the checksums of the conffiles of the given packages
+        from the dpkg status file, as a dict of <package name>: <list
+        of (path, md5sum) tuples> """
+        rv = dict()
+        pkgname = None
+        in_conffiles = False
+        status = open(os.path.join(self.dpkg_path, 'status')).read()
+        for line in status.splitlines():
+            if line.startswith('Package:'):
+                pkgname = line.split(':', 1)[1].strip()
+                in_conffiles = False
+            elif line.startswith('Conffiles:'):
+                in_conffiles = pkgname in packages
+            elif in_conffiles and line.startswith(' '):
+                fields = line.split()
+                # skip obsolete conffiles, and conffiles that dpkg
+                # hasn't recorded a checksum for yet
+                if (len(fields) == 2 and len(fields[1]) == 32):
+                    rv.setdefault(pkgname, []).append(tuple(fields))
+            else:
+                in_conffiles = False
+        return rv
+
+    def _read_md5sums(self, pkgname):
+        """ read the checksums of the files of a package from its
+        md5sums file(s), as a list of (path, md5sum) tuples, or None
+        if the package has no md5sums """
+        infodir = os.path.join(self.dpkg_path, 'info')
+        # multi-arch packages have an md5sums file per architecture
+        sumfiles = glob.glob(os.path.join(infodir, "%s.md5sums" % pkgname)) + \
+            glob.glob(os.path.join(infodir, "%s:*.md5sums" % pkgname))
+        if not sumfiles:
+            return None
+        rv = []
+        for sumfile in sumfiles:
+            for line in open(sumfile).read().splitlines():
+                fields = line.split(None, 1)
+                if len(fields) == 2:
+                    rv.append(("/" + fields[1].lstrip("/"), fields[0]))
+        return rv
+
+    def _load_debsums_cache(self):
+        """ load the cache of checksums from the last run """
+        if not self.debsums_cache:
+            return dict()
+        try:
+            return cPickle.load(open(self.debsums_cache, 'rb'))
+        except:  # pylint: disable=W0702
+            return dict()
+
+    def _save_debsums_cache(self, cache):
+        """ save the cache of checksums for the next run """
+        if not self.debsums_cache:
+            return
+        tmpfile = self.debsums_cache + ".new"
+        try:
+            cachefile = open(tmpfile, 'wb')
+            try:
+                cPickle.dump(cache, cachefile, 2)
+            finally:
+                cachefile.close()
+            os.rename(tmpfile, self.debsums_cache)
+        except (IOError, OSError):
+            err = sys.exc_info()[1]
+            self.logger.info("Failed to save checksum cache %s: %s" %
+                             (self.debsums_cache, err))
+
+    def _checksum(self, path, cache):
+        """ get the md5sum of the given file, using the checksum
+        recorded in ``cache`` if the file's size and mtime haven't
+        changed.  returns a tuple of (md5sum, stat signature), where
+        md5sum is None and the signature is the problem if the file
+        can't be read. """
+        try:
+            fstat = os.stat(path)
+        except OSError:
+            err = sys.exc_info()[1]
+            if err.errno == errno.ENOENT:
+                return (None, 'missing')
+            return (None, 'unreadable')
+        signature = (fstat.st_size, fstat.st_mtime)
+        cached = cache.get(path)
+        if cached is not None and cached[0] == signature:
+            return (cached[1], signature)
+        digest = md5()
+        try:
+            fileobj = open(path, 'rb')
+            try:
+                while True:
+                    data = fileobj.read(64 * 1024)
+                    if not data:
+                        break
+                    digest.update(data)
+            finally:
+                fileobj.close()
+        except IOError:
+            return (None, 'unreadable')
+        return (digest.hexdigest(), signature)
+
+    def BatchDebsums(self, packages):
+        """ Check the files of all of the given packages against the
+        checksums in the dpkg database in one pass, the way ``debsums
+        -as`` would check each package.  The files are checksummed in
+        a pool of threads.
+
+        :returns: dict of <package name>: <list of (problem,
+                  filename) tuples>, or None if the package has no
+                  md5sums.  Problems are 'changed', 'missing', and
+                  'unreadable'.
+        """
+        diversions = self._read_diversions()
+        conffiles = self._read_conffiles(set(packages))
+        rv = dict()
+        jobs = []
+        for pkgname in packages:
+            files = self._read_md5sums(pkgname)
+            if files is None and pkgname not in conffiles:
+                rv[pkgname] = None
+                continue
+            rv[pkgname] = []
+            for path, expected in (files or []) + conffiles.get(pkgname, []):
+                if path in diversions and diversions[path][1] != pkgname:
+                    # the file has been diverted by another package,
+                    # so this package's copy is elsewhere
+                    path = diversions[path][0]
+                jobs.append((pkgname, path, expected))
+
+        cache = self._load_debsums_cache()
+        paths = list(set([path for _, path, _ in jobs]))
+        checksums = dict(zip(paths,
+                             self.debsums_pool.map(
+                                 lambda p: self._checksum(p, cache), paths)))
+        newcache = dict()
+        for pkgname, path, expected in jobs:
+            digest, signature = checksums[path]
+            if digest is None:
+                rv[pkgname].append((signature, path))
+                continue
+            newcache[path] = (signature, digest)
+            if digest != expected:
+                rv[pkgname].append(('changed', path))
+        self._save_debsums_cache(newcache)
+        return rv
+
+    def _run_debsums(self, pkgname):
+        """ check a single package with debsums.  returns a list of
+        (problem, filename) tuples, or None if the package has no
+        md5sums """
+        output = self.cmd.run("%s -as %s" % (self.debsums, pkgname))[1]
         if len(output) == 1 and "no md5sums for" in output[0]:
+            return None
+        rv = []
+        for item in output:
+            if "checksum mismatch" in item:
+                rv.append(('changed', item.split()[-1]))
+            elif "changed file" in item:
+                rv.append(('changed', item.split()[3]))
+            elif "can't open" in item:
+                rv.append(('unreadable', item.split()[5]))
+            elif "missing file" in item:
+                rv.append(('missing', item.split()[3]))
+            elif "is not installed" in item:
+                rv.append(('missing', None))
+            else:
+                rv.append((None, item))
+        return rv
+
+    def VerifyDebsums(self, entry, modlist):
+        if entry.get('name') in self.debsums_results:
+            results = self.debsums_results[entry.get('name')]
+        else:
+            results = self._run_debsums(entry.get('name'))
+        if results is None:
             self.logger.info("Package %s has no md5sums. Cannot verify" % \
                              entry.get('name'))
             entry.set('qtext', "Reinstall Package %s-%s to setup md5sums? (y/N) " \
                       % (entry.get('name'), entry.get('version')))
             return False
         files = []
-        for item in output:
-            if "checksum mismatch" in item:
-                files.append(item.split()[-1])
-            elif "changed file" in item:
-                files.append(item.split()[3])
-            elif "can't open" in item:
-                if item.split()[5] not in self.nonexistent:
-                    files.append(item.split()[5])
-            elif "missing file" in item and \
-                 item.split()[3] in self.nonexistent:
+        for problem, filename in results:
+            if problem == 'changed':
+                files.append(filename)
+            elif problem == 'unreadable':
+                if filename not in self.nonexistent:
+                    files.append(filename)
+            elif problem == 'missing' and filename in self.nonexistent:
                 # these files should not exist
                 continue
-            elif "is not installed" in item or "missing file" in item:
+            elif problem == 'missing':
                 self.logger.error("Package %s is not fully installed" \
                                   % entry.get('name'))
             else:
                 self.logger.error("Got Unsupported pattern %s from debsums" \
-                                  % item)
-                files.append(item)
+                                  % filename)
+                files.append(filename)
         files = list(set(files) - set(self.ignores))
         # We check if there is file in the checksum to do
         if files:
@@ -19,21 +19,43 @@ class Chkconfig(Bcfg2.Client.Tools.SvcTool):
     def get_svc_command(self, service, action):
         return "/sbin/service %s %s" % (service.get('name'), action)
 
+    def gather_service_status(self, services):
+        """ Get the runlevel information of all services from a
+        single ``chkconfig --list``, as a dict of <service name>:
+        <list of fields>, in the same format as the output of
+        ``chkconfig --list <service>``. """
+        rc, output = self.cmd.run("/sbin/chkconfig --list 2>/dev/null")
+        if rc != 0:
+            return dict()
+        rv = dict()
+        for line in output:
+            fields = line.split()
+            if len(fields) == 2 and fields[0].endswith(':'):
+                # xinetd services are listed as "<name>: <on|off>"
+                rv[fields[0][:-1]] = [fields[0][:-1], fields[1]]
+            elif len(fields) > 2 and not [f for f in fields[1:]
+                                          if ':' not in f]:
+                rv[fields[0]] = fields
+        return rv
+
     def VerifyService(self, entry, _):
         """Verify Service status for entry."""
         if entry.get('status') == 'ignore':
             return True
 
-        try:
-            cmd = "/sbin/chkconfig --list %s " % (entry.get('name'))
-            raw = self.cmd.run(cmd)[1]
-            patterns = ["error reading information", "unknown service"]
-            srvdata = [line.split() for line in raw for pattern in patterns \
-                       if pattern not in line][0]
-        except IndexError:
-            # Ocurrs when no lines are returned (service not installed)
-            entry.set('current_status', 'off')
-            return False
+        srvdata = self.service_status.get(entry.get('name'))
+        if srvdata is None:
+            try:
+                cmd = "/sbin/chkconfig --list %s " % (entry.get('name'))
+                raw = self.cmd.run(cmd)[1]
+                patterns = ["error reading information", "unknown service"]
+                srvdata = [line.split() for line in raw
+                           for pattern in patterns
+                           if pattern not in line][0]
+            except IndexError:
+                # Ocurrs when no lines are returned (service not installed)
+                entry.set('current_status', 'off')
+                return False
         if len(srvdata) == 2:
             # This is an xinetd service
             if entry.get('status') == srvdata[1]:
@@ -48,11 +70,12 @@ class Chkconfig(Bcfg2.Client.Tools.SvcTool):
         except IndexError:
             onlevels = []
 
-        pstatus = self.check_service(entry)
+        # only check whether the service is running if the runlevels
+        # don't already decide the outcome
         if entry.get('status') == 'on':
-            status = (len(onlevels) > 0 and pstatus)
+            status = (len(onlevels) > 0 and self.check_service(entry))
         else:
-            status = (len(onlevels) == 0 and not pstatus)
+            status = (len(onlevels) == 0 and not self.check_service(entry))
 
         if not status:
             if entry.get('status') == 'on':
@@ -82,9 +105,16 @@ class Chkconfig(Bcfg2.Client.Tools.SvcTool):
 
     def FindExtra(self):
         """Locate extra chkconfig Services."""
-        allsrv = [line.split()[0]
-                  for line in self.cmd.run("/sbin/chkconfig "
-                                           "--list 2>/dev/null|grep :on")[1]]
+        if self.service_status:
+            allsrv = sorted([name
+                             for name, srvdata in self.service_status.items()
+                             if [level for level in srvdata[1:]
+                                 if level.endswith(':on')]])
+        else:
+            allsrv = [line.split()[0]
+                      for line in self.cmd.run("/sbin/chkconfig "
+                                               "--list 2>/dev/null|"
+                                               "grep :on")[1]]
         self.logger.debug('Found active services:')
         self.logger.debug(allsrv)
         specified = [srv.get('name') for srv in self.getSupportedEntries()]
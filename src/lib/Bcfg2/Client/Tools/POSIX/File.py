@@ -3,19 +3,94 @@
 import os
 import sys
 import stat
-import time
 import difflib
 import tempfile
 from Bcfg2.Client.Tools.POSIX.base import POSIXTool
-from Bcfg2.Compat import unicode, b64encode, b64decode  # pylint: disable=W0622
+# pylint: disable=W0622
+from Bcfg2.Compat import unicode, b64encode, b64decode, md5
+# pylint: enable=W0622
+
+
+def file_digest(filename, chunk_size=64 * 1024):
+    """ Get the MD5 hex digest of the contents of the given file,
+    which is read in chunks of ``chunk_size`` bytes.  This is the
+    digest that the client sends to the server for each of its managed
+    files so that the server can omit the contents of unchanged files.
+    Raises :exc:`IOError` if the file cannot be read. """
+    digest = md5()
+    fileobj = open(filename, 'rb')
+    try:
+        chunk = fileobj.read(chunk_size)
+        while chunk:
+            digest.update(chunk)
+            chunk = fileobj.read(chunk_size)
+    finally:
+        fileobj.close()
+    return digest.hexdigest()
+
+
+def fast_ndiff(lines1, lines2):
+    """ Produce a diff of two lists of lines in the same format as
+    :func:`difflib.ndiff`, so that it can be passed to
+    :func:`difflib.restore`, but without the intraline ``?`` hints.
+    Finding those hints is what makes ``ndiff`` so slow on files with
+    many changed lines. """
+    matcher = difflib.SequenceMatcher(None, lines1, lines2)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            for line in lines1[i1:i2]:
+                yield '  ' + line
+            continue
+        if tag in ('replace', 'delete'):
+            for line in lines1[i1:i2]:
+                yield '- ' + line
+        if tag in ('replace', 'insert'):
+            for line in lines2[j1:j2]:
+                yield '+ ' + line
 
 
 class POSIXFile(POSIXTool):
     """ Handle <Path type='file' ...> entries """
     __req__ = ['name', 'perms', 'owner', 'group']
 
+    #: The size of the chunks the file on disk is read in when
+    #: comparing it to the desired content
+    chunk_size = 64 * 1024
+
     def fully_specified(self, entry):
-        return entry.text is not None or entry.get('empty', 'false') == 'true'
+        return (entry.text is not None or
+                entry.get('empty', 'false') == 'true' or
+                self._contents_omitted(entry))
+
+    def _contents_omitted(self, entry):
+        """ Returns true if the server omitted the contents of the
+        entry because our copy of the file was current, and gave us
+        its digest instead """
+        return entry.text is None and entry.get('digest') is not None
+
+    def _verify_digest(self, entry):
+        """ Compare the file on disk to the digest of an entry whose
+        contents were omitted by the server.  Returns True if they
+        differ. """
+        try:
+            if self.verification_cache is not None:
+                digest = self.verification_cache.digest(entry.get('name'))
+            else:
+                digest = file_digest(entry.get('name'),
+                                     chunk_size=self.chunk_size)
+            if digest == entry.get('digest'):
+                return False
+        except IOError:
+            self.logger.error("POSIX: Failed to read %s: %s" %
+                              (entry.get("name"), sys.exc_info()[1]))
+            return True
+        # the file has changed since we sent its digest to the
+        # server, so we have no way to fix it in this run; it will
+        # be sent with the next configuration.
+        self.logger.error("POSIX: %s has changed during the run, and its "
+                          "contents were not sent by the server" %
+                          entry.get("name"))
+        return True
 
     def _is_string(self, strng, encoding):
         """ Returns true if the string contains no ASCII control
@@ -53,6 +128,10 @@ class POSIXFile(POSIXTool):
         return (tempdata, is_binary)
 
     def verify(self, entry, modlist):
+        if self._contents_omitted(entry):
+            different = self._verify_digest(entry)
+            return POSIXTool.verify(self, entry, modlist) and not different
+
         ondisk = self._exists(entry)
         tempdata, is_binary = self._get_data(entry)
 
@@ -68,17 +147,12 @@ class POSIXFile(POSIXTool):
             # from the size of the desired content
             different = True
         else:
-            # finally, read in the target file and compare them
-            # directly. comparison could be done with a checksum,
-            # which might be faster for big binary files, but slower
-            # for everything else
-            try:
-                content = open(entry.get('name')).read()
-            except IOError:
-                self.logger.error("POSIX: Failed to read %s: %s" %
-                                  (entry.get("name"), sys.exc_info()[1]))
+            # finally, compare the target file to the desired content
+            # a chunk at a time, so that we can stop at the first
+            # difference and never hold the whole file in memory
+            different = self._compare_cached(entry, tempdata)
+            if different is None:
                 return False
-            different = content != tempdata
 
         if different:
             self.logger.debug("POSIX: %s has incorrect contents" %
@@ -89,6 +163,49 @@ class POSIXFile(POSIXTool):
                 is_binary=is_binary, content=content)
         return POSIXTool.verify(self, entry, modlist) and not different
 
+    def _compare_cached(self, entry, data):
+        """ Compare the file on disk to the given data like
+        :func:`_compare`, unless the verification cache shows that
+        the file hasn't changed since it was last found to match the
+        data. """
+        if self.verification_cache is None:
+            return self._compare(entry, data)
+        key = ('digest', entry.get('name'))
+        signature = self.verification_cache.signature(entry.get('name'))
+        if isinstance(data, unicode):
+            digest = md5(data.encode(self.setup['encoding'])).hexdigest()
+        else:
+            digest = md5(data).hexdigest()
+        if self.verification_cache.get(key, signature) == digest:
+            return False
+        rv = self._compare(entry, data)
+        if rv is False:
+            self.verification_cache.set(key, signature, digest)
+        return rv
+
+    def _compare(self, entry, data):
+        """ Compare the file on disk to the given data, reading the
+        file in chunks of :attr:`chunk_size`.  Returns True if they
+        differ, False if they are identical, or None if the file could
+        not be read. """
+        try:
+            fileobj = open(entry.get('name'))
+            try:
+                offset = 0
+                while True:
+                    chunk = fileobj.read(self.chunk_size)
+                    if chunk != data[offset:offset + len(chunk)]:
+                        return True
+                    if not chunk:
+                        return offset != len(data)
+                    offset += len(chunk)
+            finally:
+                fileobj.close()
+        except IOError:
+            self.logger.error("POSIX: Failed to read %s: %s" %
+                              (entry.get("name"), sys.exc_info()[1]))
+            return None
+
     def _write_tmpfile(self, entry):
         """ Write the file data to a temp file """
         filedata, _ = self._get_data(entry)
@@ -135,6 +252,12 @@ class POSIXFile(POSIXTool):
 
     def install(self, entry):
         """Install device entries."""
+        if self._contents_omitted(entry):
+            # only the metadata of the file can be fixed
+            if self._verify_digest(entry):
+                return False
+            return POSIXTool.install(self, entry)
+
         if not os.path.exists(os.path.dirname(entry.get('name'))):
             if not self._makedirs(entry,
                                   path=os.path.dirname(entry.get('name'))):
@@ -156,19 +279,34 @@ class POSIXFile(POSIXTool):
 
         prompt = [entry.get('qtext', '')]
         attrs = dict()
+        limit = self.setup['posix_diff_limit']
+        desired = self._get_data(entry)[0]
         if content is None:
             # it's possible that we figured out the files are
             # different without reading in the local file.  if the
             # supplied version of the file is not binary, we now have
             # to read in the local file to figure out if _it_ is
             # binary, and either include that fact or the diff in our
-            # prompts for -I and the reports
+            # prompts for -I and the reports.  we never read more
+            # than the diff limit, though.
             try:
-                content = open(entry.get('name')).read()
+                fileobj = open(entry.get('name'))
+                try:
+                    content = fileobj.read(limit + 1)
+                finally:
+                    fileobj.close()
             except IOError:
                 self.logger.error("POSIX: Failed to read %s: %s" %
                                   (entry.get("name"), sys.exc_info()[1]))
                 return False
+        if len(content) > limit or len(desired) > limit:
+            self.logger.info("POSIX: %s is larger than the diff limit of %s "
+                             "bytes, not computing diff" %
+                             (entry.get("name"), limit))
+            prompt.append("File too large to compute diff")
+            if interactive:
+                entry.set("qtext", "\n".join(prompt))
+            return
         if not is_binary:
             is_binary |= not self._is_string(content, self.setup['encoding'])
         if is_binary:
@@ -177,55 +315,29 @@ class POSIXFile(POSIXTool):
             attrs['current_bfile'] = b64encode(content)
         else:
             if interactive:
-                diff = self._diff(content, self._get_data(entry)[0],
-                                  difflib.unified_diff,
-                                  filename=entry.get("name"))
-                if diff:
-                    udiff = '\n'.join(l.rstrip('\n') for l in diff)
-                    if hasattr(udiff, "decode"):
-                        udiff = udiff.decode(self.setup['encoding'])
-                    try:
-                        prompt.append(udiff)
-                    except UnicodeEncodeError:
-                        prompt.append("Could not encode diff")
-                else:
-                    prompt.append("Diff took too long to compute, no "
-                                  "printable diff")
+                diff = self._diff(content, desired, difflib.unified_diff)
+                udiff = '\n'.join(l.rstrip('\n') for l in diff)
+                if hasattr(udiff, "decode"):
+                    udiff = udiff.decode(self.setup['encoding'])
+                try:
+                    prompt.append(udiff)
+                except UnicodeEncodeError:
+                    prompt.append("Could not encode diff")
             if not sensitive:
-                diff = self._diff(content, self._get_data(entry)[0],
-                                  difflib.ndiff, filename=entry.get("name"))
-                if diff:
-                    attrs["current_bdiff"] = b64encode("\n".join(diff))
-                else:
-                    attrs['current_bfile'] = b64encode(content)
+                # the diff sent with the report is only used to
+                # reconstruct the current file with difflib.restore,
+                # so the much cheaper fast_ndiff will do
+                diff = self._diff(content, desired, fast_ndiff)
+                attrs["current_bdiff"] = b64encode("\n".join(diff))
         if interactive:
             entry.set("qtext", "\n".join(prompt))
         if not sensitive:
             for attr, val in attrs.items():
                 entry.set(attr, val)
 
-    def _diff(self, content1, content2, difffunc, filename=None):
+    def _diff(self, content1, content2, difffunc):
         """ Return a diff of the two strings, as produced by difffunc.
-        warns after 5 seconds and times out after 30 seconds. """
-        rv = []
-        start = time.time()
-        longtime = False
-        for diffline in difffunc(content1.split('\n'),
-                                 content2.split('\n')):
-            now = time.time()
-            rv.append(diffline)
-            if now - start > 5 and not longtime:
-                if filename:
-                    self.logger.info("POSIX: Diff of %s taking a long time" %
-                                     filename)
-                else:
-                    self.logger.info("POSIX: Diff taking a long time")
-                longtime = True
-            elif now - start > 30:
-                if filename:
-                    self.logger.error("POSIX: Diff of %s took too long; "
-                                      "giving up" % filename)
-                else:
-                    self.logger.error("POSIX: Diff took too long; giving up")
-                return False
-        return rv
+        The amount of work this does is bounded by the
+        ``[POSIX] diff_limit`` option, which is checked by the
+        caller. """
+        return list(difffunc(content1.split('\n'), content2.split('\n')))
@@ -56,6 +56,20 @@ class POSIX(Bcfg2.Client.Tools.Tool):
                 rv[etype] = hdlr(self.logger, self.setup, self.config)
         return rv
 
+    def _get_verification_cache(self):
+        """ get the verification cache that entries are checked
+        against, or None if there isn't one """
+        return getattr(self, "_verification_cache", None)
+
+    def _set_verification_cache(self, cache):
+        """ set the verification cache, and pass it on to the
+        handlers, which do the actual verification """
+        self._verification_cache = cache
+        for hdlr in self._handlers.values():
+            hdlr.verification_cache = cache
+    verification_cache = property(_get_verification_cache,
+                                  _set_verification_cache)
+
     def canVerify(self, entry):
         if not Bcfg2.Client.Tools.Tool.canVerify(self, entry):
             return False
@@ -227,7 +227,8 @@ class RPM(Bcfg2.Client.Tools.PkgTool):
                                     else:
                                         vp_ts = rpmtools.rpmtransactionset()
                                         self.instance_status[inst]['verify'] = \
-                                                                             rpmtools.rpm_verify( vp_ts, pkg, flags)
+                                                                             rpmtools.rpm_verify( vp_ts, pkg, flags,
+                                                                                 verify_cache=self.verification_cache)
                                         vp_ts.closeDB()
                                         del vp_ts
 
@@ -286,7 +287,8 @@ class RPM(Bcfg2.Client.Tools.PkgTool):
                                         else:
                                             vp_ts = rpmtools.rpmtransactionset()
                                             self.instance_status[inst]['verify'] = \
-                                                                                 rpmtools.rpm_verify( vp_ts, pkg, flags )
+                                                                                 rpmtools.rpm_verify( vp_ts, pkg, flags,
+                                                                                     verify_cache=self.verification_cache)
                                             vp_ts.closeDB()
                                             del vp_ts
 
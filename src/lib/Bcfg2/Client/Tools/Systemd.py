@@ -12,22 +12,70 @@ class Systemd(Bcfg2.Client.Tools.SvcTool):
     __handles__ = [('Service', 'systemd')]
     __req__ = {'Service': ['name', 'status']}
 
+    #: The maximum number of units to query with one systemctl call
+    batch_size = 100
+
     def get_svc_command(self, service, action):
         return "/bin/systemctl %s %s.service" % (action, service.get('name'))
 
+    def gather_service_status(self, services):
+        """ Get the LoadState and ActiveState of the given services
+        with ``systemctl show``, as a dict of <service name>: <dict of
+        properties>. """
+        names = []
+        for entry in services:
+            if entry.get('name') not in names:
+                names.append(entry.get('name'))
+        rv = dict()
+        for start in range(0, len(names), self.batch_size):
+            batch = names[start:start + self.batch_size]
+            cmd = "/bin/systemctl show -p LoadState -p ActiveState %s" % \
+                " ".join(["%s.service" % name for name in batch])
+            rc, output = self.cmd.run(cmd)
+            if rc != 0:
+                self.logger.debug("Systemd: Failed to get status of %s "
+                                  "services, checking them one at a time" %
+                                  len(batch))
+                continue
+            # systemctl prints the properties of each unit in the
+            # order they were given, separated by blank lines
+            units = []
+            props = dict()
+            for line in output + ['']:
+                if '=' in line:
+                    key, val = line.split('=', 1)
+                    props[key.strip()] = val.strip()
+                elif props:
+                    units.append(props)
+                    props = dict()
+            if len(units) != len(batch):
+                self.logger.debug("Systemd: Got status of %s services, "
+                                  "expected %s; checking them one at a "
+                                  "time" % (len(units), len(batch)))
+                continue
+            rv.update(zip(batch, units))
+        return rv
+
     def VerifyService(self, entry, _):
         """Verify Service status for entry."""
         if entry.get('status') == 'ignore':
             return True
 
-        cmd = "/bin/systemctl status %s.service " % (entry.get('name'))
-        raw = ''.join(self.cmd.run(cmd)[1])
+        props = self.service_status.get(entry.get('name'))
+        if props is not None:
+            error = props.get('LoadState') == 'error'
+            active = props.get('ActiveState') == 'active'
+        else:
+            cmd = "/bin/systemctl status %s.service " % (entry.get('name'))
+            raw = ''.join(self.cmd.run(cmd)[1])
+            error = raw.find('Loaded: error') >= 0
+            active = raw.find('Active: active') >= 0
 
-        if raw.find('Loaded: error') >= 0:
+        if error:
             entry.set('current_status', 'off')
             status = False
 
-        elif raw.find('Active: active') >= 0:
+        elif active:
             entry.set('current_status', 'on')
             if entry.get('status') == 'off':
                 status = False
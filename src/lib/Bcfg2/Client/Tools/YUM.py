@@ -297,12 +297,34 @@ class YUM(Bcfg2.Client.Tools.PkgTool):
             """ helper to perform the verify according to the best
             options for whatever version of the API we're
             using. Disabling file checksums is a new feature yum
-            3.2.17-ish """
+            3.2.17-ish.  Packages whose files haven't changed since
+            they last verified cleanly are not verified again. """
+            fast = self.setup.get('quick', False)
+            cache = self.verification_cache
+            if cache is not None:
+                key = ('yum', pkg.name, pkg.epoch, pkg.version,
+                       pkg.release, pkg.arch)
+                signature = cache.fileset_signature(
+                    pkg.returnFileEntries('file') +
+                    pkg.returnFileEntries('dir') +
+                    pkg.returnFileEntries('ghost'))
+                # a package that passed a full verify also passes a
+                # fast one
+                if cache.get(key, signature) in [fast, False]:
+                    self.logger.debug("Package %s has not changed since it "
+                                      "was verified" % pkg)
+                    return dict()
             try:
-                return pkg.verify(fast=self.setup.get('quick', False))
+                results = pkg.verify(fast=fast)
             except TypeError:
                 # Older Yum API
-                return pkg.verify()
+                results = pkg.verify()
+            if cache is not None:
+                if results:
+                    cache.invalidate(key)
+                else:
+                    cache.set(key, signature, fast)
+            return results
 
         key = (pkg_obj.name, pkg_obj.epoch, pkg_obj.version, pkg_obj.release,
                pkg_obj.arch)
@@ -60,6 +60,11 @@ class Tool(object):
     __important__ = []
     deprecated = False
 
+    #: The :class:`Bcfg2.Client.VerifyCache.VerifyCache` that records
+    #: the files that have been verified, or None if verification
+    #: results are not cached
+    verification_cache = None
+
     def __init__(self, logger, setup, config):
         self.setup = setup
         self.logger = logger
@@ -322,6 +327,35 @@ class SvcTool(Tool):
         Tool.__init__(self, logger, setup, config)
         self.restarted = []
 
+        #: A dict of <service name>: <status data> gathered in bulk by
+        #: :func:`gather_service_status` at the start of
+        #: :func:`Inventory`.  Services that aren't in it are checked
+        #: individually.
+        self.service_status = dict()
+
+    def gather_service_status(self, services):  # pylint: disable=W0613
+        """ Get the status of all of the given Service entries with as
+        few commands as possible, for use by VerifyService.  The
+        format of the status data is up to the tool. """
+        return dict()
+
+    def Inventory(self, states, structures=None):
+        """Gather the status of all services, then verify them."""
+        if not structures:
+            structures = self.config.getchildren()
+        services = [entry for struct in structures
+                    for entry in struct.getchildren()
+                    if (self.handlesEntry(entry) and
+                        entry.get('status') != 'ignore')]
+        if services:
+            self.service_status = self.gather_service_status(services)
+        try:
+            Tool.Inventory(self, states, structures)
+        finally:
+            # services may be changed by Install, so don't let the
+            # status outlive this inventory
+            self.service_status = dict()
+
     def get_svc_command(self, service, action):
         """Return the basename of the command used to start/stop services."""
         return '/etc/init.d/%s %s' % (service.get('name'), action)
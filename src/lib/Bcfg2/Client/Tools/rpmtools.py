@@ -415,7 +415,7 @@ def debug_file_flags(fflags):
     if fflags & rpm.RPMFILE_PUBKEY:
         print('rpm.RPMFILE_PUBKEY')
 
-def rpm_verify_file(fileinfo, rpmlinktos, omitmask):
+def rpm_verify_file(fileinfo, rpmlinktos, omitmask, verify_cache=None):
     """
         Verify all the files in a package.
 
@@ -423,6 +423,10 @@ def rpm_verify_file(fileinfo, rpmlinktos, omitmask):
         entries are strings that are the same as the labels for the bitwise
         flags used in the C code.
 
+        If verify_cache (a Bcfg2.Client.VerifyCache.VerifyCache) is given,
+        the checksum of a file that hasn't changed since it last matched is
+        not computed again.
+
     """
     (fname, fsize, fmode, fmtime, fflags, frdev, finode, fnlink, fstate, \
             vflags, fuser, fgroup, fmd5) = fileinfo
@@ -471,12 +475,22 @@ def rpm_verify_file(fileinfo, rpmlinktos, omitmask):
 
     prelink_size = 0
     if flags & RPMVERIFY_MD5:
-        prelink_md5, prelink_size = prelink_md5_check(fname)
-        if prelink_md5 == False:
-            file_results.append('RPMVERIFY_MD5')
-            file_results.append('RPMVERIFY_READFAIL')
-        elif  prelink_md5 != fmd5:
-            file_results.append('RPMVERIFY_MD5')
+        cached = None
+        if verify_cache is not None:
+            cache_key = ('rpm', fname)
+            signature = verify_cache.signature(fname)
+            cached = verify_cache.get(cache_key, signature)
+        if cached is not None and cached[0] == fmd5:
+            prelink_size = cached[1]
+        else:
+            prelink_md5, prelink_size = prelink_md5_check(fname)
+            if prelink_md5 == False:
+                file_results.append('RPMVERIFY_MD5')
+                file_results.append('RPMVERIFY_READFAIL')
+            elif  prelink_md5 != fmd5:
+                file_results.append('RPMVERIFY_MD5')
+            elif verify_cache is not None:
+                verify_cache.set(cache_key, signature, (fmd5, prelink_size))
 
     if flags & RPMVERIFY_LINKTO:
         linkto = os.readlink(fname)
@@ -563,7 +577,7 @@ def rpm_verify_dependencies(header):
     _ts1.closeDB()
     return dep_errors
 
-def rpm_verify_package(vp_ts, header, verify_options):
+def rpm_verify_package(vp_ts, header, verify_options, verify_cache=None):
     """
         Verify a single package specified by header.  Header is an rpm.hdr.
 
@@ -628,7 +642,8 @@ def rpm_verify_package(vp_ts, header, verify_options):
             # rpm.fi interface.
             linktos = vp_fi.FLink()
 
-            file_stat = rpm_verify_file(fileinfo, linktos, omitmask)
+            file_stat = rpm_verify_file(fileinfo, linktos, omitmask,
+                                        verify_cache=verify_cache)
 
             #if len(file_stat) > 0 or options.verbose:
             if len(file_stat) > 0:
@@ -673,7 +688,8 @@ def rpm_verify_package(vp_ts, header, verify_options):
 
     return package_results
 
-def rpm_verify(verify_ts, verify_pkgspec, verify_options=[]):
+def rpm_verify(verify_ts, verify_pkgspec, verify_options=[],
+               verify_cache=None):
     """
        Requires rpmtransactionset() to be run first to get a ts.
 
@@ -717,7 +733,8 @@ def rpm_verify(verify_ts, verify_pkgspec, verify_options=[]):
     verify_results = []
     headers = getheadersbykeyword(verify_ts, **verify_pkgspec)
     for header in headers:
-        result = rpm_verify_package(verify_ts, header, verify_options)
+        result = rpm_verify_package(verify_ts, header, verify_options,
+                                    verify_cache=verify_cache)
         if result:
             verify_results.append(result)
 
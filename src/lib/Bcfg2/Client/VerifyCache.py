@@ -0,0 +1,192 @@
+""" A persistent cache of the results of verifying files on the
+client, so that files that have not changed since they were last
+verified can be checked with a single ``stat()`` instead of being
+read again.
+
+Each record is keyed by a tuple naming what was verified, e.g.,
+``('digest', <path>)``, and stores the *signature* of the file(s) at
+the time -- device, inode, size, mtime, and ctime -- along with a
+value such as the digest of the contents.  A record is only used if
+the signature still matches.  Every change to the contents of a file
+changes its mtime and ctime, and every change to its ownership,
+permissions, or extended attributes changes its ctime, which can't be
+set from user space, so a matching signature means that the file
+hasn't changed.
+
+To guard against bugs and against changes that evade these
+timestamps (e.g., a changed clock), the whole cache is discarded and
+everything is verified in full once it is older than ``max_age``
+seconds. """
+
+import os
+import sys
+import stat
+import time
+import logging
+from Bcfg2.Compat import md5, cPickle
+
+
+class VerifyCache(object):
+    """ A persistent cache of verification results keyed by file
+    signatures """
+
+    #: The version of the cache file format
+    version = 1
+
+    #: Files that have changed less than this many seconds before
+    #: they are verified are not cached, since a further change
+    #: within the resolution of the file timestamps could go unnoticed
+    racy_window = 2
+
+    #: The size of the chunks that files are read in when computing
+    #: their digests
+    chunk_size = 64 * 1024
+
+    def __init__(self, path, max_age=86400):
+        """
+        :param path: The file the cache is stored in
+        :type path: string
+        :param max_age: The number of seconds after which the cache
+                        is discarded and everything is verified in full
+        :type max_age: int
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.path = path
+        self.max_age = max_age
+
+        #: A dict of <key>: (<signature>, <value>)
+        self.records = dict()
+
+        #: The time of the last full verification
+        self.created = time.time()
+
+        self.load()
+
+    def load(self):
+        """ load the cache from disk, or start a new one if it's
+        missing, unreadable, or too old """
+        try:
+            data = cPickle.load(open(self.path, 'rb'))
+        except IOError:
+            return
+        except:  # pylint: disable=W0702
+            self.logger.info("Discarding unreadable verification cache %s: "
+                             "%s" % (self.path, sys.exc_info()[1]))
+            return
+        if (not isinstance(data, dict) or
+            data.get('version') != self.version):
+            self.logger.info("Discarding verification cache %s from an "
+                             "older version" % self.path)
+            return
+        if self.max_age and time.time() - data['created'] > self.max_age:
+            self.logger.info("Verification cache %s has expired, verifying "
+                             "everything in full" % self.path)
+            return
+        self.created = data['created']
+        self.records = data['records']
+
+    def save(self):
+        """ write the cache to disk """
+        tmpfile = self.path + ".new"
+        try:
+            if not os.path.exists(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            cachefile = open(tmpfile, 'wb')
+            try:
+                cPickle.dump(dict(version=self.version,
+                                  created=self.created,
+                                  records=self.records),
+                             cachefile, 2)
+            finally:
+                cachefile.close()
+            os.chmod(tmpfile, 384)
+            os.rename(tmpfile, self.path)
+        except (IOError, OSError):
+            err = sys.exc_info()[1]
+            self.logger.warning("Failed to save verification cache %s: %s" %
+                                (self.path, err))
+
+    def signature(self, path):
+        """ get the signature of a file: a tuple of its device,
+        inode, size, mtime, and ctime.  the signature of a symlink
+        includes that of its target.  returns None if the file can't
+        be stat()ed. """
+        try:
+            fstat = os.lstat(path)
+            rv = (fstat.st_dev, fstat.st_ino, fstat.st_size,
+                  fstat.st_mtime, fstat.st_ctime)
+            if stat.S_ISLNK(fstat.st_mode):
+                fstat = os.stat(path)
+                rv += (fstat.st_dev, fstat.st_ino, fstat.st_size,
+                       fstat.st_mtime, fstat.st_ctime)
+            return rv
+        except OSError:
+            return None
+
+    def _is_racy(self, signature):
+        """ return True if the file(s) with the given signature
+        changed too recently for the signature to be trusted """
+        now = time.time()
+        for idx in range(3, len(signature), 5):
+            if max(signature[idx], signature[idx + 1]) > \
+                    now - self.racy_window:
+                return True
+        return False
+
+    def fileset_signature(self, paths):
+        """ get a single signature for a set of files, e.g., all of
+        the files in a package.  returns None if any of the files
+        changed too recently for the signature to be trusted. """
+        signatures = []
+        for path in sorted(paths):
+            signature = self.signature(path)
+            if signature is not None and self._is_racy(signature):
+                return None
+            signatures.append((path, signature))
+        return md5(repr(signatures).encode('UTF-8')).hexdigest()
+
+    def get(self, key, signature):
+        """ get the value recorded for ``key``, or None if there is
+        none or the signature has changed since it was recorded """
+        if signature is None:
+            return None
+        record = self.records.get(key)
+        if record is None or record[0] != signature:
+            return None
+        return record[1]
+
+    def set(self, key, signature, value):
+        """ record a value for ``key``, which was verified when the
+        file(s) had the given signature.  signatures of files that
+        have changed too recently to trust are not recorded. """
+        if signature is None or (isinstance(signature, tuple) and
+                                 self._is_racy(signature)):
+            self.invalidate(key)
+            return
+        self.records[key] = (signature, value)
+
+    def invalidate(self, key):
+        """ forget the value recorded for ``key`` """
+        self.records.pop(key, None)
+
+    def digest(self, path):
+        """ get the MD5 hex digest of the contents of a file, reading
+        it only if it has changed since its digest was last recorded.
+        raises :exc:`IOError` if the file can't be read. """
+        key = ('digest', path)
+        signature = self.signature(path)
+        rv = self.get(key, signature)
+        if rv is not None:
+            return rv
+        digest = md5()
+        fileobj = open(path, 'rb')
+        try:
+            chunk = fileobj.read(self.chunk_size)
+            while chunk:
+                digest.update(chunk)
+                chunk = fileobj.read(self.chunk_size)
+        finally:
+            fileobj.close()
+        rv = digest.hexdigest()
+        self.set(key, signature, rv)
+        return rv
@@ -319,6 +319,16 @@ def colon_split(c_string):
     return []
 
 
+def get_limits(c_string):
+    """ parse a comma-separated list of <name>:<number> pairs, e.g.,
+    'GetConfig:8, RecvStats:4', into a dict of <name>: <int> """
+    rv = dict()
+    for item in list_split(c_string):
+        name, limit = item.rsplit(':', 1)
+        rv[name.strip()] = int(limit)
+    return rv
+
+
 def get_bool(val):
     """ given a string value of a boolean configuration option, return
     an actual bool (True or False) """
@@ -572,6 +582,41 @@ SERVER_DAEMON_GROUP = \
            default=0,
            cf=('server', 'group'),
            cook=get_gid)
+SERVER_BIND_THREADS = \
+    Option('Number of threads to use to bind entries',
+           default=1,
+           cf=('server', 'bind_threads'),
+           cook=int)
+SERVER_CHILDREN = \
+    Option('Number of worker processes for the multiprocessing server '
+           'backend; 0 starts one for each CPU',
+           default=0,
+           cf=('server', 'children'),
+           cook=int)
+SERVER_THREADS = \
+    Option('Number of threads that handle requests; 0 starts a thread '
+           'for every request',
+           default=0,
+           cf=('server', 'threads'),
+           cook=int)
+SERVER_MAX_QUEUED = \
+    Option('Number of requests that can wait for a free thread before '
+           'clients are told that the server is busy',
+           default=64,
+           cf=('server', 'max_queued'),
+           cook=int)
+SERVER_RETRY_AFTER = \
+    Option('Seconds that clients are told to wait before retrying when '
+           'the server is busy',
+           default=10,
+           cf=('server', 'retry_after'),
+           cook=int)
+SERVER_METHOD_LIMITS = \
+    Option('Maximum number of concurrent calls to the given XML-RPC '
+           'methods, e.g., GetConfig:8',
+           default=dict(),
+           cf=('server', 'method_limits'),
+           cook=get_limits)
 
 # database options
 DB_ENGINE = \
@@ -641,6 +686,35 @@ REPORTING_TRANSPORT = \
            default='DirectStore',
            cf=('reporting', 'transport'),)
 
+REPORTING_BATCH_SIZE = \
+    Option('Reporting import batch size',
+           default=100,
+           cf=('reporting', 'batch_size'),
+           cook=int,)
+
+REPORTING_WORKERS = \
+    Option('Reporting collector import workers',
+           default=1,
+           cf=('reporting', 'workers'),
+           cook=int,)
+
+REPORTING_SPOOL = \
+    Option('LocalFilesystem spool format (files or segments)',
+           default='files',
+           cf=('reporting', 'spool'),)
+
+REPORTING_SPOOL_SEGMENT_SIZE = \
+    Option('LocalFilesystem spool segment size',
+           default=get_size('64m'),
+           cf=('reporting', 'spool_segment_size'),
+           cook=get_size,)
+
+REPORTING_SPOOL_COMPRESS = \
+    Option('Compress records in the LocalFilesystem spool',
+           default=True,
+           cf=('reporting', 'spool_compress'),
+           cook=get_bool,)
+
 # Client options
 CLIENT_KEY = \
     Option('Path to SSL key',
@@ -715,6 +789,22 @@ CLIENT_CACHE = \
            default=None,
            cmd='-c',
            odesc='<cache path>')
+CLIENT_MANIFEST = \
+    Option('Record the managed files in this file, so that the server '
+           'can omit the contents of unchanged files',
+           default='/var/cache/bcfg2/manifest',
+           cf=('client', 'manifest'))
+CLIENT_VERIFY_CACHE = \
+    Option('Record verified files and packages in this file, so that '
+           'unchanged ones are not read again in later runs',
+           default=None,
+           cf=('client', 'verify_cache'))
+CLIENT_VERIFY_CACHE_MAX_AGE = \
+    Option('Seconds after which the verification cache is discarded and '
+           'everything is verified in full',
+           default=86400,
+           cf=('client', 'verify_cache_max_age'),
+           cook=int)
 CLIENT_REMOVE = \
     Option('Force removal of additional configuration items',
            default=None,
@@ -793,6 +883,16 @@ CLIENT_EXIT_ON_PROBE_FAILURE = \
            long_arg=True,
            cf=('client', 'exit_on_probe_failure'),
            cook=get_bool)
+CLIENT_PROBE_THREADS = \
+    Option('The number of probes to run at the same time',
+           default=1,
+           cf=('client', 'probe_threads'),
+           cook=int)
+CLIENT_PROBE_TIMEOUT = \
+    Option('Kill probes that run for longer than this many seconds',
+           default=None,
+           cf=('client', 'probe_timeout'),
+           cook=float)
 
 # bcfg2-test and bcfg2-lint options
 TEST_NOSEOPTS = \
@@ -841,6 +941,21 @@ CLIENT_SYSTEM_ETC_PATH = \
     Option('System etc path',
            default='/etc',
            cf=('APT', 'etc_path'))
+CLIENT_APT_DEBSUMS_THREADS = \
+    Option('Number of threads to checksum package files in',
+           default=4,
+           cf=('APT', 'debsums_threads'),
+           cook=int)
+CLIENT_APT_DEBSUMS_CACHE = \
+    Option('Cache package file checksums in this file, and only '
+           'checksum files whose size or mtime has changed',
+           default=None,
+           cf=('APT', 'debsums_cache'))
+CLIENT_POSIX_DIFF_LIMIT = \
+    Option('Maximum size of files to compute diffs for',
+           default=get_size('1m'),
+           cf=('POSIX', 'diff_limit'),
+           cook=get_size)
 CLIENT_PORTAGE_BINPKGONLY = \
     Option('Portage binary packages only',
            default=False,
@@ -1078,7 +1193,13 @@ SERVER_COMMON_OPTIONS = dict(repo=SERVER_REPOSITORY,
                              ca=SERVER_CA,
                              protocol=SERVER_PROTOCOL,
                              web_configfile=WEB_CFILE,
-                             backend=SERVER_BACKEND)
+                             backend=SERVER_BACKEND,
+                             bind_threads=SERVER_BIND_THREADS,
+                             children=SERVER_CHILDREN,
+                             threads=SERVER_THREADS,
+                             max_queued=SERVER_MAX_QUEUED,
+                             retry_after=SERVER_RETRY_AFTER,
+                             method_limits=SERVER_METHOD_LIMITS)
 
 CRYPT_OPTIONS = dict(encrypt=ENCRYPT,
                      decrypt=DECRYPT,
@@ -1093,6 +1214,9 @@ DRIVER_OPTIONS = \
     dict(apt_install_path=CLIENT_APT_TOOLS_INSTALL_PATH,
          apt_var_path=CLIENT_APT_TOOLS_VAR_PATH,
          apt_etc_path=CLIENT_SYSTEM_ETC_PATH,
+         apt_debsums_threads=CLIENT_APT_DEBSUMS_THREADS,
+         apt_debsums_cache=CLIENT_APT_DEBSUMS_CACHE,
+         posix_diff_limit=CLIENT_POSIX_DIFF_LIMIT,
          portage_binpkgonly=CLIENT_PORTAGE_BINPKGONLY,
          rpm_installonly=CLIENT_RPM_INSTALLONLY,
          rpm_pkg_checks=CLIENT_RPM_PKG_CHECKS,
@@ -1135,6 +1259,9 @@ CLIENT_COMMON_OPTIONS = \
          file=CLIENT_FILE,
          interactive=INTERACTIVE,
          cache=CLIENT_CACHE,
+         manifest=CLIENT_MANIFEST,
+         verify_cache=CLIENT_VERIFY_CACHE,
+         verify_cache_max_age=CLIENT_VERIFY_CACHE_MAX_AGE,
          profile=CLIENT_PROFILE,
          remove=CLIENT_REMOVE,
          server=SERVER_LOCATION,
@@ -1152,7 +1279,9 @@ CLIENT_COMMON_OPTIONS = \
          serverCN=CLIENT_SCNS,
          timeout=CLIENT_TIMEOUT,
          decision_list=CLIENT_DECISION_LIST,
-         probe_exit=CLIENT_EXIT_ON_PROBE_FAILURE)
+         probe_exit=CLIENT_EXIT_ON_PROBE_FAILURE,
+         probe_threads=CLIENT_PROBE_THREADS,
+         probe_timeout=CLIENT_PROBE_TIMEOUT)
 CLIENT_COMMON_OPTIONS.update(DRIVER_OPTIONS)
 CLIENT_COMMON_OPTIONS.update(CLI_COMMON_OPTIONS)
 
@@ -1169,7 +1298,14 @@ DATABASE_COMMON_OPTIONS = dict(web_configfile=WEB_CFILE,
                                web_prefix=DJANGO_WEB_PREFIX)
 
 REPORTING_COMMON_OPTIONS = dict(reporting_file_limit=REPORTING_FILE_LIMIT,
-                                reporting_transport=REPORTING_TRANSPORT)
+                                reporting_transport=REPORTING_TRANSPORT,
+                                reporting_batch_size=REPORTING_BATCH_SIZE,
+                                reporting_workers=REPORTING_WORKERS,
+                                reporting_spool=REPORTING_SPOOL,
+                                reporting_spool_segment_size=\
+                                    REPORTING_SPOOL_SEGMENT_SIZE,
+                                reporting_spool_compress=\
+                                    REPORTING_SPOOL_COMPRESS)
 
 
 class OptionParser(OptionSet):
@@ -1,4 +1,5 @@
 import logging
+import random
 import re
 import socket
 
@@ -18,9 +19,11 @@ except ImportError:
 
 import sys
 import time
+import zlib
 
 # Compatibility imports
 from Bcfg2.Compat import httplib, xmlrpclib, urlparse
+from Bcfg2.Utils import SERVER_BUSY
 
 version = sys.version_info[:2]
 has_py26 = version >= (2, 6)
@@ -65,14 +68,32 @@ class RetryMethod(xmlrpclib._Method):
     log = logging.getLogger('xmlrpc')
     max_retries = 3
     retry_delay = 1
+    # calls that the server refuses because it is busy are retried
+    # separately, so that clients wait out a busy server instead of
+    # giving up
+    max_busy_retries = 20
+
+    def _busy_delay(self, fault):
+        """ get the number of seconds to wait before retrying a call
+        that the server refused because it was busy.  a random
+        amount, up to the delay the server asked for, is added, so
+        that clients that were turned away together don't all retry
+        at the same moment. """
+        mat = re.search(r'retry after (\d+) seconds', fault.faultString)
+        if mat:
+            delay = int(mat.group(1))
+        else:
+            delay = self.retry_delay
+        return delay + random.uniform(0, delay)
 
     def __call__(self, *args):
-        for retry in range(self.max_retries):
-            if retry >= self.max_retries - 1:
-                final = True
-            else:
-                final = False
+        retries = 0
+        busy_retries = 0
+        while True:
+            final = retries >= self.max_retries - 1
+            busy = False
             msg = None
+            delay = self.retry_delay
             try:
                 return _orig_Method.__call__(self, *args)
             except xmlrpclib.ProtocolError:
@@ -81,6 +102,10 @@ class RetryMethod(xmlrpclib._Method):
                     (err.errcode, err.errmsg)
             except xmlrpclib.Fault:
                 msg = sys.exc_info()[1]
+                if msg.faultCode == SERVER_BUSY:
+                    busy = True
+                    final = busy_retries >= self.max_busy_retries - 1
+                    delay = self._busy_delay(msg)
             except socket.error:
                 err = sys.exc_info()[1]
                 if hasattr(err, 'errno') and err.errno == 336265218:
@@ -109,7 +134,11 @@ class RetryMethod(xmlrpclib._Method):
                     raise ProxyError(msg)
                 else:
                     self.log.info(msg)
-                    time.sleep(self.retry_delay)
+                    time.sleep(delay)
+            if busy:
+                busy_retries += 1
+            else:
+                retries += 1
 
 xmlrpclib._Method = RetryMethod
 
@@ -279,6 +308,14 @@ class SSLHTTPConnection(httplib.HTTPConnection):
 
 
 class XMLRPCTransport(xmlrpclib.Transport):
+    """ An XML-RPC transport over SSL that keeps its connection to
+    the server open between calls, and gzip-compresses large requests
+    if the server has said that it accepts them. """
+
+    #: Requests larger than this many bytes are gzip-compressed if
+    #: the server accepts compressed requests
+    gzip_threshold = 1400
+
     def __init__(self, key=None, cert=None, ca=None,
                  scns=None, use_datetime=0, timeout=90):
         if hasattr(xmlrpclib.Transport, '__init__'):
@@ -289,38 +326,99 @@ class XMLRPCTransport(xmlrpclib.Transport):
         self.scns = scns
         self.timeout = timeout
 
+        #: A tuple of (host, connection) for the connection that is
+        #: kept open between calls
+        self._conn = None
+
+        #: Whether or not the server has advertised that it accepts
+        #: gzip-compressed requests
+        self.server_accepts_gzip = False
+
     def make_connection(self, host):
-        host, self._extra_headers = self.get_host_info(host)[0:2]
-        return SSLHTTPConnection(host,
+        if self._conn is not None and self._conn[0] == host:
+            return self._conn[1]
+        self.close()
+        chost, self._extra_headers = self.get_host_info(host)[0:2]
+        conn = SSLHTTPConnection(chost,
                                  key=self.key,
                                  cert=self.cert,
                                  ca=self.ca,
                                  scns=self.scns,
                                  timeout=self.timeout)
+        self._conn = (host, conn)
+        return conn
+
+    def close(self):
+        """ Close the connection to the server, if one is open """
+        if self._conn is not None:
+            self._conn[1].close()
+            self._conn = None
+
+    def send_content(self, connection, request_body):
+        if (self.server_accepts_gzip and
+            len(request_body) > self.gzip_threshold):
+            compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            request_body = compressor.compress(request_body) + \
+                compressor.flush()
+            connection.putheader("Content-Encoding", "gzip")
+        connection.putheader("Content-Length", str(len(request_body)))
+        try:
+            # send the body with the headers, if possible, to avoid
+            # waiting for a delayed ACK of the headers
+            connection.endheaders(request_body)
+        except TypeError:
+            # python < 2.7
+            connection.endheaders()
+            connection.send(request_body)
 
     def request(self, host, handler, request_body, verbose=0):
         """Send request to server and return response."""
-        try:
-            conn = self.send_request(host, handler, request_body, False)
-            response = conn.getresponse()
-            errcode = response.status
-            errmsg = response.reason
-            headers = response.msg
-        except (socket.error, SSL_ERROR):
-            err = sys.exc_info()[1]
-            raise ProxyError(xmlrpclib.ProtocolError(host + handler,
-                                                     408,
-                                                     str(err),
-                                                     self._extra_headers))
+        # the server may have closed a connection that we kept open
+        # since the last call, so if the call fails on an old
+        # connection, try once more on a new one
+        reused = self._conn is not None and self._conn[0] == host
+        while True:
+            try:
+                conn = self.send_request(host, handler, request_body, False)
+                response = conn.getresponse()
+                errcode = response.status
+                errmsg = response.reason
+                headers = response.msg
+                break
+            except (socket.error, SSL_ERROR, httplib.HTTPException):
+                err = sys.exc_info()[1]
+                self.close()
+                if reused:
+                    reused = False
+                    continue
+                if isinstance(err, httplib.HTTPException):
+                    raise
+                raise ProxyError(xmlrpclib.ProtocolError(host + handler,
+                                                         408,
+                                                         str(err),
+                                                         self._extra_headers))
+
+        if "gzip" in (response.getheader("Accept-Encoding") or ""):
+            self.server_accepts_gzip = True
 
         if errcode != 200:
+            self.close()
             raise ProxyError(xmlrpclib.ProtocolError(host + handler,
                                                      errcode,
                                                      errmsg,
                                                      headers))
 
         self.verbose = verbose
-        return self.parse_response(response)
+        try:
+            return self.parse_response(response)
+        except xmlrpclib.Fault:
+            # the whole response was read, so the connection can
+            # still be used
+            raise
+        except:
+            self.close()
+            raise
 
     if sys.hexversion < 0x03000000:
         def send_request(self, host, handler, request_body, debug):
@@ -329,6 +427,7 @@ class XMLRPCTransport(xmlrpclib.Transport):
             xmlrpclib.Transport.send_request(self, conn, handler, request_body)
             self.send_host(conn, host)
             self.send_user_agent(conn)
+            conn.putheader("Content-Type", "text/xml")
             self.send_content(conn, request_body)
             return conn
 
@@ -7,6 +7,7 @@ import traceback
 import threading
 
 import Bcfg2.Logger
+from Bcfg2.Compat import Queue, Empty, Full
 from Bcfg2.Reporting.Transport import load_transport_from_config, \
     TransportError, TransportImportError
 from Bcfg2.Reporting.Transport.DirectStore import DirectStore
@@ -17,9 +18,32 @@ class ReportingError(Exception):
     """Generic reporting exception"""
     pass
 
+class PendingInteraction(object):
+    """An interaction that has been fetched from the transport but
+    not yet imported"""
+
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self.received = time.time()
+        self.attempts = 0
+        self.not_before = 0
+
+
 class ReportingCollector(object):
     """The collecting process for reports"""
 
+    #: The number of times to try importing an interaction before
+    #: handing it back to the transport, to be fetched and retried
+    #: again later
+    max_attempts = 3
+
+    #: Seconds to wait before retrying a failed interaction; this is
+    #: multiplied by the number of attempts so far
+    retry_delay = 30
+
+    #: Seconds between reports of the collector's backlog
+    lag_interval = 60
+
     def __init__(self, setup):
         """Setup the collector.  This may be called by the daemon or though 
         bcfg2-admin"""
@@ -28,6 +52,19 @@ class ReportingCollector(object):
         self.encoding = setup['encoding']
         self.terminate = None
         self.context = None
+        self.batch_size = max(1, setup.get('reporting_batch_size', 1))
+        self.worker_count = max(1, setup.get('reporting_workers', 1))
+        self.workers = []
+        # interactions waiting for a worker.  this is bounded so that
+        # a slow storage backend leaves interactions in the transport
+        # rather than piling them up in memory
+        self.queue = Queue(self.worker_count * self.batch_size * 2)
+        # failed interactions waiting to be retried
+        self.retries = []
+        # all interactions that have been fetched but not imported,
+        # keyed by id()
+        self.pending = dict()
+        self.lock = threading.Lock()
 
         if setup['debug']:
             level = logging.DEBUG
@@ -85,20 +122,25 @@ class ReportingCollector(object):
 
         self.transport.start_monitor(self)
 
+        for i in range(self.worker_count):
+            worker = threading.Thread(name="ReportingWorker-%d" % i,
+                                      target=self._work)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+
+        last_lag = time.time()
         while not self.terminate.isSet():
             try:
-                interaction = self.transport.fetch()
-                if not interaction:
-                    continue
-                try:
-                    start = time.time()
-                    self.storage.import_interaction(interaction)
-                    self.logger.info("Imported interaction for %s in %ss" %
-                        (interaction.get('hostname', '<unknown>'),
-                            time.time() - start))
-                except:
-                    #TODO requeue?
-                    raise
+                for interaction in \
+                        self.transport.fetch_batch(self.batch_size):
+                    self._enqueue(PendingInteraction(interaction))
+                if time.time() - last_lag >= self.lag_interval:
+                    last_lag = time.time()
+                    depth, age = self.get_lag()
+                    if depth:
+                        self.logger.info("%d interactions pending, oldest "
+                                         "received %ds ago" % (depth, age))
             except (SystemExit, KeyboardInterrupt):
                 self.logger.info("Shutting down")
                 self.shutdown()
@@ -106,11 +148,156 @@ class ReportingCollector(object):
                 self.logger.error("Unhandled exception in main loop %s" %
                     traceback.format_exc().splitlines()[-1])
 
+    def get_lag(self):
+        """Get the number of interactions that have been fetched but
+        not yet imported, and the number of seconds since the oldest
+        of them was fetched"""
+        self.lock.acquire()
+        try:
+            if not self.pending:
+                return (0, 0)
+            oldest = min([p.received for p in self.pending.values()])
+            return (len(self.pending), time.time() - oldest)
+        finally:
+            self.lock.release()
+
+    def _enqueue(self, pending):
+        """Hand an interaction to the workers, blocking while the
+        queue is full"""
+        self.lock.acquire()
+        try:
+            self.pending[id(pending)] = pending
+        finally:
+            self.lock.release()
+        while True:
+            try:
+                # use a timeout so that signals are still handled
+                self.queue.put(pending, timeout=1)
+                return
+            except Full:
+                continue
+
+    def _next_batch(self):
+        """Get the next batch of interactions to import: any failed
+        interactions that are due to be retried, then whatever is
+        waiting in the queue.  Returns None once the collector is
+        shutting down and there is nothing left to do."""
+        batch = []
+        now = time.time()
+        self.lock.acquire()
+        try:
+            for pending in self.retries[:]:
+                if len(batch) >= self.batch_size:
+                    break
+                if pending.not_before <= now or self.terminate.isSet():
+                    self.retries.remove(pending)
+                    batch.append(pending)
+            retrying = len(self.retries)
+        finally:
+            self.lock.release()
+        try:
+            if not batch:
+                batch.append(self.queue.get(timeout=1))
+            while len(batch) < self.batch_size:
+                batch.append(self.queue.get_nowait())
+        except Empty:
+            if not batch and not retrying and self.terminate.isSet():
+                return None
+        return batch
+
+    def _work(self):
+        """Main loop of each import worker"""
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            if not batch:
+                continue
+            start = time.time()
+            try:
+                failed = self.storage.import_interactions(
+                    [p.interaction for p in batch])
+            except:
+                self.logger.error("Failed to import %d interactions: %s" %
+                                  (len(batch),
+                                   traceback.format_exc().splitlines()[-1]))
+                failed = [p.interaction for p in batch]
+            self.logger.debug("Imported %d interactions in %ss" %
+                              (len(batch) - len(failed),
+                               time.time() - start))
+            failed = set([id(i) for i in failed])
+            for pending in batch:
+                if id(pending.interaction) in failed:
+                    self._requeue(pending)
+                else:
+                    self._done(pending)
+
+    def _requeue(self, pending):
+        """Schedule a failed interaction to be retried.  If it has
+        failed too many times already, or the collector is shutting
+        down, it is handed back to the transport instead"""
+        pending.attempts += 1
+        hostname = pending.interaction.get('hostname', '<unknown>')
+        if (pending.attempts >= self.max_attempts or
+            (self.terminate is not None and self.terminate.isSet())):
+            self._spool(pending)
+            return
+        delay = self.retry_delay * pending.attempts
+        self.logger.warning("Failed to import interaction for %s, retrying "
+                            "in %ss" % (hostname, delay))
+        pending.not_before = time.time() + delay
+        self.lock.acquire()
+        try:
+            self.retries.append(pending)
+        finally:
+            self.lock.release()
+
+    def _spool(self, pending):
+        """Hand an interaction that could not be imported back to the
+        transport, so that it is kept until it is fetched and retried
+        again"""
+        interaction = pending.interaction
+        hostname = interaction.get('hostname', '<unknown>')
+        try:
+            self.transport.store(hostname, interaction.get('metadata'),
+                                 interaction.get('stats'))
+            self.logger.error("Failed to import interaction for %s after %d "
+                              "attempts, returned it to the transport to be "
+                              "retried later" % (hostname, pending.attempts))
+        except:  # pylint: disable=W0702
+            self.logger.error("Failed to import interaction for %s after %d "
+                              "attempts, and failed to return it to the "
+                              "transport, so it has been lost: %s" %
+                              (hostname, pending.attempts,
+                               traceback.format_exc().splitlines()[-1]))
+        self._done(pending)
+
+    def _done(self, pending):
+        """Forget about an interaction that has been dealt with, and
+        tell the transport that it can do the same"""
+        self.lock.acquire()
+        try:
+            del self.pending[id(pending)]
+        finally:
+            self.lock.release()
+        try:
+            self.transport.ack(pending.interaction)
+        except:  # pylint: disable=W0702
+            self.logger.error("Failed to acknowledge interaction for %s: %s" %
+                              (pending.interaction.get('hostname',
+                                                       '<unknown>'),
+                               traceback.format_exc().splitlines()[-1]))
+
     def shutdown(self):
         """Cleanup and go"""
         if self.terminate:
             # this wil be missing if called from bcfg2-admin
             self.terminate.set()
+        # let the workers import everything that has already been
+        # fetched from the transport
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
         if self.transport:
             self.transport.shutdown()
         if self.storage:
@@ -6,7 +6,7 @@ import os
 import traceback
 from lxml import etree
 from datetime import datetime
-from time import strptime
+from time import strptime, time
 
 os.environ['DJANGO_SETTINGS_MODULE'] = 'Bcfg2.settings'
 from Bcfg2 import settings
@@ -14,6 +14,7 @@ from Bcfg2 import settings
 from Bcfg2.Compat import md5
 from Bcfg2.Reporting.Storage.base import StorageBase, StorageError
 from Bcfg2.Server.Plugin.exceptions import PluginExecutionError
+from Bcfg2.Server.Plugin.helpers import bulk_create
 from django.core import management
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
 from django.core.cache import cache
@@ -25,66 +26,24 @@ from Bcfg2.Compat import b64decode
 from Bcfg2.Reporting.models import *
 
 
+def _chunks(items, size=500):
+    """Split a list into lists of at most size items, to keep IN
+    queries and bulk inserts within database parameter limits"""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
 class DjangoORM(StorageBase):
     def __init__(self, setup):
         super(DjangoORM, self).__init__(setup)
         self.size_limit = setup.get('reporting_file_limit')
 
-    @transaction.commit_on_success
-    def _import_interaction(self, interaction):
-        """Real import function"""
-        hostname = interaction['hostname']
-        stats = etree.fromstring(interaction['stats'])
-        metadata = interaction['metadata']
-        server = metadata['server']
-
-        client = cache.get(hostname)
-        if not client:
-            client, created = Client.objects.get_or_create(name=hostname)
-            if created:
-                self.logger.debug("Client %s added to the db" % hostname)
-            cache.set(hostname, client)
-
-        timestamp = datetime(*strptime(stats.get('time'))[0:6])
-        if len(Interaction.objects.filter(client=client, timestamp=timestamp)) > 0:
-            self.logger.warn("Interaction for %s at %s already exists" %
-                    (hostname, timestamp))
-            return
-
-        profile, created = Group.objects.get_or_create(name=metadata['profile'])
-        inter = Interaction(client=client,
-                             timestamp=timestamp,
-                             state=stats.get('state', default="unknown"),
-                             repo_rev_code=stats.get('revision',
-                                                          default="unknown"),
-                             good_count=stats.get('good', default="0"),
-                             total_count=stats.get('total', default="0"),
-                             server=server,
-                             profile=profile)
-        inter.save()
-        self.logger.debug("Interaction for %s at %s with INSERTED in to db" % 
-                (client.id, timestamp))
-
-        #FIXME - this should be more efficient
-        for group_name in metadata['groups']:
-            group = cache.get("GROUP_" + group_name)
-            if not group:
-                group, created = Group.objects.get_or_create(name=group_name)
-                if created:
-                    self.logger.debug("Added group %s" % group)
-                cache.set("GROUP_" + group_name, group)
-                
-            inter.groups.add(group)
-        for bundle_name in metadata['bundles']:
-            bundle = cache.get("BUNDLE_" + bundle_name)
-            if not bundle:
-                bundle, created = Bundle.objects.get_or_create(name=bundle_name)
-                if created:
-                    self.logger.debug("Added bundle %s" % bundle)
-                cache.set("BUNDLE_" + bundle_name, bundle)
-            inter.bundles.add(bundle)
-        inter.save()
+    def _parse_entries(self, stats):
+        """Parse the entries in a statistics document.
 
+        Returns a dict of Interaction M2M field name -> list of
+        (entry class, act_dict) tuples, and a dict of counter fields.
+        The target_perms and current_perms of Path entries are left as
+        (owner, group, perms) tuples so they can be looked up in bulk."""
         counter_fields = {TYPE_BAD: 0,
                           TYPE_MODIFIED: 0,
                           TYPE_EXTRA: 0}
@@ -99,14 +58,13 @@ class DjangoORM(StorageBase):
                 entry_type = entry.tag
                 name = entry.get('name')
                 exists = entry.get('current_exists', default="true").lower() == "true"
-    
+
                 # handle server failures differently
                 failure = entry.get('failure', '')
                 if failure:
                     act_dict = dict(name=name, entry_type=entry_type,
                         message=failure)
-                    newact = FailureEntry.entry_get_or_create(act_dict)
-                    updates['failures'].append(newact)
+                    updates['failures'].append((FailureEntry, act_dict))
                     continue
 
                 act_dict = dict(name=name, state=state, exists=exists)
@@ -115,7 +73,7 @@ class DjangoORM(StorageBase):
                     act_dict['status'] = entry.get('status', default="check")
                     act_dict['output'] = entry.get('rc', default=-1)
                     self.logger.debug("Adding action %s" % name)
-                    updates['actions'].append(ActionEntry.entry_get_or_create(act_dict))
+                    updates['actions'].append((ActionEntry, act_dict))
                 elif entry_type == 'Package':
                     act_dict['target_version'] = entry.get('version', default='')
                     act_dict['current_version'] = entry.get('current_version', default='')
@@ -132,40 +90,34 @@ class DjangoORM(StorageBase):
                             if arch:
                                 act_dict['current_version'] += "." + arch
                             self.logger.debug("Adding package %s %s" % (name, act_dict['current_version']))
-                            updates['packages'].append(PackageEntry.entry_get_or_create(act_dict))
+                            updates['packages'].append((PackageEntry,
+                                                        act_dict.copy()))
                     else:
 
                         self.logger.debug("Adding package %s %s" % (name, act_dict['target_version']))
 
                         # not implemented yet
                         act_dict['verification_details'] = entry.get('verification_details', '')
-                        updates['packages'].append(PackageEntry.entry_get_or_create(act_dict))
+                        updates['packages'].append((PackageEntry, act_dict))
 
                 elif entry_type == 'Path':
                     path_type = entry.get("type").lower()
                     act_dict['path_type'] = path_type
-    
-                    target_dict = dict(
-                        owner=entry.get('owner', default="root"),
-                        group=entry.get('group', default="root"),
-                        perms=entry.get('perms', default=""),
-                    )
-                    fperm, created = FilePerms.objects.get_or_create(**target_dict)
-                    act_dict['target_perms'] = fperm
-
-                    current_dict = dict(
-                        owner=entry.get('current_owner', default=""),
-                        group=entry.get('current_group', default=""),
-                        perms=entry.get('current_perms', default=""),
-                    )
-                    fperm, created = FilePerms.objects.get_or_create(**current_dict)
-                    act_dict['current_perms'] = fperm
+
+                    act_dict['target_perms'] = (
+                        entry.get('owner', default="root"),
+                        entry.get('group', default="root"),
+                        entry.get('perms', default=""))
+                    act_dict['current_perms'] = (
+                        entry.get('current_owner', default=""),
+                        entry.get('current_group', default=""),
+                        entry.get('current_perms', default=""))
 
                     if path_type in ('symlink', 'hardlink'):
                         act_dict['target_path'] = entry.get('to', default="")
                         act_dict['current_path'] = entry.get('current_to', default="")
                         self.logger.debug("Adding link %s" % name)
-                        updates['paths'].append(LinkEntry.entry_get_or_create(act_dict))
+                        updates['paths'].append((LinkEntry, act_dict))
                         continue
                     elif path_type == 'device':
                         #TODO devices
@@ -199,44 +151,304 @@ class DjangoORM(StorageBase):
                             else:
                                 act_dict['details'] = cdata
                     self.logger.debug("Adding path %s" % name)
-                    updates['paths'].append(PathEntry.entry_get_or_create(act_dict))
-
+                    updates['paths'].append((PathEntry, act_dict))
 
                     #TODO - secontext
                     #TODO - acls
-    
+
                 elif entry_type == 'Service':
                     act_dict['target_status'] = entry.get('status', default='')
                     act_dict['current_status'] = entry.get('current_status', default='')
                     self.logger.debug("Adding service %s" % name)
-                    updates['services'].append(ServiceEntry.entry_get_or_create(act_dict))
+                    updates['services'].append((ServiceEntry, act_dict))
                 elif entry_type == 'SELinux':
                     self.logger.info("SELinux not implemented yet")
                 else:
                     self.logger.error("Unknown type %s not handled by reporting yet" % entry_type)
+        return updates, counter_fields
+
+    def _resolve_clients(self, hostnames):
+        """Get a dict of hostname -> Client, creating missing clients"""
+        clients = dict()
+        for hostname in hostnames:
+            client = cache.get(hostname)
+            if client:
+                clients[hostname] = client
+        missing = [h for h in hostnames if h not in clients]
+        for chunk in _chunks(missing):
+            for client in Client.objects.filter(name__in=chunk):
+                clients.setdefault(client.name, client)
+        for hostname in missing:
+            if hostname not in clients:
+                clients[hostname] = Client.objects.create(name=hostname)
+                self.logger.debug("Client %s added to the db" % hostname)
+            cache.set(hostname, clients[hostname])
+        return clients
+
+    def _resolve_names(self, cls, prefix, names):
+        """Get a dict of name -> object for Group or Bundle objects,
+        creating missing ones in bulk"""
+        rv = dict()
+        for name in names:
+            obj = cache.get(prefix + name)
+            if obj:
+                rv[name] = obj
+        missing = [n for n in names if n not in rv]
+
+        def lookup():
+            for chunk in _chunks([n for n in missing if n not in rv]):
+                for obj in cls.objects.filter(name__in=chunk):
+                    rv[obj.name] = obj
+                    cache.set(prefix + obj.name, obj)
+
+        lookup()
+        new = [n for n in missing if n not in rv]
+        if new:
+            bulk_create(cls, [cls(name=n) for n in new])
+            self.logger.debug("Added %s %s" % (cls.__name__.lower(),
+                                               ", ".join(new)))
+            lookup()
+        return rv
+
+    def _resolve_perms(self, keys):
+        """Get a dict of (owner, group, perms) -> FilePerms, creating
+        missing ones in bulk"""
+        rv = dict()
+
+        def lookup():
+            wanted = [k for k in keys if k not in rv]
+            if not wanted:
+                return
+            perms = set([k[2] for k in wanted])
+            for fperm in FilePerms.objects.filter(perms__in=list(perms)):
+                key = (fperm.owner, fperm.group, fperm.perms)
+                if key in keys:
+                    rv[key] = fperm
+
+        lookup()
+        new = [k for k in keys if k not in rv]
+        if new:
+            bulk_create(FilePerms, [FilePerms(owner=k[0], group=k[1],
+                                               perms=k[2])
+                                     for k in new])
+            lookup()
+        return rv
+
+    def _resolve_entries(self, cls, act_dicts):
+        """Get a list of entry objects of the given class that match
+        the given act_dicts, creating missing ones in bulk.  This is
+        the batched equivalent of BaseEntry.entry_get_or_create."""
+        cls_name = cls.__name__
+        hashes = [hash_entry(act_dict) for act_dict in act_dicts]
+        found = dict()
+        for act_dict, act_hash in zip(act_dicts, hashes):
+            newact = cache.get("%s_%s" % (cls_name, act_hash))
+            if newact:
+                found[(act_hash, act_dict['name'])] = newact
+
+        def lookup():
+            wanted = set([h for h, a in zip(hashes, act_dicts)
+                          if (h, a['name']) not in found])
+            for chunk in _chunks(list(wanted)):
+                for act in cls.objects.filter(hash_key__in=chunk):
+                    key = (act.hash_key, act.name)
+                    if key not in found:
+                        found[key] = act
+                        cache.set("%s_%s" % (cls_name, act.hash_key), act)
+
+        lookup()
+        new = dict()
+        for act_dict, act_hash in zip(act_dicts, hashes):
+            key = (act_hash, act_dict['name'])
+            if key not in found and key not in new:
+                new[key] = cls(hash_key=act_hash, **act_dict)
+        if new:
+            if cls._meta.parents or not hasattr(cls.objects, "bulk_create"):
+                # bulk_create() does not support multi-table
+                # inheritance, and isn't available at all before
+                # Django 1.4.  BaseEntry.save() computes the hash key
+                # itself unless it is given one.
+                for key, newact in new.items():
+                    newact.save(hash_key=key[0])
+                    found[key] = newact
+                    cache.set("%s_%s" % (cls_name, key[0]), newact)
+            else:
+                bulk_create(cls, list(new.values()))
+                lookup()
+        return [found[(h, a['name'])] for h, a in zip(hashes, act_dicts)]
+
+    def _add_m2m(self, field_name, rows):
+        """Add rows to the given Interaction M2M relation in bulk.
+        rows is a list of (interaction id, related object id) tuples."""
+        field = Interaction._meta.get_field(field_name)
+        through = field.rel.through
+        src = field.m2m_column_name()
+        dst = field.m2m_reverse_name()
+        seen = set()
+        objs = []
+        for row in rows:
+            if row not in seen:
+                seen.add(row)
+                objs.append(through(**{src: row[0], dst: row[1]}))
+        bulk_create(through, objs)
 
-        inter.bad_count = counter_fields[TYPE_BAD]
-        inter.modified_count = counter_fields[TYPE_MODIFIED]
-        inter.extra_count = counter_fields[TYPE_EXTRA]
-        inter.save()
-        for entry_type in updates.keys():
-            getattr(inter, entry_type).add(*updates[entry_type])
-
-        # performance metrics
-        for times in stats.findall('OpStamps'):
-            for metric, value in list(times.items()):
-                Performance(interaction=inter, metric=metric, value=value).save()
+    @transaction.commit_on_success
+    def _import_interactions(self, interactions):
+        """Import a list of interactions in a single transaction,
+        looking up and creating related objects in bulk.  Returns
+        the number of interactions imported."""
+        clients = self._resolve_clients(
+            list(set([i['hostname'] for i in interactions])))
+
+        # parse everything and drop interactions that already exist
+        parsed = []
+        seen = set()
+        for interaction in interactions:
+            hostname = interaction['hostname']
+            stats = etree.fromstring(interaction['stats'])
+            timestamp = datetime(*strptime(stats.get('time'))[0:6])
+            key = (clients[hostname].id, timestamp)
+            if key in seen:
+                self.logger.warn("Interaction for %s at %s already exists" %
+                        (hostname, timestamp))
+                continue
+            seen.add(key)
+            parsed.append((interaction, stats, timestamp))
+        if not parsed:
+            return 0
+        existing = set(Interaction.objects.filter(
+                client__in=list(set([clients[i['hostname']].id
+                                     for i, _, _ in parsed])),
+                timestamp__in=[t for _, _, t in parsed]).values_list(
+                'client', 'timestamp'))
+        batch = []
+        for interaction, stats, timestamp in parsed:
+            if (clients[interaction['hostname']].id, timestamp) in existing:
+                self.logger.warn("Interaction for %s at %s already exists" %
+                        (interaction['hostname'], timestamp))
+            else:
+                updates, counters = self._parse_entries(stats)
+                batch.append((interaction, stats, timestamp, updates,
+                              counters))
+        if not batch:
+            return 0
+
+        groups = set()
+        bundles = set()
+        perms = set()
+        for interaction, _, _, updates, _ in batch:
+            metadata = interaction['metadata']
+            groups.add(metadata['profile'])
+            groups.update(metadata['groups'])
+            bundles.update(metadata['bundles'])
+            for _, act_dict in updates['paths']:
+                perms.add(act_dict['target_perms'])
+                perms.add(act_dict['current_perms'])
+        groups = self._resolve_names(Group, "GROUP_", list(groups))
+        bundles = self._resolve_names(Bundle, "BUNDLE_", list(bundles))
+        perms = self._resolve_perms(perms)
+
+        # resolve all entries of each class at once
+        entries = dict()
+        for _, _, _, updates, _ in batch:
+            for field_name, acts in updates.items():
+                for cls, act_dict in acts:
+                    if cls == PathEntry or cls == LinkEntry:
+                        for attr in ('target_perms', 'current_perms'):
+                            act_dict[attr] = perms[act_dict[attr]]
+                    entries.setdefault(cls, []).append(act_dict)
+        resolved = dict()
+        for cls, act_dicts in entries.items():
+            resolved[cls] = self._resolve_entries(cls, act_dicts)
+            resolved[cls].reverse()
+
+        m2m = dict(groups=[], bundles=[])
+        perfs = []
+        for interaction, stats, timestamp, updates, counters in batch:
+            metadata = interaction['metadata']
+            inter = Interaction(client=clients[interaction['hostname']],
+                                timestamp=timestamp,
+                                state=stats.get('state', default="unknown"),
+                                repo_rev_code=stats.get('revision',
+                                                             default="unknown"),
+                                good_count=stats.get('good', default="0"),
+                                total_count=stats.get('total', default="0"),
+                                server=metadata['server'],
+                                profile=groups[metadata['profile']],
+                                bad_count=counters[TYPE_BAD],
+                                modified_count=counters[TYPE_MODIFIED],
+                                extra_count=counters[TYPE_EXTRA])
+            # skip Interaction.save(), which updates the client's
+            # current interaction; that is done once per client below
+            super(Interaction, inter).save()
+            self.logger.debug("Interaction for %s at %s with INSERTED in to db" %
+                    (inter.client_id, timestamp))
+
+            for group_name in metadata['groups']:
+                m2m['groups'].append((inter.id, groups[group_name].id))
+            for bundle_name in metadata['bundles']:
+                m2m['bundles'].append((inter.id, bundles[bundle_name].id))
+            for field_name, acts in updates.items():
+                for cls, _ in acts:
+                    m2m.setdefault(field_name, []).append(
+                        (inter.id, resolved[cls].pop().id))
+
+            # performance metrics
+            for times in stats.findall('OpStamps'):
+                for metric, value in list(times.items()):
+                    perfs.append(Performance(interaction=inter, metric=metric,
+                                             value=value))
+
+        for field_name, rows in m2m.items():
+            if rows:
+                self._add_m2m(field_name, rows)
+        if perfs:
+            bulk_create(Performance, perfs)
+
+        for client in set([clients[i['hostname']] for i, _, _, _, _ in batch]):
+            client.current_interaction = client.interactions.latest()
+            client.save()
+        return len(batch)
+
+    def import_interactions(self, interactions):
+        """Import a batch of interactions into the backend.  If the
+        batch cannot be imported, each interaction is imported on its
+        own so that one bad interaction does not lose the rest.
+        Returns a list of the interactions that could not be
+        imported."""
+        failed = []
+        if not interactions:
+            return failed
+        start = time()
+        try:
+            count = self._import_interactions(interactions)
+        except:
+            self.logger.error("Failed to import batch of %d interactions, "
+                              "importing them one at a time: %s" %
+                              (len(interactions),
+                               traceback.format_exc().splitlines()[-1]))
+            count = 0
+            for interaction in interactions:
+                if self.import_interaction(interaction):
+                    count += 1
+                else:
+                    failed.append(interaction)
+        elapsed = time() - start
+        self.logger.info("Imported %d interactions in %.03fs (%.1f "
+                         "interactions/s)" %
+                         (count, elapsed, count / max(elapsed, 0.001)))
+        return failed
 
-            
     def import_interaction(self, interaction):
         """Import the data into the backend"""
 
         try:
-            self._import_interaction(interaction)
+            self._import_interactions([interaction])
+            return True
         except:
             self.logger.error("Failed to import interaction: %s" %
                     traceback.format_exc().splitlines()[-1])
-
+            return False
 
     def validate(self):
         """Validate backend storage.  Should be called once when loaded"""
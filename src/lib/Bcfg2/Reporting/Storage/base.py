@@ -3,6 +3,7 @@ The base for all Storage backends
 """
 
 import logging 
+import traceback
 
 class StorageError(Exception):
     """Generic StorageError"""
@@ -29,6 +30,23 @@ class StorageBase(object):
         """Import the data into the backend"""
         raise NotImplementedError
 
+    def import_interactions(self, interactions):
+        """Import a list of interactions into the backend.  Backends
+        that can import many interactions more efficiently than one
+        at a time should override this.
+
+        Returns a list of the interactions that could not be
+        imported."""
+        failed = []
+        for interaction in interactions:
+            try:
+                self.import_interaction(interaction)
+            except:
+                self.logger.error("Failed to import interaction: %s" %
+                    traceback.format_exc().splitlines()[-1])
+                failed.append(interaction)
+        return failed
+
     def validate(self):
         """Validate backend storage.  Should be called once when loaded"""
         raise NotImplementedError
@@ -35,11 +35,19 @@ class DirectStore(TransportBase, threading.Thread):
     def run(self):
         if not self._load():
             return
+        batch_size = self.setup.get('reporting_batch_size', 1)
         while not self.terminate.isSet() and self.queue is not None:
             try:
-                interaction = self.queue.get(block=True,
-                                             timeout=self.timeout)
-                self.storage.import_interaction(interaction)
+                interactions = [self.queue.get(block=True,
+                                               timeout=self.timeout)]
+                # import whatever else is already waiting along with
+                # this interaction
+                try:
+                    while len(interactions) < batch_size:
+                        interactions.append(self.queue.get_nowait())
+                except Empty:
+                    pass
+                self.storage.import_interactions(interactions)
             except Empty:
                 continue
             except:
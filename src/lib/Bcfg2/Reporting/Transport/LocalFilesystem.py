@@ -3,15 +3,26 @@ The local transport.  Stats are pickled and written to
 <repo>/store/<hostname>-timestamp
 
 Leans on FileMonitor to detect changes
+
+Alternatively, with ``spool = segments`` in the ``[reporting]``
+section, stats are appended to the segmented spool in
+<repo>/Reporting/LocalFilesystem/spool, which the collector polls and
+reads in bulk.
+
+Either way, an interaction is only removed (or the spool checkpoint
+moved past it) once the collector acknowledges that it has been dealt
+with.
 """
 
 import os
 import select
 import time
+import threading
 import traceback
 import Bcfg2.Server.FileMonitor
 from Bcfg2.Reporting.Collector import ReportingCollector, ReportingError
 from Bcfg2.Reporting.Transport.base import TransportBase, TransportError
+from Bcfg2.Reporting.Transport.Spool import SegmentSpool
 from Bcfg2.Compat import cPickle
 
 
@@ -23,6 +34,17 @@ class LocalFilesystem(TransportBase):
         self.logger.debug("LocalFilesystem: work path %s" % self.work_path)
         self.fmon = None
         self._phony_collector = None
+        self.spool = None
+        self.lock = threading.Lock()
+        #: dict of id() of a fetched interaction -> the file it was
+        #: read from, which is removed once it is acknowledged
+        self.payloads = dict()
+        #: list of [spool position, set of id()s of interactions
+        #: not yet acknowledged] for each batch read from the spool,
+        #: oldest first.  the checkpoint is moved up to the position
+        #: after a batch once it and all earlier batches are
+        #: acknowledged.
+        self.unacked = []
 
         #setup our local paths or die
         if not os.path.exists(self.work_path):
@@ -34,8 +56,23 @@ class LocalFilesystem(TransportBase):
                         traceback.format_exc().splitlines()[-1]))
                 raise TransportError
 
+        spool = setup.get('reporting_spool', 'files')
+        if spool == 'segments':
+            self.spool = SegmentSpool(
+                os.path.join(self.data, "spool"),
+                segment_size=setup.get('reporting_spool_segment_size',
+                                       64 * 1024 * 1024),
+                compress=setup.get('reporting_spool_compress', True))
+        elif spool != 'files':
+            self.logger.error("%s: Unknown spool format %s" %
+                              (self.__class__.__name__, spool))
+            raise TransportError
+
     def start_monitor(self, collector):
         """Start the file monitor.  Most of this comes from BaseCore"""
+        if self.spool:
+            # the spool is polled, so no file monitor is needed
+            return
         setup = self.setup
         try:
             fmon = Bcfg2.Server.FileMonitor.available[setup['filemonitor']]
@@ -69,6 +106,10 @@ class LocalFilesystem(TransportBase):
             self.logger.error(msg)
             raise TransportError(msg)
 
+        if self.spool:
+            self.spool.append(payload)
+            return
+
         fname = "%s-%s" % (hostname, time.time())
         save_file = os.path.join(self.work_path, fname)
         tmp_file = os.path.join(self.work_path, "." + fname)
@@ -91,6 +132,12 @@ class LocalFilesystem(TransportBase):
 
     def fetch(self):
         """Fetch the next object"""
+        if self.spool:
+            interactions = self.fetch_batch(1)
+            if interactions:
+                return interactions[0]
+            return None
+
         event = None
         fmonfd = self.fmon.fileno()
         if self.fmon.pending():
@@ -118,7 +165,11 @@ class LocalFilesystem(TransportBase):
                 payloadfd = open(payload, "r")
                 interaction = cPickle.load(payloadfd)
                 payloadfd.close()
-                os.unlink(payload)
+                self.lock.acquire()
+                try:
+                    self.payloads[id(interaction)] = payload
+                finally:
+                    self.lock.release()
                 return interaction
             except IOError:
                 self.logger.error("Failed to read payload: %s" %
@@ -130,8 +181,84 @@ class LocalFilesystem(TransportBase):
                 raise TransportError
         return None
 
+    def fetch_batch(self, maxsize):
+        """Fetch the next object, and then as many more as are
+        already waiting in the spool, up to maxsize"""
+        if self.spool:
+            return self._fetch_spool(maxsize)
+        rv = []
+        while len(rv) < maxsize:
+            try:
+                interaction = self.fetch()
+            except TransportError:
+                # the bad payload has already been logged, so carry on
+                interaction = None
+            if interaction:
+                rv.append(interaction)
+            if not self.fmon.pending():
+                break
+        return rv
+
+    def _fetch_spool(self, maxsize):
+        """Read up to maxsize objects from the segmented spool,
+        waiting for up to the timeout if it is empty"""
+        records = self.spool.read(maxsize)
+        if not records:
+            time.sleep(self.timeout)
+            records = self.spool.read(maxsize)
+        if not records:
+            return []
+        rv = []
+        for record in records:
+            try:
+                rv.append(cPickle.loads(record))
+            except:  # pylint: disable=W0702
+                self.logger.error("Failed to unpickle payload: %s" %
+                    traceback.format_exc().splitlines()[-1])
+        self.lock.acquire()
+        try:
+            self.unacked.append([self.spool.tell(),
+                                 set([id(i) for i in rv])])
+            self._commit_spool()
+        finally:
+            self.lock.release()
+        return rv
+
+    def _commit_spool(self):
+        """Move the spool checkpoint past every batch that has been
+        completely acknowledged, up to the first that hasn't.  The
+        caller must hold the lock."""
+        position = None
+        while self.unacked and not self.unacked[0][1]:
+            position = self.unacked.pop(0)[0]
+        if position is not None:
+            self.spool.commit(position)
+
+    def ack(self, interaction):
+        """Remove an interaction that has been dealt with from the
+        work directory, or from the spool"""
+        self.lock.acquire()
+        try:
+            payload = self.payloads.pop(id(interaction), None)
+            if payload is not None:
+                try:
+                    os.unlink(payload)
+                except OSError:
+                    self.logger.error("Failed to remove payload %s: %s" %
+                        (payload, traceback.format_exc().splitlines()[-1]))
+            if self.spool:
+                for batch in self.unacked:
+                    if id(interaction) in batch[1]:
+                        batch[1].discard(id(interaction))
+                        break
+                self._commit_spool()
+        finally:
+            self.lock.release()
+
     def shutdown(self):
         """Called at program exit"""
+        if self.spool:
+            self.spool.close()
         if self.fmon:
             self.fmon.shutdown()
         if self._phony_collector:
@@ -0,0 +1,276 @@
+"""
+An append-only, segmented spool of records, used by the
+LocalFilesystem transport to hand interactions from any number of
+server processes to the collector without creating a file (and a file
+monitor event) per client run.
+
+Records are appended to numbered segment files under the spool
+directory.  Each record is a header (payload length, flags, and CRC32)
+followed by the payload, which may be compressed with zlib.  Writers
+serialize on an exclusive lock on the spool directory's lock file, and
+start a new segment once the current one reaches the segment size.
+The (single) reader reads records sequentially, and records the
+segment and offset it has consumed up to in a checkpoint file once
+everything before that position has been dealt with; segments that
+have been completely consumed are removed.
+"""
+
+import os
+import sys
+import zlib
+import fcntl
+import struct
+import logging
+from Bcfg2.Reporting.Transport.base import TransportError
+
+
+class SpoolError(TransportError):
+    """Raised when the spool cannot be read or written"""
+    pass
+
+
+class SegmentSpool(object):
+    """An append-only spool of records split across rotating
+    segment files"""
+
+    #: The struct format of the record header: payload length,
+    #: flags, and CRC32 of the payload
+    header = "!IBI"
+
+    #: Flag set on records whose payload is zlib-compressed
+    FLAG_COMPRESSED = 1
+
+    #: The suffix of segment files
+    suffix = ".seg"
+
+    def __init__(self, path, segment_size=64 * 1024 * 1024, compress=True):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.path = path
+        self.segment_size = segment_size
+        self.compress = compress
+        self.lock_file = os.path.join(self.path, ".lock")
+        self.checkpoint_file = os.path.join(self.path, ".checkpoint")
+
+        #: The file descriptor of the segment that this process last
+        #: appended to
+        self._wfd = None
+
+        #: The segment number and offset that have been read, but not
+        #: yet committed
+        self._rseg = None
+        self._roffset = 0
+
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                err = sys.exc_info()[1]
+                # another process may have created it first
+                if not os.path.isdir(self.path):
+                    raise SpoolError("Unable to create spool %s: %s" %
+                                     (self.path, err))
+
+    def _segment_path(self, segment):
+        """ get the path to the given segment number """
+        return os.path.join(self.path, "%012d%s" % (segment, self.suffix))
+
+    def segments(self):
+        """ get a sorted list of the segment numbers in the spool """
+        rv = []
+        for fname in os.listdir(self.path):
+            if fname.endswith(self.suffix):
+                try:
+                    rv.append(int(fname[:-len(self.suffix)]))
+                except ValueError:
+                    continue
+        rv.sort()
+        return rv
+
+    def _open_segment(self):
+        """ open the segment to append to, starting a new one if the
+        current segment is full.  must be called with the spool lock
+        held. """
+        if self._wfd is not None:
+            if os.fstat(self._wfd).st_size < self.segment_size:
+                return self._wfd
+            os.close(self._wfd)
+            self._wfd = None
+
+        # find the newest segment, which may have been started by
+        # another writer since we last looked
+        segments = self.segments()
+        if segments:
+            segment = segments[-1]
+            path = self._segment_path(segment)
+            if os.path.getsize(path) >= self.segment_size:
+                segment += 1
+        else:
+            segment = self.read_checkpoint()[0]
+        self._wfd = os.open(self._segment_path(segment),
+                            os.O_WRONLY | os.O_APPEND | os.O_CREAT, 420)
+        return self._wfd
+
+    def append(self, payload):
+        """ append a single record to the spool """
+        flags = 0
+        if self.compress:
+            payload = zlib.compress(payload)
+            flags |= self.FLAG_COMPRESSED
+        record = struct.pack(self.header, len(payload), flags,
+                             zlib.crc32(payload) & 0xffffffff) + payload
+        try:
+            lockfd = os.open(self.lock_file, os.O_WRONLY | os.O_CREAT, 420)
+        except OSError:
+            err = sys.exc_info()[1]
+            raise SpoolError("Unable to open spool lock %s: %s" %
+                             (self.lock_file, err))
+        try:
+            fcntl.lockf(lockfd, fcntl.LOCK_EX)
+            try:
+                fd = self._open_segment()
+                written = os.write(fd, record)
+                while written < len(record):
+                    written += os.write(fd, record[written:])
+            except (IOError, OSError):
+                err = sys.exc_info()[1]
+                if self._wfd is not None:
+                    os.close(self._wfd)
+                    self._wfd = None
+                raise SpoolError("Unable to write to spool %s: %s" %
+                                 (self.path, err))
+        finally:
+            # closing the file also releases the lock
+            os.close(lockfd)
+
+    def read_checkpoint(self):
+        """ get the (segment, offset) tuple that the reader has
+        committed """
+        try:
+            data = open(self.checkpoint_file).read().split()
+            return (int(data[0]), int(data[1]))
+        except (IOError, ValueError, IndexError):
+            return (0, 0)
+
+    def _decode(self, payload, flags, crc, offset):
+        """ check and decompress the payload of the record at the
+        given offset of the current segment.  returns None if the
+        record is corrupt. """
+        if zlib.crc32(payload) & 0xffffffff != crc:
+            self.logger.error("Corrupt record at %s:%s, skipping" %
+                              (self._segment_path(self._rseg), offset))
+            return None
+        if flags & self.FLAG_COMPRESSED:
+            payload = zlib.decompress(payload)
+        return payload
+
+    def _read_segment(self, maxrecords):
+        """ read up to ``maxrecords`` complete records from the
+        current read position in the current segment.  only those
+        records are read from the segment file.  returns a tuple of
+        (list of payloads, number of unread bytes left in the
+        segment), or (None, 0) if the segment does not exist. """
+        try:
+            segfile = open(self._segment_path(self._rseg), 'rb')
+        except IOError:
+            return (None, 0)
+        hsize = struct.calcsize(self.header)
+        rv = []
+        try:
+            segfile.seek(self._roffset)
+            while len(rv) < maxrecords:
+                header = segfile.read(hsize)
+                if len(header) < hsize:
+                    break
+                length, flags, crc = struct.unpack(self.header, header)
+                payload = segfile.read(length)
+                if len(payload) < length:
+                    # a record that is still being written, or that
+                    # was torn by a writer that died
+                    break
+                offset = self._roffset
+                self._roffset += hsize + length
+                payload = self._decode(payload, flags, crc, offset)
+                if payload is not None:
+                    rv.append(payload)
+            remaining = os.fstat(segfile.fileno()).st_size - self._roffset
+        finally:
+            segfile.close()
+        return (rv, max(remaining, 0))
+
+    def read(self, maxrecords):
+        """ read up to ``maxrecords`` records past the current read
+        position.  the position is not saved until :func:`commit` is
+        called. """
+        if self._rseg is None:
+            self._rseg, self._roffset = self.read_checkpoint()
+        rv = []
+        while len(rv) < maxrecords:
+            records, remaining = self._read_segment(maxrecords - len(rv))
+            if records:
+                rv.extend(records)
+                continue
+            # we've read everything there is in this segment.  if a
+            # newer segment has been started, then no writer will
+            # append to this one again, so move on to the next one.
+            later = [s for s in self.segments() if s > self._rseg]
+            if not later:
+                break
+            if records is not None:
+                # check once more for records that were appended
+                # before the newer segment was started
+                records, remaining = self._read_segment(maxrecords -
+                                                        len(rv))
+                if records:
+                    rv.extend(records)
+                    continue
+                if remaining:
+                    self.logger.error("Discarding %s bytes of partial "
+                                      "record at %s:%s" %
+                                      (remaining,
+                                       self._segment_path(self._rseg),
+                                       self._roffset))
+            self._rseg = later[0]
+            self._roffset = 0
+        return rv
+
+    def tell(self):
+        """ get the (segment, offset) tuple of the current read
+        position """
+        if self._rseg is None:
+            return self.read_checkpoint()
+        return (self._rseg, self._roffset)
+
+    def commit(self, position=None):
+        """ save a read position returned by :func:`tell`, or the
+        current read position, and remove segments that have been
+        completely read """
+        if position is None:
+            if self._rseg is None:
+                return
+            position = self.tell()
+        segment, offset = position
+        tmpfile = self.checkpoint_file + ".new"
+        try:
+            cpfile = open(tmpfile, 'w')
+            cpfile.write("%d %d\n" % (segment, offset))
+            cpfile.close()
+            os.rename(tmpfile, self.checkpoint_file)
+        except (IOError, OSError):
+            err = sys.exc_info()[1]
+            raise SpoolError("Unable to save spool checkpoint %s: %s" %
+                             (self.checkpoint_file, err))
+        for old in self.segments():
+            if old >= segment:
+                break
+            try:
+                os.unlink(self._segment_path(old))
+            except OSError:
+                err = sys.exc_info()[1]
+                self.logger.warning("Unable to remove spool segment %s: %s" %
+                                    (self._segment_path(old), err))
+
+    def close(self):
+        """ close the segment this process has been appending to """
+        if self._wfd is not None:
+            os.close(self._wfd)
+            self._wfd = None
@@ -35,6 +35,23 @@ class TransportBase(object):
     def fetch(self):
         raise NotImplementedError
 
+    def fetch_batch(self, maxsize):
+        """Fetch up to maxsize objects, waiting no longer than a
+        single fetch() would.  Transports that can hand over
+        everything that is already waiting at once should override
+        this."""
+        interaction = self.fetch()
+        if interaction:
+            return [interaction]
+        return []
+
+    def ack(self, interaction):
+        """Called by the collector once an interaction returned by
+        fetch() or fetch_batch() has been imported, or stored again
+        with store(), so that transports that keep interactions until
+        then can forget it"""
+        pass
+
     def shutdown(self):
         """Called at program exit"""
         pass
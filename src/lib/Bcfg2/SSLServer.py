@@ -1,25 +1,53 @@
 """Bcfg2 SSL server."""
 
 __all__ = [
-    "SSLServer", "XMLRPCRequestHandler", "XMLRPCServer",
+    "EncodedString", "SSLServer", "XMLRPCRequestHandler", "XMLRPCServer",
 ]
 
 import os
 import sys
+import zlib
 import socket
 import select
 import signal
 import logging
 import ssl
+import types
 import threading
 import time
 from Bcfg2.Compat import xmlrpclib, SimpleXMLRPCServer, SocketServer, \
-    b64decode
+    b64decode, Queue, Full
+from Bcfg2.Utils import SERVER_BUSY
+
+
+class EncodedString(object):
+    """ A string returned by an XML-RPC method that has already been
+    encoded as UTF-8, e.g., a serialized client configuration.
+    Instead of decoding it and marshalling the whole response in
+    memory, :class:`XMLRPCRequestHandler` escapes it and streams it
+    to the client a chunk at a time. """
+
+    def __init__(self, data):
+        #: The UTF-8 encoded string
+        self.data = data
+
+    def decode(self):
+        """ get the string as unicode, for servers that marshal
+        responses with :func:`xmlrpclib.dumps` """
+        return self.data.decode('UTF-8')
 
 
 class XMLRPCDispatcher(SimpleXMLRPCServer.SimpleXMLRPCDispatcher):
     logger = logging.getLogger("Bcfg2.SSLServer.XMLRPCDispatcher")
 
+    #: The size of the chunks that :class:`EncodedString` responses
+    #: are escaped and written in
+    chunk_size = 64 * 1024
+
+    #: The XML escapes applied to :class:`EncodedString` responses
+    escapes = [(c.encode('UTF-8'), e.encode('UTF-8'))
+               for c, e in [("&", "&amp;"), ("<", "&lt;"), (">", "&gt;")]]
+
     def __init__(self, allow_none, encoding):
         try:
             SimpleXMLRPCServer.SimpleXMLRPCDispatcher.__init__(self,
@@ -32,13 +60,47 @@ class XMLRPCDispatcher(SimpleXMLRPCServer.SimpleXMLRPCDispatcher):
         self.allow_none = allow_none
         self.encoding = encoding
 
+        #: The number of seconds that clients are told to wait before
+        #: retrying a call that was refused because the server is busy
+        self.retry_after = 10
+
+        #: A dict of <method name>: :class:`threading.BoundedSemaphore`
+        #: that limits the number of concurrent calls to those methods
+        self.method_semaphores = dict()
+
+    def set_method_limits(self, limits):
+        """ limit the number of calls to the given methods that can
+        be handled concurrently; further calls are refused with a
+        busy fault.  ``limits`` is a dict of <method name>: <max
+        concurrent calls>. """
+        self.method_semaphores = dict()
+        for method, limit in limits.items():
+            self.method_semaphores[method] = \
+                threading.BoundedSemaphore(limit)
+
+    def _busy_response(self):
+        """ get the marshalled fault that tells a client that the
+        server is busy, and when to retry """
+        return xmlrpclib.dumps(
+            xmlrpclib.Fault(SERVER_BUSY,
+                            "Server busy, retry after %s seconds" %
+                            self.retry_after),
+            allow_none=self.allow_none, encoding=self.encoding)
+
     def _marshaled_dispatch(self, address, data):
         method_func = None
         params, method = xmlrpclib.loads(data)
+        semaphore = self.method_semaphores.get(method)
+        if semaphore is not None and not semaphore.acquire(False):
+            self.logger.info("Too many concurrent %s calls, refusing call "
+                             "from %s" % (method, address[0]))
+            return self._busy_response()
         try:
             if '.' not in method:
                 params = (address, ) + params
             response = self.instance._dispatch(method, params, self.funcs)
+            if isinstance(response, EncodedString):
+                return self._marshal_encoded(response)
             # py3k compatibility
             if type(response) not in [bool, str, list, dict]:
                 response = (response.decode('utf-8'), )
@@ -58,8 +120,29 @@ class XMLRPCDispatcher(SimpleXMLRPCServer.SimpleXMLRPCDispatcher):
             raw_response = xmlrpclib.dumps(
                 xmlrpclib.Fault(1, "%s:%s" % (sys.exc_type, sys.exc_value)),
                 allow_none=self.allow_none, encoding=self.encoding)
+        finally:
+            if semaphore is not None:
+                semaphore.release()
         return raw_response
 
+    def _marshal_encoded(self, response):
+        """ generate the marshalled XML-RPC response for an
+        :class:`EncodedString` as a series of UTF-8 encoded chunks """
+        if self.encoding:
+            head = "<?xml version='1.0' encoding='%s'?>\n" % self.encoding
+        else:
+            head = "<?xml version='1.0'?>\n"
+        yield (head + "<methodResponse>\n<params>\n<param>\n"
+               "<value><string>").encode('UTF-8')
+        data = response.data
+        for start in range(0, len(data), self.chunk_size):
+            chunk = data[start:start + self.chunk_size]
+            for char, escape in self.escapes:
+                chunk = chunk.replace(char, escape)
+            yield chunk
+        yield ("</string></value>\n</param>\n</params>\n"
+               "</methodResponse>\n").encode('UTF-8')
+
 
 class SSLServer(SocketServer.TCPServer, object):
     """TCP server supporting SSL encryption.
@@ -198,6 +281,39 @@ class XMLRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
     """
     logger = logging.getLogger("Bcfg2.SSLServer.XMLRPCRequestHandler")
 
+    #: Speak HTTP/1.1, so that clients can make several calls over
+    #: one connection
+    protocol_version = "HTTP/1.1"
+
+    #: Responses larger than this many bytes are gzip-compressed for
+    #: clients that accept it
+    gzip_threshold = 1400
+
+    #: If this is True, every request is answered with a fault
+    #: telling the client that the server is busy.  This is set on
+    #: the handler that is used when the server's request queue is
+    #: full.
+    busy = False
+
+    def handle_one_request(self):
+        """ Handle one request, closing the connection quietly if the
+        client does not send one -- e.g., if a keep-alive connection
+        is left idle until it times out """
+        try:
+            SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.handle_one_request(
+                self)
+        except (socket.error, ssl.SSLError):
+            err = sys.exc_info()[1]
+            self.logger.debug("Closing connection from %s: %s" %
+                              (self.client_address[0], err))
+            self.close_connection = 1
+
+    def log_error(self, fmt, *args):
+        """ Log errors from BaseHTTPRequestHandler -- most commonly
+        idle keep-alive connections timing out -- with the logging
+        module instead of writing them to stderr """
+        self.logger.debug("%s: %s" % (self.client_address[0], fmt % args))
+
     def authenticate(self):
         try:
             header = self.headers['Authorization']
@@ -227,6 +343,12 @@ class XMLRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
         """
         if not SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.parse_request(self):
             return False
+        if self.busy:
+            # busy requests are answered in the listening thread, so
+            # the client is turned away without authenticating it or
+            # reading the request body
+            self._send_busy()
+            return False
         try:
             if not self.authenticate():
                 self.logger.error("Authentication Failure")
@@ -251,16 +373,41 @@ class XMLRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
                     print("got select timeout")
                     raise
                 chunk_size = min(size_remaining, max_chunk_size)
-                L.append(self.rfile.read(chunk_size).decode('utf-8'))
+                L.append(self.rfile.read(chunk_size))
+                if not L[-1]:
+                    raise socket.error("Connection closed by %s" %
+                                       self.client_address[0])
                 size_remaining -= len(L[-1])
-            data = ''.join(L)
-            response = self.server._marshaled_dispatch(self.client_address,
-                                                       data)
-            if sys.hexversion >= 0x03000000:
+            data = ''.encode('utf-8').join(L)
+            if self.headers.get("content-encoding", "") == "gzip":
+                data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+            response = self.server._marshaled_dispatch(
+                self.client_address, data.decode('utf-8'))
+            accept_gzip = "gzip" in self.headers.get("accept-encoding", "")
+            # large responses are streamed with chunked transfer
+            # encoding, which HTTP/1.0 clients don't understand
+            streamed = isinstance(response, types.GeneratorType)
+            if streamed and self.request_version < "HTTP/1.1":
+                response = ''.encode('utf-8').join(response)
+                streamed = False
+            elif not streamed and sys.hexversion >= 0x03000000:
                 response = response.encode('utf-8')
+            compressor = None
+            if accept_gzip and (streamed or
+                                len(response) > self.gzip_threshold):
+                compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                              16 + zlib.MAX_WBITS)
+                if not streamed:
+                    response = compressor.compress(response) + \
+                        compressor.flush()
         except:  # pylint: disable=W0702
+            # the rest of the request may not have been read, so the
+            # connection can't be used for another request
+            self.close_connection = 1
             try:
                 self.send_response(500)
+                self.send_header("Connection", "close")
+                self.send_header("Content-length", "0")
                 self.end_headers()
             except:
                 (etype, msg) = sys.exc_info()[:2]
@@ -272,25 +419,33 @@ class XMLRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
             try:
                 self.send_response(200)
                 self.send_header("Content-type", "text/xml")
-                self.send_header("Content-length", str(len(response)))
+                if streamed:
+                    self.send_header("Transfer-Encoding", "chunked")
+                else:
+                    self.send_header("Content-length", str(len(response)))
+                if self.close_connection:
+                    self.send_header("Connection", "close")
+                # tell clients that they can send us compressed
+                # requests (RFC 7694)
+                self.send_header("Accept-Encoding", "gzip")
+                if compressor is not None:
+                    self.send_header("Content-Encoding", "gzip")
                 self.end_headers()
-                failcount = 0
-                while True:
-                    try:
-                        # If we hit SSL3_WRITE_PENDING here try to resend.
-                        self.wfile.write(response)
-                        break
-                    except ssl.SSLError:
-                        e = sys.exc_info()[1]
-                        if str(e).find("SSL3_WRITE_PENDING") < 0:
-                            raise
-                        self.logger.error("SSL3_WRITE_PENDING")
-                        failcount += 1
-                        if failcount < 5:
-                            continue
-                        raise
+                if streamed:
+                    for chunk in response:
+                        if compressor is not None:
+                            chunk = compressor.compress(chunk)
+                        self._write_chunk(chunk)
+                    if compressor is not None:
+                        self._write_chunk(compressor.flush())
+                    self._write("0\r\n\r\n".encode('utf-8'))
+                else:
+                    self._write(response)
             except socket.error:
                 err = sys.exc_info()[1]
+                # a response that was only partially written can't be
+                # followed by another one
+                self.close_connection = 1
                 if err[0] == 32:
                     self.logger.warning("Connection dropped from %s" %
                                         self.client_address[0])
@@ -302,15 +457,62 @@ class XMLRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
                                         "%s" % (self.client_address[0], err))
             except ssl.SSLError:
                 err = sys.exc_info()[1]
+                self.close_connection = 1
                 self.logger.warning("SSLError handling client %s: %s" %
                                     (self.client_address[0], err))
             except:
                 etype, err = sys.exc_info()[:2]
+                self.close_connection = 1
                 self.logger.error("Unknown error sending response to %s: "
                                   "%s (%s)" %
                                   (self.client_address[0], err,
                                    etype.__name__))
 
+    def _send_busy(self):
+        """ tell the client that the server is busy, and close the
+        connection """
+        self.close_connection = 1
+        response = self.server._busy_response()
+        if sys.hexversion >= 0x03000000:
+            response = response.encode('utf-8')
+        try:
+            self.send_response(200)
+            self.send_header("Content-type", "text/xml")
+            self.send_header("Content-length", str(len(response)))
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self._write(response)
+        except (socket.error, ssl.SSLError):
+            err = sys.exc_info()[1]
+            self.logger.debug("Error telling %s that the server is busy: %s"
+                              % (self.client_address[0], err))
+
+    def _write(self, data):
+        """ write data to the client """
+        failcount = 0
+        while True:
+            try:
+                # If we hit SSL3_WRITE_PENDING here try to resend.
+                self.wfile.write(data)
+                break
+            except ssl.SSLError:
+                e = sys.exc_info()[1]
+                if str(e).find("SSL3_WRITE_PENDING") < 0:
+                    raise
+                self.logger.error("SSL3_WRITE_PENDING")
+                failcount += 1
+                if failcount < 5:
+                    continue
+                raise
+
+    def _write_chunk(self, data):
+        """ write one chunk of a response sent with chunked transfer
+        encoding.  empty chunks are skipped, since an empty chunk ends
+        the response. """
+        if data:
+            self._write(("%x\r\n" % len(data)).encode('utf-8') + data +
+                        "\r\n".encode('utf-8'))
+
     def finish(self):
         # shut down the connection
         if not self.wfile.closed:
@@ -341,13 +543,22 @@ class XMLRPCServer(SocketServer.ThreadingMixIn, SSLServer,
     Properties:
     require_auth -- the request handler is requiring authorization
     credentials -- valid credentials being used for authentication
+
+    Requests are handled by a fixed pool of ``threads`` worker
+    threads, and up to ``max_queued`` accepted connections wait for a
+    free worker.  When the queue is full, further requests are
+    answered immediately with a fault that tells the client to retry
+    after ``retry_after`` seconds.  If ``threads`` is 0, a new thread
+    is started for every request instead.
     """
 
     def __init__(self, listen_all, server_address, RequestHandlerClass=None,
                  keyfile=None, certfile=None, ca=None, protocol='xmlrpc/ssl',
                  timeout=10,
                  logRequests=False,
-                 register=True, allow_none=True, encoding=None):
+                 register=True, allow_none=True, encoding=None,
+                 threads=0, max_queued=None, retry_after=10,
+                 method_limits=None):
         """Initialize the XML-RPC server.
 
         Arguments:
@@ -362,6 +573,12 @@ class XMLRPCServer(SocketServer.ThreadingMixIn, SSLServer,
                     (default True)
         allow_none -- allow None values in xml-rpc
         encoding -- encoding to use for xml-rpc (default UTF-8)
+        threads -- the number of worker threads (default 0, unlimited)
+        max_queued -- the number of requests that can wait for a
+                      worker thread (default: twice ``threads``)
+        retry_after -- seconds that busy clients are told to wait
+        method_limits -- dict of the maximum number of concurrent
+                         calls to individual methods
         """
 
         XMLRPCDispatcher.__init__(self, allow_none, encoding)
@@ -390,6 +607,29 @@ class XMLRPCServer(SocketServer.ThreadingMixIn, SSLServer,
         self.logger.info("service available at %s" % self.url)
         self.timeout = timeout
 
+        self.threads = threads
+        if max_queued is None:
+            max_queued = 2 * threads
+        self.retry_after = retry_after
+        if method_limits:
+            self.set_method_limits(method_limits)
+
+        #: The queue of accepted requests waiting for a worker thread,
+        #: or None if every request gets its own thread
+        self.request_queue = None
+        if self.threads:
+            self.request_queue = Queue(max(max_queued, 1))
+
+        class BusyRequestHandlerClass(RequestHandlerClass):
+            """A request handler that answers every request with a
+            fault saying that the server is busy."""
+            busy = True
+
+        #: The request handler used to answer requests that can't be
+        #: queued because the server is busy
+        self.BusyRequestHandlerClass = BusyRequestHandlerClass
+        self.pool = []
+
     def _tasks_thread(self):
         try:
             while self.serve:
@@ -402,6 +642,37 @@ class XMLRPCServer(SocketServer.ThreadingMixIn, SSLServer,
         except:
             self.logger.error("tasks_thread failed", exc_info=1)
 
+    def _pool_thread(self):
+        """ handle queued requests until shutdown """
+        while True:
+            item = self.request_queue.get()
+            if item is None:
+                break
+            self.process_request_thread(*item)
+
+    def process_request(self, request, client_address):
+        """ hand a request off to the worker pool, or turn it away if
+        the request queue is full """
+        if self.request_queue is None:
+            SocketServer.ThreadingMixIn.process_request(self, request,
+                                                        client_address)
+            return
+        try:
+            self.request_queue.put_nowait((request, client_address))
+        except Full:
+            self.logger.warning("Request queue full, telling %s to retry "
+                                "in %s seconds" % (client_address[0],
+                                                   self.retry_after))
+            # this is handled in the listening thread, but the busy
+            # handler answers as soon as it has read the request
+            # headers, without reading the body
+            try:
+                self.BusyRequestHandlerClass(request, client_address, self)
+            except:  # pylint: disable=W0702
+                self.logger.debug("Error refusing request from %s: %s" %
+                                  (client_address[0], sys.exc_info()[1]))
+            self.close_request(request)
+
     def server_close(self):
         SSLServer.server_close(self)
         self.logger.info("server_close()")
@@ -445,6 +716,13 @@ class XMLRPCServer(SocketServer.ThreadingMixIn, SSLServer,
         self.logger.info("serve_forever() [start]")
         signal.signal(signal.SIGINT, self._handle_shutdown_signal)
         signal.signal(signal.SIGTERM, self._handle_shutdown_signal)
+        if self.request_queue is not None:
+            for i in range(self.threads):
+                thread = threading.Thread(target=self._pool_thread,
+                                          name="XMLRPCWorker-%d" % i)
+                thread.setDaemon(True)
+                thread.start()
+                self.pool.append(thread)
 
         try:
             while self.serve:
@@ -458,6 +736,9 @@ class XMLRPCServer(SocketServer.ThreadingMixIn, SSLServer,
                     self.logger.error("Got unexpected error in handle_request",
                                       exc_info=1)
         finally:
+            for _ in self.pool:
+                self.request_queue.put(None)
+            self.pool = []
             self.logger.info("serve_forever() [stop]")
 
     def shutdown(self):
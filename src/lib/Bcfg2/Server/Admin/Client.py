@@ -28,8 +28,8 @@ class Client(Bcfg2.Server.Admin.MetadataCore):
                 print("Error in deleting client")
                 raise SystemExit(1)
         elif args[0] in ['list', 'ls']:
-            for client in self.metadata.list_clients():
-                print(client.hostname)
+            for client in sorted(self.metadata.list_clients()):
+                print(client)
         else:
             print("No command specified")
             raise SystemExit(1)
@@ -7,11 +7,21 @@ import Bcfg2.Server.Admin
 
 class Perf(Bcfg2.Server.Admin.Mode):
     __shorthelp__ = ("Query server for performance data")
-    __longhelp__ = (__shorthelp__ + "\n\nbcfg2-admin perf\n")
-    __usage__ = ("bcfg2-admin perf")
+    __longhelp__ = (__shorthelp__ + "\n\nbcfg2-admin perf [<minutes>]\n")
+    __usage__ = ("bcfg2-admin perf [<minutes>]\n\n"
+                 "     %-32s%s\n" %
+                 ("<minutes>",
+                  "only report on the last <minutes> minutes"))
 
     def __call__(self, args):
-        output = [('Name', 'Min', 'Max', 'Mean', 'Count')]
+        window = None
+        if args:
+            try:
+                window = int(args[0])
+            except ValueError:
+                self.errExit("Usage: %s" % self.__usage__)
+        output = [('Name', 'Min', 'Max', 'Mean', 'p50', 'p95', 'p99',
+                   'Count')]
         optinfo = {
             'ca': Bcfg2.Options.CLIENT_CA,
             'certificate': Bcfg2.Options.CLIENT_CERT,
@@ -30,7 +40,10 @@ class Perf(Bcfg2.Server.Admin.Mode):
                                            cert=setup['certificate'],
                                            ca=setup['ca'],
                                            timeout=setup['timeout'])
-        data = proxy.get_statistics()
+        if window:
+            data = proxy.get_statistics(window)
+        else:
+            data = proxy.get_statistics()
         for key in sorted(data.keys()):
             output.append((key, ) +
                           tuple(["%.06f" % item
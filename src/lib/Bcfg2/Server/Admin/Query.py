@@ -29,7 +29,7 @@ class Query(Bcfg2.Server.Admin.MetadataCore):
 
     def __call__(self, args):
         Bcfg2.Server.Admin.MetadataCore.__call__(self, args)
-        clients = self.metadata.clients
+        clients = sorted(self.metadata.clients)
         filename_arg = False
         filename = None
         for arg in args:
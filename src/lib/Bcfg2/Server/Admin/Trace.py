@@ -0,0 +1,53 @@
+import getopt
+import sys
+
+import Bcfg2.Trace
+import Bcfg2.Server.Admin
+
+
+class Trace(Bcfg2.Server.Admin.MetadataCore):
+    """ Build the configuration for a client and dump a trace of the
+    time spent in each plugin call """
+    __shorthelp__ = ("Trace the time spent in each plugin call while "
+                     "building a client configuration")
+    __longhelp__ = (__shorthelp__ +
+                    "\n\nbcfg2-admin trace [-c] [-o <file>] <client>\n")
+    __usage__ = ("bcfg2-admin trace [options] <client>\n\n"
+                 "     %-25s%s\n"
+                 "     %-25s%s\n" %
+                ("-c, --chrome",
+                 "dump the trace in Chrome trace event format",
+                 "-o, --outfile <file>",
+                 "write the trace to a file"))
+
+    def __call__(self, args):
+        Bcfg2.Server.Admin.MetadataCore.__call__(self, args)
+        try:
+            opts, args = getopt.getopt(args, 'co:', ['chrome', 'outfile='])
+        except getopt.GetoptError:
+            msg = sys.exc_info()[1]
+            self.errExit("%s\nUsage: %s" % (msg, self.__usage__))
+        if len(args) != 1:
+            self.errExit("Usage: %s" % self.__usage__)
+        client = args[0]
+
+        chrome = False
+        output = sys.stdout
+        for opt, arg in opts:
+            if opt in ("-c", "--chrome"):
+                chrome = True
+            elif opt in ("-o", "--outfile"):
+                try:
+                    output = open(arg, 'w')
+                except IOError:
+                    err = sys.exc_info()[1]
+                    self.errExit("Failed to open %s: %s" % (arg, err))
+
+        trace = Bcfg2.Trace.start_trace("BuildConfiguration", client=client)
+        try:
+            self.bcore.BuildConfiguration(client)
+        finally:
+            Bcfg2.Trace.end(trace)
+        output.write(Bcfg2.Trace.dump(trace, chrome=chrome) + "\n")
+        if output != sys.stdout:
+            output.close()
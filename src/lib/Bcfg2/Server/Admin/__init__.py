@@ -15,6 +15,7 @@ __all__ = [
         'Snapshots',
         'Syncdb',
         'Tidy',
+        'Trace',
         'Viz',
         'Xcmd'
         ]
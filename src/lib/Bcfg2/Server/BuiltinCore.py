@@ -86,7 +86,12 @@ class Core(BaseCore):
                                        register=False,
                                        timeout=1,
                                        ca=self.setup['ca'],
-                                       protocol=self.setup['protocol'])
+                                       protocol=self.setup['protocol'],
+                                       threads=self.setup['threads'],
+                                       max_queued=self.setup['max_queued'],
+                                       retry_after=self.setup['retry_after'],
+                                       method_limits=self.setup[
+                                           'method_limits'])
         except:  # pylint: disable=W0702
             err = sys.exc_info()[1]
             self.logger.error("Server startup failed: %s" % err)
@@ -4,6 +4,7 @@ import sys
 import time
 import Bcfg2.Statistics
 from Bcfg2.Compat import urlparse, xmlrpclib, b64decode
+from Bcfg2.SSLServer import EncodedString
 from Bcfg2.Server.Core import BaseCore
 import cherrypy
 from cherrypy.lib import xmlrpcutil
@@ -88,6 +89,8 @@ class Core(BaseCore):
             Bcfg2.Statistics.stats.add_value(rpcmethod,
                                              time.time() - method_start)
 
+        if isinstance(body, EncodedString):
+            body = body.decode()
         xmlrpcutil.respond(body, 'utf-8', True)
         return cherrypy.serving.response.body
 
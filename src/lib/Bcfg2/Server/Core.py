@@ -2,10 +2,12 @@
 
 import os
 import atexit
+import base64
 import logging
 import select
 import sys
 import threading
+import copy
 import time
 import inspect
 import lxml.etree
@@ -14,9 +16,12 @@ import Bcfg2.settings
 import Bcfg2.Server
 import Bcfg2.Logger
 import Bcfg2.Server.FileMonitor
-from Bcfg2.Cache import Cache
+from Bcfg2.Cache import Cache, DependencyCache
+from Bcfg2.SSLServer import EncodedString
 import Bcfg2.Statistics
-from Bcfg2.Compat import xmlrpclib, reduce  # pylint: disable=W0622
+import Bcfg2.Trace
+from Bcfg2.Utils import WorkerPool
+from Bcfg2.Compat import xmlrpclib, md5, unicode  # pylint: disable=W0622
 from Bcfg2.Server.Plugin import PluginInitError, PluginExecutionError, \
     track_statistics
 
@@ -48,6 +53,382 @@ def sort_xml(node, key=None):
     node[:] = sorted_children
 
 
+def _freeze(data):
+    """ convert the given data into a structure of nested tuples with
+    a stable ordering, so that its repr can be hashed """
+    if isinstance(data, dict):
+        return tuple(sorted([(_freeze(k), _freeze(v))
+                             for k, v in data.items()], key=repr))
+    elif isinstance(data, (set, frozenset)):
+        return tuple(sorted([_freeze(d) for d in data], key=repr))
+    elif isinstance(data, (list, tuple)):
+        return tuple([_freeze(d) for d in data])
+    elif lxml.etree.iselement(data):
+        return lxml.etree.tostring(data)
+    return data
+
+
+def metadata_fingerprint(metadata):
+    """ get a digest of everything in a client metadata object that
+    can affect the configuration built for that client, including
+    data from Connector plugins.  Connector data that has no stable
+    representation simply produces a fingerprint that never matches,
+    so clients with such data are never served a cached config. """
+    data = [metadata.hostname, metadata.profile, metadata.groups,
+            metadata.bundles, metadata.categories, metadata.aliases,
+            metadata.addresses, metadata.uuid, metadata.version]
+    for conn in sorted(metadata.connectors):
+        data.append((conn, getattr(metadata, conn, None)))
+    return md5(repr(_freeze(data)).encode('UTF-8')).hexdigest()
+
+
+def omit_unchanged_files(config, digests):
+    """ remove the contents of the ``Path type="file"`` entries in a
+    client configuration that the client already has.  ``digests`` is
+    a dict of <path>: <MD5 hex digest> of the client's copies of its
+    managed files; the contents of entries whose digest matches are
+    removed, and the digest is set as the ``digest`` attribute of the
+    entry instead, so that the client can still verify the file.
+
+    :returns: int - the number of entries whose contents were removed
+    """
+    omitted = 0
+    for entry in config.xpath("//Path[@type='file']"):
+        if entry.text is None or entry.get('name') not in digests:
+            continue
+        if entry.get('encoding') == 'base64':
+            data = base64.b64decode(entry.text)
+        else:
+            data = entry.text
+            if isinstance(data, unicode):
+                data = data.encode('UTF-8')
+        digest = md5(data).hexdigest()
+        if digest == digests[entry.get('name')]:
+            entry.text = None
+            entry.set('digest', digest)
+            omitted += 1
+    return omitted
+
+
+def _handles_entries(generator):
+    """ return True if the given generator overrides
+    :func:`Bcfg2.Server.Plugin.interfaces.Generator.HandlesEntry` """
+    meth = getattr(generator.__class__, "HandlesEntry", None)
+    default = Bcfg2.Server.Plugin.Generator.HandlesEntry
+    return (getattr(meth, "im_func", meth) is not
+            getattr(default, "im_func", default))
+
+
+class GeneratorIndex(object):
+    """ An index of the entries that can be bound by each generator,
+    so that the core does not need to ask every generator about every
+    entry.  Exact matches in the ``Entries`` dicts of the generators
+    are kept in a dict of (tag, name) -> generators, which is updated
+    one generator at a time when :func:`expire` is called for a
+    generator whose ``Entries`` have changed.  ``Entries`` that are
+    not plain dicts (e.g., :class:`Bcfg2.Server.Plugins.Pkgmgr.FuzzyDict`)
+    may match names that are not among their keys, so they are
+    searched on every lookup instead.
+
+    The generators that might handle a given tag through
+    :func:`Bcfg2.Server.Plugin.interfaces.Generator.HandlesEntry`
+    are also cached by tag, so tags that no generator handles can be
+    rejected without calling anything. """
+
+    def __init__(self, generators):
+        """
+        :param generators: The loaded generator plugins
+        :type generators: list of Bcfg2.Server.Plugin.Generator
+        """
+        self.generators = generators
+        self.lock = threading.Lock()
+        #: dict of tag -> dict of name -> list of generators whose
+        #: ``Entries`` contain that entry
+        self.index = dict()
+        #: dict of tag -> list of generators whose ``Entries`` for
+        #: that tag must be searched on every lookup
+        self.unindexed = dict()
+        #: dict of generator -> list of (tag, name) tuples that
+        #: generator contributes to :attr:`index`
+        self.indexed = dict()
+        #: generators that must be reindexed before the next lookup
+        self.dirty = set(generators)
+        #: dict of tag -> list of generators whose ``HandlesEntry``
+        #: may accept entries with that tag
+        self.handlers = dict()
+
+    def expire(self, generator=None):
+        """ note that the ``Entries`` of the given generator, or of
+        all generators, have changed """
+        self.lock.acquire()
+        try:
+            if generator is None:
+                self.dirty.update(self.generators)
+            else:
+                self.dirty.add(generator)
+        finally:
+            self.lock.release()
+
+    def expire_path(self, path):
+        """ note that ``path`` has changed, which may change the
+        ``Entries`` of any generator whose data directory contains it """
+        path = os.path.normpath(path)
+        for gen in self.generators:
+            data = getattr(gen, "data", None)
+            if (data and (path == data or
+                          path.startswith(data.rstrip(os.path.sep) +
+                                          os.path.sep))):
+                self.expire(gen)
+
+    def _remove(self, generator):
+        """ remove a generator from the index.  the lock must be held
+        by the caller. """
+        for tag, name in self.indexed.pop(generator, []):
+            gens = self.index[tag][name]
+            gens.remove(generator)
+            if not gens:
+                del self.index[tag][name]
+        for gens in self.unindexed.values():
+            if generator in gens:
+                gens.remove(generator)
+
+    def _add(self, generator):
+        """ add a generator to the index.  the lock must be held by
+        the caller. """
+        keys = []
+        for tag, entries in list(generator.Entries.items()):
+            if type(entries) is not dict:
+                self.unindexed.setdefault(tag, []).append(generator)
+                continue
+            tindex = self.index.setdefault(tag, dict())
+            for name in list(entries.keys()):
+                tindex.setdefault(name, []).append(generator)
+                keys.append((tag, name))
+        self.indexed[generator] = keys
+
+    def _refresh(self):
+        """ reindex all generators that have changed.  the lock must
+        be held by the caller. """
+        while self.dirty:
+            gen = self.dirty.pop()
+            self._remove(gen)
+            self._add(gen)
+
+    def get_generators(self, tag, name):
+        """ get the generators whose ``Entries`` can bind the entry
+        with the given tag and name, in the order the generators were
+        loaded in """
+        self.lock.acquire()
+        try:
+            self._refresh()
+            # entries may have been removed since the generator was
+            # last indexed, so check that each candidate still has it
+            rv = [gen for gen in (self.index.get(tag, dict()).get(name, []) +
+                                  self.unindexed.get(tag, []))
+                  if name in gen.Entries.get(tag, dict())]
+        finally:
+            self.lock.release()
+        if len(rv) > 1:
+            rv.sort(key=self.generators.index)
+        return rv
+
+    def get_handlers(self, tag):
+        """ get the generators whose ``HandlesEntry`` may accept
+        entries with the given tag """
+        try:
+            return self.handlers[tag]
+        except KeyError:
+            rv = [gen for gen in self.generators
+                  if (_handles_entries(gen) and
+                      (gen.handles_tags is None or
+                       tag in gen.handles_tags))]
+            self.handlers[tag] = rv
+            return rv
+
+
+class MetadataWarmup(object):
+    """ Builds and caches the metadata of clients in background
+    threads, so that the first clients to connect after the server
+    starts or the metadata cache is cleared do not have to wait for
+    their metadata to be built.  At most ``rate`` clients are built
+    per second, so that warming up does not starve client requests. """
+
+    def __init__(self, core, threads=1, rate=0):
+        """
+        :param core: The server core
+        :type core: Bcfg2.Server.Core.BaseCore
+        :param threads: The number of threads to build metadata in
+        :type threads: int
+        :param rate: The maximum number of clients to build per
+                     second, or 0 for no limit
+        :type rate: float
+        """
+        self.core = core
+        self.threads = threads
+        self.rate = rate
+        self.lock = threading.Lock()
+        #: Clients waiting to be built
+        self.queue = []
+        self.queued = set()
+        self.workers = []
+        #: The earliest time the next client may be built at
+        self.next_time = 0
+
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.started = None
+        self.finished = None
+
+        #: Clients whose metadata failed to build.  These are not
+        #: queued again until their cached metadata is expired, which
+        #: is when whatever made the build fail may have been fixed.
+        self.failed_clients = set()
+
+    def add(self, clients):
+        """ queue the given clients to be built, and start building
+        them if the warm-up is not already running.  Clients whose
+        metadata failed to build are skipped. """
+        self.lock.acquire()
+        try:
+            new = [c for c in clients
+                   if c not in self.queued and c not in self.failed_clients]
+            if not new:
+                return
+            if not self.workers:
+                # start counting progress anew
+                self.total = self.done = self.failed = 0
+                self.started = time.time()
+                self.finished = None
+                self.core.logger.info("Warming up metadata for %d clients" %
+                                      len(new))
+            self.queue.extend(new)
+            self.queued.update(new)
+            self.total += len(new)
+            while len(self.workers) < min(self.threads, len(self.queue)):
+                thread = threading.Thread(name="MetadataWarmup-%d" %
+                                          len(self.workers),
+                                          target=self._work)
+                thread.setDaemon(True)
+                self.workers.append(thread)
+                thread.start()
+        finally:
+            self.lock.release()
+
+    def _next(self):
+        """ get the next client to build, once the rate limit allows
+        it, or None if there are none left """
+        self.lock.acquire()
+        try:
+            if not self.queue or self.core.terminate.isSet():
+                self.workers.remove(threading.currentThread())
+                if not self.workers and self.finished is None:
+                    self.finished = time.time()
+                    self.core.logger.info(
+                        "Warmed up metadata for %d of %d clients in %.02fs "
+                        "(%d failed)" % (self.done, self.total,
+                                         self.finished - self.started,
+                                         self.failed))
+                return None
+            client = self.queue.pop(0)
+            self.queued.discard(client)
+            delay = 0
+            if self.rate:
+                now = time.time()
+                slot = max(self.next_time, now)
+                self.next_time = slot + 1.0 / self.rate
+                delay = slot - now
+        finally:
+            self.lock.release()
+        if delay > 0:
+            self.core.terminate.wait(delay)
+        return client
+
+    def _work(self):
+        """ the main loop of each warm-up thread """
+        while True:
+            client = self._next()
+            if client is None:
+                return
+            start = time.time()
+            error = None
+            try:
+                self.core.warm_metadata(client)
+            except Bcfg2.Server.Plugin.MetadataRuntimeError:
+                # metadata hasn't been loaded yet.  the warm-up will
+                # be restarted once it has been.
+                error = False
+            except:
+                error = sys.exc_info()[1]
+                self.core.logger.warning("Failed to build metadata for %s: "
+                                         "%s" % (client, error))
+            Bcfg2.Statistics.stats.add_value("Core:metadata_warmup",
+                                             time.time() - start)
+            self.lock.acquire()
+            try:
+                if error is None:
+                    self.done += 1
+                elif error is False:
+                    self.total -= len(self.queue) + 1
+                    self.queue = []
+                    self.queued = set()
+                else:
+                    self.failed += 1
+                    self.failed_clients.add(client)
+            finally:
+                self.lock.release()
+
+    def forget_failures(self, client=None):
+        """ allow the given client, or all clients, to be built again
+        after their metadata failed to build """
+        self.lock.acquire()
+        try:
+            if client is None:
+                self.failed_clients.clear()
+            else:
+                self.failed_clients.discard(client)
+        finally:
+            self.lock.release()
+
+    def status(self):
+        """ get the progress of the current or most recent warm-up
+        as a dict """
+        self.lock.acquire()
+        try:
+            if self.started is None:
+                elapsed = 0
+            elif self.finished is None:
+                elapsed = time.time() - self.started
+            else:
+                elapsed = self.finished - self.started
+            return dict(running=bool(self.workers),
+                        total=self.total,
+                        done=self.done,
+                        failed=self.failed,
+                        queued=len(self.queue),
+                        elapsed=elapsed)
+        finally:
+            self.lock.release()
+
+
+class MetadataCache(Cache):
+    """ The cache of client metadata.  Expiring a client's metadata
+    also lets the :class:`MetadataWarmup` build it again if it failed
+    to build before. """
+
+    def __init__(self, *args, **kwargs):
+        Cache.__init__(self, *args, **kwargs)
+        #: The :class:`MetadataWarmup` to notify when metadata is
+        #: expired, or None
+        self.warmup = None
+
+    def expire(self, key=None):
+        Cache.expire(self, key=key)
+        if self.warmup is not None:
+            self.warmup.forget_failures(key)
+    expire.__doc__ = Cache.expire.__doc__
+
+
 class CoreInitError(Exception):
     """This error is raised when the core cannot be initialized."""
     pass
@@ -67,6 +448,20 @@ class BaseCore(object):
     Bcfg2 Server logic and modules.
     """
 
+    #: Optional protocol extensions supported by the server, which are
+    #: returned to clients that call :func:`DeclareVersion`.
+    #: ``file_digests`` means that :func:`GetConfig` accepts a dict of
+    #: the digests of the client's files, and omits the contents of
+    #: files that have not changed.
+    capabilities = ['file_digests']
+
+    #: Whether data received from clients, e.g., probe data, is
+    #: written to disk or the database.  This is False in the worker
+    #: processes of :mod:`Bcfg2.Server.MultiprocessingCore`, where the
+    #: master process writes the data and the workers only update
+    #: their copies of it in memory.
+    write_client_data = True
+
     def __init__(self, setup):  # pylint: disable=R0912,R0915
         self.datastore = setup['repo']
 
@@ -115,6 +510,20 @@ class BaseCore(object):
         self.password = setup['password']
         self.encoding = setup['encoding']
         self.setup = setup
+
+        #: A :class:`Bcfg2.Cache.DependencyCache` of compiled client
+        #: configurations, keyed by client name.  Each value is a
+        #: tuple of the :func:`metadata_fingerprint` of the client
+        #: when the config was built and the config itself.
+        self.config_cache = DependencyCache()
+        self.fam.add_listener(self._expire_config_cache)
+
+        #: The number of file monitor events that have been handled,
+        #: used to tell whether the file monitor thread handled any
+        #: events on each pass
+        self.fam_event_count = 0
+        self.fam.add_listener(self._count_fam_event)
+
         atexit.register(self.shutdown)
         # Create an event to signal worker threads to shutdown
         self.terminate = threading.Event()
@@ -176,6 +585,12 @@ class BaseCore(object):
         self.pull_sources = \
             self.plugins_by_type(Bcfg2.Server.Plugin.PullSource)
         self.generators = self.plugins_by_type(Bcfg2.Server.Plugin.Generator)
+
+        #: A :class:`GeneratorIndex` used to find the generator that
+        #: binds each entry
+        self.generator_index = GeneratorIndex(self.generators)
+        self.fam.add_listener(self._expire_generator_index)
+
         self.structures = self.plugins_by_type(Bcfg2.Server.Plugin.Structure)
         self.connectors = self.plugins_by_type(Bcfg2.Server.Plugin.Connector)
         self.ca = setup['ca']
@@ -184,7 +599,36 @@ class BaseCore(object):
                              target=self._file_monitor_thread)
         self.lock = threading.Lock()
 
-        self.metadata_cache = Cache()
+        self.metadata_cache = MetadataCache()
+
+        #: dict of client name -> :class:`threading.Event` for
+        #: clients whose metadata is being built and cached by some
+        #: thread, so that other threads can wait for it instead of
+        #: building it again
+        self.metadata_building = dict()
+        self.metadata_lock = threading.Lock()
+
+        #: A :class:`MetadataWarmup` used to build client metadata in
+        #: the background when it is not cached, or None if metadata
+        #: is only built on demand
+        self.metadata_warmup = None
+        warmup_threads = int(setup.cfp.get("caching",
+                                           "metadata_warmup_threads",
+                                           default="0"))
+        if warmup_threads > 0:
+            self.metadata_warmup = MetadataWarmup(
+                self,
+                threads=warmup_threads,
+                rate=float(setup.cfp.get("caching", "metadata_warmup_rate",
+                                         default="0")))
+            self.metadata_cache.warmup = self.metadata_warmup
+
+        #: A :class:`Bcfg2.Utils.WorkerPool` used to bind entries in
+        #: parallel, or None if entries are bound sequentially
+        self.bind_pool = None
+        if setup['bind_threads'] > 1:
+            self.bind_pool = WorkerPool(setup['bind_threads'],
+                                        name="BindPool")
 
     def plugins_by_type(self, base_cls):
         """Return a list of loaded plugins that match the passed type.
@@ -204,6 +648,7 @@ class BaseCore(object):
         famfd = self.fam.fileno()
         terminate = self.terminate
         while not terminate.isSet():
+            count = self.fam_event_count
             try:
                 if famfd:
                     select.select([famfd], [], [], 2)
@@ -213,9 +658,25 @@ class BaseCore(object):
                 self.fam.handle_event_set(self.lock)
             except:
                 continue
-            # VCS plugin periodic updates
-            for plugin in self.plugins_by_type(Bcfg2.Server.Plugin.Version):
-                self.revision = plugin.get_revision()
+            self._fam_events_handled(handled=self.fam_event_count != count)
+
+    def _count_fam_event(self, _, path):
+        """ count a handled file monitor event.  events on paths that
+        the config cache ignores, such as data files that plugins
+        write themselves, are not counted, so they don't restart the
+        metadata warm-up. """
+        if not self.config_cache.is_ignored(path):
+            self.fam_event_count += 1
+
+    def _fam_events_handled(self, handled=True):
+        """ update state that depends on the repository after a pass
+        of the file monitor loop.  ``handled`` is False if no events
+        were handled on this pass. """
+        if handled and self.metadata_warmup is not None:
+            self.start_metadata_warmup()
+        # VCS plugin periodic updates
+        for plugin in self.plugins_by_type(Bcfg2.Server.Plugin.Version):
+            self.revision = plugin.get_revision()
 
     def init_plugins(self, plugin):
         """Handling for the plugins."""
@@ -254,6 +715,8 @@ class BaseCore(object):
         if not self.terminate.isSet():
             self.terminate.set()
             self.fam.shutdown()
+            if self.bind_pool is not None:
+                self.bind_pool.shutdown()
             for plugin in list(self.plugins.values()):
                 plugin.shutdown()
 
@@ -268,22 +731,46 @@ class BaseCore(object):
         else:
             return mode
 
+    @property
+    def config_cache_enabled(self):
+        """ whether or not compiled client configurations are cached """
+        return self.setup.cfp.getboolean("caching", "client_config",
+                                         default=False)
+
+    def _expire_config_cache(self, _, path):
+        """ expire cached configurations that depend on the given
+        path.  this is called for every FAM event, even if the cache
+        is empty, so that builds in progress notice the change. """
+        expired = self.config_cache.expire_path(path)
+        if expired:
+            self.logger.debug("Expired cached configs for %s due to change "
+                              "to %s" % (", ".join(expired), path))
+
+    def _expire_generator_index(self, _, path):
+        """ reindex the generators whose ``Entries`` may have changed
+        due to a FAM event """
+        self.generator_index.expire_path(path)
+
     def client_run_hook(self, hook, metadata):
         """invoke client run hooks for a given stage."""
         start = time.time()
         try:
             for plugin in \
                     self.plugins_by_type(Bcfg2.Server.Plugin.ClientRunHooks):
+                span = Bcfg2.Trace.start("%s:%s" % (plugin.name, hook))
                 try:
-                    getattr(plugin, hook)(metadata)
-                except AttributeError:
-                    err = sys.exc_info()[1]
-                    self.logger.error("Unknown attribute: %s" % err)
-                    raise
-                except:
-                    err = sys.exc_info()[1]
-                    self.logger.error("%s: Error invoking hook %s: %s" %
-                                      (plugin, hook, err))
+                    try:
+                        getattr(plugin, hook)(metadata)
+                    except AttributeError:
+                        err = sys.exc_info()[1]
+                        self.logger.error("Unknown attribute: %s" % err)
+                        raise
+                    except:
+                        err = sys.exc_info()[1]
+                        self.logger.error("%s: Error invoking hook %s: %s" %
+                                          (plugin, hook, err))
+                finally:
+                    Bcfg2.Trace.end(span)
         finally:
             Bcfg2.Statistics.stats.add_value("%s:client_run_hook:%s" %
                                              (self.__class__.__name__, hook),
@@ -294,38 +781,51 @@ class BaseCore(object):
         """Checks the data structure."""
         for plugin in \
                 self.plugins_by_type(Bcfg2.Server.Plugin.StructureValidator):
+            span = Bcfg2.Trace.start("%s:validate_structures" % plugin.name)
             try:
-                plugin.validate_structures(metadata, data)
-            except Bcfg2.Server.Plugin.ValidationError:
-                err = sys.exc_info()[1]
-                self.logger.error("Plugin %s structure validation failed: %s" %
-                                  (plugin.name, err))
-                raise
-            except:
-                self.logger.error("Plugin %s: unexpected structure validation "
-                                  "failure" % plugin.name, exc_info=1)
+                try:
+                    plugin.validate_structures(metadata, data)
+                except Bcfg2.Server.Plugin.ValidationError:
+                    err = sys.exc_info()[1]
+                    self.logger.error("Plugin %s structure validation failed: "
+                                      "%s" % (plugin.name, err))
+                    raise
+                except:
+                    self.logger.error("Plugin %s: unexpected structure "
+                                      "validation failure" % plugin.name,
+                                      exc_info=1)
+            finally:
+                Bcfg2.Trace.end(span)
 
     @track_statistics()
     def validate_goals(self, metadata, data):
         """Checks that the config matches the goals enforced by the plugins."""
         for plugin in self.plugins_by_type(Bcfg2.Server.Plugin.GoalValidator):
+            span = Bcfg2.Trace.start("%s:validate_goals" % plugin.name)
             try:
-                plugin.validate_goals(metadata, data)
-            except Bcfg2.Server.Plugin.ValidationError:
-                err = sys.exc_info()[1]
-                self.logger.error("Plugin %s goal validation failed: %s" %
-                                  (plugin.name, err.message))
-                raise
-            except:
-                self.logger.error("Plugin %s: unexpected goal validation "
-                                  "failure" % plugin.name, exc_info=1)
+                try:
+                    plugin.validate_goals(metadata, data)
+                except Bcfg2.Server.Plugin.ValidationError:
+                    err = sys.exc_info()[1]
+                    self.logger.error("Plugin %s goal validation failed: %s" %
+                                      (plugin.name, err.message))
+                    raise
+                except:
+                    self.logger.error("Plugin %s: unexpected goal validation "
+                                      "failure" % plugin.name, exc_info=1)
+            finally:
+                Bcfg2.Trace.end(span)
 
     @track_statistics()
     def GetStructures(self, metadata):
         """Get all structures for client specified by metadata."""
-        structures = reduce(lambda x, y: x + y,
-                            [struct.BuildStructures(metadata)
-                             for struct in self.structures], [])
+        structures = []
+        for struct in self.structures:
+            span = Bcfg2.Trace.start("%s:BuildStructures" % struct.name)
+            try:
+                structures.extend(struct.BuildStructures(metadata))
+            finally:
+                Bcfg2.Trace.end(span)
         sbundles = [b.get('name') for b in structures if b.tag == 'Bundle']
         missing = [b for b in metadata.bundles if b not in sbundles]
         if missing:
@@ -337,6 +837,11 @@ class BaseCore(object):
     def BindStructures(self, structures, metadata, config):
         """ Given a list of structures, bind all the entries in them
         and add the structures to the config. """
+        if self.bind_pool is not None:
+            try:
+                self.BindParallel(structures, metadata)
+            except:
+                self.logger.error("error in BindParallel", exc_info=1)
         for astruct in structures:
             try:
                 self.BindStructure(astruct, metadata)
@@ -351,23 +856,95 @@ class BaseCore(object):
             if entry.tag.startswith("Bound"):
                 entry.tag = entry.tag[5:]
                 continue
+            self.BindEntry(entry, metadata)
+
+    def BindEntry(self, entry, metadata):
+        """ Bind a single entry, recording any failure on the entry
+        itself rather than raising it. """
+        try:
+            self.Bind(entry, metadata)
+        except PluginExecutionError:
+            exc = sys.exc_info()[1]
+            if 'failure' not in entry.attrib:
+                entry.set('failure', 'bind error: %s' % format_exc())
+            self.logger.error("Failed to bind entry %s:%s: %s" %
+                              (entry.tag, entry.get('name'), exc))
+        except Exception:
+            exc = sys.exc_info()[1]
+            if 'failure' not in entry.attrib:
+                entry.set('failure', 'bind error: %s' % format_exc())
+            self.logger.error("Unexpected failure in BindStructure: %s %s"
+                              % (entry.tag, entry.get('name')), exc_info=1)
+
+    def _can_bind_in_parallel(self, entry):
+        """ Determine whether the given entry can be bound in a
+        :attr:`bind_pool` thread, i.e., whether every generator that
+        might bind it is thread-safe """
+        names = [entry.get('name')]
+        if 'altsrc' in entry.attrib:
+            names.append(entry.get('altsrc'))
+        glist = []
+        for name in names:
+            gens = self.generator_index.get_generators(entry.tag, name)
+            if len(gens) != 1:
+                # the entry will be bound with HandlesEntry(), so any
+                # generator that handles the tag might get it
+                gens = gens + self.generator_index.get_handlers(entry.tag)
+            glist.extend(gens)
+        for gen in glist:
+            if not getattr(gen, "thread_safe", True):
+                return False
+        return True
+
+    @track_statistics()
+    def BindParallel(self, structures, metadata):
+        """ Bind the entries in the given structures in the
+        :attr:`bind_pool` threads.  Each entry is bound as a detached
+        copy, since lxml does not allow a single document to be
+        modified from several threads at once, and then put back in
+        place of the abstract entry in its structure, with its tag
+        prefixed with ``Bound`` so that :func:`BindStructure` leaves
+        it alone.  Entries handled by generators that are not
+        thread-safe are left for :func:`BindStructure`. """
+        work = []
+        for struct in structures:
+            for entry in struct.getchildren():
+                if (isinstance(entry.tag, str) and
+                    not entry.tag.startswith("Bound") and
+                    self._can_bind_in_parallel(entry)):
+                    work.append((struct, entry))
+        if not work:
+            return
+
+        parent = Bcfg2.Trace.current()
+
+        def bind_copy(item):
+            """ bind a copy of the given entry """
+            bound = copy.deepcopy(item[1])
+            old = Bcfg2.Trace.set_current(parent)
             try:
-                self.Bind(entry, metadata)
-            except PluginExecutionError:
-                exc = sys.exc_info()[1]
-                if 'failure' not in entry.attrib:
-                    entry.set('failure', 'bind error: %s' % format_exc())
-                self.logger.error("Failed to bind entry %s:%s: %s" %
-                                  (entry.tag, entry.get('name'), exc))
-            except Exception:
-                exc = sys.exc_info()[1]
-                if 'failure' not in entry.attrib:
-                    entry.set('failure', 'bind error: %s' % format_exc())
-                self.logger.error("Unexpected failure in BindStructure: %s %s"
-                                  % (entry.tag, entry.get('name')), exc_info=1)
+                self.BindEntry(bound, metadata)
+            finally:
+                Bcfg2.Trace.set_current(old)
+            return bound
+
+        for (struct, entry), bound in zip(work,
+                                          self.bind_pool.map(bind_copy, work)):
+            bound.tag = "Bound" + bound.tag
+            struct.replace(entry, bound)
 
     def Bind(self, entry, metadata):
         """Bind an entry using the appropriate generator."""
+        span = Bcfg2.Trace.start("Bind:%s" % entry.tag,
+                                 name=entry.get('name'))
+        try:
+            return self._bind(entry, metadata, span)
+        finally:
+            Bcfg2.Trace.end(span)
+
+    def _bind(self, entry, metadata, span):
+        """ bind an entry, recording the generator that binds it in
+        the given trace span, if any """
         start = time.time()
         if 'altsrc' in entry.attrib:
             oldname = entry.get('name')
@@ -387,20 +964,28 @@ class BaseCore(object):
                 self.logger.error("Falling back to %s:%s" %
                                   (entry.tag, entry.get('name')))
 
-        glist = [gen for gen in self.generators if
-                 entry.get('name') in gen.Entries.get(entry.tag, {})]
+        glist = self.generator_index.get_generators(entry.tag,
+                                                    entry.get('name'))
         if len(glist) == 1:
-            return glist[0].Entries[entry.tag][entry.get('name')](entry,
-                                                                  metadata)
+            if span is not None:
+                span.attrs['generator'] = glist[0].name
+            ret = glist[0].Entries[entry.tag][entry.get('name')](entry,
+                                                                 metadata)
+            self._add_config_dependencies(glist[0], entry, metadata)
+            return ret
         elif len(glist) > 1:
             generators = ", ".join([gen.name for gen in glist])
             self.logger.error("%s %s served by multiple generators: %s" %
                               (entry.tag, entry.get('name'), generators))
-        g2list = [gen for gen in self.generators if
-                  gen.HandlesEntry(entry, metadata)]
+        g2list = [gen for gen in self.generator_index.get_handlers(entry.tag)
+                  if gen.HandlesEntry(entry, metadata)]
         try:
             if len(g2list) == 1:
-                return g2list[0].HandleEntry(entry, metadata)
+                if span is not None:
+                    span.attrs['generator'] = g2list[0].name
+                ret = g2list[0].HandleEntry(entry, metadata)
+                self._add_config_dependencies(g2list[0], entry, metadata)
+                return ret
             entry.set('failure', 'no matching generator')
             raise PluginExecutionError("No matching generator: %s:%s" %
                                        (entry.tag, entry.get('name')))
@@ -410,6 +995,31 @@ class BaseCore(object):
                                               entry.tag),
                                              time.time() - start)
 
+    def _add_config_dependencies(self, generator, entry, metadata):
+        """ record the repository paths that the given bound entry
+        depends on in :attr:`config_cache` """
+        if not self.config_cache_enabled:
+            return
+        deps = generator.get_config_dependencies(entry, metadata)
+        if deps is None:
+            return
+        for path in deps:
+            self.config_cache.add_dependency(metadata.hostname, path)
+
+    def _get_cached_config(self, client, meta, fingerprint):
+        """ get a copy of the cached configuration for the given
+        client, or None if there is no cached configuration that was
+        built from the same metadata and revision """
+        try:
+            cached_fp, config = self.config_cache[client]
+        except KeyError:
+            return None
+        if cached_fp != fingerprint:
+            self.logger.debug("Metadata for %s has changed; not using cached "
+                              "config" % meta.hostname)
+            return None
+        return copy.deepcopy(config)
+
     def BuildConfiguration(self, client):
         """Build configuration for clients."""
         start = time.time()
@@ -422,6 +1032,21 @@ class BaseCore(object):
                               client)
             return lxml.etree.Element("error", type='metadata error')
 
+        use_cache = self.config_cache_enabled
+        if use_cache:
+            fingerprint = "%s:%s" % (self.revision, metadata_fingerprint(meta))
+            cached = self._get_cached_config(client, meta, fingerprint)
+            if cached is not None:
+                self.client_run_hook("start_client_run", meta)
+                self.client_run_hook("end_client_run", meta)
+                self.logger.info("Served cached config for %s in %.03f "
+                                 "seconds" % (client, time.time() - start))
+                return cached
+            # forget the dependencies of the stale config; the bind
+            # below will register a fresh set
+            self.config_cache.expire(client)
+            generation = self.config_cache.generation
+
         self.client_run_hook("start_client_run", meta)
 
         try:
@@ -453,6 +1078,18 @@ class BaseCore(object):
 
         sort_xml(config, key=lambda e: e.get('name'))
 
+        if use_cache:
+            if config.xpath("//*[@failure]"):
+                self.logger.debug("Not caching config for %s: entries failed "
+                                  "to bind" % client)
+                self.config_cache.expire(client)
+            elif generation != self.config_cache.generation:
+                self.logger.debug("Not caching config for %s: repository "
+                                  "changed during build" % client)
+            else:
+                self.config_cache[client] = (fingerprint,
+                                             copy.deepcopy(config))
+
         self.logger.info("Generated config for %s in %.03f seconds" %
                          (client, time.time() - start))
         return config
@@ -466,6 +1103,7 @@ class BaseCore(object):
             return
         self.setup.reparse()
         self.metadata_cache.expire()
+        self.config_cache.expire()
 
     def run(self):
         """ run the server core. note that it is the responsibility of
@@ -526,25 +1164,93 @@ class BaseCore(object):
         if not hasattr(self, 'metadata'):
             # some threads start before metadata is even loaded
             raise Bcfg2.Server.Plugin.MetadataRuntimeError
-        if self.metadata_cache_mode == 'initial':
+        if self.metadata_cache_mode not in ['cautious', 'aggressive']:
             # the Metadata plugin handles loading the cached data if
             # we're only caching the initial metadata object
-            imd = None
-        else:
+            return self._build_metadata(client_name)
+        imd = self.metadata_cache.get(client_name, None)
+        if imd:
+            return imd
+
+        # only one thread builds the metadata for a given client at a
+        # time; any others wait for it to be cached
+        self.metadata_lock.acquire()
+        try:
+            imd = self.metadata_cache.get(client_name, None)
+            building = self.metadata_building.get(client_name, None)
+            owner = not imd and building is None
+            if owner:
+                building = threading.Event()
+                self.metadata_building[client_name] = building
+        finally:
+            self.metadata_lock.release()
+        if imd:
+            return imd
+        if not owner:
+            building.wait()
             imd = self.metadata_cache.get(client_name, None)
-        if not imd:
-            imd = self.metadata.get_initial_metadata(client_name)
-            for conn in self.connectors:
+            if imd:
+                return imd
+            # building it failed, or it was expired as soon as it
+            # was cached
+            return self._build_metadata(client_name)
+        try:
+            return self._build_metadata(client_name)
+        finally:
+            self.metadata_lock.acquire()
+            try:
+                del self.metadata_building[client_name]
+            finally:
+                self.metadata_lock.release()
+            building.set()
+
+    def _build_metadata(self, client_name):
+        """ Build the metadata structure for a client, and cache it
+        if final metadata is cached """
+        imd = self.metadata.get_initial_metadata(client_name)
+        for conn in self.connectors:
+            span = Bcfg2.Trace.start("%s:get_additional_groups" %
+                                     conn.name)
+            try:
                 grps = conn.get_additional_groups(imd)
-                self.metadata.merge_additional_groups(imd, grps)
-            for conn in self.connectors:
+            finally:
+                Bcfg2.Trace.end(span)
+            self.metadata.merge_additional_groups(imd, grps)
+        for conn in self.connectors:
+            span = Bcfg2.Trace.start("%s:get_additional_data" % conn.name)
+            try:
                 data = conn.get_additional_data(imd)
-                self.metadata.merge_additional_data(imd, conn.name, data)
-            imd.query.by_name = self.build_metadata
-            if self.metadata_cache_mode in ['cautious', 'aggressive']:
-                self.metadata_cache[client_name] = imd
+            finally:
+                Bcfg2.Trace.end(span)
+            self.metadata.merge_additional_data(imd, conn.name, data)
+        imd.query.by_name = self.build_metadata
+        if self.metadata_cache_mode in ['cautious', 'aggressive']:
+            self.metadata_cache[client_name] = imd
         return imd
 
+    def warm_metadata(self, client_name):
+        """ Build and cache the metadata for a client, if it is not
+        cached already.  Only the initial metadata is built if that is
+        all that is cached. """
+        if self.metadata_cache_mode == 'initial':
+            self.metadata.get_initial_metadata(client_name)
+        else:
+            self.build_metadata(client_name)
+
+    def start_metadata_warmup(self):
+        """ Start building the metadata of all clients whose metadata
+        is not cached in the background.  This is called whenever file
+        monitor events are handled, since those can expire cached
+        metadata.  Nothing is done unless metadata is cached. """
+        if (self.metadata_warmup is None or
+            self.metadata_cache_mode not in ['initial', 'cautious',
+                                             'aggressive']):
+            return
+        clients = getattr(self.metadata, "clients", [])
+        missing = set(clients).difference(self.metadata_cache.keys())
+        if missing:
+            self.metadata_warmup.add(sorted(missing))
+
     def process_statistics(self, client_name, statistics):
         """Proceed statistics for client."""
         meta = self.build_metadata(client_name)
@@ -634,7 +1340,8 @@ class BaseCore(object):
 
     @exposed
     def DeclareVersion(self, address, version):
-        """ declare the client version """
+        """ declare the client version, and get the list of protocol
+        extensions the server supports """
         client = self.resolve_client(address, metadata=False)[0]
         try:
             self.metadata.set_version(client, version)
@@ -643,7 +1350,7 @@ class BaseCore(object):
             err = sys.exc_info()[1]
             self.critical_error("Unable to set version for %s: %s" %
                                 (client, err))
-        return True
+        return self.capabilities
 
     @exposed
     def GetProbes(self, address):
@@ -713,13 +1420,24 @@ class BaseCore(object):
         return True
 
     @exposed
-    def GetConfig(self, address):
-        """Build config for a client."""
+    def GetConfig(self, address, digests=None):
+        """Build config for a client.  If ``digests`` is given, it is
+        a dict of <path>: <MD5 hex digest> of the client's copies of
+        its managed files, and the contents of files that the client
+        already has are omitted."""
         client = self.resolve_client(address)[0]
         try:
             config = self.BuildConfiguration(client)
-            return lxml.etree.tostring(config,
-                                       xml_declaration=False).decode('UTF-8')
+            if digests:
+                omitted = omit_unchanged_files(config, digests)
+                self.logger.debug("Omitted the contents of %s unchanged "
+                                  "files from the config for %s" %
+                                  (omitted, client))
+            # return the serialized config as bytes, so that it can
+            # be streamed to the client without decoding it and
+            # building the whole XML-RPC response in memory
+            return EncodedString(lxml.etree.tostring(config,
+                                                     xml_declaration=False))
         except Bcfg2.Server.Plugin.MetadataConsistencyError:
             self.critical_error("Metadata consistency failure for %s" % client)
 
@@ -754,6 +1472,26 @@ class BaseCore(object):
         return self._database_available
 
     @exposed
-    def get_statistics(self, _):
-        """Get current statistics about component execution"""
-        return Bcfg2.Statistics.stats.display()
+    def get_statistics(self, _, window=None):
+        """ Get current statistics about component execution.  For
+        each statistic, this returns a tuple of the minimum, maximum,
+        mean, 50th, 95th, and 99th percentile execution times, and the
+        number of invocations.
+
+        :param window: Only report on invocations in the last
+                       ``window`` minutes
+        :type window: int
+        :returns: dict of name -> tuple """
+        return Bcfg2.Statistics.stats.display(window=window)
+
+    @exposed
+    def get_metadata_warmup_status(self, _):
+        """ Get the progress of the current or most recent background
+        metadata warm-up.
+
+        :returns: dict with the keys ``running``, ``total``, ``done``,
+                  ``failed``, ``queued``, and ``elapsed``, or an empty
+                  dict if metadata warm-up is disabled """
+        if self.metadata_warmup is None:
+            return dict()
+        return self.metadata_warmup.status()
@@ -41,6 +41,7 @@ class Fam(FileMonitor):
         else:
             handle = self.filemonitor.monitorFile(path, None)
         self.handles[handle.requestID()] = handle
+        self.paths[handle.requestID()] = path
         if obj != None:
             self.users[handle.requestID()] = obj
         return handle.requestID()
@@ -79,6 +80,7 @@ class Fam(FileMonitor):
                 except:  # pylint: disable=W0702
                     LOGGER.error("Handling event for file %s" % event.filename,
                                  exc_info=1)
+            self.notify_listeners(event)
         end = time()
         LOGGER.info("Processed %s fam events in %03.03f seconds. "
                     "%s coalesced" % (count, (end - start), collapsed))
@@ -68,6 +68,7 @@ class Gamin(FileMonitor):
         else:
             self.mon.watch_file(path, self.queue, handle)
         self.handles[handle] = obj
+        self.paths[handle] = path
         return handle
 
     def pending(self):
@@ -14,6 +14,7 @@ class Pseudo(FileMonitor):
         """add a monitor to path, installing a callback to obj.HandleEvent"""
         if handleID is None:
             handleID = len(list(self.handles.keys()))
+        self.paths[handleID] = path
         self.events.append(Event(handleID, path, 'exists'))
         if os.path.isdir(path):
             dirlist = os.listdir(path)
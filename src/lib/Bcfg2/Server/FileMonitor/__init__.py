@@ -34,6 +34,10 @@ class FileMonitor(object):
         object.__init__(self)
         self.debug = debug
         self.handles = dict()
+        #: the paths being monitored, keyed by handle ID
+        self.paths = dict()
+        #: callables that are notified of every handled event
+        self.listeners = []
         self.events = []
         if ignore is None:
             ignore = []
@@ -79,6 +83,33 @@ class FileMonitor(object):
         """ get the file descriptor of the file monitor thread """
         return 0
 
+    def add_listener(self, func):
+        """ register a callable that will be called with each event
+        and the full path it applies to after the event has been
+        dispatched to the object monitoring that path """
+        self.listeners.append(func)
+
+    def event_path(self, event):
+        """ get the full path to the file the given event applies
+        to.  events on monitored directories carry filenames relative
+        to that directory. """
+        if os.path.isabs(event.filename):
+            return event.filename
+        return os.path.join(self.paths.get(event.requestID, ''),
+                            event.filename)
+
+    def notify_listeners(self, event):
+        """ pass the given event on to all registered listeners """
+        if self.listeners:
+            path = self.event_path(event)
+            for listener in self.listeners:
+                try:
+                    listener(event, path)
+                except:  # pylint: disable=W0702
+                    err = sys.exc_info()[1]
+                    LOGGER.error("Error notifying listener of event %s for "
+                                 "%s: %s" % (event.code2str(), path, err))
+
     def handle_one_event(self, event):
         """ handle the given event by dispatching it to the object
         that handles events for the path """
@@ -99,6 +130,7 @@ class FileMonitor(object):
             err = sys.exc_info()[1]
             LOGGER.error("Error in handling of event %s for %s: %s" %
                          (event.code2str(), event.filename, err))
+        self.notify_listeners(event)
 
     def handle_event_set(self, lock=None):
         """ Handle all pending events """
@@ -0,0 +1,491 @@
+""" The multiprocessing server core is a pre-forking version of the
+:mod:`Bcfg2.Server.BuiltinCore`.  The master process loads the
+plugins and the repository once, then forks a number of worker
+processes that all accept connections on the same listening socket
+and serve clients with their own (copy-on-write) copy of the server
+state, so that building configurations is not limited to a single
+CPU.
+
+The master process keeps handling file monitor events, and passes
+each event on to the workers, which dispatch it to their copies of
+the objects that handle it.  Calls that change the state of a client
+(see :attr:`Core.master_methods` and :attr:`Core.metadata_methods`)
+are passed on from the worker that received them to the master, which
+is the only process that writes client data; calls whose results are
+only kept in memory, like probe data, are then replayed in every
+worker. """
+
+import sys
+import time
+import signal
+import threading
+import multiprocessing
+import Bcfg2.settings
+import Bcfg2.Statistics
+from Bcfg2.Compat import xmlrpclib
+from Bcfg2.Server.FileMonitor import FileMonitor, Event
+from Bcfg2.Server.BuiltinCore import Core as BuiltinCore
+
+
+class ForwardedFileMonitor(FileMonitor):
+    """ The file monitor of a worker process.  It does not monitor
+    anything itself; the events handled by the master's file monitor
+    are forwarded to it with :func:`add_event`, and dispatched to the
+    worker's copies of the objects the master dispatched them to.
+
+    Plugins keep references to the file monitor they were created
+    with, so a worker converts its copy of the master's file monitor
+    in place with :func:`forward_events` instead of creating a new
+    one. """
+
+    #: dict of monitored path -> handle ID
+    ids = None
+
+    def AddMonitor(self, path, obj, handleID=None):
+        """ register ``obj`` to handle the events that the master
+        forwards for ``path``.  The master adds its own monitor for
+        the path when it handles the same event. """
+        if handleID is None:
+            handleID = path
+        self.handles[handleID] = obj
+        self.paths[handleID] = path
+        self.ids[path.rstrip("/")] = handleID
+        return handleID
+
+    def add_event(self, request_id, path, filename, code):
+        """ queue an event forwarded from the master.  ``request_id``
+        and ``path`` are the handle ID and the path of the master's
+        monitor.  The event is only mapped to this process's monitor
+        when it is dispatched, since the monitor may be added while an
+        earlier event in the same set is handled. """
+        self.events.append((request_id, path, filename, code))
+
+    def start(self):
+        self.started = True
+
+    def pending(self):
+        return FileMonitor.pending(self)
+
+    def get_event(self):
+        request_id, path, filename, code = FileMonitor.get_event(self)
+        if self.paths.get(request_id) != path:
+            # the master added the monitor after this process was
+            # forked, so it has a different ID here
+            request_id = self.ids.get(path and path.rstrip("/"))
+        return Event(request_id, filename, code)
+
+    def fileno(self):
+        return FileMonitor.fileno(self)
+
+    def handle_event_set(self, lock=None):
+        FileMonitor.handle_event_set(self, lock=lock)
+
+    def handle_events_in_interval(self, interval):
+        FileMonitor.handle_events_in_interval(self, interval)
+
+    def shutdown(self):
+        self.started = False
+
+
+def forward_events(fam):
+    """ convert a file monitor inherited from the master process into
+    a :class:`ForwardedFileMonitor` """
+    fam.__class__ = type("Forwarded%s" % fam.__class__.__name__,
+                         (ForwardedFileMonitor, fam.__class__), dict())
+    fam.ids = dict((path.rstrip("/"), hid) for hid, path in fam.paths.items())
+    fam.events = []
+    fam.started = True
+
+
+class Channel(object):
+    """ One end of the pipe between the master and a worker process.
+    Messages are tuples whose first item is the message type, and
+    can be sent from any thread. """
+
+    def __init__(self, conn, process=None):
+        self.conn = conn
+        #: The worker process, in the master
+        self.process = process
+        self.lock = threading.Lock()
+
+    def send(self, *msg):
+        """ send a message """
+        self.lock.acquire()
+        try:
+            self.conn.send(msg)
+        finally:
+            self.lock.release()
+
+    def recv(self):
+        """ wait for the next message """
+        return self.conn.recv()
+
+    def poll(self):
+        """ return True if a message is waiting """
+        return self.conn.poll()
+
+    def close(self):
+        """ close this end of the pipe """
+        self.conn.close()
+
+
+class MasterCall(object):
+    """ A call that a worker has passed on to the master, and that is
+    waiting for the result """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        #: A tuple of (fault code, fault string) if the call failed
+        self.fault = None
+
+    def finish(self, result, fault):
+        """ record the result of the call and wake up the caller """
+        self.result = result
+        self.fault = fault
+        self.done.set()
+
+
+class Core(BuiltinCore):
+    """ A multi-process server core.  The master process forks the
+    number of worker processes given by ``children`` in the
+    ``[server]`` section of ``bcfg2.conf``, or one for each CPU. """
+    name = 'bcfg2-server'
+
+    #: XML-RPC methods that change client state.  Workers pass calls
+    #: to these methods on to the master, which is the only process
+    #: that writes client data to the repository or the database.
+    master_methods = ['DeclareVersion', 'AssertProfile', 'RecvProbeData',
+                      'RecvStats']
+
+    #: Methods in :attr:`master_methods` that are replayed in every
+    #: worker after the master has handled them, so that the workers
+    #: update their copies of the data in memory.  Other changes that
+    #: the master writes to the repository, like those to
+    #: ``clients.xml``, reach the workers through the file monitor.
+    replayed_methods = ['AssertProfile', 'RecvProbeData']
+
+    #: Methods of the Metadata plugin that change client data when a
+    #: worker builds metadata, e.g., by adding a new client with the
+    #: default profile.  The worker only updates its copy of the data
+    #: in memory, and then passes the call on to the master, which
+    #: writes the data.  Calls made while a worker replays a call or
+    #: handles a file monitor event are not passed on, since the
+    #: master has already made them itself.
+    metadata_methods = ['set_profile', 'set_version']
+
+    def __init__(self, setup):
+        BuiltinCore.__init__(self, setup)
+        self.children = setup['children']
+        if self.children < 1:
+            self.children = multiprocessing.cpu_count()
+
+        #: :class:`Channel` objects for the worker processes, in the
+        #: master
+        self.workers = []
+
+        #: :class:`Channel` to the master, in a worker process
+        self.master = None
+
+        #: The thread that handles messages from the master, in a
+        #: worker process
+        self.master_thread = None
+
+        #: Set once the workers have been forked; the master does not
+        #: handle file monitor events before then
+        self.forked = threading.Event()
+        self.running = True
+
+        #: The client that a call passed on by a worker was made by,
+        #: as resolved by the worker
+        self.resolved = threading.local()
+
+        #: dict of ID -> :class:`MasterCall` of the calls that a
+        #: worker is waiting on the master for
+        self.calls = dict()
+        self.last_call_id = 0
+        self.calls_lock = threading.Lock()
+
+        self.fam.add_listener(self._forward_event)
+
+    def _file_monitor_thread(self):
+        self.forked.wait()
+        BuiltinCore._file_monitor_thread(self)
+
+    def _start_workers(self):
+        """ load the repository and fork the worker processes """
+        # load the repository before forking, so that it is only
+        # loaded once
+        self.fam.handle_events_in_interval(1)
+        if Bcfg2.settings.HAS_DJANGO:
+            # database connections can't be shared between processes
+            from django import db
+            for conn in db.connections.all():
+                conn.close()
+
+        for num in range(self.children):
+            mconn, wconn = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=self._worker_main,
+                                           args=(wconn,),
+                                           name="Worker-%d" % num)
+            proc.start()
+            wconn.close()
+            self.workers.append(Channel(mconn, process=proc))
+        self.logger.info("Started %d worker processes" % len(self.workers))
+
+        # the workers serve all clients, and warm up their own
+        # metadata caches
+        self.server.server_close()
+        self.metadata_warmup = None
+        for worker in self.workers:
+            thread = threading.Thread(name="%s-calls" % worker.process.name,
+                                      target=self._serve_worker,
+                                      args=(worker,))
+            thread.setDaemon(True)
+            thread.start()
+
+    def _block(self):
+        try:
+            self._start_workers()
+        finally:
+            self.forked.set()
+
+        signal.signal(signal.SIGINT, self._handle_shutdown_signal)
+        signal.signal(signal.SIGTERM, self._handle_shutdown_signal)
+        try:
+            while self.running and self.workers:
+                time.sleep(1)
+                for worker in self.workers[:]:
+                    if not worker.process.is_alive():
+                        self.logger.error("Worker process %s exited with "
+                                          "status %s" %
+                                          (worker.process.pid,
+                                           worker.process.exitcode))
+                        self.workers.remove(worker)
+            if not self.workers:
+                self.logger.error("All worker processes have exited")
+        finally:
+            for worker in self.workers:
+                worker.process.terminate()
+            for worker in self.workers:
+                worker.process.join(5)
+            self.context.close()
+        self.shutdown()
+
+    def _handle_shutdown_signal(self, *_):
+        """ stop the master process """
+        self.running = False
+
+    def _broadcast(self, *msg):
+        """ send a message to all worker processes """
+        for worker in self.workers[:]:
+            try:
+                worker.send(*msg)
+            except (IOError, OSError):
+                err = sys.exc_info()[1]
+                self.logger.debug("Failed to send %s to worker process %s: "
+                                  "%s" % (msg[0], worker.process.pid, err))
+
+    def _forward_event(self, event, _):
+        """ pass a file monitor event that the master has handled on to
+        the workers """
+        self._broadcast("event", event.requestID,
+                        self.fam.paths.get(event.requestID),
+                        event.filename, event.code2str())
+
+    def _serve_worker(self, worker):
+        """ handle the calls that a worker passes on to the master """
+        while True:
+            try:
+                msg = worker.recv()
+            except (EOFError, IOError):
+                return
+            thread = threading.Thread(target=self._handle_call,
+                                      args=(worker, ) + msg[1:])
+            thread.setDaemon(True)
+            thread.start()
+
+    def _handle_call(self, worker, call_id, method, args, client):
+        """ handle one call that a worker has passed on to the master,
+        and send the result back """
+        metadata_calls = dict(("Metadata.%s" % name,
+                               getattr(self.metadata, name))
+                              for name in self.metadata_methods)
+        self.resolved.client = client
+        try:
+            try:
+                result = self._dispatch(method, args, metadata_calls)
+                fault = None
+            except xmlrpclib.Fault:
+                err = sys.exc_info()[1]
+                result = None
+                fault = (err.faultCode, err.faultString)
+        finally:
+            self.resolved.client = None
+        if fault is None and method in self.replayed_methods:
+            # the worker that made the call gets the replay before
+            # the result, so it has the new data when it returns
+            self._broadcast("replay", method, args, client)
+        try:
+            worker.send("result", call_id, result, fault)
+        except (IOError, OSError):
+            err = sys.exc_info()[1]
+            self.logger.error("Failed to return the result of %s to worker "
+                              "process %s: %s" %
+                              (method, worker.process.pid, err))
+
+    def _worker_main(self, conn):
+        """ the main loop of a worker process """
+        for worker in self.workers:
+            # close the master's end of the pipes to the workers that
+            # were forked before this one
+            worker.close()
+        self.workers = []
+        self.master = Channel(conn)
+        self.write_client_data = False
+        forward_events(self.fam)
+        # the worker only receives the events that the master has
+        # forwarded
+        self.fam.listeners.remove(self._forward_event)
+        for name in self.metadata_methods:
+            setattr(self.metadata, name, self._metadata_method(name))
+
+        thread = threading.Thread(name="MasterThread",
+                                  target=self._master_thread)
+        thread.setDaemon(True)
+        thread.start()
+        if self.metadata_warmup is not None:
+            self.start_metadata_warmup()
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            if self.bind_pool is not None:
+                self.bind_pool.shutdown()
+
+    def _master_thread(self):
+        """ handle messages from the master in a worker process """
+        self.master_thread = threading.currentThread()
+        while True:
+            try:
+                msg = self.master.recv()
+            except (EOFError, IOError):
+                self.logger.error("Lost connection to the master process, "
+                                  "shutting down")
+                self.server.shutdown()
+                self.calls_lock.acquire()
+                try:
+                    for call in self.calls.values():
+                        call.finish(None, (xmlrpclib.APPLICATION_ERROR,
+                                           "Server is shutting down"))
+                    self.calls = dict()
+                finally:
+                    self.calls_lock.release()
+                return
+            if msg[0] == "event":
+                self.fam.add_event(*msg[1:])
+                if not self.master.poll():
+                    try:
+                        self.fam.handle_event_set(self.lock)
+                    except:  # pylint: disable=W0702
+                        continue
+                    self._fam_events_handled()
+            elif msg[0] == "replay":
+                self._replay(*msg[1:])
+            elif msg[0] == "result":
+                self.calls_lock.acquire()
+                try:
+                    call = self.calls.pop(msg[1], None)
+                finally:
+                    self.calls_lock.release()
+                if call is not None:
+                    call.finish(*msg[2:])
+
+    def _replay(self, method, args, client):
+        """ replay a call that the master has handled in a worker """
+        self.resolved.client = client
+        try:
+            try:
+                getattr(self, method)(*args)
+            except:  # pylint: disable=W0702
+                err = sys.exc_info()[1]
+                self.logger.error("Failed to replay %s for %s: %s" %
+                                  (method, client, err))
+        finally:
+            self.resolved.client = None
+
+    def _metadata_method(self, name):
+        """ get a replacement for the Metadata method ``name`` in a
+        worker process.  See :attr:`metadata_methods`. """
+        func = getattr(self.metadata, name)
+
+        def call_master(client, *args):
+            """ update the worker's copy of the client data, then have
+            the master write it """
+            rv = func(client, *args)
+            if threading.currentThread() is not self.master_thread:
+                self._call_master("Metadata.%s" % name, (client, ) + args,
+                                  client=client)
+            return rv
+
+        call_master.__doc__ = func.__doc__
+        return call_master
+
+    def _call_master(self, method, args, client=None):
+        """ pass a call on to the master and wait for the result.  If
+        ``client`` is not given, the first argument is the address
+        the call was made from. """
+        if client is None:
+            client = self.resolve_client(args[0], metadata=False)[0]
+        if threading.currentThread() is self.master_thread:
+            # the result could never be received
+            raise xmlrpclib.Fault(xmlrpclib.APPLICATION_ERROR,
+                                  "Cannot pass %s for %s on to the master "
+                                  "while handling a message from it" %
+                                  (method, client))
+        call = MasterCall()
+        self.calls_lock.acquire()
+        try:
+            self.last_call_id += 1
+            call_id = self.last_call_id
+            self.calls[call_id] = call
+        finally:
+            self.calls_lock.release()
+        try:
+            self.master.send("call", call_id, method, args, client)
+        except (IOError, OSError):
+            err = sys.exc_info()[1]
+            self.calls_lock.acquire()
+            try:
+                self.calls.pop(call_id, None)
+            finally:
+                self.calls_lock.release()
+            self.critical_error("Failed to pass %s for %s on to the master "
+                                "process: %s" % (method, client, err))
+        call.done.wait()
+        if call.fault is not None:
+            raise xmlrpclib.Fault(*call.fault)
+        return call.result
+
+    def _dispatch(self, method, args, dispatch_dict):
+        if self.master is None or method not in self.master_methods:
+            return BuiltinCore._dispatch(self, method, args, dispatch_dict)
+        method_start = time.time()
+        try:
+            return self._call_master(method, args)
+        finally:
+            Bcfg2.Statistics.stats.add_value(method,
+                                             time.time() - method_start)
+
+    def resolve_client(self, address, cleanup_cache=False, metadata=True):
+        client = getattr(self.resolved, "client", None)
+        if client is None:
+            return BuiltinCore.resolve_client(self, address,
+                                              cleanup_cache=cleanup_cache,
+                                              metadata=metadata)
+        # the worker that received the call has already resolved the
+        # client, which the master may not be able to do (e.g., if
+        # it authenticated with a UUID)
+        if metadata:
+            return (client, self.build_metadata(client))
+        return (client, None)
@@ -11,6 +11,7 @@ import lxml.etree
 import Bcfg2.Server
 import Bcfg2.Options
 import Bcfg2.Statistics
+import Bcfg2.Trace
 from Bcfg2.Compat import CmpMixin, wraps
 from Bcfg2.Server.Plugin.base import Debuggable, Plugin
 from Bcfg2.Server.Plugin.interfaces import Generator
@@ -81,7 +82,8 @@ def bind_info(entry, metadata, infoxml=None, default=DEFAULT_FILE_METADATA):
 
 class track_statistics(object):  # pylint: disable=C0103
     """ Decorator that tracks execution time for the given
-    :class:`Plugin` method for reporting via ``bcfg2-admin perf`` """
+    :class:`Plugin` method for reporting via ``bcfg2-admin perf``,
+    and records it in the active :mod:`Bcfg2.Trace` trace, if any """
 
     def __init__(self, name=None):
         """
@@ -103,9 +105,11 @@ class track_statistics(object):  # pylint: disable=C0103
             name = "%s:%s" % (obj.__class__.__name__, self.name)
 
             start = time.time()
+            span = Bcfg2.Trace.start(name)
             try:
                 return func(obj, *args, **kwargs)
             finally:
+                Bcfg2.Trace.end(span)
                 Bcfg2.Statistics.stats.add_value(name, time.time() - start)
 
         return inner
@@ -157,6 +161,28 @@ class PluginDatabaseModel(object):
         app_label = "Server"
 
 
+def bulk_create(model, objs):
+    """ Insert the given instances of a Django model with as few
+    queries as possible, in batches small enough for any database to
+    handle.  ``bulk_create()`` is only available in Django 1.4 and
+    newer; on older versions, each object is saved individually.
+
+    :param model: The Django model class to insert objects of
+    :param objs: The model instances to insert
+    :type objs: list
+    """
+    if not objs:
+        return
+    if not hasattr(model.objects, "bulk_create"):
+        for obj in objs:
+            obj.save()
+        return
+    # sqlite allows at most 999 parameters in a single query
+    size = max(1, 900 // len(model._meta.fields))
+    for i in range(0, len(objs), size):
+        model.objects.bulk_create(objs[i:i + size])
+
+
 class FileBacked(object):
     """ This object caches file data in memory. FileBacked objects are
     principally meant to be used as a part of
@@ -32,6 +32,19 @@ class Generator(object):
        :func:`HandleEntry`.
     """
 
+    #: Whether or not entries handled by this generator can be bound
+    #: concurrently with other entries for the same client when
+    #: ``bind_threads`` is greater than 1.  Generators that keep
+    #: per-client state between entries (e.g., generating a key the
+    #: first time any of several entries is bound) should set this to
+    #: False, and their entries will be bound sequentially.
+    thread_safe = True
+
+    #: The entry tags that :func:`HandlesEntry` may return True for,
+    #: or None if it may handle entries with any tag.  The core never
+    #: calls :func:`HandlesEntry` for entries with other tags.
+    handles_tags = None
+
     def HandlesEntry(self, entry, metadata):  # pylint: disable=W0613
         """ HandlesEntry is the slow path method for routing
         configuration binding requests.  It is called if the
@@ -63,6 +76,29 @@ class Generator(object):
         """
         return entry
 
+    # pylint: disable=W0613
+    def get_config_dependencies(self, entry, metadata):
+        """ Return the paths in the Bcfg2 repository that the given
+        entry was bound from.  This is used to expire cached client
+        configurations when those paths change.  A directory matches
+        any change to a file beneath it.
+
+        A generator that returns paths here should call
+        :func:`Bcfg2.Cache.DependencyCache.track_path` on
+        ``self.core.config_cache`` for the directory its data lives
+        in; changes to untracked paths expire all cached
+        configurations.
+
+        :param entry: The bound entry
+        :type entry: lxml.etree._Element
+        :param metadata: The client metadata
+        :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
+        :return: list of strings, or None if the dependencies of the
+                 entry are not known
+        """
+        return None
+    # pylint: enable=W0613
+
 
 class Structure(object):
     """ Structure Plugins contribute to abstract client
@@ -654,8 +654,15 @@ class Cfg(Bcfg2.Server.Plugin.GroupSpool,
         if 'validate' not in SETUP:
             SETUP.add_option('validate', Bcfg2.Options.CFG_VALIDATION)
             SETUP.reparse()
+
+        core.config_cache.track_path(os.path.join(datastore, self.name))
     __init__.__doc__ = Bcfg2.Server.Plugin.GroupSpool.__init__.__doc__
 
+    def get_config_dependencies(self, entry, metadata):
+        return [os.path.join(self.data, entry.get('name').lstrip('/'))]
+    get_config_dependencies.__doc__ = \
+        Bcfg2.Server.Plugin.Generator.get_config_dependencies.__doc__
+
     def has_generator(self, entry, metadata):
         """ Return True if the given entry can be generated for the
         given metadata; False otherwise
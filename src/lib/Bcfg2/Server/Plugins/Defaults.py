@@ -16,6 +16,7 @@ class Defaults(Bcfg2.Server.Plugins.Rules.Rules,
     # validation phase.  so we overload Handle(s)Entry and HandleEvent
     # to ensure that Defaults handles no entries, even though it's a
     # Generator.
+    handles_tags = []
 
     def HandlesEntry(self, entry, metadata):
         return False
@@ -97,6 +97,10 @@ class FileProbes(Bcfg2.Server.Plugin.Plugin,
 
     def ReceiveData(self, metadata, datalist):
         """Receive data from probe."""
+        if not self.core.write_client_data:
+            # the files written by another process reach this one
+            # through the file monitor
+            return
         self.debug_log("Receiving file probe data from %s" % metadata.hostname)
 
         for data in datalist:
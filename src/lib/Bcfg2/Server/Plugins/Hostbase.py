@@ -99,6 +99,10 @@ class Hostbase(Bcfg2.Server.Plugin.Plugin,
         self.buildHostsLPD()
         self.buildPrinters()
         self.buildNetgroups()
+        if hasattr(self.core, "generator_index"):
+            # our Entries have changed, but not in response to a FAM
+            # event, so the core must be told to reindex them
+            self.core.generator_index.expire(self)
         return True
 
     def buildZones(self):
@@ -7,8 +7,10 @@ import sys
 import time
 import copy
 import fcntl
+import heapq
 import socket
 import logging
+import threading
 import lxml.etree
 import Bcfg2.Server
 import Bcfg2.Server.Lint
@@ -158,6 +160,10 @@ class XMLMetadataConfig(Bcfg2.Server.Plugin.XMLFileBacked):
 
     def write_xml(self, fname, xmltree):
         """Write changes to xml back to disk."""
+        if not self.metadata.core.write_client_data:
+            # the changes are written by another process, and reach
+            # this one through the file monitor
+            return
         tmpfile = "%s.new" % fname
         try:
             datafile = open(tmpfile, 'w')
@@ -365,6 +371,244 @@ class MetadataGroup(tuple):
         return hash(self.name)
 
 
+class MetadataGroupRule(object):
+    """ a single group membership rule from groups.xml: a group that
+    a client is added to (or, if ``negate`` is True, removed from) if
+    the predicate is true """
+
+    # pylint: disable=R0913
+    def __init__(self, index, group, predicate, conditions, negate=False,
+                 category=None):
+        #: The position of the rule in evaluation order
+        self.index = index
+        self.group = group
+        self.predicate = predicate
+        self.negate = negate
+        #: The category checked by the predicate, if any
+        self.category = category
+
+        #: The names of the groups that the predicate depends on.
+        #: The rule's own group is included, since the rule does
+        #: nothing unless the client is (for negated rules) or is not
+        #: (otherwise) a member of it.
+        self.inputs = set([group.name])
+
+        #: The key that the rule is indexed by: a tuple of ("Client",
+        #: <name>) or ("Group", <name>), or None if the rule has no
+        #: condition that must be true for it to apply
+        self.trigger = None
+        for tag, name, cond_negate in conditions:
+            if tag == 'Group':
+                self.inputs.add(name)
+            if not cond_negate and (self.trigger is None or
+                                    self.trigger[0] != 'Client'):
+                self.trigger = (tag, name)
+    # pylint: enable=R0913
+
+    def apply(self, client, groups, categories):
+        """ evaluate the rule for a client, and add the group to or
+        remove it from the client's groups if the predicate is true.
+        Returns True if the client's groups were changed, False
+        otherwise. """
+        if self.negate:
+            if (self.group.name not in groups or
+                not self.predicate(client, groups, categories)):
+                return False
+            groups.remove(self.group.name)
+            if self.group.category:
+                del categories[self.group.category]
+        else:
+            if (self.group.name in groups or
+                not self.predicate(client, groups, categories)):
+                return False
+            groups.add(self.group.name)
+            if self.group.category:
+                categories[self.group.category] = self.group.name
+        return True
+
+    def __repr__(self):
+        return "%s %s%s (trigger=%s)" % (self.__class__.__name__,
+                                         self.negate and "!" or "",
+                                         self.group.name, self.trigger)
+
+
+class MetadataGroupRules(object):
+    """ the group membership rules from groups.xml, indexed so that
+    only the rules that can possibly apply to a client are evaluated.
+
+    Rules are evaluated in passes, in the order they were added,
+    until a pass changes no groups, exactly as if every rule were
+    evaluated on every pass.  On the first pass, only the rules whose
+    trigger condition (a positive Client or Group condition) is true
+    are evaluated; after that, a rule is only evaluated again once a
+    group or category that it depends on has changed. """
+
+    def __init__(self):
+        self.rules = []
+        #: Rules with no positive condition, which must always be
+        #: evaluated
+        self.always = []
+        #: mapping of client name -> rules triggered by it
+        self.by_client = dict()
+        #: mapping of group name -> rules triggered by it
+        self.by_group = dict()
+        #: mapping of group name -> rules that depend on it
+        self.by_input = dict()
+        #: mapping of category -> rules that depend on it
+        self.by_category = dict()
+
+    def __len__(self):
+        return len(self.rules)
+
+    def add(self, group, predicate, conditions, negate=False,
+            category=None):
+        """ add a rule.  ``conditions`` is a list of (tag, name,
+        negate) tuples describing the Client and Group conditions that
+        make up the predicate. """
+        rule = MetadataGroupRule(len(self.rules), group, predicate,
+                                 conditions, negate=negate,
+                                 category=category)
+        self.rules.append(rule)
+        if rule.trigger is None:
+            self.always.append(rule.index)
+        elif rule.trigger[0] == 'Client':
+            self.by_client.setdefault(rule.trigger[1],
+                                      []).append(rule.index)
+        else:
+            self.by_group.setdefault(rule.trigger[1], []).append(rule.index)
+        for name in rule.inputs:
+            self.by_input.setdefault(name, []).append(rule.index)
+        if category:
+            self.by_category.setdefault(category, []).append(rule.index)
+        return rule
+
+    def merge(self, client, groups, categories):
+        """ apply the rules to a client, modifying ``groups`` and
+        ``categories`` in place """
+        current = set(self.always)
+        current.update(self.by_client.get(client, []))
+        for group in groups:
+            current.update(self.by_group.get(group, []))
+        current = list(current)
+        while current:
+            numgroups = len(groups)
+            heapq.heapify(current)
+            queued = set(current)
+            pending = set()
+            while current:
+                idx = heapq.heappop(current)
+                queued.discard(idx)
+                rule = self.rules[idx]
+                if not rule.apply(client, groups, categories):
+                    continue
+                deps = self.by_input.get(rule.group.name, [])
+                if rule.group.category:
+                    deps = deps + self.by_category.get(rule.group.category,
+                                                       [])
+                for dep in deps:
+                    if dep > idx:
+                        # later in this pass
+                        if dep not in queued:
+                            queued.add(dep)
+                            heapq.heappush(current, dep)
+                    else:
+                        pending.add(dep)
+            if numgroups == len(groups):
+                break
+            current = list(pending)
+        return (groups, categories)
+
+
+class MetadataClientIndex(object):
+    """ an inverted index of client names by the values of some
+    attribute of their metadata (e.g., groups or bundles), so that the
+    clients with a given value can be found without building metadata
+    for every client.  Each client's entry records a key that callers
+    can use to tell if the entry is still current. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        #: mapping of client name -> (key, set of values)
+        self.entries = dict()
+        #: mapping of value -> set of client names
+        self.index = dict()
+
+    def __contains__(self, client):
+        return client in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_key(self, client):
+        """ get the key that the given client's entry was indexed
+        with, or None if the client is not indexed """
+        try:
+            return self.entries[client][0]
+        except KeyError:
+            return None
+
+    def _remove(self, client):
+        """ remove a client from the index.  must be called with the
+        lock held. """
+        if client not in self.entries:
+            return
+        for value in self.entries.pop(client)[1]:
+            clients = self.index[value]
+            clients.discard(client)
+            if not clients:
+                del self.index[value]
+
+    def update(self, client, values, key=None):
+        """ set the values indexed for a client """
+        self.lock.acquire()
+        try:
+            self._remove(client)
+            values = set(values)
+            self.entries[client] = (key, values)
+            for value in values:
+                self.index.setdefault(value, set()).add(client)
+        finally:
+            self.lock.release()
+
+    def remove(self, client):
+        """ remove a client from the index """
+        self.lock.acquire()
+        try:
+            self._remove(client)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        """ remove all clients from the index """
+        self.lock.acquire()
+        try:
+            self.entries = dict()
+            self.index = dict()
+        finally:
+            self.lock.release()
+
+    def missing(self, clients):
+        """ get the set of the given clients that are not indexed """
+        return set(clients).difference(self.entries)
+
+    def lookup(self, values, match_all=True):
+        """ get the set of clients that have all (or, if
+        ``match_all`` is False, any) of the given values """
+        self.lock.acquire()
+        try:
+            sets = [self.index.get(value, set()) for value in set(values)]
+            if not sets:
+                if match_all:
+                    return set(self.entries.keys())
+                return set()
+            if not match_all:
+                return set().union(*sets)
+            sets.sort(key=len)
+            return sets[0].intersection(*sets[1:])
+        finally:
+            self.lock.release()
+
+
 class Metadata(Bcfg2.Server.Plugin.Metadata,
                Bcfg2.Server.Plugin.Statistics,
                Bcfg2.Server.Plugin.DatabaseBacked):
@@ -401,8 +645,11 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
         self.raddresses = {}
         # mapping of clientname -> [groups]
         self.clientgroups = {}
-        # list of clients
-        self.clients = []
+        # set of clients
+        self.clients = set()
+        # mapping of clientname -> serialized <Client> tag from
+        # clients.xml, used to find the clients that have changed
+        self.client_data = {}
         self.aliases = {}
         self.raliases = {}
         # mapping of groupname -> MetadataGroup object
@@ -410,12 +657,23 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
         # mappings of predicate -> MetadataGroup object
         self.group_membership = dict()
         self.negated_groups = dict()
+        # the rules from group_membership and negated_groups, indexed
+        # for _merge_groups()
+        self.group_rules = MetadataGroupRules()
         # mapping of hostname -> version string
         if self._use_db:
             self.versions = ClientVersions()
         else:
             self.versions = dict()
         self.uuid = {}
+        # mapping of clientname -> uuid
+        self.ruuid = {}
+        # inverted indexes of clients by profile (from the initial
+        # metadata) and by groups and bundles (from the final,
+        # cached metadata)
+        self.profile_index = MetadataClientIndex()
+        self.group_index = MetadataClientIndex()
+        self.bundle_index = MetadataClientIndex()
         self.session_cache = {}
         self.default = None
         self.pdirty = False
@@ -521,8 +779,11 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
             attribs = dict()
         if self._use_db:
             client = MetadataClientModel(hostname=client_name)
-            client.save()
-            self.clients = self.list_clients()
+            if self.core.write_client_data:
+                client.save()
+                self.clients = self.list_clients()
+            else:
+                self.clients.add(client_name)
             return client
         else:
             return self._add_xdata(self.clients_xml, "Client", client_name,
@@ -626,7 +887,7 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
         """ handle all events for clients.xml and files xincluded from
         clients.xml """
         xdata = self.clients_xml.xdata
-        self.clients = []
+        self.clients = set()
         self.clientgroups = {}
         self.aliases = {}
         self.raliases = {}
@@ -634,8 +895,11 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
         self.floating = []
         self.addresses = {}
         self.raddresses = {}
+        client_data = {}
         for client in xdata.findall('.//Client'):
             clname = client.get('name').lower()
+            client_data.setdefault(clname, []).append(
+                lxml.etree.tostring(client))
             if 'address' in client.attrib:
                 caddr = client.get('address')
                 if caddr in self.addresses:
@@ -650,6 +914,7 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
                                                            'cert+password')
             if 'uuid' in client.attrib:
                 self.uuid[client.get('uuid')] = clname
+                self.ruuid[clname] = client.get('uuid')
             if client.get('secure', 'false').lower() == 'true':
                 self.secure.append(clname)
             if (client.get('location', 'fixed') == 'floating' or
@@ -673,7 +938,7 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
                 if clname not in self.raddresses:
                     self.raddresses[clname] = set()
                 self.raddresses[clname].add(alias.get('address'))
-            self.clients.append(clname)
+            self.clients.add(clname)
             profile = client.get("profile")
             if self.groups:  # check if we've parsed groups.xml yet
                 if profile not in self.groups:
@@ -687,12 +952,21 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
                 self.clientgroups[clname].append(profile)
             except KeyError:
                 self.clientgroups[clname] = [profile]
+
+        # only clients whose entries in clients.xml have changed need
+        # their metadata rebuilt
+        changed = [c for c in set(client_data) | set(self.client_data)
+                   if client_data.get(c) != self.client_data.get(c)]
+        self.client_data = client_data
+        self.expire_clients(changed)
         self.states['clients.xml'] = True
         if self._use_db:
             self.clients = self.list_clients()
 
     def _handle_groups_xml_event(self, _):  # pylint: disable=R0912
         """ re-read groups.xml on any event on it """
+        # groups.xml can change the metadata of every client
+        self.expire_clients()
         self.groups = {}
 
         # these three functions must be separate functions in order to
@@ -762,6 +1036,9 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
 
         self.group_membership = dict()
         self.negated_groups = dict()
+        # mapping of predicate -> list of (tag, name, negate) tuples
+        # describing the conditions it checks
+        rule_conditions = dict()
 
         # confusing loop condition; the XPath query asks for all
         # elements under a Group tag under a Groups tag; that is
@@ -777,32 +1054,49 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
                 continue
 
             conditions = []
+            parents = []
             for parent in el.iterancestors():
                 cond = get_condition(parent)
                 if cond:
                     conditions.append(cond)
+                    parents.append(
+                        (parent.tag, parent.get("name"),
+                         parent.get('negate', 'false').lower() == 'true'))
 
             gname = el.get("name")
             if el.get("negate", "false").lower() == "true":
-                self.negated_groups[aggregate_conditions(conditions)] = \
-                    self.groups[gname]
+                predicate = aggregate_conditions(conditions)
+                self.negated_groups[predicate] = self.groups[gname]
             else:
                 if self.groups[gname].category:
                     conditions.append(
                         get_category_condition(self.groups[gname].category,
                                                gname))
 
-                self.group_membership[aggregate_conditions(conditions)] = \
-                    self.groups[gname]
+                predicate = aggregate_conditions(conditions)
+                self.group_membership[predicate] = self.groups[gname]
+            rule_conditions[predicate] = parents
+
+        # the order that rules are evaluated in can matter (e.g., for
+        # categories, or groups with negated conditions), so the rules
+        # are added in the order that they have always been evaluated
+        # in: all of group_membership, then all of negated_groups
+        group_rules = MetadataGroupRules()
+        for predicate, group in self.group_membership.items():
+            group_rules.add(group, predicate, rule_conditions[predicate],
+                            category=group.category)
+        for predicate, group in self.negated_groups.items():
+            group_rules.add(group, predicate, rule_conditions[predicate],
+                            negate=True)
+        self.group_rules = group_rules
         self.states['groups.xml'] = True
 
     def HandleEvent(self, event):
         """Handle update events for data files."""
         for handles, event_handler in self.handlers.items():
             if handles(event):
-                # clear the entire cache when we get an event for any
-                # metadata file
-                self.core.metadata_cache.expire()
+                # the event handlers expire cached metadata for the
+                # clients affected by the change
                 event_handler(event)
 
         if False not in list(self.states.values()) and self.debug_flag:
@@ -820,6 +1114,21 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
                         self.debug_log("Group %s set as nonexistent group %s" %
                                        (gname, group))
 
+    def expire_clients(self, clients=None):
+        """ expire cached metadata and index entries for the given
+        clients, or for all clients if ``clients`` is None """
+        if clients is None:
+            self.core.metadata_cache.expire()
+            self.profile_index.clear()
+            self.group_index.clear()
+            self.bundle_index.clear()
+            return
+        for client in clients:
+            self.core.metadata_cache.expire(client)
+            self.profile_index.remove(client)
+            self.group_index.remove(client)
+            self.bundle_index.remove(client)
+
     def set_profile(self, client, profile, addresspair):
         """Set group parameter for provided client."""
         self.logger.info("Asserting client %s profile to %s" %
@@ -868,8 +1177,9 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
                                          address=addresspair[0]))
                 else:
                     self.add_client(client, dict(profile=profile))
-                self.clients.append(client)
+                self.clients.add(client)
                 self.clientgroups[client] = [profile]
+        self.profile_index.remove(client)
         if not self._use_db:
             self.clients_xml.write()
 
@@ -934,26 +1244,9 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
         """ set group membership based on the contents of groups.xml
         and initial group membership of this client. Returns a tuple
         of (allgroups, categories)"""
-        numgroups = -1  # force one initial pass
         if categories is None:
             categories = dict()
-        while numgroups != len(groups):
-            numgroups = len(groups)
-            for predicate, group in self.group_membership.items():
-                if group.name in groups:
-                    continue
-                if predicate(client, groups, categories):
-                    groups.add(group.name)
-                    if group.category:
-                        categories[group.category] = group.name
-            for predicate, group in self.negated_groups.items():
-                if group.name not in groups:
-                    continue
-                if predicate(client, groups, categories):
-                    groups.remove(group.name)
-                    if group.category:
-                        del categories[group.category]
-        return (groups, categories)
+        return self.group_rules.merge(client, groups, categories)
 
     def get_initial_metadata(self, client):  # pylint: disable=R0914,R0912
         """Return the metadata for a given client."""
@@ -1031,12 +1324,7 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
             password = self.passwords[client]
         else:
             password = None
-        uuids = [item for item, value in list(self.uuid.items())
-                 if value == client]
-        if uuids:
-            uuid = uuids[0]
-        else:
-            uuid = None
+        uuid = self.ruuid.get(client, None)
         if not profile:
             # one last ditch attempt at setting the profile
             profiles = [g for g in groups
@@ -1068,23 +1356,52 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
 
     def get_client_names_by_profiles(self, profiles):
         """ return a list of names of clients in the given profile groups """
-        rv = []
+        # a client's profile only depends on clients.xml and
+        # groups.xml, so index entries are kept until those change
+        for client in self.profile_index.missing(list(self.clients)):
+            self.profile_index.update(
+                client, [self.get_initial_metadata(client).profile])
+        clients = self.profile_index.lookup(profiles, match_all=False)
+        return [c for c in clients if c in self.clients]
+
+    def _update_final_index(self):
+        """ make sure that the group and bundle indexes are current
+        for all clients.  Index entries are only valid as long as the
+        final metadata they were built from is still cached; Connector
+        plugins expire a client's cached metadata when its additional
+        groups change. """
+        cache = self.core.metadata_cache
         for client in list(self.clients):
-            mdata = self.get_initial_metadata(client)
-            if mdata.profile in profiles:
-                rv.append(client)
-        return rv
+            imd = cache.get(client, None)
+            if imd is None or imd is not self.group_index.get_key(client):
+                imd = self.core.build_metadata(client)
+                self.group_index.update(client, imd.groups, key=imd)
+                self.bundle_index.update(client, imd.bundles, key=imd)
 
     def get_client_names_by_groups(self, groups):
         """ return a list of names of clients in the given groups """
-        mdata = [self.core.build_metadata(client) for client in self.clients]
-        return [md.hostname for md in mdata if md.groups.issuperset(groups)]
+        if self.core.metadata_cache_mode not in ['cautious', 'aggressive']:
+            # without cached final metadata, we can't tell when
+            # groups added by connectors have changed
+            mdata = [self.core.build_metadata(c)
+                     for c in list(self.clients)]
+            return [md.hostname for md in mdata
+                    if md.groups.issuperset(groups)]
+        self._update_final_index()
+        return [c for c in self.group_index.lookup(groups)
+                if c in self.clients]
 
     def get_client_names_by_bundles(self, bundles):
         """ given a list of bundles, return a list of names of clients
         that use those bundles """
-        mdata = [self.core.build_metadata(client) for client in self.clients]
-        return [md.hostname for md in mdata if md.bundles.issuperset(bundles)]
+        if self.core.metadata_cache_mode not in ['cautious', 'aggressive']:
+            mdata = [self.core.build_metadata(c)
+                     for c in list(self.clients)]
+            return [md.hostname for md in mdata
+                    if md.bundles.issuperset(bundles)]
+        self._update_final_index()
+        return [c for c in self.bundle_index.lookup(bundles)
+                if c in self.clients]
 
     def merge_additional_groups(self, imd, groups):
         for group in groups:
@@ -1165,6 +1482,7 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
             if user not in self.uuid:
                 client = user
                 self.uuid[user] = user
+                self.ruuid.setdefault(user, user)
             else:
                 client = self.uuid[user]
 
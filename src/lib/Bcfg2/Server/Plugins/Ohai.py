@@ -79,7 +79,12 @@ class Ohai(Bcfg2.Server.Plugin.Plugin,
         return [self.probe]
 
     def ReceiveData(self, meta, datalist):
-        self.cache[meta.hostname] = datalist[0].text
+        if self.core.write_client_data:
+            self.cache[meta.hostname] = datalist[0].text
+        else:
+            # another process has written the data; forget the old
+            # copy so that the new one is read
+            self.cache.cache.pop(meta.hostname, None)
 
     def get_additional_data(self, meta):
         if meta.hostname in self.cache:
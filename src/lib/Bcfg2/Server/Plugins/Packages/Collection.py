@@ -126,7 +126,6 @@ class Collection(list, Bcfg2.Server.Plugin.Debuggable):
         self.metadata = metadata
         self.basepath = basepath
         self.cachepath = cachepath
-        self.virt_pkgs = dict()
         self.fam = fam
 
         try:
@@ -500,7 +499,24 @@ class Collection(list, Bcfg2.Server.Plugin.Debuggable):
         return list(complete.difference(initial))
 
     @Bcfg2.Server.Plugin.track_statistics()
-    def complete(self, packagelist):  # pylint: disable=R0912,R0914
+    def get_index(self):
+        """ Get the :class:`PackageIndex` for this collection's
+        sources and relevant groups.  Indexes are shared by all
+        collections with the same :attr:`cachekey` and relevant
+        groups, and are kept until :func:`clear_indexes` is called.
+
+        :returns: :class:`PackageIndex`
+        """
+        key = (self.cachekey, tuple(self.get_relevant_groups()))
+        try:
+            return INDEXES[key]
+        except KeyError:
+            index = PackageIndex(self.get_vpkgs())
+            INDEXES[key] = index
+            return index
+
+    @Bcfg2.Server.Plugin.track_statistics()
+    def complete(self, packagelist):
         """ Build a complete list of all packages and their dependencies.
 
         :param packagelist: Set of initial packages computed from the
@@ -512,109 +528,135 @@ class Collection(list, Bcfg2.Server.Plugin.Debuggable):
                   set of symbols whose dependencies could not be
                   resolved.
         """
-        # setup vpkg cache
-        pgrps = tuple(self.get_relevant_groups())
-        if pgrps not in self.virt_pkgs:
-            self.virt_pkgs[pgrps] = self.get_vpkgs()
-        vpkg_cache = self.virt_pkgs[pgrps]
-
-        # unclassified is set of unsatisfied requirements (may be pkg
-        # for vpkg)
-        unclassified = set(packagelist)
-        vpkgs = set()
-        both = set()
-        pkgs = set(packagelist)
+        index = self.get_index()
 
-        packages = set()
-        examined = set()
+        # every package in the initial list is added, whatever it
+        # turns out to be
+        packages = set(packagelist)
+        examined = set(packagelist)
         unknown = set()
-
-        final_pass = False
-        really_done = False
-        # do while unclassified or vpkgs or both or pkgs
-        while unclassified or pkgs or both or final_pass:
-            if really_done:
-                break
-            if len(unclassified) + len(pkgs) + len(both) == 0:
-                # one more pass then exit
-                really_done = True
-
+        # worklist of requirements that have not been examined yet
+        # (may be pkg or vpkg)
+        unclassified = []
+        for current in packagelist:
+            deps = index.get_deps(self, current)
+            providers = index.provides.get(current)
+            if deps is None and providers is None:
+                unknown.add(current)
+            elif deps is None and len(providers) == 1:
+                unclassified.extend(providers)
+            if deps:
+                unclassified.extend(deps)
+
+        # requirements that are both packages and virtual packages.
+        # these are satisfied by any of their providers, but if none
+        # of them are required by the time everything else has been
+        # resolved, then the package with that name is used.
+        both = set()
+        while unclassified or both:
             while unclassified:
                 current = unclassified.pop()
+                if current in examined:
+                    continue
                 examined.add(current)
-                is_pkg = False
-                if self.is_package(current):
-                    is_pkg = True
-
-                is_vpkg = current in vpkg_cache
-
-                if is_pkg and is_vpkg:
+                deps = index.get_deps(self, current)
+                providers = index.provides.get(current)
+                if deps is not None and providers is not None:
                     both.add(current)
-                elif is_pkg and not is_vpkg:
-                    pkgs.add(current)
-                elif is_vpkg and not is_pkg:
-                    vpkgs.add(current)
-                elif not is_vpkg and not is_pkg:
+                elif deps is not None:
+                    # direct packages; current can be added, and all
+                    # deps should be resolved.  this is the hot path,
+                    # so only build debug messages if they'll be used
+                    packages.add(current)
+                    if self.debug_flag:
+                        self.debug_log("Packages: handling package "
+                                       "requirement %s" % current)
+                        if deps.difference(examined):
+                            self.debug_log("Packages: Package %s added "
+                                           "requirements %s" %
+                                           (current,
+                                            deps.difference(examined)))
+                    unclassified.extend(deps)
+                elif providers is not None:
+                    # virtual dependencies, satisfied if one of N in
+                    # the config, or can be forced if only one provider
+                    if self.debug_flag:
+                        self.debug_log("Packages: requirement %s satisfied "
+                                       "by %s" % (current, list(providers)))
+                    if len(providers) == 1:
+                        unclassified.extend(providers)
+                else:
                     unknown.add(current)
 
-            while pkgs:
-                # direct packages; current can be added, and all deps
-                # should be resolved
-                current = pkgs.pop()
-                self.debug_log("Packages: handling package requirement %s" %
+            forced = [current for current in both
+                      if not index.provides[current] & packages]
+            both = set()
+            for current in forced:
+                self.debug_log("Packages: forcing package requirement %s" %
                                current)
                 packages.add(current)
-                deps = self.get_deps(current)
-                newdeps = set(deps).difference(examined)
-                if newdeps:
-                    self.debug_log("Packages: Package %s added requirements %s"
-                                   % (current, newdeps))
-                unclassified.update(newdeps)
-
-            satisfied_vpkgs = set()
-            for current in vpkgs:
-                # virtual dependencies, satisfied if one of N in the
-                # config, or can be forced if only one provider
-                if len(vpkg_cache[current]) == 1:
-                    self.debug_log("Packages: requirement %s satisfied by %s" %
-                                   (current, vpkg_cache[current]))
-                    unclassified.update(
-                        vpkg_cache[current].difference(examined))
-                    satisfied_vpkgs.add(current)
-                else:
-                    satisfiers = [item for item in vpkg_cache[current]
-                                  if item in packages]
-                    self.debug_log("Packages: requirement %s satisfied by %s" %
-                                   (current, satisfiers))
-                    satisfied_vpkgs.add(current)
-            vpkgs.difference_update(satisfied_vpkgs)
-
-            satisfied_both = set()
-            for current in both:
-                # packages that are both have virtual providers as
-                # well as a package with that name. allow use of virt
-                # through explicit specification, then fall back to
-                # forcing current on last pass
-                satisfiers = [item for item in vpkg_cache[current]
-                              if item in packages]
-                if satisfiers:
-                    self.debug_log("Packages: requirement %s satisfied by %s" %
-                                   (current, satisfiers))
-                    satisfied_both.add(current)
-                elif current in packagelist or final_pass:
-                    pkgs.add(current)
-                    satisfied_both.add(current)
-            both.difference_update(satisfied_both)
-
-            if len(unclassified) + len(pkgs) == 0:
-                final_pass = True
-            else:
-                final_pass = False
+                unclassified.extend(index.get_deps(self, current))
 
-            self.filter_unknown(unknown)
+        self.filter_unknown(unknown)
         return packages, unknown
 
 
+class PackageIndex(object):
+    """ An index of the packages and virtual packages available to
+    a :class:`Collection`, used by :func:`Collection.complete` to
+    resolve dependencies without asking every source about every
+    package. """
+
+    def __init__(self, vpkgs):
+        """
+        :param vpkgs: The virtual packages provided by the collection,
+                      as returned by :func:`Collection.get_vpkgs`
+        :type vpkgs: dict of string -> set of strings
+        """
+        #: A dict of virtual package name -> frozenset of the names
+        #: of packages that provide it
+        self.provides = dict()
+        for name, providers in vpkgs.items():
+            self.provides[name] = frozenset(providers)
+
+        #: A dict of package name -> frozenset of the package's
+        #: dependencies, or None if the name is not a package.  This
+        #: is filled in as packages are looked up.
+        self.deps = dict()
+
+    def get_deps(self, collection, package):
+        """ Get the dependencies of a package.
+
+        :param collection: The collection to look up the package in
+                           if it has not been indexed yet
+        :type collection: Collection
+        :param package: The name of the package
+        :type package: string
+        :returns: frozenset of strings, or None if ``package`` is not
+                  a package
+        """
+        try:
+            return self.deps[package]
+        except KeyError:
+            if collection.is_package(package):
+                deps = frozenset(collection.get_deps(package))
+            else:
+                deps = None
+            self.deps[package] = deps
+            return deps
+
+
+#: A dict of (:attr:`Collection.cachekey`, relevant groups) ->
+#: :class:`PackageIndex`
+INDEXES = dict()  # pylint: disable=C0103
+
+
+def clear_indexes():
+    """ Forget all :class:`PackageIndex` objects, e.g., when the
+    package sources have been reloaded """
+    INDEXES.clear()
+
+
 def get_collection_class(source_type):
     """ Given a source type, determine the class of Collection object
     that should be used to contain these sources.  Note that
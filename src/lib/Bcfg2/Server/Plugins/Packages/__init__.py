@@ -5,13 +5,16 @@ determine the completeness of the client configuration. """
 import os
 import sys
 import glob
+import time
 import shutil
 import lxml.etree
 import Bcfg2.Logger
+import Bcfg2.Statistics
 import Bcfg2.Server.Plugin
+from Bcfg2.Cache import LRUCache
 from Bcfg2.Compat import ConfigParser, urlopen
 from Bcfg2.Server.Plugins.Packages.Collection import Collection, \
-    get_collection_class
+    get_collection_class, clear_indexes
 from Bcfg2.Server.Plugins.Packages.PackagesSources import PackagesSources
 
 #: The default path for generated yum configs
@@ -44,6 +47,10 @@ class Packages(Bcfg2.Server.Plugin.Plugin,
     #: and :func:`Reload`
     __rmi__ = Bcfg2.Server.Plugin.Plugin.__rmi__ + ['Refresh', 'Reload']
 
+    #: Packages only handles ``Package`` entries and the ``Path``
+    #: entries for yum/apt configs
+    handles_tags = ['Package', 'Path']
+
     def __init__(self, core, datastore):
         Bcfg2.Server.Plugin.Plugin.__init__(self, core, datastore)
         Bcfg2.Server.Plugin.StructureValidator.__init__(self)
@@ -102,6 +109,22 @@ class Packages(Bcfg2.Server.Plugin.Plugin,
         #: which could be shared among multiple clients.
         self.collections = dict()
 
+        #: A cache of the results of
+        #: :func:`Bcfg2.Server.Plugins.Packages.Collection.Collection.complete`,
+        #: keyed by the collection
+        #: :attr:`Bcfg2.Server.Plugins.Packages.Collection.Collection.cachekey`,
+        #: its relevant groups, and the initial set of packages.
+        #: Clients with the same sources and the same initial package
+        #: list share a resolved package list.
+        try:
+            cache_size = int(self.core.setup.cfp.get(
+                "packages", "resolver_cache_size", default="128"))
+        except ValueError:
+            self.logger.error("Packages: Bad resolver_cache_size, using "
+                              "the default of 128")
+            cache_size = 128
+        self.resolved = LRUCache(maxsize=cache_size)
+
         #: clients is a cache mapping of hostname ->
         #: :attr:`Bcfg2.Server.Plugins.Packages.Collection.Collection.cachekey`
         #: Unlike :attr:`collections`, this _is_ used to return a
@@ -346,7 +369,7 @@ class Packages(Bcfg2.Server.Plugin.Plugin,
         for el in to_remove:
             el.getparent().remove(el)
 
-        packages, unknown = collection.complete(base)
+        packages, unknown = self._complete(collection, base)
         if unknown:
             self.logger.info("Packages: Got %d unknown entries" % len(unknown))
             self.logger.info("Packages: %s" % list(unknown))
@@ -356,6 +379,37 @@ class Packages(Bcfg2.Server.Plugin.Plugin,
         newpkgs.sort()
         collection.packages_to_entry(newpkgs, independent)
 
+    def _complete(self, collection, base):
+        """ Get the complete list of packages for the given initial
+        list, from :attr:`resolved` if another client with the same
+        sources has already resolved the same list.
+
+        :param collection: The collection of sources for this client.
+        :type collection: Bcfg2.Server.Plugins.Packages.Collection.Collection
+        :param base: The initial set of packages
+        :type base: set
+        :returns: tuple of sets, as returned by
+                  :func:`Bcfg2.Server.Plugins.Packages.Collection.Collection.complete`
+        """
+        if not self.resolved.maxsize:
+            return collection.complete(base)
+        start = time.time()
+        key = (collection.cachekey, tuple(collection.get_relevant_groups()),
+               frozenset(base))
+        result = self.resolved.get(key)
+        if result is None:
+            packages, unknown = collection.complete(base)
+            # the result is shared by every client that gets it from
+            # the cache, so it must not be modified
+            result = (frozenset(packages), frozenset(unknown))
+            self.resolved[key] = result
+            Bcfg2.Statistics.stats.add_value("Packages:resolver_cache_miss",
+                                             time.time() - start)
+        else:
+            Bcfg2.Statistics.stats.add_value("Packages:resolver_cache_hit",
+                                             time.time() - start)
+        return result
+
     @Bcfg2.Server.Plugin.track_statistics()
     def Refresh(self):
         """ Packages.Refresh() => True|False
@@ -402,11 +456,17 @@ class Packages(Bcfg2.Server.Plugin.Plugin,
         # clear Collection caches
         self.clients = dict()
         self.collections = dict()
+        # package lists in cached client configs may now be stale
+        self.core.config_cache.expire()
 
         for source in self.sources.entries:
             cachefiles.add(source.cachefile)
             if not self.disableMetaData:
                 source.setup_data(force_update)
+        # forget dependency indexes and package lists built from the
+        # old source data
+        clear_indexes()
+        self.resolved.expire()
 
         for cfile in glob.glob(os.path.join(self.cachepath, "cache-*")):
             if cfile not in cachefiles:
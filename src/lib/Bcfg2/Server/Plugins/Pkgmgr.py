@@ -144,6 +144,7 @@ class Pkgmgr(Bcfg2.Server.Plugin.PrioDir):
     __author__ = 'bcfg-dev@mcs.anl.gov'
     __child__ = PkgSrc
     __element__ = 'Package'
+    handles_tags = ['Package']
 
     def HandleEvent(self, event):
         '''Handle events and update dispatch table'''
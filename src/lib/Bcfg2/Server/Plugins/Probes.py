@@ -5,13 +5,16 @@ import os
 import sys
 import time
 import copy
+import fcntl
+import datetime
 import operator
+import threading
 import lxml.etree
 import Bcfg2.Server
 import Bcfg2.Server.Plugin
 
 try:
-    from django.db import models
+    from django.db import models, transaction
     HAS_DJANGO = True
 
     class ProbesDataModel(models.Model,
@@ -117,7 +120,8 @@ class ProbeData(str):
 
 class ProbeSet(Bcfg2.Server.Plugin.EntrySet):
     """ Handle universal and group- and host-specific probe files """
-    ignore = re.compile("^(\.#.*|.*~|\\..*\\.(tmp|sw[px])|probed\\.xml)$")
+    ignore = re.compile("^(\.#.*|.*~|\\..*\\.(tmp|sw[px])|"
+                        "probed\\.(xml|journal))$")
     probename = \
         re.compile("(.*/)?(?P<basename>\S+?)(\.(?P<mode>(?:G\d\d)|H)_\S+)?$")
     bangline = re.compile('^#!\s*(?P<interpreter>.*)$')
@@ -131,9 +135,11 @@ class ProbeSet(Bcfg2.Server.Plugin.EntrySet):
         fam.AddMonitor(path, self)
 
     def HandleEvent(self, event):
-        """ handle events on everything but probed.xml """
+        """ handle events on everything but probed.xml and
+        probed.journal """
         if (event.filename != self.path and
-            not event.filename.endswith("probed.xml")):
+            not event.filename.endswith("probed.xml") and
+            not event.filename.endswith("probed.journal")):
             return self.handle_event(event)
 
     def get_probe_data(self, metadata):
@@ -172,9 +178,28 @@ class ProbeSet(Bcfg2.Server.Plugin.EntrySet):
 class Probes(Bcfg2.Server.Plugin.Probing,
              Bcfg2.Server.Plugin.Connector,
              Bcfg2.Server.Plugin.DatabaseBacked):
-    """ A plugin to gather information from a client machine """
+    """ A plugin to gather information from a client machine.
+
+    When the database is not in use, probe data is stored in
+    ``probed.xml`` and ``probed.journal``.  Data received from a
+    client is appended to the journal as a single ``<Client>``
+    record, and the journal is periodically compacted into
+    ``probed.xml``, so a client check-in does not require rewriting
+    the data for every client. """
     __author__ = 'bcfg-dev@mcs.anl.gov'
 
+    #: How long, in seconds, probe data received from clients is held
+    #: in memory before it is appended to ``probed.journal``.  If a
+    #: client checks in again before then, only its newest data is
+    #: written.  Queued data is written out by a timer, so it is not
+    #: held any longer if no other client checks in.
+    flush_interval = 5
+
+    #: ``probed.journal`` is compacted into ``probed.xml`` once it
+    #: holds more records than there are clients, or this many
+    #: records, whichever is greater
+    compact_threshold = 100
+
     def __init__(self, core, datastore):
         Bcfg2.Server.Plugin.Connector.__init__(self)
         Bcfg2.Server.Plugin.Probing.__init__(self)
@@ -189,7 +214,40 @@ class Probes(Bcfg2.Server.Plugin.Probing,
 
         self.probedata = dict()
         self.cgroups = dict()
+        self.journal = os.path.join(self.data, 'probed.journal')
+        # probe data only reaches client configs through client
+        # metadata, which is fingerprinted separately, so writing it
+        # out mustn't expire every cached config
+        for fname in ['probed.xml', 'probed.journal', '.probed.xml.tmp']:
+            core.config_cache.ignore_path(os.path.join(self.data, fname))
+        #: dict of hostname -> ``<Client>`` record waiting to be
+        #: appended to the journal
+        self.pending_records = dict()
+        #: dict of hostname -> (probe data, groups) waiting to be
+        #: written to the database by the background database writer
+        self.pending_db_writes = dict()
+        #: Protects :attr:`pending_records` and
+        #: :attr:`pending_db_writes`
+        self.pending_lock = threading.Lock()
+        self.pending_cond = threading.Condition(self.pending_lock)
+        self.last_flush = time.time()
+        #: The :class:`threading.Timer` that will write out queued
+        #: probe data, if any is queued
+        self.flush_timer = None
+        self.journal_records = 0
         self.load_data()
+
+        #: The thread that writes probe data to the database in the
+        #: background, if ``db_writer`` in the ``[probes]`` section
+        #: of ``bcfg2.conf`` is set to ``thread``
+        self.db_writer = None
+        if (self.core.setup.cfp.get("probes", "db_writer",
+                                    default="inline") == "thread" and
+            self._use_db):
+            self.db_writer = threading.Thread(target=self._db_writer,
+                                              name="ProbesDBWriter")
+            self.db_writer.setDaemon(True)
+            self.db_writer.start()
     __init__.__doc__ = Bcfg2.Server.Plugin.DatabaseBacked.__init__.__doc__
 
     def write_data(self, client):
@@ -199,50 +257,203 @@ class Probes(Bcfg2.Server.Plugin.Probing,
         else:
             return self._write_data_xml(client)
 
-    def _write_data_xml(self, _):
-        """ Write received probe data to probed.xml """
-        top = lxml.etree.Element("Probed")
-        for client, probed in sorted(self.probedata.items()):
-            ctag = lxml.etree.SubElement(top, 'Client', name=client,
-                                         timestamp=str(int(probed.timestamp)))
-            for probe in sorted(probed):
-                lxml.etree.SubElement(ctag, 'Probe', name=probe,
-                                      value=str(self.probedata[client][probe]))
-            for group in sorted(self.cgroups[client]):
-                lxml.etree.SubElement(ctag, "Group", name=group)
+    def _client_xml(self, client):
+        """ Get a ``<Client>`` element describing the probe data and
+        groups for the named client """
+        probed = self.probedata[client]
+        ctag = lxml.etree.Element('Client', name=client,
+                                  timestamp=str(int(probed.timestamp)))
+        for probe in sorted(probed):
+            lxml.etree.SubElement(ctag, 'Probe', name=probe,
+                                  value=str(probed[probe]))
+        for group in sorted(self.cgroups[client]):
+            lxml.etree.SubElement(ctag, "Group", name=group)
+        return ctag
+
+    def _write_data_xml(self, client):
+        """ Queue received probe data to be appended to
+        probed.journal, and write out all queued data if
+        :attr:`flush_interval` has passed since it was last written.
+        Otherwise, make sure that a timer will write it out once
+        :attr:`flush_interval` has passed. """
+        # attribute values are serialized with newlines escaped, so
+        # each record is a single line
+        record = lxml.etree.tostring(self._client_xml(client.hostname),
+                                     xml_declaration=False).decode('UTF-8')
+        self.pending_lock.acquire()
+        try:
+            self.pending_records[client.hostname] = record
+            if time.time() - self.last_flush >= self.flush_interval:
+                self._flush_journal()
+            elif self.flush_timer is None:
+                self.flush_timer = threading.Timer(self.flush_interval,
+                                                   self._timed_flush)
+                self.flush_timer.setDaemon(True)
+                self.flush_timer.start()
+        finally:
+            self.pending_lock.release()
+
+    def _timed_flush(self):
+        """ Write out queued probe data when :attr:`flush_timer`
+        fires """
+        self.pending_lock.acquire()
+        try:
+            self.flush_timer = None
+            self._flush_journal()
+        finally:
+            self.pending_lock.release()
+
+    def _flush_journal(self):
+        """ Append all queued probe data to probed.journal, and
+        compact the journal if it has grown large enough.  The caller
+        must hold :attr:`pending_lock`. """
+        self.last_flush = time.time()
+        if not self.pending_records:
+            return
+        records = list(self.pending_records.values())
+        self.pending_records = dict()
+        try:
+            journal = open(self.journal, 'a')
+            try:
+                # other server processes may be writing to the
+                # journal, too
+                fcntl.lockf(journal.fileno(), fcntl.LOCK_EX)
+                journal.write("".join([r + "\n" for r in records]))
+            finally:
+                journal.close()
+        except IOError:
+            err = sys.exc_info()[1]
+            self.logger.error("Failed to write probed.journal: %s" % err)
+            return
+        self.journal_records += len(records)
+        if self.journal_records > max(len(self.probedata),
+                                      self.compact_threshold):
+            self._compact_xml()
+
+    def _compact_xml(self):
+        """ Merge probed.journal into probed.xml.  The new probed.xml
+        is written to a temporary file and renamed into place, so it
+        is always complete. """
         try:
-            datafile = open(os.path.join(self.data, 'probed.xml'), 'w')
-            datafile.write(lxml.etree.tostring(
-                    top, xml_declaration=False,
-                    pretty_print='true').decode('UTF-8'))
+            journal = open(self.journal, 'a')
         except IOError:
             err = sys.exc_info()[1]
-            self.logger.error("Failed to write probed.xml: %s" % err)
+            self.logger.error("Failed to open probed.journal: %s" % err)
+            return
+        try:
+            fcntl.lockf(journal.fileno(), fcntl.LOCK_EX)
+            top = lxml.etree.Element("Probed")
+            clients = self._read_data_xml()
+            for client in sorted(clients.keys()):
+                top.append(clients[client])
+            tmpfile = os.path.join(self.data, '.probed.xml.tmp')
+            try:
+                datafile = open(tmpfile, 'w')
+                datafile.write(lxml.etree.tostring(
+                        top, xml_declaration=False,
+                        pretty_print='true').decode('UTF-8'))
+                datafile.close()
+                os.rename(tmpfile, os.path.join(self.data, 'probed.xml'))
+                journal.truncate(0)
+                self.journal_records = 0
+            except (IOError, OSError):
+                err = sys.exc_info()[1]
+                self.logger.error("Failed to write probed.xml: %s" % err)
+        finally:
+            journal.close()
 
     def _write_data_db(self, client):
-        """ Write received probe data to the database """
-        for probe, data in self.probedata[client.hostname].items():
-            pdata = \
-                ProbesDataModel.objects.get_or_create(hostname=client.hostname,
-                                                      probe=probe)[0]
-            if pdata.data != data:
-                pdata.data = data
-                pdata.save()
-        ProbesDataModel.objects.filter(
-            hostname=client.hostname).exclude(
-            probe__in=self.probedata[client.hostname]).delete()
-
-        for group in self.cgroups[client.hostname]:
+        """ Write received probe data to the database, or queue it for
+        the background database writer if it is enabled """
+        probedata = dict(self.probedata[client.hostname])
+        groups = list(self.cgroups[client.hostname])
+        if self.db_writer is None:
+            self._sync_db(client.hostname, probedata, groups)
+            return
+        self.pending_cond.acquire()
+        try:
+            # if the client checks in again before its data has been
+            # written, only the newest data is written
+            self.pending_db_writes[client.hostname] = (probedata, groups)
+            self.pending_cond.notify()
+        finally:
+            self.pending_cond.release()
+
+    def _sync_db(self, hostname, probedata, groups):
+        """ Make the probe data and groups stored in the database for
+        a client match the given data.  The existing rows for the
+        client are read once, and only the differences are written, in
+        a single transaction. """
+        transaction.commit_on_success(self._sync_db_rows)(hostname,
+                                                          probedata,
+                                                          groups)
+
+    def _sync_db_rows(self, hostname, probedata, groups):
+        """ Do the work of :func:`_sync_db` """
+        stale = []
+        existing = dict()
+        for pdata in ProbesDataModel.objects.filter(hostname=hostname):
+            if pdata.probe in probedata and pdata.probe not in existing:
+                existing[pdata.probe] = pdata
+            else:
+                stale.append(pdata.pk)
+        if stale:
+            ProbesDataModel.objects.filter(pk__in=stale).delete()
+        new = []
+        now = datetime.datetime.now()
+        for probe, data in probedata.items():
+            if probe not in existing:
+                new.append(ProbesDataModel(hostname=hostname, probe=probe,
+                                           data=data, timestamp=now))
+            elif existing[probe].data != data:
+                # update() skips the extra query that save() makes to
+                # check that the row exists, but doesn't set
+                # auto_now fields
+                ProbesDataModel.objects.filter(
+                    pk=existing[probe].pk).update(data=data, timestamp=now)
+        Bcfg2.Server.Plugin.bulk_create(ProbesDataModel, new)
+
+        stale = []
+        existing = set()
+        for pgroup in ProbesGroupsModel.objects.filter(hostname=hostname):
+            if pgroup.group in groups and pgroup.group not in existing:
+                existing.add(pgroup.group)
+            else:
+                stale.append(pgroup.pk)
+        if stale:
+            ProbesGroupsModel.objects.filter(pk__in=stale).delete()
+        new = []
+        for group in groups:
+            if group not in existing:
+                existing.add(group)
+                new.append(ProbesGroupsModel(hostname=hostname, group=group))
+        Bcfg2.Server.Plugin.bulk_create(ProbesGroupsModel, new)
+
+    def _db_writer(self):
+        """ Write probe data queued by :func:`_write_data_db` to the
+        database.  This runs in its own thread, so that client runs
+        do not wait for the database. """
+        while True:
+            self.pending_cond.acquire()
             try:
-                ProbesGroupsModel.objects.get(hostname=client.hostname,
-                                              group=group)
-            except ProbesGroupsModel.DoesNotExist:
-                grp = ProbesGroupsModel(hostname=client.hostname,
-                                        group=group)
-                grp.save()
-        ProbesGroupsModel.objects.filter(
-            hostname=client.hostname).exclude(
-            group__in=self.cgroups[client.hostname]).delete()
+                while (not self.pending_db_writes and
+                       self.db_writer is not None):
+                    self.pending_cond.wait(5)
+                pending = self.pending_db_writes
+                self.pending_db_writes = dict()
+                if not pending:
+                    # shutdown() has been called and everything has
+                    # been written
+                    return
+            finally:
+                self.pending_cond.release()
+            for hostname, (probedata, groups) in pending.items():
+                try:
+                    self._sync_db(hostname, probedata, groups)
+                except:  # pylint: disable=W0702
+                    err = sys.exc_info()[1]
+                    self.logger.error("Failed to write probe data for %s "
+                                      "to the database: %s" % (hostname, err))
 
     def load_data(self):
         """ Load probe data from the appropriate backend (probed.xml
@@ -252,18 +463,47 @@ class Probes(Bcfg2.Server.Plugin.Probing,
         else:
             return self._load_data_xml()
 
-    def _load_data_xml(self):
-        """ Load probe data from probed.xml """
+    def _read_data_xml(self):
+        """ Read the probe data for all clients from probed.xml and
+        probed.journal.
+
+        :returns: dict of hostname -> ``<Client>`` element """
+        rv = dict()
         try:
             data = lxml.etree.parse(os.path.join(self.data, 'probed.xml'),
                                     parser=Bcfg2.Server.XMLParser).getroot()
+            for client in data.getchildren():
+                rv[client.get('name')] = client
         except (IOError, lxml.etree.XMLSyntaxError):
             err = sys.exc_info()[1]
             self.logger.error("Failed to read file probed.xml: %s" % err)
-            return
+
+        if os.path.exists(self.journal):
+            records = 0
+            try:
+                for line in open(self.journal):
+                    records += 1
+                    try:
+                        client = lxml.etree.XML(line,
+                                                parser=Bcfg2.Server.XMLParser)
+                    except lxml.etree.XMLSyntaxError:
+                        # probably a record that was being written when
+                        # the server died
+                        self.logger.warning("Skipping bad record in "
+                                            "probed.journal")
+                        continue
+                    rv[client.get('name')] = client
+            except IOError:
+                err = sys.exc_info()[1]
+                self.logger.error("Failed to read probed.journal: %s" % err)
+            self.journal_records = records
+        return rv
+
+    def _load_data_xml(self):
+        """ Load probe data from probed.xml and probed.journal """
         self.probedata = {}
         self.cgroups = {}
-        for client in data.getchildren():
+        for client in self._read_data_xml().values():
             self.probedata[client.get('name')] = \
                 ClientProbeDataSet(timestamp=client.get("timestamp"))
             self.cgroups[client.get('name')] = []
@@ -288,6 +528,33 @@ class Probes(Bcfg2.Server.Plugin.Probing,
                 self.cgroups[pgroup.hostname] = []
             self.cgroups[pgroup.hostname].append(pgroup.group)
 
+    def shutdown(self):
+        """ Write out any queued probe data.  With file-based storage,
+        also compact probed.journal into probed.xml """
+        Bcfg2.Server.Plugin.DatabaseBacked.shutdown(self)
+        if self.db_writer is not None:
+            # tell the database writer to finish writing what's queued
+            # and exit
+            writer = self.db_writer
+            self.pending_cond.acquire()
+            try:
+                self.db_writer = None
+                self.pending_cond.notify()
+            finally:
+                self.pending_cond.release()
+            writer.join()
+        elif not self._use_db:
+            self.pending_lock.acquire()
+            try:
+                if self.flush_timer is not None:
+                    self.flush_timer.cancel()
+                    self.flush_timer = None
+                self._flush_journal()
+                if self.journal_records:
+                    self._compact_xml()
+            finally:
+                self.pending_lock.release()
+
     def GetProbes(self, meta):
         return self.probes.get_probe_data(meta)
     GetProbes.__doc__ = Bcfg2.Server.Plugin.Probing.GetProbes.__doc__
@@ -307,7 +574,8 @@ class Probes(Bcfg2.Server.Plugin.Probing,
         if (self.core.metadata_cache_mode in ['cautious', 'aggressive'] and
             olddata != self.cgroups[client.hostname]):
             self.core.metadata_cache.expire(client.hostname)
-        self.write_data(client)
+        if self.core.write_client_data:
+            self.write_data(client)
     ReceiveData.__doc__ = Bcfg2.Server.Plugin.Probing.ReceiveData.__doc__
 
     def ReceiveDataItem(self, client, data):
@@ -43,6 +43,9 @@ class SEModules(Bcfg2.Server.Plugin.GroupSpool):
     #: SEModules manages ``SELinux`` entries
     entry_type = 'SELinux'
 
+    #: SEModules only handles ``SELinux`` entries
+    handles_tags = ['SELinux']
+
     #: The SEModules plugin is experimental
     experimental = True
 
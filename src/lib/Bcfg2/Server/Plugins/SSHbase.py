@@ -123,6 +123,10 @@ class SSHbase(Bcfg2.Server.Plugin.Plugin,
                    "ssh_host_rsa_key.pub",
                    "ssh_host_key.pub"]
 
+    #: private and public keys are bound as separate entries, and
+    #: binding either one may generate both
+    thread_safe = False
+
     def __init__(self, core, datastore):
         Bcfg2.Server.Plugin.Plugin.__init__(self, core, datastore)
         Bcfg2.Server.Plugin.Generator.__init__(self)
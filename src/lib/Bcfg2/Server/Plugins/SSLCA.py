@@ -19,6 +19,10 @@ class SSLCA(Bcfg2.Server.Plugin.GroupSpool):
     cert_specs = {}
     CAs = {}
 
+    #: certificates are built from keys that may be generated while
+    #: binding a different entry
+    thread_safe = False
+
     def __init__(self, core, datastore):
         Bcfg2.Server.Plugin.GroupSpool.__init__(self, core, datastore)
         self.infoxml = dict()
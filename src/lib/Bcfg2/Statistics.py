@@ -1,44 +1,210 @@
 """ module for tracking execution time statistics from the bcfg2
 server core """
 
+import math
+import time
+import threading
+
+
+class Histogram(object):
+    """ a fixed-memory histogram of values, used to estimate
+    percentiles.  values are sorted into buckets whose boundaries grow
+    geometrically, so that any percentile can be estimated to within
+    :attr:`growth` of its true value regardless of how many values
+    are added. """
+
+    #: The upper boundary of the smallest bucket; smaller values are
+    #: all counted in it
+    min_value = 1e-6
+
+    #: The ratio between the boundaries of adjacent buckets
+    growth = 1.05
+
+    #: The number of buckets.  With the defaults above, the largest
+    #: bucket starts at about 10 hours.
+    buckets = 500
+
+    def __init__(self):
+        #: dict of bucket index -> number of values in that bucket
+        self.counts = dict()
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def bucket(self, value):
+        """ get the index of the bucket that ``value`` falls into """
+        if value <= self.min_value:
+            return 0
+        idx = int(math.log(value / self.min_value, self.growth)) + 1
+        return min(idx, self.buckets - 1)
+
+    def add_value(self, value):
+        """ add a value to the histogram """
+        value = float(value)
+        idx = self.bucket(value)
+        self.counts[idx] = self.counts.get(idx, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def update(self, other):
+        """ add all of the values in another histogram to this one """
+        for idx, count in other.counts.items():
+            self.counts[idx] = self.counts.get(idx, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or
+                                      other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or
+                                      other.max > self.max):
+            self.max = other.max
+
+    def mean(self):
+        """ get the mean of all values in the histogram """
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def percentile(self, pct):
+        """ estimate the given percentile (from 0 to 100) of the
+        values in the histogram """
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(self.count * pct / 100.0)))
+        seen = 0
+        for idx in sorted(self.counts.keys()):
+            seen += self.counts[idx]
+            if seen >= rank:
+                break
+        # use the geometric midpoint of the bucket, which is never
+        # more than a factor of sqrt(growth) from any value in it
+        if idx == 0:
+            value = self.min_value
+        else:
+            value = self.min_value * self.growth ** (idx - 0.5)
+        return min(max(value, self.min), self.max)
+
 
 class Statistic(object):
     """ a single named statistic, tracking minimum, maximum, and
-    average execution time, and number of invocations """
-    def __init__(self, name, initial_value):
+    average execution time, percentiles of execution time, and number
+    of invocations, both overall and over the last
+    :attr:`window_slots` minutes """
+
+    #: The length of the time slots that windowed statistics are
+    #: kept in, in seconds
+    slot_length = 60
+
+    #: The number of time slots kept for windowed statistics
+    window_slots = 60
+
+    #: The percentiles reported by :func:`get_value`
+    percentiles = (50, 95, 99)
+
+    def __init__(self, name, initial_value=None):
         self.name = name
-        self.min = float(initial_value)
-        self.max = float(initial_value)
-        self.ave = float(initial_value)
-        self.count = 1
+        #: A :class:`Histogram` of all values
+        self.histogram = Histogram()
+        #: A list of (slot number, :class:`Histogram`) tuples, used
+        #: as a ring buffer of recent values
+        self.slots = [(None, None)] * self.window_slots
+        if initial_value is not None:
+            self.add_value(initial_value)
 
-    def add_value(self, value):
+    @property
+    def min(self):
+        """ the smallest value """
+        return self.histogram.min
+
+    @property
+    def max(self):
+        """ the largest value """
+        return self.histogram.max
+
+    @property
+    def ave(self):
+        """ the mean of all values """
+        return self.histogram.mean()
+
+    @property
+    def count(self):
+        """ the number of values """
+        return self.histogram.count
+
+    def add_value(self, value, now=None):
         """ add a value to the statistic """
-        self.min = min(self.min, value)
-        self.max = max(self.max, value)
-        self.ave = (((self.ave * (self.count - 1)) + value) / self.count)
-        self.count += 1
+        if now is None:
+            now = time.time()
+        self.histogram.add_value(value)
+        slotnum = int(now // self.slot_length)
+        idx = slotnum % self.window_slots
+        if self.slots[idx][0] != slotnum:
+            self.slots[idx] = (slotnum, Histogram())
+        self.slots[idx][1].add_value(value)
+
+    def get_histogram(self, window=None, now=None):
+        """ get a :class:`Histogram` of all values, or of the values
+        added in the last ``window`` minutes.  ``window`` is limited
+        to :attr:`window_slots` slots. """
+        if not window:
+            return self.histogram
+        if now is None:
+            now = time.time()
+        current = int(now // self.slot_length)
+        first = current - min(int(math.ceil(window * 60.0 /
+                                            self.slot_length)),
+                              self.window_slots) + 1
+        rv = Histogram()
+        for slotnum, hist in self.slots:
+            if slotnum is not None and first <= slotnum <= current:
+                rv.update(hist)
+        return rv
 
-    def get_value(self):
-        """ get a tuple of all the stats tracked on this named item """
-        return (self.name, (self.min, self.max, self.ave, self.count))
+    def get_value(self, window=None, now=None):
+        """ get a tuple of all the stats tracked on this named item.
+        the count is always last, so that callers that only know
+        about minimum, maximum, and average can still find it. """
+        hist = self.get_histogram(window=window, now=now)
+        if not hist.count:
+            return (self.name, None)
+        return (self.name,
+                tuple([hist.min, hist.max, hist.mean()] +
+                      [hist.percentile(p) for p in self.percentiles] +
+                      [hist.count]))
 
 
 class Statistics(object):
     """ A collection of named statistics """
     def __init__(self):
         self.data = dict()
+        self.lock = threading.Lock()
 
     def add_value(self, name, value):
         """ add a value to the named statistic """
-        if name not in self.data:
-            self.data[name] = Statistic(name, value)
-        else:
-            self.data[name].add_value(value)
+        self.lock.acquire()
+        try:
+            if name not in self.data:
+                self.data[name] = Statistic(name, value)
+            else:
+                self.data[name].add_value(value)
+        finally:
+            self.lock.release()
 
-    def display(self):
-        """ return a dict of all statistics """
-        return dict([value.get_value() for value in list(self.data.values())])
+    def display(self, window=None):
+        """ return a dict of all statistics, or of the statistics for
+        values added in the last ``window`` minutes """
+        self.lock.acquire()
+        try:
+            values = [stat.get_value(window=window)
+                      for stat in list(self.data.values())]
+        finally:
+            self.lock.release()
+        return dict([value for value in values if value[1] is not None])
 
 
 stats = Statistics()  # pylint: disable=C0103
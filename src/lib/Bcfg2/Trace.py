@@ -0,0 +1,141 @@
+""" module for recording hierarchical timing traces of single client
+runs on the bcfg2 server.  Tracing is enabled per-thread by
+:func:`start_trace`; when no trace is active in the current thread,
+:func:`start` and :func:`end` do nothing but a single attribute
+lookup, so they can be left in place on hot code paths. """
+
+import time
+import threading
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+_local = threading.local()  # pylint: disable=C0103
+
+
+class Span(object):
+    """ a single timed operation in a trace, along with the
+    operations that were performed while it ran """
+
+    def __init__(self, name, parent=None, attrs=None):
+        self.name = name
+        self.parent = parent
+        if attrs is None:
+            attrs = dict()
+        self.attrs = attrs
+        self.children = []
+        self.thread = threading.currentThread().getName()
+        self.start = time.time()
+        self.end = None
+
+    def finish(self):
+        """ record the end time of the span """
+        self.end = time.time()
+
+    @property
+    def duration(self):
+        """ the length of the span in seconds, or None if it has not
+        finished """
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    def to_dict(self):
+        """ get the span and its children as a dict suitable for
+        dumping as JSON """
+        return dict(name=self.name,
+                    start=self.start,
+                    duration=self.duration,
+                    thread=self.thread,
+                    attrs=self.attrs,
+                    children=[c.to_dict() for c in self.children])
+
+    def to_chrome(self, origin=None, tids=None):
+        """ get the span and its children as a list of "complete"
+        events in the Chrome trace event format, which can be loaded
+        in ``chrome://tracing`` and similar tools """
+        if origin is None:
+            origin = self.start
+        if tids is None:
+            tids = dict()
+        rv = []
+        if self.thread not in tids:
+            tids[self.thread] = len(tids)
+            rv.append(dict(name="thread_name", ph="M", pid=1,
+                           tid=tids[self.thread],
+                           args=dict(name=self.thread)))
+        end = self.end
+        if end is None:
+            end = time.time()
+        rv.append(dict(name=self.name,
+                       cat="bcfg2",
+                       ph="X",
+                       ts=int((self.start - origin) * 1000000),
+                       dur=int((end - self.start) * 1000000),
+                       pid=1,
+                       tid=tids[self.thread],
+                       args=self.attrs))
+        for child in self.children:
+            rv.extend(child.to_chrome(origin=origin, tids=tids))
+        return rv
+
+
+def current():
+    """ get the active span in the current thread, or None if no
+    trace is active """
+    return getattr(_local, "span", None)
+
+
+def set_current(span):
+    """ make ``span`` the active span in the current thread, e.g., to
+    continue a trace in a worker thread.
+
+    :returns: The previously active span """
+    old = current()
+    _local.span = span
+    return old
+
+
+def start_trace(spanname, **attrs):
+    """ start a new trace in the current thread.  keyword arguments
+    are recorded as attributes of the root span.
+
+    :returns: :class:`Span` - the root span of the trace """
+    span = Span(spanname, attrs=attrs)
+    _local.span = span
+    return span
+
+
+def start(spanname, **attrs):
+    """ start a span as a child of the active span, if a trace is
+    active in the current thread.  keyword arguments are recorded as
+    attributes of the span.
+
+    :returns: :class:`Span`, or None if no trace is active """
+    parent = getattr(_local, "span", None)
+    if parent is None:
+        return None
+    span = Span(spanname, parent=parent, attrs=attrs)
+    parent.children.append(span)
+    _local.span = span
+    return span
+
+
+def end(span):
+    """ finish the given span, which must have been returned by
+    :func:`start` or :func:`start_trace`, and make its parent the
+    active span again.  ending the root span ends the trace. """
+    if span is None:
+        return
+    span.finish()
+    _local.span = span.parent
+
+
+def dump(span, chrome=False):
+    """ dump a trace as JSON, either as a tree of spans or in the
+    Chrome trace event format """
+    if chrome:
+        return json.dumps(dict(traceEvents=span.to_chrome()))
+    return json.dumps(span.to_dict())
@@ -0,0 +1,191 @@
+""" Miscellaneous useful utility functions, classes, etc., that are
+used by both client and server. """
+
+import os
+import sys
+import signal
+import threading
+from subprocess import Popen, PIPE
+from Bcfg2.Compat import Queue
+
+#: The XML-RPC fault code the server returns when it is too busy to
+#: handle a call.  The fault string says how many seconds to wait
+#: before retrying.
+SERVER_BUSY = 503
+
+
+class _Batch(object):
+    """ bookkeeping for a single :func:`WorkerPool.map` call """
+
+    def __init__(self, count):
+        self.remaining = count
+        self.results = [None] * count
+        self.error = None
+        self.cond = threading.Condition()
+
+    def finish(self, idx, result=None, error=None):
+        """ record the result of the job at position ``idx`` """
+        self.cond.acquire()
+        try:
+            self.results[idx] = result
+            if error is not None and self.error is None:
+                self.error = error
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def wait(self):
+        """ block until all jobs in the batch have finished """
+        self.cond.acquire()
+        try:
+            while self.remaining:
+                self.cond.wait()
+        finally:
+            self.cond.release()
+
+
+class WorkerPool(object):
+    """ A fixed-size pool of daemon threads that run jobs from a
+    shared queue.  Threads are not started until the pool is first
+    used, so a pool can safely be created before a process forks. """
+
+    def __init__(self, size, name="WorkerPool"):
+        """
+        :param size: The number of worker threads
+        :type size: int
+        :param name: A name for the pool, used to name its threads
+        :type name: string
+        """
+        self.size = size
+        self.name = name
+        self.queue = Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        """ start the worker threads, if they are not running
+        already """
+        self.lock.acquire()
+        try:
+            while len(self.threads) < self.size:
+                thread = threading.Thread(name="%s-%d" % (self.name,
+                                                          len(self.threads)),
+                                          target=self._work)
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+        finally:
+            self.lock.release()
+
+    def _work(self):
+        """ the main loop of each worker thread """
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            batch, idx, func, args = job
+            try:
+                batch.finish(idx, result=func(*args))
+            except:  # pylint: disable=W0702
+                batch.finish(idx, error=sys.exc_info())
+
+    def map(self, func, items):
+        """ Call ``func`` on each item in ``items`` in the worker
+        threads, and wait for all of the calls to finish.  If any call
+        raises an exception, the first such exception is re-raised
+        once all calls have finished.
+
+        :returns: list - the return values, in the order of ``items``
+        """
+        items = list(items)
+        if not items:
+            return []
+        self.start()
+        batch = _Batch(len(items))
+        for idx in range(len(items)):
+            self.queue.put((batch, idx, func, (items[idx],)))
+        batch.wait()
+        if batch.error is not None:
+            raise batch.error[1]
+        return batch.results
+
+    def shutdown(self):
+        """ stop all worker threads once the jobs currently queued
+        have finished """
+        self.lock.acquire()
+        try:
+            for _ in self.threads:
+                self.queue.put(None)
+            self.threads = []
+        finally:
+            self.lock.release()
+
+
+def _find_setsid():
+    """ find the setsid(1) command, or return None if it isn't
+    installed """
+    path = os.environ.get('PATH', os.defpath).split(os.pathsep)
+    for pathdir in path + ['/usr/bin', '/bin']:
+        setsid = os.path.join(pathdir, 'setsid')
+        if os.path.isfile(setsid) and os.access(setsid, os.X_OK):
+            return setsid
+    return None
+
+#: The setsid(1) command that :func:`run_with_timeout` uses to run
+#: commands that have a timeout in their own session, or None if it
+#: isn't available
+SETSID = _find_setsid()
+
+
+def _kill_session(proc, killed):
+    """ kill a process started by :func:`run_with_timeout` that has
+    timed out, along with everything it started """
+    killed.append(True)
+    try:
+        if SETSID:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+                return
+            except OSError:
+                # the process may not have started its session yet
+                pass
+        os.kill(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def run_with_timeout(command, timeout=None):
+    """ Run a command, and kill it if it runs for longer than
+    ``timeout`` seconds.  If a timeout is given, the command is run
+    in its own session with setsid(1), where that is available, so
+    that everything it started is killed along with it.  The command
+    doesn't inherit any other file descriptors, which makes it safe to
+    run several commands at once from different threads.
+
+    :param command: The command and its arguments
+    :type command: list of strings
+    :param timeout: The number of seconds to let the command run, or
+                    None to let it run for as long as it likes
+    :type timeout: int
+    :returns: tuple of (<return code>, <stdout>, <stderr>, <bool
+              timed out>)
+    """
+    if timeout and SETSID:
+        command = [SETSID] + list(command)
+    proc = Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                 close_fds=True)
+    killed = []
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, _kill_session, args=(proc, killed))
+        timer.setDaemon(True)
+        timer.start()
+    try:
+        stdout, stderr = proc.communicate()
+        rv = proc.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+    return (rv, stdout, stderr, bool(killed))
@@ -0,0 +1,146 @@
+import os
+import sys
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+from Bcfg2.Cache import *
+
+
+class TestCache(Bcfg2TestCase):
+    test_obj = Cache
+
+    def test_expire(self):
+        cache = self.test_obj()
+        cache['foo'] = 1
+        cache['bar'] = 2
+        cache.expire('foo')
+        self.assertNotIn('foo', cache)
+        self.assertIn('bar', cache)
+
+        # expiring a key that isn't cached is a no-op
+        cache.expire('foo')
+        self.assertIn('bar', cache)
+
+        cache.expire()
+        self.assertEqual(len(cache), 0)
+
+
+class TestDependencyCache(TestCache):
+    test_obj = DependencyCache
+
+    def get_obj(self):
+        cache = self.test_obj()
+        cache.track_path("/repo/Cfg")
+        cache.ignore_path("/repo/Probes/probed.xml")
+        cache['foo'] = 1
+        cache['bar'] = 2
+        cache['baz'] = 3
+        cache.add_dependency('foo', "/repo/Cfg/etc/motd")
+        cache.add_dependency('foo', "/repo/Cfg/etc/issue/")
+        cache.add_dependency('bar', "/repo/Cfg/etc/motd")
+        cache.add_dependency('baz', "/repo/Cfg/etc/hosts")
+        return cache
+
+    def test_expire(self):
+        TestCache.test_expire(self)
+
+        cache = self.get_obj()
+        generation = cache.generation
+        cache.expire('foo')
+        self.assertNotIn('foo', cache)
+        self.assertNotIn('foo', cache.dependencies)
+        self.assertItemsEqual(cache.dependents["/repo/Cfg/etc/motd"],
+                              ['bar'])
+        self.assertNotIn("/repo/Cfg/etc/issue", cache.dependents)
+        self.assertEqual(cache.generation, generation)
+
+        cache.expire()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.dependents, dict())
+        self.assertEqual(cache.dependencies, dict())
+        self.assertGreater(cache.generation, generation)
+
+    def test_is_tracked(self):
+        cache = self.get_obj()
+        self.assertTrue(cache.is_tracked("/repo/Cfg"))
+        self.assertTrue(cache.is_tracked("/repo/Cfg/etc/motd/motd"))
+        self.assertFalse(cache.is_tracked("/repo/Cfgfoo"))
+        self.assertFalse(cache.is_tracked("/repo/Bundler/foo.xml"))
+
+    def test_is_ignored(self):
+        cache = self.get_obj()
+        self.assertTrue(cache.is_ignored("/repo/Probes/probed.xml"))
+        self.assertTrue(cache.is_ignored("/repo/Probes//probed.xml"))
+        self.assertFalse(cache.is_ignored("/repo/Probes/probed.xml.bak"))
+        self.assertFalse(cache.is_ignored("/repo/Probes/fqdn"))
+        self.assertFalse(cache.is_ignored("/repo/Cfg/etc/motd"))
+
+    def test_expire_path(self):
+        # changes to untracked paths expire everything
+        cache = self.get_obj()
+        self.assertIsNone(cache.expire_path("/repo/Rules/services.xml"))
+        self.assertEqual(len(cache), 0)
+
+        # a change to a file in a directory that is depended upon
+        cache = self.get_obj()
+        generation = cache.generation
+        self.assertItemsEqual(
+            cache.expire_path("/repo/Cfg/etc/motd/motd.H_foo"),
+            ['foo', 'bar'])
+        self.assertItemsEqual(cache.keys(), ['baz'])
+        self.assertGreater(cache.generation, generation)
+
+        # a change to a directory that contains dependencies
+        cache = self.get_obj()
+        self.assertItemsEqual(cache.expire_path("/repo/Cfg/etc"),
+                              ['foo', 'bar', 'baz'])
+
+        # a change to a tracked path that nothing depends on
+        cache = self.get_obj()
+        generation = cache.generation
+        self.assertEqual(cache.expire_path("/repo/Cfg/etc/fstab/fstab"), [])
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.generation, generation)
+
+        # changes to ignored paths expire nothing
+        cache = self.get_obj()
+        generation = cache.generation
+        self.assertEqual(cache.expire_path("/repo/Probes/probed.xml"), [])
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.generation, generation)
+
+
+class TestLRUCache(TestCache):
+    test_obj = LRUCache
+
+    def test_get(self):
+        cache = self.test_obj(maxsize=2)
+        cache['foo'] = 1
+        cache['bar'] = 2
+        self.assertEqual(cache.get('foo'), 1)
+        self.assertIsNone(cache.get('baz'))
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+
+        # bar is now the least recently used item
+        cache['baz'] = 3
+        self.assertItemsEqual(cache.keys(), ['foo', 'baz'])
+        self.assertItemsEqual(cache.used.keys(), ['foo', 'baz'])
+
+        cache['foo'] = 4
+        cache['quux'] = 5
+        self.assertItemsEqual(cache.keys(), ['foo', 'quux'])
+        self.assertEqual(cache.get('foo'), 4)
+
+        del cache['foo']
+        cache.expire('quux')
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.used, dict())
@@ -0,0 +1,237 @@
+import os
+import sys
+import shutil
+import tempfile
+import lxml.etree
+from mock import Mock, MagicMock, patch
+from Bcfg2.Compat import md5
+from Bcfg2.Utils import WorkerPool
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+try:
+    from Bcfg2.Client.Tools.APT import APT
+    HAS_APT = True
+except ImportError:
+    HAS_APT = False
+
+
+def checksum(data):
+    return md5(data.encode("UTF-8")).hexdigest()
+
+
+class TestAPT(Bcfg2TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmpdir, "root")
+        self.dpkg_path = os.path.join(self.tmpdir, "dpkg")
+        os.makedirs(os.path.join(self.dpkg_path, "info"))
+
+        # foo: one good, one changed and one missing file, a good
+        # conffile, an obsolete conffile and a new conffile
+        self.write_file("usr/bin/foo", "foo")
+        self.write_file("usr/bin/foo-changed", "changed")
+        self.write_file("etc/foo.conf", "foo.conf")
+        self.write_md5sums("foo", [("usr/bin/foo", "foo"),
+                                   ("usr/bin/foo-changed", "original"),
+                                   ("usr/bin/foo-missing", "missing")])
+        # bar: multi-arch, with a changed file in one architecture
+        self.write_file("usr/lib/x86_64/libbar.so", "bar64")
+        self.write_file("usr/lib/i386/libbar.so", "changed")
+        self.write_md5sums("bar:amd64", [("usr/lib/x86_64/libbar.so",
+                                          "bar64")])
+        self.write_md5sums("bar:i386", [("usr/lib/i386/libbar.so",
+                                         "bar32")])
+        # baz: no md5sums at all
+        # qux: a file that has been diverted by another package
+        self.write_file("usr/share/qux/data", "diverted")
+        self.write_file("usr/share/qux/data.distrib", "data")
+        self.write_md5sums("qux", [("usr/share/qux/data", "data")])
+        # quux: only a changed conffile
+        self.write_file("etc/quux.conf", "changed")
+
+        status = open(os.path.join(self.dpkg_path, "status"), "w")
+        status.write("""Package: foo
+Status: install ok installed
+Conffiles:
+ %s %s
+ %s %s obsolete
+ %s newconffile
+Description: foo
+ conffiles in the description aren't conffiles
+ /etc/foo.conf 00000000000000000000000000000000
+
+Package: unrelated
+Status: install ok installed
+Conffiles:
+ %s %s
+
+Package: quux
+Status: install ok installed
+Conffiles:
+ %s %s
+""" % (self.path("etc/foo.conf"), checksum("foo.conf"),
+       self.path("etc/foo.old"), checksum("foo.old"),
+       self.path("etc/foo.new"),
+       self.path("etc/unrelated.conf"), checksum("unrelated"),
+       self.path("etc/quux.conf"), checksum("quux.conf")))
+        status.close()
+
+        diversions = open(os.path.join(self.dpkg_path, "diversions"), "w")
+        diversions.write("%s\n%s\nother\n" %
+                         (self.path("usr/share/qux/data"),
+                          self.path("usr/share/qux/data.distrib")))
+        diversions.close()
+
+        self.expected = dict(
+            foo=[('changed', self.path("usr/bin/foo-changed")),
+                 ('missing', self.path("usr/bin/foo-missing"))],
+            bar=[('changed', self.path("usr/lib/i386/libbar.so"))],
+            baz=None,
+            qux=[],
+            quux=[('changed', self.path("etc/quux.conf"))])
+
+        # the output of "debsums -as" for each package
+        self.debsums_output = dict(
+            foo=["debsums: changed file %s (from foo package)" %
+                 self.path("usr/bin/foo-changed"),
+                 "debsums: missing file %s (from foo package)" %
+                 self.path("usr/bin/foo-missing")],
+            bar=["debsums: changed file %s (from bar:i386 package)" %
+                 self.path("usr/lib/i386/libbar.so")],
+            baz=["debsums: no md5sums for baz"],
+            qux=[],
+            quux=["debsums: changed file %s (from quux package)" %
+                  self.path("etc/quux.conf")])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, relpath):
+        return os.path.join(self.root, relpath)
+
+    def write_file(self, relpath, data):
+        fpath = self.path(relpath)
+        if not os.path.exists(os.path.dirname(fpath)):
+            os.makedirs(os.path.dirname(fpath))
+        open(fpath, "w").write(data)
+
+    def write_md5sums(self, pkgname, files):
+        sumfile = open(os.path.join(self.dpkg_path, "info",
+                                    "%s.md5sums" % pkgname), "w")
+        for relpath, data in files:
+            sumfile.write("%s  %s\n" % (checksum(data),
+                                        self.path(relpath).lstrip("/")))
+        sumfile.close()
+
+    def get_obj(self):
+        apt = APT.__new__(APT)
+        apt.logger = Mock()
+        apt.setup = MagicMock()
+        apt.cmd = Mock()
+        apt.debsums = "/usr/bin/debsums"
+        apt.dpkg_path = self.dpkg_path
+        apt.debsums_pool = WorkerPool(2)
+        apt.debsums_cache = None
+        apt.debsums_results = dict()
+        apt.nonexistent = []
+        apt.ignores = []
+        return apt
+
+    @skipUnless(HAS_APT, "python-apt not found, skipping")
+    def test__read_conffiles(self):
+        apt = self.get_obj()
+        self.assertEqual(apt._read_conffiles(set(["foo", "quux"])),
+                         dict(foo=[(self.path("etc/foo.conf"),
+                                    checksum("foo.conf"))],
+                              quux=[(self.path("etc/quux.conf"),
+                                     checksum("quux.conf"))]))
+
+    @skipUnless(HAS_APT, "python-apt not found, skipping")
+    def test__read_md5sums(self):
+        apt = self.get_obj()
+        self.assertItemsEqual(
+            apt._read_md5sums("bar"),
+            [(self.path("usr/lib/x86_64/libbar.so"), checksum("bar64")),
+             (self.path("usr/lib/i386/libbar.so"), checksum("bar32"))])
+        self.assertIsNone(apt._read_md5sums("baz"))
+
+    @skipUnless(HAS_APT, "python-apt not found, skipping")
+    def test__read_diversions(self):
+        apt = self.get_obj()
+        self.assertEqual(apt._read_diversions(),
+                         {self.path("usr/share/qux/data"):
+                          (self.path("usr/share/qux/data.distrib"),
+                           "other")})
+        os.unlink(os.path.join(self.dpkg_path, "diversions"))
+        self.assertEqual(apt._read_diversions(), dict())
+
+    @skipUnless(HAS_APT, "python-apt not found, skipping")
+    def test_BatchDebsums(self):
+        apt = self.get_obj()
+        results = apt.BatchDebsums(list(self.expected.keys()))
+        self.assertItemsEqual(results.keys(), self.expected.keys())
+        for pkgname, expected in self.expected.items():
+            if expected is None:
+                self.assertIsNone(results[pkgname])
+            else:
+                self.assertItemsEqual(results[pkgname], expected)
+
+    @skipUnless(HAS_APT, "python-apt not found, skipping")
+    def test_BatchDebsums_cache(self):
+        apt = self.get_obj()
+        apt.debsums_cache = os.path.join(self.tmpdir, "debsums.cache")
+        # use a whole-second mtime so that it can be set again exactly
+        fpath = self.path("usr/share/qux/data.distrib")
+        os.utime(fpath, (1000000000, 1000000000))
+        self.assertEqual(apt.BatchDebsums(["qux"]), dict(qux=[]))
+        self.assertTrue(os.path.exists(apt.debsums_cache))
+
+        # a file whose size and mtime haven't changed isn't read again
+        open(fpath, "w").write("atad")
+        os.utime(fpath, (1000000000, 1000000000))
+        self.assertEqual(apt.BatchDebsums(["qux"]), dict(qux=[]))
+
+        # but one whose mtime has changed is
+        os.utime(fpath, (1000000010, 1000000010))
+        self.assertEqual(apt.BatchDebsums(["qux"]),
+                         dict(qux=[('changed', fpath)]))
+
+        # an unreadable cache is ignored
+        open(apt.debsums_cache, "w").write("garbage")
+        self.assertEqual(apt.BatchDebsums(["qux"]),
+                         dict(qux=[('changed', fpath)]))
+
+    @skipUnless(HAS_APT, "python-apt not found, skipping")
+    def test_VerifyDebsums(self):
+        """ BatchDebsums gets the same verdicts as debsums -as """
+        apt = self.get_obj()
+        batch = apt.BatchDebsums(list(self.expected.keys()))
+        for pkgname, output in self.debsums_output.items():
+            apt.cmd.run.return_value = (0, output)
+            self.assertItemsEqual(apt._run_debsums(pkgname) or [],
+                                  batch[pkgname] or [])
+
+            entry = lxml.etree.Element("Package", name=pkgname,
+                                       version="1.0")
+            apt.debsums_results = dict()
+            expected = apt.VerifyDebsums(entry, [])
+            expected_qtext = entry.get("qtext")
+
+            entry = lxml.etree.Element("Package", name=pkgname,
+                                       version="1.0")
+            apt.debsums_results = batch
+            self.assertEqual(apt.VerifyDebsums(entry, []), expected)
+            self.assertEqual(entry.get("qtext"), expected_qtext)
+        # debsums was only run when there were no batch results
+        self.assertEqual(apt.cmd.run.call_count,
+                         2 * len(self.debsums_output))
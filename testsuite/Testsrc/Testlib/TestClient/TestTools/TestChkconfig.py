@@ -0,0 +1,114 @@
+import os
+import sys
+import lxml.etree
+from mock import Mock, MagicMock, patch
+from Bcfg2.Client.Tools.Chkconfig import Chkconfig
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+
+CHKCONFIG_LIST = """
+Note: This output shows SysV services only and does not include native
+      systemd services. SysV configuration data might be overridden by native
+      systemd configuration.
+
+netconsole     \t0:off\t1:off\t2:off\t3:off\t4:off\t5:off\t6:off
+network        \t0:off\t1:off\t2:on\t3:on\t4:on\t5:on\t6:off
+sshd           \t0:off\t1:off\t2:on\t3:on\t4:on\t5:on\t6:off
+
+xinetd based services:
+\tchargen-dgram: \toff
+\ttftp:          \ton
+""".splitlines()
+
+
+def get_service(name, status="on"):
+    return lxml.etree.Element("Service", name=name, type="chkconfig",
+                              status=status)
+
+
+class TestChkconfig(Bcfg2TestCase):
+    test_obj = Chkconfig
+
+    @patch("Bcfg2.Client.Tools.Chkconfig.Chkconfig.__execs__", [])
+    def get_obj(self, config=None):
+        if config is None:
+            config = lxml.etree.Element("Configuration")
+        tool = self.test_obj(Mock(), MagicMock(), config)
+        tool.cmd = Mock()
+        return tool
+
+    def test_gather_service_status(self):
+        tool = self.get_obj()
+        tool.cmd.run.return_value = (0, CHKCONFIG_LIST)
+        status = tool.gather_service_status([get_service("sshd")])
+        tool.cmd.run.assert_called_once_with(
+            "/sbin/chkconfig --list 2>/dev/null")
+        # the note and the xinetd header are skipped
+        self.assertItemsEqual(status.keys(),
+                              ["netconsole", "network", "sshd",
+                               "chargen-dgram", "tftp"])
+        self.assertEqual(status['sshd'],
+                         ["sshd", "0:off", "1:off", "2:on", "3:on", "4:on",
+                          "5:on", "6:off"])
+        self.assertEqual(status['tftp'], ["tftp", "on"])
+        self.assertEqual(status['chargen-dgram'], ["chargen-dgram", "off"])
+
+        tool.cmd.run.return_value = (1, [])
+        self.assertEqual(tool.gather_service_status([get_service("sshd")]),
+                         dict())
+
+    def test_VerifyService(self):
+        tool = self.get_obj()
+        tool.cmd.run.return_value = (0, CHKCONFIG_LIST)
+        tool.service_status = tool.gather_service_status([])
+        tool.cmd.run.reset_mock()
+
+        # xinetd services don't need to be checked any further
+        entry = get_service("tftp")
+        self.assertTrue(tool.VerifyService(entry, []))
+        entry = get_service("chargen-dgram")
+        self.assertFalse(tool.VerifyService(entry, []))
+        self.assertEqual(entry.get("current_status"), "off")
+        self.assertFalse(tool.cmd.run.called)
+
+        # services that are off in every runlevel but should be on
+        # aren't checked to see if they are running
+        entry = get_service("netconsole")
+        self.assertFalse(tool.VerifyService(entry, []))
+        self.assertEqual(entry.get("current_status"), "off")
+        self.assertFalse(tool.cmd.run.called)
+
+        # services that are on are
+        tool.cmd.run.return_value = (0, [])
+        self.assertTrue(tool.VerifyService(get_service("sshd"), []))
+        tool.cmd.run.assert_called_once_with("/sbin/service sshd status")
+
+        # services that aren't in the snapshot are checked on their own
+        tool.cmd.run.reset_mock()
+        tool.cmd.run.return_value = (1, [])
+        entry = get_service("bogus")
+        self.assertFalse(tool.VerifyService(entry, []))
+        self.assertEqual(entry.get("current_status"), "off")
+        tool.cmd.run.assert_called_once_with("/sbin/chkconfig --list bogus ")
+
+    def test_FindExtra(self):
+        config = lxml.etree.Element("Configuration")
+        bundle = lxml.etree.SubElement(config, "Bundle", name="test")
+        bundle.append(get_service("sshd"))
+        tool = self.get_obj(config=config)
+        tool.cmd.run.return_value = (0, CHKCONFIG_LIST)
+        tool.service_status = tool.gather_service_status([])
+        tool.cmd.run.reset_mock()
+        self.assertEqual([e.get("name") for e in tool.FindExtra()],
+                         ["network"])
+        self.assertFalse(tool.cmd.run.called)
@@ -40,6 +40,34 @@ class TestPOSIXFile(TestPOSIXTool):
         entry.set("empty", "false")
         entry.text = "text"
         self.assertTrue(self.ptool.fully_specified(entry))
+
+        entry = lxml.etree.Element("Path", name="/test", type="file",
+                                   digest="d8e8fca2dc0f896fd7cb4cb0031ba249")
+        self.assertTrue(self.ptool.fully_specified(entry))
+
+    @patch("%s.open" % builtins)
+    def test_file_digest(self, mock_open):
+        mock_open.return_value.read.side_effect = ["te", "st", "\n", ""]
+        self.assertEqual(file_digest("/test", chunk_size=2),
+                         "d8e8fca2dc0f896fd7cb4cb0031ba249")
+        mock_open.assert_called_with("/test", "rb")
+        mock_open.return_value.read.assert_called_with(2)
+        self.assertTrue(mock_open.return_value.close.called)
+
+    @patch("Bcfg2.Client.Tools.POSIX.File.file_digest")
+    def test__verify_digest(self, mock_file_digest):
+        entry = lxml.etree.Element("Path", name="/test", type="file",
+                                   digest="d8e8fca2dc0f896fd7cb4cb0031ba249")
+        mock_file_digest.return_value = entry.get("digest")
+        self.assertFalse(self.ptool._verify_digest(entry))
+        mock_file_digest.assert_called_with(entry.get("name"),
+                                            chunk_size=self.ptool.chunk_size)
+
+        mock_file_digest.return_value = "0" * 32
+        self.assertTrue(self.ptool._verify_digest(entry))
+
+        mock_file_digest.side_effect = IOError
+        self.assertTrue(self.ptool._verify_digest(entry))
     
     def test_is_string(self):
         for char in list(range(8)) + list(range(14, 32)):
@@ -81,23 +109,23 @@ class TestPOSIXFile(TestPOSIXTool):
         entry.text = ustr
         self.assertEqual(ptool._get_data(entry), (ustr, False))
 
-    @patch("%s.open" % builtins)
     @patch("Bcfg2.Client.Tools.POSIX.base.POSIXTool.verify")
     @patch("Bcfg2.Client.Tools.POSIX.File.%s._exists" % test_obj.__name__)
     @patch("Bcfg2.Client.Tools.POSIX.File.%s._get_data" % test_obj.__name__)
     @patch("Bcfg2.Client.Tools.POSIX.File.%s._get_diffs" % test_obj.__name__)
-    def test_verify(self, mock_get_diffs, mock_get_data, mock_exists,
-                    mock_verify, mock_open):
+    @patch("Bcfg2.Client.Tools.POSIX.File.%s._compare" % test_obj.__name__)
+    def test_verify(self, mock_compare, mock_get_diffs, mock_get_data,
+                    mock_exists, mock_verify):
         entry = lxml.etree.Element("Path", name="/test", type="file")
         setup = dict(interactive=False, ppath='/', max_copies=5)
         ptool = self.get_obj(posix=get_posix_object(setup=setup))
 
         def reset():
+            mock_compare.reset_mock()
             mock_get_diffs.reset_mock()
             mock_get_data.reset_mock()
             mock_exists.reset_mock()
             mock_verify.reset_mock()
-            mock_open.reset_mock()
 
         mock_get_data.return_value = ("test", False)
         mock_exists.return_value = False
@@ -105,6 +133,7 @@ class TestPOSIXFile(TestPOSIXTool):
         self.assertFalse(ptool.verify(entry, []))
         mock_exists.assert_called_with(entry)
         mock_verify.assert_called_with(ptool, entry, [])
+        self.assertFalse(mock_compare.called)
         mock_get_diffs.assert_called_with(entry, interactive=False,
                                           sensitive=False,
                                           is_binary=False,
@@ -118,41 +147,86 @@ class TestPOSIXFile(TestPOSIXTool):
         self.assertFalse(ptool.verify(entry, []))
         mock_exists.assert_called_with(entry)
         mock_verify.assert_called_with(ptool, entry, [])
+        self.assertFalse(mock_compare.called)
         mock_get_diffs.assert_called_with(entry, interactive=False,
                                           sensitive=False,
                                           is_binary=True,
                                           content=None)
-        
+
         reset()
         mock_get_data.return_value = ("test", False)
         exists_rv.__getitem__.return_value = 4
         entry.set("sensitive", "true")
-        mock_open.return_value.read.return_value = "tart"
+        mock_compare.return_value = True
         self.assertFalse(ptool.verify(entry, []))
         mock_exists.assert_called_with(entry)
         mock_verify.assert_called_with(ptool, entry, [])
-        mock_open.assert_called_with(entry.get("name"))
-        mock_open.return_value.read.assert_called_with()
+        mock_compare.assert_called_with(entry, "test")
         mock_get_diffs.assert_called_with(entry, interactive=False,
                                           sensitive=True,
                                           is_binary=False,
-                                          content="tart")
+                                          content=None)
 
         reset()
-        mock_open.return_value.read.return_value = "test"
+        mock_compare.return_value = False
         self.assertTrue(ptool.verify(entry, []))
         mock_exists.assert_called_with(entry)
         mock_verify.assert_called_with(ptool, entry, [])
-        mock_open.assert_called_with(entry.get("name"))
-        mock_open.return_value.read.assert_called_with()
+        mock_compare.assert_called_with(entry, "test")
         self.assertFalse(mock_get_diffs.called)
 
         reset()
-        mock_open.side_effect = IOError
+        mock_compare.return_value = None
         self.assertFalse(ptool.verify(entry, []))
         mock_exists.assert_called_with(entry)
-        mock_open.assert_called_with(entry.get("name"))
-    
+        mock_compare.assert_called_with(entry, "test")
+        self.assertFalse(mock_get_diffs.called)
+
+        # contents omitted by the server; verify by digest
+        entry = lxml.etree.Element("Path", name="/test", type="file",
+                                   digest="d8e8fca2dc0f896fd7cb4cb0031ba249")
+        for different in [True, False]:
+            reset()
+            ptool._verify_digest = Mock(return_value=different)
+            self.assertEqual(ptool.verify(entry, []), not different)
+            ptool._verify_digest.assert_called_with(entry)
+            mock_verify.assert_called_with(ptool, entry, [])
+            self.assertFalse(mock_get_data.called)
+            self.assertFalse(mock_compare.called)
+            self.assertFalse(mock_get_diffs.called)
+
+    @patch("%s.open" % builtins)
+    def test__compare(self, mock_open):
+        entry = lxml.etree.Element("Path", name="/test", type="file")
+        ptool = self.get_obj()
+        ptool.chunk_size = 4
+
+        def compare(ondisk, data):
+            chunks = [ondisk[i:i + ptool.chunk_size]
+                      for i in range(0, len(ondisk), ptool.chunk_size)]
+            mock_open.reset_mock()
+            mock_open.return_value.read.side_effect = chunks + [""]
+            rv = ptool._compare(entry, data)
+            mock_open.assert_called_with(entry.get("name"))
+            mock_open.return_value.read.assert_called_with(ptool.chunk_size)
+            self.assertTrue(mock_open.return_value.close.called)
+            return rv
+
+        self.assertFalse(compare("test data", "test data"))
+        self.assertFalse(compare("", ""))
+        self.assertTrue(compare("test data", "test date"))
+        self.assertTrue(compare("tost data", "test data"))
+        self.assertTrue(compare("test", "test data"))
+        self.assertTrue(compare("test data", "test"))
+
+        # stop reading at the first difference
+        self.assertTrue(compare("tost data", "test data"))
+        self.assertEqual(mock_open.return_value.read.call_count, 1)
+
+        mock_open.reset_mock()
+        mock_open.side_effect = IOError
+        self.assertIsNone(ptool._compare(entry, "test"))
+
     @patch("os.fdopen")
     @patch("tempfile.mkstemp")
     @patch("Bcfg2.Client.Tools.POSIX.File.%s._get_data" % test_obj.__name__)
@@ -223,7 +297,8 @@ class TestPOSIXFile(TestPOSIXTool):
                                         group='root')
         orig_entry.text = "test"
         ondisk = "test2"
-        setup = dict(encoding="utf-8", ppath='/', max_copies=5)
+        setup = dict(encoding="utf-8", ppath='/', max_copies=5,
+                     posix_diff_limit=10)
         ptool = self.get_obj(posix=get_posix_object(setup=setup))
 
         def reset():
@@ -242,7 +317,7 @@ class TestPOSIXFile(TestPOSIXTool):
         entry = reset()
         ptool._get_diffs(entry, is_binary=True)
         mock_open.assert_called_with(entry.get("name"))
-        mock_open.return_value.read.assert_any_call()
+        mock_open.return_value.read.assert_called_with(11)
         self.assertFalse(mock_diff.called)
         self.assertEqual(entry.get("current_bfile"), b64encode(ondisk))
 
@@ -266,9 +341,8 @@ class TestPOSIXFile(TestPOSIXTool):
         entry = reset()
         ptool._get_diffs(entry, sensitive=True, interactive=True)
         mock_open.assert_called_with(entry.get("name"))
-        mock_open.return_value.read.assert_any_call()
-        mock_diff.assert_called_with(ondisk, entry.text, difflib.unified_diff,
-                                     filename=entry.get("name"))
+        mock_open.return_value.read.assert_called_with(11)
+        mock_diff.assert_called_with(ondisk, entry.text, difflib.unified_diff)
         self.assertIsNotNone(entry.get("qtext"))
         del entry.attrib['qtext']
         self.assertItemsEqual(orig_entry.attrib, entry.attrib)
@@ -277,8 +351,7 @@ class TestPOSIXFile(TestPOSIXTool):
         entry = reset()
         ptool._get_diffs(entry, content=ondisk)
         self.assertFalse(mock_open.called)
-        mock_diff.assert_called_with(ondisk, entry.text, difflib.ndiff,
-                                     filename=entry.get("name"))
+        mock_diff.assert_called_with(ondisk, entry.text, fast_ndiff)
         self.assertIsNone(entry.get("qtext"))
         self.assertEqual(entry.get("current_bdiff"),
                          b64encode("\n".join(mock_diff.return_value)))
@@ -291,12 +364,11 @@ class TestPOSIXFile(TestPOSIXTool):
         entry.set("qtext", "test")
         ptool._get_diffs(entry, interactive=True)
         mock_open.assert_called_with(entry.get("name"))
-        mock_open.return_value.read.assert_any_call()
+        mock_open.return_value.read.assert_called_with(11)
         self.assertItemsEqual(mock_diff.call_args_list,
-                              [call(ondisk, entry.text, difflib.unified_diff,
-                                    filename=entry.get("name")),
-                               call(ondisk, entry.text, difflib.ndiff,
-                                    filename=entry.get("name"))])
+                              [call(ondisk, entry.text,
+                                    difflib.unified_diff),
+                               call(ondisk, entry.text, fast_ndiff)])
         self.assertIsNotNone(entry.get("qtext"))
         self.assertTrue(entry.get("qtext").startswith("test\n"))
         self.assertEqual(entry.get("current_bdiff"),
@@ -313,12 +385,10 @@ class TestPOSIXFile(TestPOSIXTool):
         mock_get_data.return_value = (encoded, False)
         ptool._get_diffs(entry, interactive=True)
         mock_open.assert_called_with(entry.get("name"))
-        mock_open.return_value.read.assert_any_call()
+        mock_open.return_value.read.assert_called_with(11)
         self.assertItemsEqual(mock_diff.call_args_list,
-                              [call(ondisk, encoded, difflib.unified_diff,
-                                    filename=entry.get("name")),
-                               call(ondisk, encoded, difflib.ndiff,
-                                    filename=entry.get("name"))])
+                              [call(ondisk, encoded, difflib.unified_diff),
+                               call(ondisk, encoded, fast_ndiff)])
         self.assertIsNotNone(entry.get("qtext"))
         self.assertEqual(entry.get("current_bdiff"),
                          b64encode("\n".join(mock_diff.return_value)))
@@ -326,6 +396,26 @@ class TestPOSIXFile(TestPOSIXTool):
         del entry.attrib["current_bdiff"]
         self.assertItemsEqual(orig_entry.attrib, entry.attrib)
 
+        # file on disk larger than the diff limit
+        entry = reset()
+        mock_get_data.return_value = (orig_entry.text, False)
+        mock_open.return_value.read.return_value = "x" * 11
+        ptool._get_diffs(entry, interactive=True)
+        mock_open.return_value.read.assert_called_with(11)
+        self.assertFalse(mock_is_string.called)
+        self.assertFalse(mock_diff.called)
+        self.assertIsNotNone(entry.get("qtext"))
+        del entry.attrib['qtext']
+        self.assertItemsEqual(orig_entry.attrib, entry.attrib)
+
+        # desired content larger than the diff limit
+        entry = reset()
+        mock_get_data.return_value = ("x" * 11, True)
+        ptool._get_diffs(entry, is_binary=True, content=ondisk)
+        self.assertFalse(mock_open.called)
+        self.assertFalse(mock_diff.called)
+        self.assertXMLEqual(entry, orig_entry)
+
     @patch("os.path.exists")
     @patch("Bcfg2.Client.Tools.POSIX.base.POSIXTool.install")
     @patch("Bcfg2.Client.Tools.POSIX.File.%s._makedirs" % test_obj.__name__)
@@ -414,33 +504,39 @@ class TestPOSIXFile(TestPOSIXTool):
         mock_rename.assert_called_with(newfile, entry)
         mock_install.assert_called_with(self.ptool, entry)
 
-    @patch("time.time")
-    def test_diff(self, mock_time):
+        # contents omitted by the server; only the metadata is fixed,
+        # and only if the contents are still correct
+        entry.set("digest", "d8e8fca2dc0f896fd7cb4cb0031ba249")
+        self.ptool._verify_digest = Mock()
+        reset()
+        self.ptool._verify_digest.return_value = True
+        self.assertFalse(self.ptool.install(entry))
+        self.ptool._verify_digest.assert_called_with(entry)
+        self.assertFalse(mock_write.called)
+        self.assertFalse(mock_install.called)
+
+        reset()
+        self.ptool._verify_digest.return_value = False
+        self.assertTrue(self.ptool.install(entry))
+        self.assertFalse(mock_write.called)
+        mock_install.assert_called_with(self.ptool, entry)
+
+    def test_diff(self):
         content1 = "line1\nline2"
         content2 = "line3"
 
-        self.now = 1345640723
-        def time_rv():
-            self.now += 1
-            return self.now
-        mock_time.side_effect = time_rv
-
         rv = ["line1", "line2", "line3"]
         func = Mock()
-        func.return_value = rv
+        func.return_value = iter(rv)
         self.assertItemsEqual(self.ptool._diff(content1, content2, func), rv)
         func.assert_called_with(["line1", "line2"], ["line3"])
 
-        func.reset_mock()
-        mock_time.reset_mock()
-        def time_rv():
-            self.now += 5
-            return self.now
-        mock_time.side_effect = time_rv
-
-        def slow_diff(content1, content2):
-            for i in range(1, 10):
-                yield "line%s" % i
-        func.side_effect = slow_diff
-        self.assertFalse(self.ptool._diff(content1, content2, func), rv)
-        func.assert_called_with(["line1", "line2"], ["line3"])
+    def test_fast_ndiff(self):
+        lines1 = ["a", "b", "c", "d", "e", "f"]
+        lines2 = ["a", "x", "c", "e", "f", "g", "h"]
+        diff = list(fast_ndiff(lines1, lines2))
+        self.assertEqual(diff, ["  a", "- b", "+ x", "  c", "- d", "  e",
+                                "  f", "+ g", "+ h"])
+        self.assertEqual(list(difflib.restore(diff, 1)), lines1)
+        self.assertEqual(list(difflib.restore(diff, 2)), lines2)
+        self.assertEqual(list(fast_ndiff([], [])), [])
@@ -0,0 +1,99 @@
+import os
+import sys
+import lxml.etree
+from mock import Mock, MagicMock, patch
+from Bcfg2.Client.Tools.Systemd import Systemd
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+
+def get_service(name, status="on"):
+    return lxml.etree.Element("Service", name=name, type="systemd",
+                              status=status)
+
+
+class TestSystemd(Bcfg2TestCase):
+    test_obj = Systemd
+
+    @patch("Bcfg2.Client.Tools.Systemd.Systemd.__execs__", [])
+    def get_obj(self):
+        tool = self.test_obj(Mock(), MagicMock(),
+                             lxml.etree.Element("Configuration"))
+        tool.cmd = Mock()
+        return tool
+
+    def test_gather_service_status(self):
+        tool = self.get_obj()
+        services = [get_service("sshd"), get_service("bogus"),
+                    get_service("crond", status="off"), get_service("sshd")]
+        tool.cmd.run.return_value = (0, ["LoadState=loaded",
+                                         "ActiveState=active",
+                                         "",
+                                         "LoadState=not-found",
+                                         "ActiveState=inactive",
+                                         "",
+                                         "LoadState=loaded",
+                                         "ActiveState=failed"])
+        status = tool.gather_service_status(services)
+        tool.cmd.run.assert_called_once_with(
+            "/bin/systemctl show -p LoadState -p ActiveState "
+            "sshd.service bogus.service crond.service")
+        self.assertEqual(status,
+                         dict(sshd=dict(LoadState="loaded",
+                                        ActiveState="active"),
+                              bogus=dict(LoadState="not-found",
+                                         ActiveState="inactive"),
+                              crond=dict(LoadState="loaded",
+                                         ActiveState="failed")))
+
+        # unknown units are off
+        tool.service_status = status
+        entry = services[1]
+        self.assertFalse(tool.VerifyService(entry, []))
+        self.assertEqual(entry.get("current_status"), "off")
+        self.assertTrue(tool.VerifyService(services[2], []))
+        self.assertTrue(tool.VerifyService(services[0], []))
+        self.assertEqual(services[0].get("current_status"), "on")
+        self.assertEqual(tool.cmd.run.call_count, 1)
+
+    def test_gather_service_status_batches(self):
+        tool = self.get_obj()
+        tool.batch_size = 2
+        services = [get_service("svc%d" % i) for i in range(5)]
+
+        def run(cmd):
+            count = len(cmd.split()) - 6
+            if "svc2" in cmd:
+                # the output for a batch doesn't cover every unit
+                count -= 1
+            if "svc4" in cmd:
+                return (1, [])
+            rv = []
+            for _ in range(count):
+                rv.extend(["LoadState=loaded", "ActiveState=active", ""])
+            return (0, rv)
+
+        tool.cmd.run.side_effect = run
+        status = tool.gather_service_status(services)
+        self.assertEqual(tool.cmd.run.call_count, 3)
+        # services from batches whose output couldn't be matched up
+        # are left out, to be checked one at a time
+        self.assertItemsEqual(status.keys(), ["svc0", "svc1"])
+
+        tool.service_status = status
+        tool.cmd.run.reset_mock()
+        tool.cmd.run.side_effect = None
+        tool.cmd.run.return_value = (0, ["   Loaded: loaded",
+                                         "   Active: active (running)"])
+        self.assertTrue(tool.VerifyService(services[3], []))
+        tool.cmd.run.assert_called_once_with(
+            "/bin/systemctl status svc3.service ")
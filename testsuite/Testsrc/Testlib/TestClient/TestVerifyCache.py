@@ -0,0 +1,116 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+from Bcfg2.Compat import md5
+from Bcfg2.Client.VerifyCache import *
+
+
+class TestVerifyCache(Bcfg2TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cachefile = os.path.join(self.tmpdir, "cache", "verify")
+        self.datafile = os.path.join(self.tmpdir, "data")
+        self.write_data("foo")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_data(self, data, age=60):
+        """ write data to the data file, and set its mtime to
+        ``age`` seconds ago so that it isn't too new to cache """
+        open(self.datafile, 'w').write(data)
+        mtime = time.time() - age
+        os.utime(self.datafile, (mtime, mtime))
+
+    def get_obj(self, max_age=86400):
+        cache = VerifyCache(self.cachefile, max_age=max_age)
+        # ctime can't be set back, so don't treat the test files as
+        # too new to cache
+        cache.racy_window = -60
+        return cache
+
+    def test_get_set(self):
+        cache = self.get_obj()
+        signature = cache.signature(self.datafile)
+        self.assertIsNone(cache.get("key", signature))
+        cache.set("key", signature, "value")
+        self.assertEqual(cache.get("key", signature), "value")
+        self.assertEqual(cache.get("key", cache.signature(self.datafile)),
+                         "value")
+
+        # changing the file changes its signature
+        self.write_data("bar", age=30)
+        self.assertIsNone(cache.get("key", cache.signature(self.datafile)))
+
+        cache.invalidate("key")
+        self.assertIsNone(cache.get("key", signature))
+
+        # files that can't be stat()ed are never cached
+        self.assertIsNone(cache.signature(self.datafile + ".missing"))
+        cache.set("missing", None, "value")
+        self.assertIsNone(cache.get("missing", None))
+
+    def test_racy(self):
+        cache = self.get_obj()
+        cache.racy_window = 2
+        self.write_data("foo", age=0)
+        signature = cache.signature(self.datafile)
+        cache.set("key", signature, "value")
+        self.assertIsNone(cache.get("key", signature))
+        self.assertIsNone(cache.fileset_signature([self.datafile]))
+
+    def test_digest(self):
+        cache = self.get_obj()
+        foo = md5("foo".encode("UTF-8")).hexdigest()
+        self.assertEqual(cache.digest(self.datafile), foo)
+        self.assertEqual(cache.get(('digest', self.datafile),
+                                   cache.signature(self.datafile)),
+                         foo)
+        self.write_data("bar", age=30)
+        self.assertEqual(cache.digest(self.datafile),
+                         md5("bar".encode("UTF-8")).hexdigest())
+        self.assertRaises(IOError, cache.digest, self.datafile + ".missing")
+
+    def test_fileset_signature(self):
+        cache = self.get_obj()
+        other = os.path.join(self.tmpdir, "other")
+        signature = cache.fileset_signature([self.datafile, other])
+        self.assertEqual(cache.fileset_signature([other, self.datafile]),
+                         signature)
+        open(other, 'w').write("baz")
+        self.assertNotEqual(cache.fileset_signature([self.datafile, other]),
+                            signature)
+
+    def test_save_load(self):
+        cache = self.get_obj()
+        signature = cache.signature(self.datafile)
+        cache.set("key", signature, "value")
+        cache.save()
+        self.assertTrue(os.path.exists(self.cachefile))
+
+        cache = self.get_obj()
+        self.assertEqual(cache.get("key", signature), "value")
+
+        # an expired cache is discarded
+        cache.created = time.time() - 100
+        cache.save()
+        cache = self.get_obj(max_age=10)
+        self.assertIsNone(cache.get("key", signature))
+
+        # as is an unreadable one
+        open(self.cachefile, 'w').write("garbage")
+        cache = self.get_obj()
+        self.assertIsNone(cache.get("key", signature))
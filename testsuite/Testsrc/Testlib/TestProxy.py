@@ -0,0 +1,252 @@
+import os
+import sys
+import zlib
+import socket
+from mock import Mock, MagicMock, patch
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+from Bcfg2.Compat import xmlrpclib, httplib
+from Bcfg2.Utils import SERVER_BUSY
+from Bcfg2.Proxy import RetryMethod, ProxyError, XMLRPCTransport
+
+
+class TestRetryMethod(Bcfg2TestCase):
+    def get_obj(self, send):
+        return RetryMethod(send, "GetConfig")
+
+    @patch("random.uniform")
+    def test__busy_delay(self, mock_uniform):
+        method = self.get_obj(Mock())
+        mock_uniform.return_value = 2.5
+        self.assertEqual(
+            method._busy_delay(
+                xmlrpclib.Fault(SERVER_BUSY,
+                                "Server busy, retry after 10 seconds")),
+            12.5)
+        mock_uniform.assert_called_with(0, 10)
+
+        # without a delay in the fault string, the default retry
+        # delay is used
+        mock_uniform.reset_mock()
+        self.assertEqual(
+            method._busy_delay(xmlrpclib.Fault(SERVER_BUSY, "Busy")),
+            method.retry_delay + 2.5)
+        mock_uniform.assert_called_with(0, method.retry_delay)
+
+    @patch("time.sleep")
+    @patch("random.uniform")
+    def test_call_busy(self, mock_uniform, mock_sleep):
+        mock_uniform.return_value = 1
+        send = Mock()
+        send.side_effect = [
+            xmlrpclib.Fault(SERVER_BUSY,
+                            "Server busy, retry after 10 seconds"),
+            "config"]
+        method = self.get_obj(send)
+        self.assertEqual(method(), "config")
+        self.assertEqual(send.call_count, 2)
+        mock_sleep.assert_called_once_with(11)
+
+        # other faults wait the default retry delay
+        send.reset_mock()
+        mock_sleep.reset_mock()
+        send.side_effect = [xmlrpclib.Fault(1, "Error"), "config"]
+        self.assertEqual(method(), "config")
+        mock_sleep.assert_called_once_with(method.retry_delay)
+
+        # busy faults don't count against max_retries
+        busy = xmlrpclib.Fault(SERVER_BUSY,
+                               "Server busy, retry after 10 seconds")
+        send.reset_mock()
+        send.side_effect = [busy] * (method.max_retries + 1) + \
+            [xmlrpclib.Fault(1, "Error")] * (method.max_retries - 1) + \
+            ["config"]
+        self.assertEqual(method(), "config")
+
+        # and a busy server is given up on after max_busy_retries
+        send.reset_mock()
+        mock_sleep.reset_mock()
+        send.side_effect = busy
+        self.assertRaises(ProxyError, method)
+        self.assertEqual(send.call_count, method.max_busy_retries)
+        self.assertEqual(mock_sleep.call_count, method.max_busy_retries - 1)
+
+        # as is a server that keeps failing, however busy it was
+        send.reset_mock()
+        send.side_effect = [busy] * 2 + [xmlrpclib.Fault(1, "Error")] * \
+            method.max_retries
+        self.assertRaises(ProxyError, method)
+        self.assertEqual(send.call_count, method.max_retries + 2)
+
+
+class TestXMLRPCTransport(Bcfg2TestCase):
+    def setUp(self):
+        Bcfg2TestCase.setUp(self)
+        self.conns = []
+        patcher = patch("Bcfg2.Proxy.SSLHTTPConnection")
+        self.mock_conn = patcher.start()
+        self.mock_conn.side_effect = self.get_conn
+        self.addCleanup(patcher.stop)
+
+    def get_conn(self, *args, **kwargs):
+        """ get a new fake connection to the server """
+        conn = Mock()
+        conn.getresponse.return_value = self.get_response()
+        self.conns.append(conn)
+        return conn
+
+    def get_response(self, status=200, accept_gzip=False):
+        response = Mock()
+        response.status = status
+        response.reason = "OK"
+        headers = dict()
+        if accept_gzip:
+            headers["Accept-Encoding"] = "gzip"
+        response.getheader.side_effect = \
+            lambda name, default=None: headers.get(name, default)
+        return response
+
+    def get_obj(self):
+        transport = XMLRPCTransport()
+        transport.parse_response = Mock(return_value=("config", ))
+        return transport
+
+    def get_body(self, conn):
+        """ get the request body that was sent on a fake
+        connection """
+        body = conn.endheaders.call_args[0][0]
+        if call("Content-Encoding", "gzip") in conn.putheader.call_args_list:
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return body
+
+    def test_request(self):
+        transport = self.get_obj()
+        self.assertEqual(transport.request("server:6789", "/RPC2", "<call/>"),
+                         ("config", ))
+        self.assertEqual(transport.request("server:6789", "/RPC2", "<call/>"),
+                         ("config", ))
+        # the connection is kept open between calls
+        self.assertEqual(len(self.conns), 1)
+        self.assertEqual(self.conns[0].getresponse.call_count, 2)
+        self.assertFalse(self.conns[0].close.called)
+
+        # a connection to another server is not reused
+        transport.request("other:6789", "/RPC2", "<call/>")
+        self.assertEqual(len(self.conns), 2)
+        self.assertTrue(self.conns[0].close.called)
+
+    def test_request_retry(self):
+        transport = self.get_obj()
+        transport.request("server:6789", "/RPC2", "<call/>")
+
+        # the server closed the connection that was kept open, so
+        # the call is retried once on a new one
+        self.conns[0].getresponse.side_effect = \
+            httplib.BadStatusLine("''")
+        self.assertEqual(transport.request("server:6789", "/RPC2",
+                                           "<call/>"),
+                         ("config", ))
+        self.assertEqual(len(self.conns), 2)
+        self.assertTrue(self.conns[0].close.called)
+        self.assertEqual(self.get_body(self.conns[1]), "<call/>")
+
+        # a call that fails on the new connection too isn't retried
+        # again
+        self.conns[1].getresponse.side_effect = socket.error("reset")
+        self.mock_conn.side_effect = None
+        self.mock_conn.return_value = self.conns[1]
+        self.assertRaises(ProxyError, transport.request,
+                          "server:6789", "/RPC2", "<call/>")
+        self.assertEqual(self.conns[1].getresponse.call_count, 3)
+        self.assertEqual(self.mock_conn.call_count, 3)
+
+    def test_request_no_retry(self):
+        # a call that fails on a new connection is not retried
+        transport = self.get_obj()
+        self.mock_conn.side_effect = None
+        self.mock_conn.return_value = self.get_conn()
+        self.conns[0].getresponse.side_effect = socket.error("refused")
+        self.assertRaises(ProxyError, transport.request,
+                          "server:6789", "/RPC2", "<call/>")
+        self.assertEqual(self.mock_conn.call_count, 1)
+        self.assertTrue(self.conns[0].close.called)
+
+        self.conns[0].getresponse.side_effect = httplib.BadStatusLine("''")
+        self.assertRaises(httplib.HTTPException, transport.request,
+                          "server:6789", "/RPC2", "<call/>")
+        self.assertEqual(self.mock_conn.call_count, 2)
+
+    def test_request_close(self):
+        transport = self.get_obj()
+
+        # a fault is a complete response, so the connection is kept
+        transport.parse_response.side_effect = xmlrpclib.Fault(1, "Error")
+        self.assertRaises(xmlrpclib.Fault, transport.request,
+                          "server:6789", "/RPC2", "<call/>")
+        self.assertFalse(self.conns[0].close.called)
+        self.assertIsNotNone(transport._conn)
+
+        # other errors close the connection
+        transport.parse_response.side_effect = ValueError
+        self.assertRaises(ValueError, transport.request,
+                          "server:6789", "/RPC2", "<call/>")
+        self.assertTrue(self.conns[0].close.called)
+        self.assertIsNone(transport._conn)
+
+        # as do HTTP errors
+        self.conns = []
+        transport.parse_response.side_effect = None
+        self.mock_conn.side_effect = None
+        self.mock_conn.return_value = self.get_conn()
+        self.conns[0].getresponse.return_value = self.get_response(500)
+        self.assertRaises(ProxyError, transport.request,
+                          "server:6789", "/RPC2", "<call/>")
+        self.assertTrue(self.conns[0].close.called)
+        self.assertIsNone(transport._conn)
+
+    def test_send_content(self):
+        transport = self.get_obj()
+        large = "<call>%s</call>" % ("x" * transport.gzip_threshold)
+        small = "<call/>"
+
+        # requests aren't compressed until the server says that it
+        # accepts compressed requests
+        transport.request("server:6789", "/RPC2", large)
+        conn = self.conns[0]
+        self.assertNotIn(call("Content-Encoding", "gzip"),
+                         conn.putheader.call_args_list)
+        self.assertIn(call("Content-Length", str(len(large))),
+                      conn.putheader.call_args_list)
+        self.assertFalse(transport.server_accepts_gzip)
+
+        conn.getresponse.return_value = self.get_response(accept_gzip=True)
+        transport.request("server:6789", "/RPC2", large)
+        self.assertTrue(transport.server_accepts_gzip)
+        self.assertNotIn(call("Content-Encoding", "gzip"),
+                         conn.putheader.call_args_list)
+
+        # then only requests over the threshold are compressed
+        conn.putheader.reset_mock()
+        transport.request("server:6789", "/RPC2", large)
+        self.assertIn(call("Content-Encoding", "gzip"),
+                      conn.putheader.call_args_list)
+        sent = conn.endheaders.call_args[0][0]
+        self.assertIn(call("Content-Length", str(len(sent))),
+                      conn.putheader.call_args_list)
+        self.assertTrue(len(sent) < len(large))
+        self.assertEqual(self.get_body(conn), large)
+
+        conn.putheader.reset_mock()
+        transport.request("server:6789", "/RPC2", small)
+        self.assertNotIn(call("Content-Encoding", "gzip"),
+                         conn.putheader.call_args_list)
+        self.assertEqual(self.get_body(conn), small)
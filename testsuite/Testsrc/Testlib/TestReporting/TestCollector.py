@@ -0,0 +1,217 @@
+import os
+import sys
+import time
+import threading
+from mock import Mock, patch
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+from Bcfg2.Compat import Queue
+
+try:
+    from Bcfg2.Reporting.Collector import ReportingCollector, \
+        PendingInteraction
+    from Bcfg2.Reporting.Transport.base import TransportError
+    HAS_DAEMON = True
+except ImportError:
+    HAS_DAEMON = False
+
+
+def get_interaction(hostname):
+    return dict(hostname=hostname, metadata=dict(profile="basic"),
+                stats="<Statistics/>")
+
+
+class TestReportingCollector(Bcfg2TestCase):
+    def get_obj(self, batch_size=2, worker_count=1):
+        collector = ReportingCollector.__new__(ReportingCollector)
+        collector.logger = Mock()
+        collector.terminate = threading.Event()
+        collector.batch_size = batch_size
+        collector.worker_count = worker_count
+        collector.workers = []
+        collector.queue = Queue(worker_count * batch_size * 2)
+        collector.retries = []
+        collector.pending = dict()
+        collector.lock = threading.Lock()
+        collector.storage = Mock()
+        collector.storage.import_interactions.return_value = []
+        collector.transport = Mock()
+        return collector
+
+    def start_workers(self, collector):
+        for i in range(collector.worker_count):
+            worker = threading.Thread(target=collector._work)
+            worker.setDaemon(True)
+            worker.start()
+            collector.workers.append(worker)
+
+    def wait_for(self, predicate, timeout=5):
+        end = time.time() + timeout
+        while not predicate() and time.time() < end:
+            time.sleep(0.01)
+        self.assertTrue(predicate())
+
+    def stop_workers(self, collector):
+        collector.terminate.set()
+        for worker in collector.workers:
+            worker.join(5)
+            self.assertFalse(worker.isAlive())
+
+    @skipUnless(HAS_DAEMON, "python-daemon not found, skipping")
+    def test__next_batch(self):
+        collector = self.get_obj(batch_size=2)
+        queued = [PendingInteraction(get_interaction("foo%d" % i))
+                  for i in range(3)]
+        for pending in queued:
+            collector._enqueue(pending)
+        self.assertEqual(collector.get_lag()[0], 3)
+
+        # batches hold up to batch_size interactions
+        self.assertEqual(collector._next_batch(), queued[:2])
+        self.assertEqual(collector._next_batch(), queued[2:])
+
+        # retries that are due come first, and those that aren't are
+        # left alone
+        due = PendingInteraction(get_interaction("due"))
+        later = PendingInteraction(get_interaction("later"))
+        later.not_before = time.time() + 60
+        collector.retries = [later, due]
+        collector._enqueue(queued[0])
+        self.assertEqual(collector._next_batch(), [due, queued[0]])
+        self.assertEqual(collector.retries, [later])
+
+        # an idle collector returns empty batches until it's shut
+        # down, and then every retry is attempted at once
+        self.assertEqual(collector._next_batch(), [])
+        collector.terminate.set()
+        self.assertEqual(collector._next_batch(), [later])
+        self.assertIsNone(collector._next_batch())
+
+    @skipUnless(HAS_DAEMON, "python-daemon not found, skipping")
+    def test__work(self):
+        collector = self.get_obj(batch_size=2, worker_count=3)
+        batches = []
+
+        def import_interactions(interactions):
+            batches.append((threading.currentThread().getName(),
+                            [i['hostname'] for i in interactions]))
+            time.sleep(0.1)
+            return []
+
+        collector.storage.import_interactions.side_effect = \
+            import_interactions
+        self.start_workers(collector)
+        hostnames = ["foo%d" % i for i in range(10)]
+        for hostname in hostnames:
+            collector._enqueue(PendingInteraction(get_interaction(hostname)))
+        self.stop_workers(collector)
+
+        # every interaction was imported exactly once, in batches of
+        # no more than batch_size, by more than one worker
+        imported = []
+        for _, batch in batches:
+            self.assertLessEqual(len(batch), 2)
+            imported.extend(batch)
+        self.assertItemsEqual(imported, hostnames)
+        self.assertGreater(len(set([w for w, _ in batches])), 1)
+        self.assertEqual(collector.pending, dict())
+        # and the transport was told about every one of them
+        self.assertItemsEqual(
+            [c[0][0]['hostname']
+             for c in collector.transport.ack.call_args_list],
+            hostnames)
+
+    @skipUnless(HAS_DAEMON, "python-daemon not found, skipping")
+    def test__requeue(self):
+        collector = self.get_obj()
+        pending = PendingInteraction(get_interaction("foo"))
+        collector.pending[id(pending)] = pending
+
+        # each retry waits longer than the last
+        now = time.time()
+        collector._requeue(pending)
+        self.assertEqual(collector.retries, [pending])
+        self.assertAlmostEqual(pending.not_before,
+                               now + collector.retry_delay, delta=5)
+        collector.retries = []
+        collector._requeue(pending)
+        self.assertEqual(collector.retries, [pending])
+        self.assertAlmostEqual(pending.not_before,
+                               now + 2 * collector.retry_delay, delta=5)
+        self.assertFalse(collector.transport.store.called)
+
+        # after max_attempts, the interaction is handed back to the
+        # transport rather than dropped
+        collector.retries = []
+        collector._requeue(pending)
+        self.assertEqual(pending.attempts, collector.max_attempts)
+        self.assertEqual(collector.retries, [])
+        collector.transport.store.assert_called_once_with(
+            "foo", dict(profile="basic"), "<Statistics/>")
+        collector.transport.ack.assert_called_once_with(pending.interaction)
+        self.assertEqual(collector.pending, dict())
+
+        # as it is if the collector is shutting down
+        collector.transport.reset_mock()
+        pending = PendingInteraction(get_interaction("bar"))
+        collector.pending[id(pending)] = pending
+        collector.terminate.set()
+        collector._requeue(pending)
+        self.assertEqual(collector.retries, [])
+        collector.transport.store.assert_called_once_with(
+            "bar", dict(profile="basic"), "<Statistics/>")
+        self.assertEqual(collector.pending, dict())
+
+        # an interaction the transport can't take is forgotten
+        collector.transport.store.side_effect = TransportError
+        pending = PendingInteraction(get_interaction("baz"))
+        collector.pending[id(pending)] = pending
+        collector._requeue(pending)
+        self.assertEqual(collector.pending, dict())
+        self.assertTrue(collector.logger.error.called)
+
+    @skipUnless(HAS_DAEMON, "python-daemon not found, skipping")
+    def test__work_retries(self):
+        collector = self.get_obj()
+        collector.retry_delay = 0
+        attempts = []
+
+        def import_interactions(interactions):
+            attempts.extend([i['hostname'] for i in interactions])
+            return [i for i in interactions if i['hostname'] == "bad"]
+
+        collector.storage.import_interactions.side_effect = \
+            import_interactions
+        self.start_workers(collector)
+        collector._enqueue(PendingInteraction(get_interaction("good")))
+        collector._enqueue(PendingInteraction(get_interaction("bad")))
+        self.wait_for(lambda: not collector.pending)
+        self.stop_workers(collector)
+
+        # the failed interaction was retried, and then handed back to
+        # the transport
+        self.assertEqual(attempts.count("good"), 1)
+        self.assertEqual(attempts.count("bad"), collector.max_attempts)
+        collector.transport.store.assert_called_once_with(
+            "bad", dict(profile="basic"), "<Statistics/>")
+
+        # interactions that fail when the whole batch fails are
+        # retried too
+        collector.transport.reset_mock()
+        collector.terminate.clear()
+        collector.workers = []
+        collector.storage.import_interactions.side_effect = ValueError
+        self.start_workers(collector)
+        collector._enqueue(PendingInteraction(get_interaction("foo")))
+        self.wait_for(lambda: not collector.pending)
+        self.stop_workers(collector)
+        self.assertEqual(collector.transport.store.call_count, 1)
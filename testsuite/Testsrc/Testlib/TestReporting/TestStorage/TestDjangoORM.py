@@ -0,0 +1,172 @@
+import os
+import sys
+import time
+import lxml.etree
+from mock import Mock
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+try:
+    import django.core.management
+    from django.core.cache import cache
+    from django.db.models.manager import Manager
+    from Bcfg2.settings import HAS_SOUTH
+    from Bcfg2.Reporting.Storage.DjangoORM import DjangoORM
+    from Bcfg2.Reporting.models import Client, Interaction, Performance, \
+        PackageEntry, PathEntry, FilePerms, Group, Bundle, TYPE_BAD
+    HAS_REPORTING = HAS_SOUTH
+except ImportError:
+    HAS_REPORTING = False
+
+
+class TestReportingDB(DBModelTestCase):
+    if HAS_REPORTING:
+        models = [Performance, Interaction, Client, PackageEntry, PathEntry,
+                  FilePerms, Group, Bundle]
+
+    @skipUnless(HAS_REPORTING, "Django or South not found, skipping")
+    def test_syncdb(self):
+        DBModelTestCase.test_syncdb(self)
+        # the reporting models are managed by south
+        django.core.management.call_command("migrate", "Reporting",
+                                            interactive=False, verbosity=0)
+
+
+def get_interaction(hostname, timestamp, packages=None):
+    """ get an interaction with a bad package and a modified file """
+    if packages is None:
+        packages = ["foo"]
+    stats = lxml.etree.Element(
+        "Statistics", state="dirty", revision="1", good="3", total="5",
+        time=time.strftime("%a %b %d %H:%M:%S %Y",
+                           time.localtime(timestamp)))
+    bad = lxml.etree.SubElement(stats, "Bad")
+    for package in packages:
+        lxml.etree.SubElement(bad, "Package", name=package, version="1.0",
+                              current_version="0.9")
+    modified = lxml.etree.SubElement(stats, "Modified")
+    lxml.etree.SubElement(modified, "Path", name="/etc/motd", type="file",
+                          owner="root", group="root", perms="0644",
+                          current_owner="root", current_group="root",
+                          current_perms="0600")
+    lxml.etree.SubElement(stats, "OpStamps", start="1.5", finished="3.5")
+    return dict(hostname=hostname,
+                metadata=dict(profile="basic", groups=["basic", "web"],
+                              bundles=["motd"], server="bcfg2.example.com"),
+                stats=lxml.etree.tostring(stats))
+
+
+class TestDjangoORM(Bcfg2TestCase):
+    def setUp(self):
+        if HAS_REPORTING:
+            syncdb(TestReportingDB)
+            cache.clear()
+
+    def get_obj(self):
+        storage = DjangoORM(dict(encoding="UTF-8",
+                                 reporting_file_limit=1024))
+        storage.logger = Mock()
+        return storage
+
+    def check_interactions(self, hostnames):
+        self.assertItemsEqual([i.client.name
+                               for i in Interaction.objects.all()],
+                              hostnames)
+        for inter in Interaction.objects.all():
+            self.assertEqual(inter.client.current_interaction,
+                             inter.client.interactions.latest())
+            self.assertEqual(inter.profile.name, "basic")
+            self.assertItemsEqual([g.name for g in inter.groups.all()],
+                                  ["basic", "web"])
+            self.assertItemsEqual([b.name for b in inter.bundles.all()],
+                                  ["motd"])
+            self.assertEqual(inter.modified_count, 1)
+            self.assertEqual([(p.name, p.state, p.target_version)
+                              for p in inter.packages.all()],
+                             [("foo", TYPE_BAD, "1.0")])
+            paths = list(inter.paths.all())
+            self.assertEqual(len(paths), 1)
+            self.assertEqual(paths[0].target_perms.perms, "0644")
+            self.assertEqual(paths[0].current_perms.perms, "0600")
+            self.assertItemsEqual([(p.metric, float(p.value))
+                                   for p in inter.performance_items.all()],
+                                  [("start", 1.5), ("finished", 3.5)])
+
+    @skipUnless(HAS_REPORTING, "Django or South not found, skipping")
+    def test_import_interactions(self):
+        storage = self.get_obj()
+        # the same package is listed twice for foo
+        interactions = [get_interaction("foo", 1700000000,
+                                        packages=["foo", "foo"]),
+                        get_interaction("bar", 1700000000),
+                        get_interaction("bar", 1700000060)]
+        self.assertEqual(storage.import_interactions(interactions), [])
+        self.check_interactions(["foo", "bar", "bar"])
+
+        # entries, groups and permissions shared by interactions are
+        # only created once
+        self.assertEqual(PackageEntry.objects.count(), 1)
+        self.assertEqual(PathEntry.objects.count(), 1)
+        self.assertEqual(FilePerms.objects.count(), 2)
+        self.assertEqual(Group.objects.count(), 2)
+        self.assertEqual(Bundle.objects.count(), 1)
+
+        # one row per interaction in the through table, even though
+        # foo lists the package twice
+        through = Interaction._meta.get_field("packages").rel.through
+        self.assertEqual(through.objects.count(), 3)
+        foo = Interaction.objects.get(client__name="foo")
+        self.assertEqual(through.objects.filter(interaction=foo).count(), 1)
+
+        # interactions that already exist, in the database or earlier
+        # in the batch, are skipped
+        cache.clear()
+        self.assertEqual(
+            storage.import_interactions([get_interaction("foo", 1700000000),
+                                         get_interaction("baz", 1700000000),
+                                         get_interaction("baz", 1700000000)]),
+            [])
+        self.check_interactions(["foo", "bar", "bar", "baz"])
+        self.assertEqual(PackageEntry.objects.count(), 1)
+        self.assertEqual(through.objects.count(), 4)
+
+    @skipUnless(HAS_REPORTING, "Django or South not found, skipping")
+    def test_import_interactions_fallback(self):
+        storage = self.get_obj()
+        bad = get_interaction("bad", 1700000000)
+        bad['stats'] = "<Statistics/>"
+        interactions = [get_interaction("foo", 1700000000), bad,
+                        get_interaction("bar", 1700000000)]
+
+        # a batch that fails is rolled back, and each interaction is
+        # then imported on its own
+        self.assertEqual(storage.import_interactions(interactions), [bad])
+        self.assertTrue(storage.logger.error.called)
+        self.check_interactions(["foo", "bar"])
+        self.assertEqual(PackageEntry.objects.count(), 1)
+
+    @skipUnless(HAS_REPORTING, "Django or South not found, skipping")
+    def test_import_interactions_without_bulk_create(self):
+        # bulk_create() was added in Django 1.4
+        bulk_create = Manager.__dict__['bulk_create']
+        del Manager.bulk_create
+        try:
+            storage = self.get_obj()
+            interactions = [get_interaction("foo", 1700000000),
+                            get_interaction("bar", 1700000000)]
+            self.assertEqual(storage.import_interactions(interactions), [])
+            self.assertFalse(storage.logger.error.called)
+        finally:
+            Manager.bulk_create = bulk_create
+        self.check_interactions(["foo", "bar"])
+        self.assertEqual(PackageEntry.objects.count(), 1)
+        self.assertEqual(PathEntry.objects.count(), 1)
@@ -0,0 +1,90 @@
+import os
+import sys
+import shutil
+import tempfile
+from mock import Mock
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+try:
+    from Bcfg2.Reporting.Transport.LocalFilesystem import LocalFilesystem
+    HAS_DAEMON = True
+except ImportError:
+    HAS_DAEMON = False
+
+
+class TestLocalFilesystem(Bcfg2TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get_obj(self, spool="segments"):
+        transport = LocalFilesystem(dict(repo=self.tmpdir,
+                                         reporting_spool=spool))
+        transport.timeout = 0
+        return transport
+
+    def get_hostnames(self, interactions):
+        return [i['hostname'] for i in interactions]
+
+    @skipUnless(HAS_DAEMON, "python-daemon not found, skipping")
+    def test_ack_spool(self):
+        transport = self.get_obj()
+        for i in range(3):
+            transport.store("foo%d" % i, dict(), "<Statistics/>")
+        batch1 = transport.fetch_batch(2)
+        batch2 = transport.fetch_batch(2)
+        self.assertEqual(self.get_hostnames(batch1), ["foo0", "foo1"])
+        self.assertEqual(self.get_hostnames(batch2), ["foo2"])
+        self.assertEqual(transport.fetch_batch(2), [])
+
+        # nothing is committed until it has been acknowledged, so a
+        # new collector would fetch everything again
+        self.assertEqual(transport.spool.read_checkpoint(), (0, 0))
+        self.assertEqual(self.get_hostnames(self.get_obj().fetch_batch(5)),
+                         ["foo0", "foo1", "foo2"])
+
+        # the checkpoint doesn't move past interactions that haven't
+        # been acknowledged, even if later ones have
+        transport.ack(batch2[0])
+        transport.ack(batch1[1])
+        self.assertEqual(transport.spool.read_checkpoint(), (0, 0))
+        self.assertEqual(self.get_hostnames(self.get_obj().fetch_batch(5)),
+                         ["foo0", "foo1", "foo2"])
+
+        transport.ack(batch1[0])
+        self.assertEqual(transport.spool.read_checkpoint(),
+                         transport.spool.tell())
+        self.assertEqual(transport.unacked, [])
+        self.assertEqual(self.get_obj().fetch_batch(5), [])
+
+    @skipUnless(HAS_DAEMON, "python-daemon not found, skipping")
+    def test_ack_files(self):
+        transport = self.get_obj(spool="files")
+        transport.store("foo", dict(), "<Statistics/>")
+        fname = os.listdir(transport.work_path)[0]
+        event = Mock()
+        event.filename = fname
+        event.code2str.return_value = "created"
+        transport.fmon = Mock()
+        transport.fmon.pending.return_value = True
+        transport.fmon.get_event.return_value = event
+
+        # the payload is only removed once it has been acknowledged
+        interaction = transport.fetch()
+        self.assertEqual(interaction['hostname'], "foo")
+        self.assertEqual(os.listdir(transport.work_path), [fname])
+        transport.ack(interaction)
+        self.assertEqual(os.listdir(transport.work_path), [])
+        self.assertEqual(transport.payloads, dict())
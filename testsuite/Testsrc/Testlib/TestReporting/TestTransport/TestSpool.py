@@ -0,0 +1,189 @@
+import os
+import sys
+import struct
+import shutil
+import tempfile
+from mock import Mock, patch
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+from Bcfg2.Reporting.Transport.Spool import SegmentSpool
+
+
+class TestSegmentSpool(Bcfg2TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "spool")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get_obj(self, **kwargs):
+        return SegmentSpool(self.path, **kwargs)
+
+    def get_records(self, count):
+        return [("record %d " % i * 10).encode("UTF-8")
+                for i in range(count)]
+
+    def record_size(self, payload):
+        return struct.calcsize(SegmentSpool.header) + len(payload)
+
+    def test_read(self):
+        for compress in [True, False]:
+            spool = self.get_obj(compress=compress)
+            records = self.get_records(3)
+            for record in records:
+                spool.append(record)
+            self.assertEqual(spool.read(2), records[:2])
+            self.assertEqual(spool.read(5), records[2:])
+            self.assertEqual(spool.read(5), [])
+            spool.append(records[0])
+            self.assertEqual(spool.read(5), records[:1])
+            spool.commit()
+            spool.close()
+            shutil.rmtree(self.path)
+
+    def test__read_segment(self):
+        spool = self.get_obj(compress=False)
+        records = self.get_records(5)
+        for record in records:
+            spool.append(record)
+        spool._rseg, spool._roffset = spool.read_checkpoint()
+
+        # only the records asked for are read
+        read = []
+        real_open = open
+
+        def mock_open(fname, mode='r'):
+            fobj = real_open(fname, mode)
+            wrapped = Mock()
+            wrapped.fileno = fobj.fileno
+            wrapped.seek = fobj.seek
+            wrapped.close = fobj.close
+
+            def read_data(size=-1):
+                data = fobj.read(size)
+                read.append(len(data))
+                return data
+
+            wrapped.read = read_data
+            return wrapped
+
+        @patch("%s.open" % builtins, mock_open)
+        def inner():
+            return spool._read_segment(2)
+
+        rv, remaining = inner()
+        self.assertEqual(rv, records[:2])
+        size = sum([self.record_size(r) for r in records[:2]])
+        self.assertEqual(sum(read), size)
+        self.assertEqual(spool.tell(), (0, size))
+        self.assertEqual(remaining,
+                         sum([self.record_size(r) for r in records[2:]]))
+
+    def test_segment_rollover(self):
+        records = self.get_records(3)
+        spool = self.get_obj(segment_size=self.record_size(records[0]) + 1,
+                             compress=False)
+        spool.append(records[0])
+        spool.append(records[1])
+        self.assertEqual(spool.segments(), [0])
+        # the first segment is full once it holds two records
+        spool.append(records[2])
+        self.assertEqual(spool.segments(), [0, 1])
+        spool.append(records[0])
+        spool.append(records[1])
+        self.assertEqual(spool.segments(), [0, 1, 2])
+
+        self.assertEqual(spool.read(10), records + records[:2])
+        self.assertEqual(spool.tell(), (2, self.record_size(records[1])))
+
+        # segments that have been read completely are removed once
+        # the read position is committed
+        self.assertEqual(spool.segments(), [0, 1, 2])
+        spool.commit()
+        self.assertEqual(spool.segments(), [2])
+
+    def test_checkpoint_resume(self):
+        records = self.get_records(4)
+        spool = self.get_obj(segment_size=self.record_size(records[0]) + 1)
+        for record in records:
+            spool.append(record)
+        self.assertEqual(spool.read(1), records[:1])
+        position = spool.tell()
+        self.assertEqual(spool.read(2), records[1:3])
+
+        # nothing is saved until the position is committed
+        self.assertEqual(self.get_obj().read(10), records)
+
+        # a reader picks up from the committed position
+        spool.commit(position)
+        self.assertEqual(self.get_obj().read(10), records[1:])
+        spool.commit()
+        self.assertEqual(self.get_obj().read(10), records[3:])
+        self.assertEqual(spool.read(10), records[3:])
+        spool.commit()
+        self.assertEqual(self.get_obj().read(10), [])
+
+        # records appended by a new writer are read from where the
+        # reader left off
+        spool.close()
+        spool = self.get_obj()
+        spool.append(records[0])
+        self.assertEqual(spool.read(10), records[:1])
+
+    def test_torn_record(self):
+        spool = self.get_obj(compress=False)
+        records = self.get_records(3)
+        spool.append(records[0])
+        spool.append(records[1])
+        segment = spool._segment_path(0)
+        complete = os.path.getsize(segment)
+        spool.append(records[2])
+        data = open(segment, 'rb').read()
+        torn = data[complete:complete + self.record_size(records[2]) - 5]
+        open(segment, 'wb').write(data[:complete] + torn)
+
+        # the torn record isn't read, and the read position stays in
+        # front of it
+        self.assertEqual(spool.read(10), records[:2])
+        self.assertEqual(spool.tell(), (0, complete))
+        self.assertEqual(spool._read_segment(10), ([], len(torn)))
+
+        # until the rest of it has been written
+        open(segment, 'ab').write(data[complete + len(torn):])
+        self.assertEqual(spool.read(10), records[2:])
+
+        # a torn record that is followed by a new segment will never
+        # be completed, so it is skipped
+        torn_spool = self.get_obj(compress=False)
+        open(segment, 'ab').write(torn)
+        open(torn_spool._segment_path(1), 'wb').write(data[:complete])
+        torn_spool.logger = Mock()
+        torn_spool._rseg, torn_spool._roffset = spool.tell()
+        self.assertEqual(torn_spool.read(10), records[:2])
+        self.assertTrue(torn_spool.logger.error.called)
+        self.assertEqual(torn_spool.tell(), (1, complete))
+
+    def test_corrupt_record(self):
+        spool = self.get_obj(compress=False)
+        records = self.get_records(3)
+        for record in records:
+            spool.append(record)
+        segment = spool._segment_path(0)
+        data = open(segment, 'rb').read()
+        offset = self.record_size(records[0]) + \
+            struct.calcsize(SegmentSpool.header)
+        open(segment, 'wb').write(data[:offset] + "X".encode("UTF-8") +
+                                  data[offset + 1:])
+        spool.logger = Mock()
+        self.assertEqual(spool.read(10), [records[0], records[2]])
+        self.assertTrue(spool.logger.error.called)
@@ -0,0 +1,368 @@
+import os
+import sys
+import zlib
+import threading
+from mock import Mock, MagicMock, patch
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+from Bcfg2.Compat import xmlrpclib, Queue
+from Bcfg2.Utils import SERVER_BUSY
+from Bcfg2.SSLServer import XMLRPCDispatcher, XMLRPCServer, \
+    XMLRPCRequestHandler, EncodedString
+
+try:
+    from io import BytesIO
+except ImportError:
+    # python 2.4/2.5
+    from StringIO import StringIO as BytesIO
+
+
+class BusyTestCase(Bcfg2TestCase):
+    def assertBusy(self, response, retry_after=10):
+        try:
+            xmlrpclib.loads(response)
+        except xmlrpclib.Fault:
+            fault = sys.exc_info()[1]
+            self.assertEqual(fault.faultCode, SERVER_BUSY)
+            self.assertIn("retry after %s seconds" % retry_after,
+                          fault.faultString)
+        else:
+            self.fail("%s is not a busy fault" % response)
+
+
+class TestXMLRPCDispatcher(BusyTestCase):
+    def get_obj(self):
+        dispatcher = XMLRPCDispatcher(True, "UTF-8")
+        dispatcher.instance = Mock()
+        dispatcher.instance._dispatch.return_value = True
+        return dispatcher
+
+    def test__busy_response(self):
+        dispatcher = self.get_obj()
+        self.assertBusy(dispatcher._busy_response())
+        dispatcher.retry_after = 42
+        self.assertBusy(dispatcher._busy_response(), retry_after=42)
+
+    def test__marshaled_dispatch_limits(self):
+        dispatcher = self.get_obj()
+        dispatcher.set_method_limits(dict(GetConfig=1))
+        request = xmlrpclib.dumps((), "GetConfig")
+
+        # calls are dispatched, and the semaphore released afterwards
+        self.assertEqual(
+            xmlrpclib.loads(dispatcher._marshaled_dispatch(("foo", 1234),
+                                                           request)),
+            ((True, ), None))
+        self.assertEqual(
+            xmlrpclib.loads(dispatcher._marshaled_dispatch(("foo", 1234),
+                                                           request)),
+            ((True, ), None))
+        self.assertEqual(dispatcher.instance._dispatch.call_count, 2)
+
+        # even if the call raises an error
+        dispatcher.instance._dispatch.side_effect = ValueError
+        self.assertRaises(xmlrpclib.Fault, xmlrpclib.loads,
+                          dispatcher._marshaled_dispatch(("foo", 1234),
+                                                         request))
+        dispatcher.instance._dispatch.side_effect = None
+
+        # calls over the limit are refused without being dispatched
+        dispatcher.instance._dispatch.reset_mock()
+        dispatcher.method_semaphores['GetConfig'].acquire()
+        self.assertBusy(dispatcher._marshaled_dispatch(("foo", 1234),
+                                                       request))
+        self.assertFalse(dispatcher.instance._dispatch.called)
+
+        # other methods aren't limited
+        self.assertEqual(
+            xmlrpclib.loads(dispatcher._marshaled_dispatch(
+                ("foo", 1234), xmlrpclib.dumps((), "GetProbes"))),
+            ((True, ), None))
+
+    def test__marshal_encoded(self):
+        dispatcher = self.get_obj()
+        text = u"caf\u00e9 <b>&amp;</b> & <<>>"
+        data = text.encode("UTF-8")
+        dispatcher.instance._dispatch.return_value = EncodedString(data)
+        for size in [dispatcher.chunk_size, 1, 2, 3, 5, 7]:
+            dispatcher.chunk_size = size
+            response = dispatcher._marshaled_dispatch(
+                ("foo", 1234), xmlrpclib.dumps((), "GetConfig"))
+            chunks = list(response)
+            self.assertEqual(xmlrpclib.loads(''.encode('UTF-8').join(chunks)),
+                             ((text, ), None))
+
+        # escapes that fall on the boundaries of 64k chunks
+        dispatcher.chunk_size = 64 * 1024
+        text = u"x" * (dispatcher.chunk_size - 1) + u"&<" + \
+            u"y" * (dispatcher.chunk_size - 2) + u">&"
+        dispatcher.instance._dispatch.return_value = \
+            EncodedString(text.encode("UTF-8"))
+        chunks = list(dispatcher._marshaled_dispatch(
+            ("foo", 1234), xmlrpclib.dumps((), "GetConfig")))
+        self.assertEqual(len(chunks), 5)
+        self.assertTrue(chunks[1].endswith("x&amp;".encode("UTF-8")))
+        self.assertTrue(chunks[2].startswith("&lt;y".encode("UTF-8")))
+        self.assertTrue(chunks[2].endswith("y&gt;".encode("UTF-8")))
+        self.assertEqual(chunks[3], "&amp;".encode("UTF-8"))
+        self.assertEqual(xmlrpclib.loads(''.encode('UTF-8').join(chunks)),
+                         ((text, ), None))
+
+
+class TestXMLRPCServer(Bcfg2TestCase):
+    def get_obj(self, threads=2, max_queued=1):
+        server = XMLRPCServer.__new__(XMLRPCServer)
+        server.threads = threads
+        server.retry_after = 10
+        server.request_queue = None
+        if threads:
+            server.request_queue = Queue(max_queued)
+        server.pool = []
+        server.BusyRequestHandlerClass = Mock()
+        server.process_request_thread = Mock()
+        server.close_request = Mock()
+        return server
+
+    def test_process_request(self):
+        server = self.get_obj()
+        server.process_request("req1", ("foo", 1234))
+        self.assertEqual(server.request_queue.get_nowait(),
+                         ("req1", ("foo", 1234)))
+        self.assertFalse(server.BusyRequestHandlerClass.called)
+
+        # with the queue full, requests are answered by the busy
+        # handler and closed
+        server.process_request("req1", ("foo", 1234))
+        server.process_request("req2", ("bar", 1234))
+        server.BusyRequestHandlerClass.assert_called_with("req2",
+                                                          ("bar", 1234),
+                                                          server)
+        server.close_request.assert_called_with("req2")
+        self.assertEqual(server.request_queue.get_nowait(),
+                         ("req1", ("foo", 1234)))
+        self.assertFalse(server.process_request_thread.called)
+
+        # errors answering a busy request are not fatal
+        server.process_request("req1", ("foo", 1234))
+        server.close_request.reset_mock()
+        server.BusyRequestHandlerClass.side_effect = IOError
+        server.process_request("req2", ("bar", 1234))
+        server.close_request.assert_called_with("req2")
+
+    @patch("Bcfg2.Compat.SocketServer.ThreadingMixIn.process_request")
+    def test_process_request_unpooled(self, mock_process_request):
+        server = self.get_obj(threads=0)
+        server.process_request("req1", ("foo", 1234))
+        mock_process_request.assert_called_with(server, "req1",
+                                                ("foo", 1234))
+
+    def test__pool_thread(self):
+        server = self.get_obj(max_queued=3)
+        server.request_queue.put(("req1", ("foo", 1234)))
+        server.request_queue.put(("req2", ("bar", 1234)))
+        server.request_queue.put(None)
+        thread = threading.Thread(target=server._pool_thread)
+        thread.setDaemon(True)
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.isAlive())
+        self.assertEqual(server.process_request_thread.call_args_list,
+                         [call("req1", ("foo", 1234)),
+                          call("req2", ("bar", 1234))])
+
+
+class RequestHandler(XMLRPCRequestHandler):
+    """ a request handler that doesn't handle a request as soon as it
+    is created """
+    def __init__(self):
+        pass
+
+
+class RequestFile(BytesIO):
+    """ a request body that do_POST() can select() on """
+    def fileno(self):
+        return 0
+
+
+def read_chunks(response):
+    """ split a response sent with chunked transfer encoding into its
+    chunks, checking the framing """
+    chunks = []
+    crlf = "\r\n".encode("UTF-8")
+    while True:
+        size, response = response.split(crlf, 1)
+        size = int(size, 16)
+        if size == 0:
+            if response != crlf:
+                raise AssertionError("Trailing data after last chunk: %r"
+                                     % response)
+            return chunks
+        chunks.append(response[:size])
+        if response[size:size + 2] != crlf:
+            raise AssertionError("Chunk of %s bytes is not followed by "
+                                 "CRLF" % size)
+        response = response[size + 2:]
+
+
+class TestXMLRPCRequestHandler(BusyTestCase):
+    def get_obj(self, request, busy=False):
+        handler = RequestHandler()
+        handler.busy = busy
+        handler.rfile = RequestFile(request)
+        handler.wfile = BytesIO()
+        handler.client_address = ("foo", 1234)
+        handler.request = Mock()
+        handler.server = XMLRPCDispatcher(True, "UTF-8")
+        handler.server.instance = Mock()
+        handler.server.logRequests = False
+        handler.close_connection = 0
+        return handler
+
+    def get_request(self, body, version="HTTP/1.1",
+                    headers=["Content-Encoding: gzip"]):
+        return ("POST /RPC2 %s\r\n"
+                "Content-Type: text/xml\r\n"
+                "%s"
+                "Content-Length: %d\r\n"
+                "\r\n" % (version,
+                           "".join([h + "\r\n" for h in headers]),
+                           len(body))).encode("UTF-8") + body
+
+    def handle_request(self, version="HTTP/1.1", headers=None, size=None):
+        """ handle a GetConfig call that returns an
+        :class:`Bcfg2.SSLServer.EncodedString`, and get the response
+        headers and body """
+        if headers is None:
+            headers = []
+        body = xmlrpclib.dumps((), "GetConfig").encode("UTF-8")
+        handler = self.get_obj(self.get_request(body, version=version,
+                                                headers=headers))
+        handler.authenticate = Mock(return_value=True)
+        if size is not None:
+            handler.server.chunk_size = size
+        self.text = u"<Configuration>caf\u00e9 & </Configuration>" * 100
+        handler.server.instance._dispatch.return_value = \
+            EncodedString(self.text.encode("UTF-8"))
+        handler._write_chunk = Mock(side_effect=handler._write_chunk)
+        patcher = patch("select.select")
+        patcher.start()
+        try:
+            handler.handle_one_request()
+        finally:
+            patcher.stop()
+        self.assertTrue(handler.server.instance._dispatch.called)
+        headers, response = \
+            handler.wfile.getvalue().split("\r\n\r\n".encode("UTF-8"), 1)
+        return handler, headers.decode("UTF-8"), response
+
+    def test_do_POST_chunked(self):
+        handler, headers, response = self.handle_request(size=16)
+        self.assertIn("Transfer-Encoding: chunked", headers)
+        self.assertNotIn("Content-length", headers)
+        chunks = read_chunks(response)
+        self.assertTrue(len(chunks) > 2)
+        self.assertEqual(xmlrpclib.loads(''.encode("UTF-8").join(chunks)),
+                         ((self.text, ), None))
+        self.assertFalse(handler.close_connection)
+
+    def test_do_POST_chunked_gzip(self):
+        handler, headers, response = \
+            self.handle_request(headers=["Accept-Encoding: gzip"], size=16)
+        self.assertIn("Transfer-Encoding: chunked", headers)
+        self.assertIn("Content-Encoding: gzip", headers)
+        # the compressor buffers most of the small chunks it is
+        # given, and the empty output is not written, since an empty
+        # chunk would end the response
+        self.assertIn(call(''.encode("UTF-8")),
+                      handler._write_chunk.call_args_list)
+        chunks = read_chunks(response)
+        self.assertTrue(len(chunks) < handler._write_chunk.call_count)
+        data = zlib.decompress(''.encode("UTF-8").join(chunks),
+                               16 + zlib.MAX_WBITS)
+        self.assertEqual(xmlrpclib.loads(data), ((self.text, ), None))
+
+    def test_do_POST_http10(self):
+        # HTTP/1.0 clients don't understand chunked transfer
+        # encoding, so the response is joined and sent with a length
+        handler, headers, response = self.handle_request(version="HTTP/1.0",
+                                                         size=16)
+        self.assertNotIn("Transfer-Encoding", headers)
+        self.assertIn("Content-length: %d" % len(response), headers)
+        self.assertFalse(handler._write_chunk.called)
+        self.assertEqual(xmlrpclib.loads(response), ((self.text, ), None))
+
+        handler, headers, response = \
+            self.handle_request(version="HTTP/1.0", size=16,
+                                headers=["Accept-Encoding: gzip"])
+        self.assertNotIn("Transfer-Encoding", headers)
+        self.assertIn("Content-Encoding: gzip", headers)
+        self.assertIn("Content-length: %d" % len(response), headers)
+        self.assertEqual(
+            xmlrpclib.loads(zlib.decompress(response, 16 + zlib.MAX_WBITS)),
+            ((self.text, ), None))
+
+    def test_do_POST_gzip_request(self):
+        request = xmlrpclib.dumps(("foo", "probe output\n" * 200),
+                                  "RecvProbeData").encode("UTF-8")
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        body = compressor.compress(request) + compressor.flush()
+        handler = self.get_obj(self.get_request(body))
+        handler.authenticate = Mock(return_value=True)
+        handler.server.instance._dispatch.return_value = True
+        patcher = patch("select.select")
+        patcher.start()
+        try:
+            handler.handle_one_request()
+        finally:
+            patcher.stop()
+
+        # compressed requests are decompressed before they are
+        # dispatched, and servers tell clients that they accept them
+        handler.server.instance._dispatch.assert_called_with(
+            "RecvProbeData", (("foo", 1234), "foo", "probe output\n" * 200),
+            handler.server.funcs)
+        headers, response = \
+            handler.wfile.getvalue().split("\r\n\r\n".encode("UTF-8"), 1)
+        self.assertIn("Accept-Encoding: gzip", headers.decode("UTF-8"))
+        self.assertEqual(xmlrpclib.loads(response), ((True, ), None))
+        self.assertFalse(handler.close_connection)
+
+    def test__write_chunk(self):
+        handler = self.get_obj("".encode("UTF-8"))
+        handler._write_chunk("".encode("UTF-8"))
+        self.assertEqual(handler.wfile.getvalue(), "".encode("UTF-8"))
+        handler._write_chunk("x" * 26)
+        self.assertEqual(handler.wfile.getvalue(),
+                         ("1a\r\n" + "x" * 26 + "\r\n").encode("UTF-8"))
+
+    def test_handle_one_request_busy(self):
+        # the body isn't valid gzip data, so it would fail if it were
+        # decompressed
+        body = "not gzipped".encode("UTF-8")
+        handler = self.get_obj(self.get_request(body), busy=True)
+        handler.do_POST = Mock()
+        handler.authenticate = Mock()
+        handler.handle_one_request()
+
+        # the client is told the server is busy as soon as the
+        # request headers have been read
+        self.assertFalse(handler.do_POST.called)
+        self.assertFalse(handler.authenticate.called)
+        self.assertFalse(handler.server.instance._dispatch.called)
+        self.assertEqual(handler.rfile.read(), body)
+        self.assertTrue(handler.close_connection)
+        headers, response = \
+            handler.wfile.getvalue().split("\r\n\r\n".encode("UTF-8"), 1)
+        self.assertIn("Connection: close".encode("UTF-8"), headers)
+        self.assertIn("Content-length: %d" % len(response),
+                      headers.decode("UTF-8"))
+        self.assertBusy(response.decode("UTF-8"))
@@ -0,0 +1,47 @@
+import os
+import sys
+from mock import Mock, patch
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+from Bcfg2.Compat import unicode  # pylint: disable=W0622
+from Bcfg2.SSLServer import EncodedString
+
+try:
+    from Bcfg2.Server.CherryPyCore import Core
+    HAS_CHERRYPY = True
+except ImportError:
+    HAS_CHERRYPY = False
+
+
+class TestCherryPyCore(Bcfg2TestCase):
+    @skipUnless(HAS_CHERRYPY, "CherryPy not found, skipping")
+    @patch("cherrypy.request")
+    @patch("cherrypy.serving")
+    @patch("cherrypy.lib.xmlrpcutil.respond")
+    @patch("cherrypy.lib.xmlrpcutil.process_body")
+    def test_default(self, mock_process_body, mock_respond, mock_serving,
+                     mock_request):
+        core = Core.__new__(Core)
+        text = u"<Configuration>caf\u00e9 &amp;</Configuration>"
+        core.GetConfig = Mock()
+        core.GetConfig.return_value = EncodedString(text.encode("UTF-8"))
+        core.GetConfig.exposed = True
+        mock_process_body.return_value = ((), "GetConfig")
+        mock_request.remote.ip = "1.2.3.4"
+        mock_request.remote.name = "foo.example.com"
+
+        self.assertEqual(core.default(), mock_serving.response.body)
+        core.GetConfig.assert_called_with(("1.2.3.4", "foo.example.com"))
+        # the CherryPy core marshals responses itself, so encoded
+        # strings are decoded first
+        mock_respond.assert_called_with(text, 'utf-8', True)
+        self.assertIsInstance(mock_respond.call_args[0][0], unicode)
@@ -0,0 +1,606 @@
+import os
+import sys
+import copy
+import time
+import logging
+import threading
+import lxml.etree
+from mock import Mock, MagicMock, patch
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+import Bcfg2.Server.Plugin
+from Bcfg2.Utils import WorkerPool
+from Bcfg2.Server.Core import *
+from Bcfg2.Server.Plugins.Pkgmgr import FuzzyDict
+
+try:
+    # importing Hostbase sets the Django settings module
+    django_settings = os.environ.get('DJANGO_SETTINGS_MODULE')
+    try:
+        from Bcfg2.Server.Plugins.Hostbase import Hostbase
+        HAS_HOSTBASE = True
+    except ImportError:
+        HAS_HOSTBASE = False
+finally:
+    if django_settings is None:
+        os.environ.pop('DJANGO_SETTINGS_MODULE', None)
+    else:
+        os.environ['DJANGO_SETTINGS_MODULE'] = django_settings
+
+
+def get_core(cache_mode="cautious"):
+    """ get a BaseCore object with just enough set up to build client
+    metadata """
+    core = BaseCore.__new__(BaseCore)
+    core.setup = MagicMock()
+    core.setup.cfp.get.return_value = cache_mode
+    core.logger = logging.getLogger("TestCore")
+    core.metadata = Mock()
+    core.connectors = []
+    core.terminate = threading.Event()
+    core.metadata_cache = MetadataCache()
+    core.metadata_building = dict()
+    core.metadata_lock = threading.Lock()
+    core.metadata_warmup = None
+    core.plugins = dict()
+    core.fam_event_count = 0
+    core.lock = threading.Lock()
+    core.generators = []
+    core.generator_index = GeneratorIndex(core.generators)
+    core.bind_pool = None
+    core.setup.cfp.getboolean.return_value = False
+    return core
+
+
+class EntriesGenerator(Bcfg2.Server.Plugin.Generator):
+    """ a generator that binds the Path entries in its ``Entries``,
+    and records the threads it binds them in """
+
+    def __init__(self, name, paths, thread_safe=True):
+        self.name = name
+        self.thread_safe = thread_safe
+        self.Entries = dict(Path=dict((p, self.bind_entry) for p in paths))
+        self.threads = set()
+
+    def bind_entry(self, entry, metadata):
+        self.threads.add(threading.currentThread())
+        if entry.get("name").startswith("/fail"):
+            raise Bcfg2.Server.Plugin.PluginExecutionError("%s failed" %
+                                                           entry.get("name"))
+        entry.set("type", "file")
+        entry.text = "%s:%s" % (self.name, entry.get("name"))
+
+
+class HandlerGenerator(EntriesGenerator):
+    """ a generator that binds Service entries with
+    :func:`HandlesEntry` """
+    handles_tags = ["Service"]
+
+    def HandlesEntry(self, entry, metadata):
+        return entry.get("name").startswith("svc")
+
+    def HandleEntry(self, entry, metadata):
+        self.threads.add(threading.currentThread())
+        entry.set("status", "on")
+
+
+class TestBaseCore(Bcfg2TestCase):
+    def test_build_metadata(self):
+        core = get_core()
+        built = []
+
+        def build(client):
+            built.append(client)
+            time.sleep(0.1)
+            rv = Mock()
+            rv.hostname = client
+            return rv
+
+        core.metadata.get_initial_metadata.side_effect = build
+        results = []
+
+        def run():
+            results.append(core.build_metadata("foo"))
+
+        threads = [threading.Thread(target=run) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # the metadata was only built once, and every thread got the
+        # same cached object
+        self.assertEqual(built, ["foo"])
+        self.assertEqual(len(results), 10)
+        self.assertEqual(len(set([id(r) for r in results])), 1)
+        self.assertEqual(core.metadata_cache["foo"], results[0])
+        self.assertEqual(core.metadata_building, dict())
+
+        # cached metadata is returned without being built again
+        self.assertEqual(core.build_metadata("foo"), results[0])
+        self.assertEqual(built, ["foo"])
+
+    def test_build_metadata_failure(self):
+        core = get_core()
+        built = []
+
+        def build(client):
+            built.append(client)
+            time.sleep(0.1)
+            raise ValueError(client)
+
+        core.metadata.get_initial_metadata.side_effect = build
+        errors = []
+
+        def run():
+            try:
+                core.build_metadata("foo")
+            except ValueError:
+                errors.append(sys.exc_info()[1])
+
+        threads = [threading.Thread(target=run) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # threads that waited for a failed build try it themselves,
+        # and nobody is left waiting
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(len(built), 3)
+        self.assertEqual(core.metadata_building, dict())
+        self.assertNotIn("foo", core.metadata_cache)
+
+    def test_build_metadata_uncached(self):
+        core = get_core(cache_mode="off")
+        core.build_metadata("foo")
+        core.build_metadata("foo")
+        self.assertEqual(core.metadata.get_initial_metadata.call_count, 2)
+        self.assertNotIn("foo", core.metadata_cache)
+
+    def test__fam_events_handled(self):
+        core = get_core()
+        core.metadata_warmup = Mock()
+        core.start_metadata_warmup = Mock()
+        core._fam_events_handled(handled=False)
+        self.assertFalse(core.start_metadata_warmup.called)
+        core._fam_events_handled()
+        core.start_metadata_warmup.assert_called_with()
+
+    def test__file_monitor_thread(self):
+        core = get_core()
+        core.config_cache = DependencyCache()
+        core.config_cache.ignore_path("/repo/Probes/probed.xml")
+        core.fam = Mock()
+        core.fam.fileno.return_value = 0
+        core.fam.pending.return_value = True
+        core._fam_events_handled = Mock()
+        passes = [["/repo/foo"], [], ["/repo/Probes/probed.xml"],
+                  ["/repo/Probes/probed.xml", "/repo/Probes/probed.xml",
+                   "/repo/bar"]]
+
+        def handle_event_set(lock):
+            for path in passes.pop(0):
+                core._count_fam_event(Mock(), path)
+            if not passes:
+                core.terminate.set()
+
+        core.fam.handle_event_set.side_effect = handle_event_set
+        core._file_monitor_thread()
+        # events on ignored paths, like data that a plugin writes
+        # itself, don't count as handled events
+        self.assertEqual(core._fam_events_handled.call_args_list,
+                         [call(handled=True), call(handled=False),
+                          call(handled=False), call(handled=True)])
+
+
+class TestConfigCache(Bcfg2TestCase):
+    def get_core(self):
+        core = get_core()
+        core.setup.cfp.getboolean.return_value = True
+        core.config_cache = DependencyCache()
+        core.revision = "1"
+        core.client_run_hook = Mock()
+        core.GetStructures = Mock(return_value=[])
+        core.validate_structures = Mock()
+        core.validate_goals = Mock()
+        core.BindStructures = Mock(side_effect=self.bind)
+        self.failed = False
+        self.during_bind = None
+
+        self.metadata = Mock()
+        self.metadata.hostname = "foo.example.com"
+        self.metadata.profile = "basic"
+        self.metadata.groups = set(["basic", "web"])
+        self.metadata.bundles = set(["web"])
+        self.metadata.categories = dict()
+        self.metadata.aliases = []
+        self.metadata.addresses = []
+        self.metadata.uuid = None
+        self.metadata.version = "1.3.0"
+        self.metadata.connectors = []
+        core.build_metadata = Mock(return_value=self.metadata)
+        return core
+
+    def bind(self, structures, metadata, config):
+        entry = lxml.etree.SubElement(config, "Path", name="/etc/motd")
+        if self.failed:
+            entry.set("failure", "bind failed")
+        if self.during_bind is not None:
+            self.during_bind()
+
+    def test_BuildConfiguration(self):
+        core = self.get_core()
+        config = core.BuildConfiguration("foo.example.com")
+        self.assertEqual(core.BindStructures.call_count, 1)
+        self.assertIn("foo.example.com", core.config_cache)
+
+        # a cache hit is served without binding anything, and is a
+        # copy that the caller can change without changing the cache
+        cached = core.BuildConfiguration("foo.example.com")
+        self.assertEqual(core.BindStructures.call_count, 1)
+        self.assertXMLEqual(cached, config)
+        self.assertIsNot(cached, config)
+        self.assertIsNot(cached, core.config_cache["foo.example.com"][1])
+        cached[0].set("name", "/etc/issue")
+        self.assertXMLEqual(core.BuildConfiguration("foo.example.com"),
+                            config)
+        self.assertEqual(core.BindStructures.call_count, 1)
+        core.client_run_hook.assert_called_with("end_client_run",
+                                                self.metadata)
+
+    def test_BuildConfiguration_changed(self):
+        core = self.get_core()
+        core.BuildConfiguration("foo.example.com")
+        self.assertEqual(core.BindStructures.call_count, 1)
+
+        # changed metadata doesn't match the fingerprint the config
+        # was cached with, so the config is rebuilt and recached
+        self.metadata.groups = set(["basic", "db"])
+        core.BuildConfiguration("foo.example.com")
+        self.assertEqual(core.BindStructures.call_count, 2)
+        core.BuildConfiguration("foo.example.com")
+        self.assertEqual(core.BindStructures.call_count, 2)
+
+        # as does a new revision of the repository
+        core.revision = "2"
+        core.BuildConfiguration("foo.example.com")
+        self.assertEqual(core.BindStructures.call_count, 3)
+        self.assertTrue(
+            core.config_cache["foo.example.com"][0].startswith("2:"))
+
+    def test_BuildConfiguration_failure(self):
+        core = self.get_core()
+        self.failed = True
+        core.BuildConfiguration("foo.example.com")
+        self.assertNotIn("foo.example.com", core.config_cache)
+        core.BuildConfiguration("foo.example.com")
+        self.assertEqual(core.BindStructures.call_count, 2)
+
+        # a config that binds after a failure is cached
+        self.failed = False
+        core.BuildConfiguration("foo.example.com")
+        self.assertIn("foo.example.com", core.config_cache)
+
+    def test_BuildConfiguration_generation(self):
+        core = self.get_core()
+
+        # a config built while the repository changed isn't cached,
+        # since it may have been built from the old data
+        self.during_bind = core.config_cache.expire
+        config = core.BuildConfiguration("foo.example.com")
+        self.assertEqual(len(config), 1)
+        self.assertNotIn("foo.example.com", core.config_cache)
+
+        self.during_bind = None
+        core.BuildConfiguration("foo.example.com")
+        self.assertIn("foo.example.com", core.config_cache)
+
+    def test_BuildConfiguration_disabled(self):
+        core = self.get_core()
+        core.setup.cfp.getboolean.return_value = False
+        core.BuildConfiguration("foo.example.com")
+        core.BuildConfiguration("foo.example.com")
+        self.assertEqual(core.BindStructures.call_count, 2)
+        self.assertNotIn("foo.example.com", core.config_cache)
+
+    def test__expire_config_cache(self):
+        core = self.get_core()
+        core.config_cache.ignore_path("/repo/Probes/probed.xml")
+        core.BuildConfiguration("foo.example.com")
+        core._expire_config_cache(Mock(), "/repo/Probes/probed.xml")
+        self.assertIn("foo.example.com", core.config_cache)
+        core._expire_config_cache(Mock(), "/repo/Bundler/web.xml")
+        self.assertNotIn("foo.example.com", core.config_cache)
+
+
+class TestGeneratorIndex(Bcfg2TestCase):
+    def get_generators(self):
+        gen1 = EntriesGenerator("Gen1", ["/foo", "/both"])
+        gen1.data = "/repo/Gen1"
+        gen2 = EntriesGenerator("Gen2", ["/bar", "/both"])
+        gen2.data = "/repo/Gen2"
+        return [gen1, gen2]
+
+    def test_get_generators(self):
+        gen1, gen2 = self.get_generators()
+        index = GeneratorIndex([gen1, gen2])
+        self.assertEqual(index.get_generators("Path", "/foo"), [gen1])
+        self.assertEqual(index.get_generators("Path", "/bar"), [gen2])
+        self.assertEqual(index.get_generators("Path", "/both"),
+                         [gen1, gen2])
+        self.assertEqual(index.get_generators("Path", "/baz"), [])
+        self.assertEqual(index.get_generators("Service", "/foo"), [])
+
+        # entries that have been removed are never returned, even
+        # before the generator is reindexed
+        del gen1.Entries["Path"]["/both"]
+        self.assertEqual(index.get_generators("Path", "/both"), [gen2])
+
+    def test_expire_path(self):
+        gen1, gen2 = self.get_generators()
+        index = GeneratorIndex([gen1, gen2])
+        index.get_generators("Path", "/foo")
+        index._add = Mock(side_effect=index._add)
+
+        gen1.Entries["Path"]["/new"] = gen1.bind_entry
+        gen2.Entries["Path"]["/new2"] = gen2.bind_entry
+        self.assertEqual(index.get_generators("Path", "/new"), [])
+
+        # paths outside of a generator's data directory don't
+        # expire it
+        for path in ["/repo", "/repo/Gen10/foo", "/etc/foo"]:
+            index.expire_path(path)
+            self.assertEqual(index.get_generators("Path", "/new"), [])
+        self.assertFalse(index._add.called)
+
+        # only the generator whose data changed is reindexed
+        index.expire_path("/repo/Gen1/new/info.xml")
+        self.assertEqual(index.get_generators("Path", "/new"), [gen1])
+        index._add.assert_called_once_with(gen1)
+        self.assertEqual(index.get_generators("Path", "/new2"), [])
+        self.assertEqual(index.get_generators("Path", "/both"),
+                         [gen1, gen2])
+
+        index._add.reset_mock()
+        index.expire_path("/repo/Gen2")
+        self.assertEqual(index.get_generators("Path", "/new2"), [gen2])
+        index._add.assert_called_once_with(gen2)
+
+        # expire() reindexes every generator
+        index._add.reset_mock()
+        index.expire()
+        self.assertEqual(index.get_generators("Path", "/foo"), [gen1])
+        self.assertItemsEqual(index._add.call_args_list,
+                              [call(gen1), call(gen2)])
+
+    def test_unindexed(self):
+        gen1, gen2 = self.get_generators()
+        gen1.Entries["Package"] = FuzzyDict(foo=gen1.bind_entry)
+        gen2.Entries["Package"] = dict(bar=gen2.bind_entry)
+        index = GeneratorIndex([gen1, gen2])
+
+        # FuzzyDict matches names that aren't among its keys, so it is
+        # searched on every lookup
+        self.assertEqual(index.get_generators("Package", "foo"), [gen1])
+        self.assertEqual(index.get_generators("Package", "foo:i386"), [gen1])
+        self.assertEqual(index.get_generators("Package", "bar"), [gen2])
+        self.assertEqual(index.get_generators("Package", "baz"), [])
+        self.assertEqual(index.index["Package"].keys(), ["bar"])
+        self.assertEqual(index.unindexed["Package"], [gen1])
+
+        # and changes to it are seen without reindexing
+        gen1.Entries["Package"]["baz"] = gen1.bind_entry
+        self.assertEqual(index.get_generators("Package", "baz"), [gen1])
+
+        # reindexing doesn't add it twice
+        index.expire()
+        self.assertEqual(index.get_generators("Package", "foo"), [gen1])
+        self.assertEqual(index.unindexed["Package"], [gen1])
+
+    def test_get_handlers(self):
+        entries, = self.get_generators()[:1]
+        services = HandlerGenerator("Services", [])
+        anything = HandlerGenerator("Anything", [])
+        anything.handles_tags = None
+        index = GeneratorIndex([entries, services, anything])
+
+        # generators that don't override HandlesEntry() are never
+        # asked about entries
+        self.assertEqual(index.get_handlers("Service"), [services, anything])
+        self.assertEqual(index.get_handlers("Path"), [anything])
+
+        # the generators for each tag are cached, even if there are
+        # none, so tags that no generator handles are rejected without
+        # calling anything
+        anything.handles_tags = ["Package"]
+        index.generators.remove(anything)
+        self.assertEqual(index.get_handlers("Path"), [anything])
+        self.assertEqual(index.get_handlers("Action"), [])
+        self.assertEqual(index.handlers["Action"], [])
+        index.generators.append(anything)
+        anything.handles_tags = None
+        self.assertEqual(index.get_handlers("Action"), [])
+
+    def test__bind_unhandled(self):
+        core = get_core()
+        services = HandlerGenerator("Services", [])
+        services.HandlesEntry = Mock(return_value=False)
+        core.generators = [services]
+        core.generator_index = GeneratorIndex(core.generators)
+        entry = lxml.etree.Element("Action", name="foo")
+        self.assertRaises(Bcfg2.Server.Plugin.PluginExecutionError,
+                          core.Bind, entry, Mock())
+        self.assertEqual(entry.get("failure"), "no matching generator")
+        self.assertFalse(services.HandlesEntry.called)
+
+    @skipUnless(HAS_HOSTBASE, "Hostbase could not be imported, skipping")
+    def test_hostbase_expire(self):
+        hostbase = Hostbase.__new__(Hostbase)
+        hostbase.name = "Hostbase"
+        hostbase.Entries = dict(ConfigFile=dict())
+        hostbase.core = Mock()
+        hostbase.core.generator_index = GeneratorIndex([hostbase])
+        self.assertEqual(
+            hostbase.core.generator_index.get_generators("ConfigFile",
+                                                         "/etc/hosts"),
+            [])
+
+        def build_hosts():
+            hostbase.Entries["ConfigFile"]["/etc/hosts"] = Mock()
+
+        for method in ["buildZones", "buildDHCP", "buildHostsLPD",
+                       "buildPrinters", "buildNetgroups"]:
+            setattr(hostbase, method, Mock())
+        hostbase.buildHosts = Mock(side_effect=build_hosts)
+
+        # Hostbase's entries change without a file monitor event, so
+        # it expires them itself
+        self.assertTrue(hostbase.rebuildState(None))
+        self.assertEqual(
+            hostbase.core.generator_index.get_generators("ConfigFile",
+                                                         "/etc/hosts"),
+            [hostbase])
+
+
+class TestBindParallel(Bcfg2TestCase):
+    def get_core(self, generators):
+        core = get_core()
+        core.generators = generators
+        core.generator_index = GeneratorIndex(generators)
+        return core
+
+    def get_structures(self):
+        bundle1 = lxml.etree.Element("Bundle", name="bundle1")
+        for name in ["/safe1", "/unsafe1", "/fail1", "/missing", "/both",
+                     "/unsafe2", "/safe2"]:
+            lxml.etree.SubElement(bundle1, "Path", name=name)
+        lxml.etree.SubElement(bundle1, "Path", name="/alt", altsrc="/safe1")
+        lxml.etree.SubElement(bundle1, "Path", name="/unsafe-alt",
+                              altsrc="/unsafe1")
+        lxml.etree.SubElement(bundle1, "Service", name="svc1")
+        lxml.etree.SubElement(bundle1, "Service", name="other")
+        bundle2 = lxml.etree.Element("Bundle", name="bundle2")
+        for name in ["/safe3", "/fail2", "/safe1"]:
+            lxml.etree.SubElement(bundle2, "Path", name=name)
+        return [bundle1, bundle2]
+
+    def get_generators(self):
+        return [EntriesGenerator("Safe", ["/safe1", "/safe2", "/safe3",
+                                          "/fail1", "/fail2", "/both"]),
+                EntriesGenerator("Unsafe", ["/unsafe1", "/unsafe2", "/both"],
+                                 thread_safe=False),
+                HandlerGenerator("Services", [])]
+
+    def build(self, core, metadata):
+        config = lxml.etree.Element("Configuration")
+        core.BindStructures(self.get_structures(), metadata, config)
+        sort_xml(config, key=lambda e: e.get('name'))
+        for entry in config.xpath("//*[@failure]"):
+            # the traceback differs between threads, so only the
+            # error it ends with is compared
+            entry.set("failure", entry.get("failure").splitlines()[-1])
+        return lxml.etree.tostring(config)
+
+    def test_BindStructures(self):
+        metadata = Mock()
+        metadata.hostname = "foo.example.com"
+        serial = self.build(self.get_core(self.get_generators()), metadata)
+
+        generators = self.get_generators()
+        core = self.get_core(generators)
+        core.bind_pool = WorkerPool(4, name="TestBindPool")
+        try:
+            parallel = self.build(core, metadata)
+        finally:
+            core.bind_pool.shutdown()
+        self.assertEqual(parallel, serial)
+        for entry in lxml.etree.XML(parallel).xpath("//*[@failure]"):
+            self.assertIn(entry.get("name"),
+                          ["/fail1", "/fail2", "/missing", "/both", "other"])
+
+        # entries bound by thread-safe generators were bound in the
+        # pool, and the others in the calling thread
+        safe, unsafe, services = generators
+        self.assertNotIn(threading.currentThread(), safe.threads)
+        self.assertEqual(unsafe.threads, set([threading.currentThread()]))
+        self.assertNotIn(threading.currentThread(), services.threads)
+
+    def test__can_bind_in_parallel(self):
+        safe, unsafe, services = self.get_generators()
+        core = self.get_core([safe, unsafe, services])
+
+        def can_bind(tag, name, **attrs):
+            return core._can_bind_in_parallel(
+                lxml.etree.Element(tag, name=name, **attrs))
+
+        self.assertTrue(can_bind("Path", "/safe1"))
+        self.assertFalse(can_bind("Path", "/unsafe1"))
+        self.assertFalse(can_bind("Path", "/safe1", altsrc="/unsafe1"))
+        self.assertFalse(can_bind("Path", "/unsafe1", altsrc="/safe1"))
+        self.assertTrue(can_bind("Service", "svc1"))
+        # entries with no exact match can go to any generator that
+        # handles the tag with HandlesEntry()
+        self.assertTrue(can_bind("Path", "/missing"))
+        services.thread_safe = False
+        self.assertFalse(can_bind("Service", "svc1"))
+        self.assertTrue(can_bind("Path", "/missing"))
+        self.assertTrue(can_bind("Path", "/safe1"))
+
+        # an entry in the Entries of more than one generator is bound
+        # with HandlesEntry() too
+        services.handles_tags = None
+        core.generator_index = GeneratorIndex(core.generators)
+        self.assertFalse(can_bind("Path", "/missing"))
+        self.assertFalse(can_bind("Path", "/both"))
+        self.assertTrue(can_bind("Path", "/safe1"))
+
+
+class TestMetadataWarmup(Bcfg2TestCase):
+    def test_failed_clients(self):
+        core = get_core()
+        core.metadata.clients = ["good", "bad"]
+
+        def build(client):
+            if client == "bad":
+                raise ValueError(client)
+            return Mock()
+
+        core.metadata.get_initial_metadata.side_effect = build
+        core.metadata_warmup = MetadataWarmup(core, threads=2)
+        core.metadata_cache.warmup = core.metadata_warmup
+
+        def warm_up():
+            core.start_metadata_warmup()
+            while core.metadata_warmup.status()['running']:
+                time.sleep(0.01)
+
+        warm_up()
+        self.assertIn("good", core.metadata_cache)
+        self.assertEqual(core.metadata_warmup.failed_clients,
+                         set(["bad"]))
+        self.assertEqual(core.metadata.get_initial_metadata.call_count, 2)
+
+        # the failed client isn't retried
+        warm_up()
+        self.assertEqual(core.metadata.get_initial_metadata.call_count, 2)
+
+        # until its metadata is expired
+        core.metadata_cache.expire("bad")
+        self.assertEqual(core.metadata_warmup.failed_clients, set())
+        warm_up()
+        self.assertEqual(core.metadata.get_initial_metadata.call_count, 3)
+
+        # or all metadata is expired
+        core.metadata_cache.expire()
+        self.assertEqual(core.metadata_warmup.failed_clients, set())
+        warm_up()
+        self.assertEqual(core.metadata.get_initial_metadata.call_count, 5)
@@ -0,0 +1,284 @@
+import os
+import sys
+import threading
+from mock import Mock
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+from Bcfg2.Compat import xmlrpclib
+from Bcfg2.Server.FileMonitor import FileMonitor
+
+try:
+    import multiprocessing
+    from Bcfg2.Server.MultiprocessingCore import Core, Channel, \
+        forward_events
+    HAS_MULTIPROCESSING = True
+except ImportError:
+    HAS_MULTIPROCESSING = False
+
+
+class MasterMonitor(FileMonitor):
+    """ a file monitor backend whose event handling must not be used
+    in a worker process """
+
+    def AddMonitor(self, path, obj, handleID=None):
+        if handleID is None:
+            handleID = len(self.handles)
+        self.handles[handleID] = obj
+        self.paths[handleID] = path
+        return handleID
+
+    def fileno(self):
+        return 42
+
+    def handle_event_set(self, lock=None):
+        raise AssertionError("handle_event_set() called on the master's "
+                             "file monitor")
+
+    def handle_events_in_interval(self, interval):
+        raise AssertionError("handle_events_in_interval() called on the "
+                             "master's file monitor")
+
+
+class TestForwardedFileMonitor(Bcfg2TestCase):
+    def get_obj(self, paths):
+        fam = MasterMonitor()
+        handlers = dict()
+        for fpath in paths:
+            handlers[fpath] = Mock()
+            fam.AddMonitor(fpath, handlers[fpath])
+        forward_events(fam)
+        return fam, handlers
+
+    def get_handled(self, handler):
+        return [(e.filename, e.code2str())
+                for e in [c[0][0] for c in handler.HandleEvent.call_args_list]]
+
+    @skipUnless(HAS_MULTIPROCESSING, "multiprocessing not found, skipping")
+    def test_forward_events(self):
+        fam, handlers = self.get_obj(["/repo/foo"])
+        self.assertEqual(fam.fileno(), 0)
+        fam.handle_events_in_interval(0)
+        fam.add_event(0, "/repo/foo", "bar", "changed")
+        fam.handle_event_set(threading.Lock())
+        self.assertEqual(self.get_handled(handlers["/repo/foo"]),
+                         [("bar", "changed")])
+        self.assertFalse(fam.pending())
+
+    @skipUnless(HAS_MULTIPROCESSING, "multiprocessing not found, skipping")
+    def test_remap(self):
+        fam, handlers = self.get_obj(["/repo/foo", "/repo/bar/"])
+        new = Mock()
+
+        def add_monitor(event):
+            if event.code2str() == "created":
+                fam.AddMonitor("/repo/foo/%s" % event.filename, new)
+
+        # the handler for /repo/foo adds a monitor for a new
+        # directory while the event set that includes the first event
+        # for that directory is handled
+        handlers["/repo/foo"].HandleEvent.side_effect = add_monitor
+        # the master's IDs for the monitors it adds after the worker
+        # was forked may belong to other monitors in the worker
+        fam.add_event(0, "/repo/foo", "new", "created")
+        fam.add_event(1, "/repo/foo/new", "baz", "created")
+        fam.add_event(1, "/repo/bar/", "quux", "changed")
+        fam.add_event(7, "/repo/bar", "quux", "deleted")
+        fam.add_event(8, "/repo/unknown", "quux", "changed")
+        fam.handle_event_set()
+
+        self.assertEqual(self.get_handled(handlers["/repo/foo"]),
+                         [("new", "created")])
+        self.assertEqual(self.get_handled(new), [("baz", "created")])
+        self.assertEqual(self.get_handled(handlers["/repo/bar/"]),
+                         [("quux", "changed"), ("quux", "deleted")])
+        self.assertEqual(fam.paths["/repo/foo/new"], "/repo/foo/new")
+
+
+class TestMultiprocessingCore(Bcfg2TestCase):
+    def get_core(self):
+        core = Core.__new__(Core)
+        core.logger = Mock()
+        core.workers = []
+        core.master = None
+        core.resolved = threading.local()
+        core.calls = dict()
+        core.last_call_id = 0
+        core.calls_lock = threading.Lock()
+        core.metadata = Mock()
+        core.server = Mock()
+        core.master_thread = None
+        return core
+
+    def start_thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+    def call_master(self, worker, method, args):
+        """ call _call_master() in another thread, so that a worker
+        that deadlocks doesn't hang the test suite """
+        rv = []
+
+        def inner():
+            try:
+                rv.append(worker._call_master(method, args))
+            except xmlrpclib.Fault:
+                rv.append(sys.exc_info()[1])
+
+        thread = self.start_thread(inner)
+        thread.join(5)
+        self.assertFalse(thread.isAlive())
+        return rv[0]
+
+    def get_cores(self):
+        """ get a master and a worker core that are connected by a
+        pipe, with the threads that handle calls from the worker and
+        messages from the master running """
+        mconn, wconn = multiprocessing.Pipe()
+        master = self.get_core()
+        master.workers = [Channel(mconn, process=Mock())]
+        worker = self.get_core()
+        worker.master = Channel(wconn)
+        worker.resolve_client = Mock(return_value=("foo.example.com", None))
+        self.start_thread(master._serve_worker, master.workers[0])
+        self.start_thread(worker._master_thread)
+        self.conns = [mconn, wconn]
+        return master, worker
+
+    def tearDown(self):
+        for conn in getattr(self, "conns", []):
+            conn.close()
+
+    @skipUnless(HAS_MULTIPROCESSING, "multiprocessing not found, skipping")
+    def test__call_master(self):
+        master, worker = self.get_cores()
+        master.RecvStats = Mock(return_value="<ok/>")
+        self.assertEqual(worker._call_master("RecvStats",
+                                             ("1.2.3.4", "<Statistics/>")),
+                         "<ok/>")
+        master.RecvStats.assert_called_with("1.2.3.4", "<Statistics/>")
+        worker.resolve_client.assert_called_with("1.2.3.4", metadata=False)
+        self.assertEqual(worker.calls, dict())
+
+        # faults are raised in the worker
+        master.RecvStats.side_effect = ValueError("bogus statistics")
+        try:
+            worker._call_master("RecvStats", ("1.2.3.4", "<Statistics/>"))
+            self.fail("_call_master() did not raise a fault")
+        except xmlrpclib.Fault:
+            err = sys.exc_info()[1]
+            self.assertEqual(err.faultString, "bogus statistics")
+        self.assertEqual(worker.calls, dict())
+
+    @skipUnless(HAS_MULTIPROCESSING, "multiprocessing not found, skipping")
+    def test__call_master_replay(self):
+        master, worker = self.get_cores()
+        master.RecvProbeData = Mock(return_value=True)
+        resolved = []
+
+        def replay(address, probedata):
+            resolved.append(worker.resolve_client(address,
+                                                  metadata=False)[0])
+
+        worker.RecvProbeData = Mock(side_effect=replay)
+        del worker.resolve_client
+        worker.resolved.client = "foo.example.com"
+        self.assertTrue(worker._call_master("RecvProbeData",
+                                            ("1.2.3.4", "<probes/>")))
+        # the worker that made the call has replayed it by the time
+        # the call returns, with the client that it resolved
+        worker.RecvProbeData.assert_called_with("1.2.3.4", "<probes/>")
+        self.assertEqual(resolved, ["foo.example.com"])
+
+        # calls that fail aren't replayed
+        worker.RecvProbeData.reset_mock()
+        master.RecvProbeData.side_effect = ValueError
+        self.assertRaises(xmlrpclib.Fault, worker._call_master,
+                          "RecvProbeData", ("1.2.3.4", "<probes/>"))
+        self.assertFalse(worker.RecvProbeData.called)
+
+        # nor are calls that are only made in the master
+        master.RecvStats = Mock(return_value="<ok/>")
+        worker.RecvStats = Mock()
+        worker._call_master("RecvStats", ("1.2.3.4", "<Statistics/>"))
+        self.assertFalse(worker.RecvStats.called)
+
+    @skipUnless(HAS_MULTIPROCESSING, "multiprocessing not found, skipping")
+    def test__metadata_method(self):
+        master, worker = self.get_cores()
+        master.metadata.set_profile.return_value = None
+        set_profile = worker._metadata_method("set_profile")
+        set_profile("foo.example.com", "basic", (None, None))
+        # the worker updates its copy of the data, and the master
+        # writes it
+        worker.metadata.set_profile.assert_called_with("foo.example.com",
+                                                       "basic", (None, None))
+        master.metadata.set_profile.assert_called_with("foo.example.com",
+                                                       "basic", (None, None))
+        self.assertFalse(worker.resolve_client.called)
+
+        master.metadata.set_profile.side_effect = ValueError
+        self.assertRaises(xmlrpclib.Fault, set_profile, "foo.example.com",
+                          "basic", (None, None))
+
+    @skipUnless(HAS_MULTIPROCESSING, "multiprocessing not found, skipping")
+    def test__replay_new_client(self):
+        master, worker = self.get_cores()
+        master.RecvProbeData = Mock(return_value=True)
+        master.metadata.set_profile.return_value = None
+        local_set_profile = worker.metadata.set_profile
+        worker.metadata.set_profile = worker._metadata_method("set_profile")
+
+        def replay(address, probedata):
+            # the master added the new client when it handled the
+            # call, and resolving it in the worker adds it again
+            worker.metadata.set_profile("new.example.com", "basic",
+                                        (None, None))
+
+        worker.RecvProbeData = Mock(side_effect=replay)
+        self.assertTrue(self.call_master(worker, "RecvProbeData",
+                                         ("1.2.3.4", "<probes/>")))
+        # the worker updates its copy of the data, but doesn't pass
+        # the call on to the master
+        local_set_profile.assert_called_with("new.example.com", "basic",
+                                             (None, None))
+        self.assertFalse(master.metadata.set_profile.called)
+        self.assertFalse(worker.logger.error.called)
+
+        # calls to the master while a call is replayed fail instead
+        # of waiting for a result that can never be received
+        master.RecvStats = Mock(return_value="<ok/>")
+        failed = []
+
+        def replay_call(address, probedata):
+            try:
+                worker._call_master("RecvStats", (address, "<Statistics/>"))
+            except xmlrpclib.Fault:
+                failed.append(sys.exc_info()[1])
+
+        worker.RecvProbeData.side_effect = replay_call
+        self.assertTrue(self.call_master(worker, "RecvProbeData",
+                                         ("1.2.3.4", "<probes/>")))
+        self.assertEqual(len(failed), 1)
+        self.assertFalse(master.RecvStats.called)
+        self.assertEqual(worker.calls, dict())
+
+    @skipUnless(HAS_MULTIPROCESSING, "multiprocessing not found, skipping")
+    def test__replay_assert_profile(self):
+        master, worker = self.get_cores()
+        master.AssertProfile = Mock(return_value=True)
+        worker.AssertProfile = Mock(return_value=True)
+        self.assertTrue(self.call_master(worker, "AssertProfile",
+                                         ("1.2.3.4", "web")))
+        master.AssertProfile.assert_called_with("1.2.3.4", "web")
+        worker.AssertProfile.assert_called_with("1.2.3.4", "web")
@@ -72,6 +72,27 @@ class TestFunctions(Bcfg2TestCase):
                                    test4="test4",
                                    name="/test"))
 
+    def test_bulk_create(self):
+        model = Mock()
+        model._meta.fields = range(300)
+        objs = list(range(7))
+        bulk_create(model, objs)
+        # objects are inserted in batches that stay well under
+        # sqlite's limit of 999 parameters per query
+        self.assertEqual(model.objects.bulk_create.call_args_list,
+                         [call([0, 1, 2]), call([3, 4, 5]), call([6])])
+
+        model.objects.reset_mock()
+        bulk_create(model, [])
+        self.assertFalse(model.objects.bulk_create.called)
+
+        # before Django 1.4, each object is saved on its own
+        model.objects = Mock(spec=["filter"])
+        objs = [Mock(), Mock()]
+        bulk_create(model, objs)
+        for obj in objs:
+            obj.save.assert_called_with()
+
 
 class TestDatabaseBacked(TestPlugin):
     test_obj = DatabaseBacked
@@ -364,6 +364,12 @@ class TestXMLMetadataConfig(TestXMLFileBacked):
         self.assertRaises(Bcfg2.Server.Plugin.MetadataRuntimeError,
                           config.write_xml, fpath, get_clients_test_tree())
 
+        # nothing is written by processes that don't write client data
+        mock_open.reset_mock()
+        self.metadata.core.write_client_data = False
+        config.write_xml(fpath, get_clients_test_tree())
+        self.assertFalse(mock_open.called)
+
     @patch("Bcfg2.Server.Plugins.Metadata.XMLMetadataConfig.load_xml", Mock())
     @patch('lxml.etree.parse')
     def test_find_xml_for_xpath(self, mock_parse):
@@ -413,6 +419,31 @@ class TestClientMetadata(Bcfg2TestCase):
         self.assertFalse(cm.inGroup("group3"))
 
 
+class TestMetadataClientIndex(Bcfg2TestCase):
+    def test_lookup(self):
+        index = MetadataClientIndex()
+        index.update("foo", ["group1", "group2"], key=1)
+        index.update("bar", ["group2"])
+        self.assertIn("foo", index)
+        self.assertEqual(index.get_key("foo"), 1)
+        self.assertIsNone(index.get_key("baz"))
+        self.assertEqual(index.missing(["foo", "baz"]), set(["baz"]))
+
+        self.assertEqual(index.lookup(["group2"]), set(["foo", "bar"]))
+        self.assertEqual(index.lookup(["group1", "group2"]), set(["foo"]))
+        self.assertEqual(index.lookup(["group1", "group3"]), set())
+        self.assertEqual(index.lookup(["group1", "group3"], match_all=False),
+                         set(["foo"]))
+        self.assertEqual(index.lookup([]), set(["foo", "bar"]))
+
+        index.update("foo", ["group3"])
+        self.assertEqual(index.lookup(["group2"]), set(["bar"]))
+        index.remove("bar")
+        self.assertNotIn("group2", index.index)
+        index.clear()
+        self.assertEqual(len(index), 0)
+
+
 class TestMetadata(_TestMetadata, TestStatistics, TestDatabaseBacked):
     test_obj = Metadata
     use_db = False
@@ -735,8 +766,16 @@ class TestMetadata(_TestMetadata, TestStatistics, TestDatabaseBacked):
 
         self.assertItemsEqual(metadata.addresses, addresses)
         self.assertItemsEqual(metadata.raddresses, raddresses)
+        self.assertEqual(metadata.ruuid, dict(client3="uuid1"))
         self.assertTrue(metadata.states['clients.xml'])
 
+        # only the metadata of clients that have changed is expired
+        metadata.core.metadata_cache = Mock()
+        metadata.clients_xml.xdata.xpath("//Client[@name='client2']")[0].set(
+            "profile", "group1")
+        metadata._handle_clients_xml_event(Mock())
+        metadata.core.metadata_cache.expire.assert_called_once_with("client2")
+
     def load_groups_data(self, metadata=None, xdata=None):
         if metadata is None:
             metadata = self.get_obj()
@@ -789,6 +828,8 @@ class TestMetadata(_TestMetadata, TestStatistics, TestDatabaseBacked):
         self.assertItemsEqual([g.name
                                for g in metadata.negated_groups.values()],
                               negated_groups)
+        self.assertEqual(len(metadata.group_rules),
+                         len(all_groups) + len(negated_groups))
         
     @patch("Bcfg2.Server.Plugins.Metadata.XMLMetadataConfig.load_xml", Mock())
     def test_set_profile(self):
@@ -982,6 +1023,20 @@ class TestMetadata(_TestMetadata, TestStatistics, TestDatabaseBacked):
                          (set(["group1", "group8", "group9", "group10"]),
                           dict(group1="category1")))
 
+        # group9 is added by group8, and then removed again for
+        # client9
+        groups = metadata._merge_groups("client9", set(["group8"]))[0]
+        self.assertIn("group11", groups)
+        self.assertNotIn("group9", groups)
+
+        # group1 and group4 are suppressed by category1
+        groups, categories = \
+            metadata._merge_groups("client2", set(["group2"]),
+                                   categories=dict(category1="group2"))
+        self.assertNotIn("group1", groups)
+        self.assertNotIn("group4", groups)
+        self.assertEqual(categories['category1'], "group2")
+
     @patch("Bcfg2.Server.Plugins.Metadata.XMLMetadataConfig.load_xml", Mock())
     def test_get_all_group_names(self):
         metadata = self.load_groups_data()
@@ -1018,6 +1073,51 @@ class TestMetadata(_TestMetadata, TestStatistics, TestDatabaseBacked):
                               [c.get("name")
                                for c in get_clients_test_tree().findall("//Client[@profile='group2']")])
 
+        # with final metadata cached, clients are looked up in the
+        # index, and metadata is only rebuilt for clients whose
+        # cached metadata has expired
+        cache = dict()
+
+        def build_metadata(client):
+            if client not in cache:
+                cache[client] = metadata.get_initial_metadata(client)
+            return cache[client]
+
+        metadata.core.build_metadata.side_effect = build_metadata
+        metadata.core.metadata_cache = cache
+        metadata.core.metadata_cache_mode = "cautious"
+        for _ in range(2):
+            metadata.core.build_metadata.reset_mock()
+            self.assertItemsEqual(
+                metadata.get_client_names_by_groups(["group2"]),
+                [c.get("name")
+                 for c in get_clients_test_tree().findall("//Client[@profile='group2']")])
+        self.assertFalse(metadata.core.build_metadata.called)
+
+        del cache["client1"]
+        self.assertItemsEqual(metadata.get_client_names_by_bundles(["bundle1"]),
+                              metadata.get_client_names_by_groups(["group2"]))
+        metadata.core.build_metadata.assert_called_once_with("client1")
+
+        # new clients can be added while metadata is built for the
+        # existing ones
+        expected = metadata.get_client_names_by_groups(["group2"])
+        for mode in ["cautious", "off"]:
+            added = []
+
+            def build_and_add(client):
+                added.append("new%d" % len(added))
+                metadata.clients.add(added[-1])
+                return metadata.get_initial_metadata(client)
+
+            cache.clear()
+            metadata.core.metadata_cache_mode = mode
+            metadata.core.build_metadata.side_effect = build_and_add
+            self.assertItemsEqual(
+                metadata.get_client_names_by_groups(["group2"]), expected)
+            self.assertTrue(added)
+            metadata.clients.difference_update(added)
+
     @patch("Bcfg2.Server.Plugins.Metadata.XMLMetadataConfig.load_xml", Mock())
     def test_merge_additional_groups(self):
         metadata = self.load_clients_data(metadata=self.load_groups_data())
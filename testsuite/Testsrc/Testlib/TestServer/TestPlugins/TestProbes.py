@@ -1,6 +1,7 @@
 import os
 import sys
 import time
+import threading
 import lxml.etree
 import Bcfg2.Server
 import Bcfg2.Server.Plugin
@@ -87,7 +88,8 @@ class TestProbeData(Bcfg2TestCase):
 class TestProbeSet(TestEntrySet):
     test_obj = ProbeSet
     basenames = ["test", "_test", "test-test"]
-    ignore = ["foo~", ".#foo", ".foo.swp", ".foo.swx", "probed.xml"]
+    ignore = ["foo~", ".#foo", ".foo.swp", ".foo.swx", "probed.xml",
+              "probed.journal", ".probed.xml.tmp"]
     bogus_names = ["test.py"]
 
     def get_obj(self, path=datastore, fam=None, encoding=None,
@@ -123,6 +125,11 @@ class TestProbeSet(TestEntrySet):
         evt.filename = "probed.xml"
         ps.HandleEvent(evt)
         self.assertFalse(ps.handle_event.called)
+
+        evt.reset_mock()
+        evt.filename = "probed.journal"
+        ps.HandleEvent(evt)
+        self.assertFalse(ps.handle_event.called)
         
         # test that other events are processed appropriately
         evt.reset_mock()
@@ -261,6 +268,11 @@ text
         mock_load_data.assert_any_call()
         self.assertEqual(probes.probedata, ClientProbeDataSet())
         self.assertEqual(probes.cgroups, dict())
+        # writing probe data doesn't expire cached configs
+        probes.core.config_cache.ignore_path.assert_any_call(
+            os.path.join(datastore, probes.name, "probed.xml"))
+        probes.core.config_cache.ignore_path.assert_any_call(
+            os.path.join(datastore, probes.name, "probed.journal"))
 
     @patch("Bcfg2.Server.Plugins.Probes.Probes.load_data", Mock())
     def test__use_db(self):
@@ -288,15 +300,123 @@ text
         probes._write_data_db.assert_called_with("test")
         self.assertFalse(probes._write_data_xml.called)
 
+    @patch("threading.Timer")
+    def test__write_data_xml(self, mock_Timer):
+        probes = self.get_probes_object(use_db=False)
+        probes.probedata = self.get_test_probedata()
+        probes.cgroups = self.get_test_cgroups()
+        probes._flush_journal = Mock()
+        probes.last_flush = time.time()
+        client = Mock()
+        client.hostname = "foo.example.com"
+
+        # data is queued until flush_interval has passed, and a
+        # single timer is started to write it out then
+        probes._write_data_xml(client)
+        probes._write_data_xml(client)
+        self.assertFalse(probes._flush_journal.called)
+        mock_Timer.assert_called_once_with(probes.flush_interval,
+                                           probes._timed_flush)
+        mock_Timer.return_value.start.assert_called_once_with()
+        self.assertEqual(probes.flush_timer, mock_Timer.return_value)
+        self.assertItemsEqual(probes.pending_records.keys(), [client.hostname])
+        record = probes.pending_records[client.hostname]
+        self.assertNotIn("\n", record)
+        self.assertEqual(len(lxml.etree.XML(record).findall("Probe")),
+                         len(probes.probedata[client.hostname]))
+
+        probes.last_flush = time.time() - probes.flush_interval
+        probes._write_data_xml(client)
+        probes._flush_journal.assert_called_with()
+
+    def test__timed_flush(self):
+        probes = self.get_probes_object(use_db=False)
+        probes.probedata = self.get_test_probedata()
+        probes.cgroups = self.get_test_cgroups()
+        probes.flush_interval = 0.1
+        probes.last_flush = time.time()
+        flushed = threading.Event()
+        probes._flush_journal = Mock()
+        probes._flush_journal.side_effect = lambda: flushed.set()
+        client = Mock()
+        client.hostname = "foo.example.com"
+
+        # queued data is written out once flush_interval has passed,
+        # even if no other client checks in
+        probes._write_data_xml(client)
+        self.assertIsNotNone(probes.flush_timer)
+        flushed.wait(5)
+        probes._flush_journal.assert_called_once_with()
+        probes.pending_lock.acquire()
+        self.assertIsNone(probes.flush_timer)
+        probes.pending_lock.release()
+
+    @patch("Bcfg2.Server.Plugin.DatabaseBacked.shutdown", Mock())
+    def test_shutdown_xml(self):
+        probes = self.get_probes_object(use_db=False)
+        probes._flush_journal = Mock()
+        probes._compact_xml = Mock()
+        timer = Mock()
+        probes.flush_timer = timer
+        probes.journal_records = 1
+        probes.shutdown()
+        timer.cancel.assert_called_with()
+        self.assertIsNone(probes.flush_timer)
+        probes._flush_journal.assert_called_with()
+        probes._compact_xml.assert_called_with()
+
+    @patch("fcntl.lockf", Mock())
     @patch("%s.open" % builtins)
-    def test__write_data_xml(self, mock_open):
+    def test__flush_journal(self, mock_open):
+        probes = self.get_probes_object(use_db=False)
+        probes._compact_xml = Mock()
+        probes.pending_records = {
+            "foo.example.com": "<Client name='foo'/>",
+            "bar.example.com": "<Client name='bar'/>"}
+        probes._flush_journal()
+        mock_open.assert_called_with(probes.journal, 'a')
+        written = mock_open.return_value.write.call_args[0][0]
+        self.assertItemsEqual(written.splitlines(),
+                              ["<Client name='foo'/>", "<Client name='bar'/>"])
+        self.assertEqual(probes.pending_records, dict())
+        self.assertEqual(probes.journal_records, 2)
+        self.assertFalse(probes._compact_xml.called)
+
+        # the journal is compacted once it's big enough
+        mock_open.reset_mock()
+        probes.journal_records = probes.compact_threshold
+        probes.pending_records = {"foo.example.com": "<Client name='foo'/>"}
+        probes._flush_journal()
+        probes._compact_xml.assert_called_with()
+
+        # nothing is written if nothing is queued
+        mock_open.reset_mock()
+        probes._flush_journal()
+        self.assertFalse(mock_open.called)
+
+    @patch("fcntl.lockf", Mock())
+    @patch("os.rename")
+    @patch("%s.open" % builtins)
+    def test__compact_xml(self, mock_open, mock_rename):
         probes = self.get_probes_object(use_db=False)
         probes.probedata = self.get_test_probedata()
         probes.cgroups = self.get_test_cgroups()
-        probes._write_data_xml(None)
+        clients = dict([(c, probes._client_xml(c))
+                        for c in probes.probedata.keys()])
+        probes._read_data_xml = Mock()
+        probes._read_data_xml.return_value = clients
+        probes.journal_records = 10
+        probes._compact_xml()
+
+        tmpfile = os.path.join(datastore, probes.name, ".probed.xml.tmp")
+        mock_open.assert_any_call(probes.journal, 'a')
+        mock_open.assert_any_call(tmpfile, 'w')
+        mock_rename.assert_called_with(tmpfile,
+                                       os.path.join(datastore, probes.name,
+                                                    "probed.xml"))
+        mock_open.return_value.truncate.assert_called_with(0)
+        self.assertEqual(probes.journal_records, 0)
 
-        mock_open.assert_called_with(os.path.join(datastore, probes.name,
-                                                  "probed.xml"), "w")
         data = lxml.etree.XML(mock_open.return_value.write.call_args[0][0])
         self.assertEqual(len(data.xpath("//Client")), 2)
 
@@ -396,6 +516,30 @@ text
         pgroups = ProbesGroupsModel.objects.filter(hostname=cname).all()
         self.assertEqual(len(pgroups), len(probes.cgroups[cname]))
 
+        # test that changed data is updated and duplicate rows are
+        # removed
+        probes.probedata[cname]['multiline'] = ProbeData("changed")
+        ProbesDataModel(hostname=cname, probe="xml", data="dup").save()
+        probes._write_data_db(client)
+        pdata = ProbesDataModel.objects.filter(hostname=cname).all()
+        self.assertItemsEqual([(p.probe, p.data) for p in pdata],
+                              probes.probedata[cname].items())
+
+        # test that the background writer writes only the newest
+        # queued data for each client
+        probes.db_writer = Mock()
+        probes._sync_db = Mock()
+        probes._write_data_db(client)
+        probes.probedata[cname]['text'] = ProbeData("newest")
+        probes._write_data_db(client)
+        self.assertFalse(probes._sync_db.called)
+        self.assertItemsEqual(probes.pending_db_writes.keys(), [cname])
+        probes.db_writer = None
+        probes._db_writer()
+        probes._sync_db.assert_called_once_with(
+            cname, dict(probes.probedata[cname]), probes.cgroups[cname])
+        self.assertEqual(probes.pending_db_writes, dict())
+
     @skipUnless(HAS_DJANGO, "Django not found, skipping")
     @patch("Bcfg2.Server.Plugins.Probes.Probes._load_data_db", Mock())
     @patch("Bcfg2.Server.Plugins.Probes.Probes._load_data_xml", Mock())
@@ -414,19 +558,18 @@ text
         probes._load_data_db.assert_any_call()
         self.assertFalse(probes._load_data_xml.called)
 
+    @patch("os.path.exists")
     @patch("%s.open" % builtins)
     @patch("lxml.etree.parse")
-    def test__load_data_xml(self, mock_parse, mock_open):
+    def test__load_data_xml(self, mock_parse, mock_open, mock_exists):
         probes = self.get_probes_object(use_db=False)
-        # to get the value for lxml.etree.parse to parse, we call
-        # _write_data_xml, mock the open() call, and grab the data
-        # that gets "written" to probed.xml
         probes.probedata = self.get_test_probedata()
         probes.cgroups = self.get_test_cgroups()
-        probes._write_data_xml(None)
-        xdata = \
-            lxml.etree.XML(str(mock_open.return_value.write.call_args[0][0]))
+        xdata = lxml.etree.Element("Probed")
+        for client in sorted(probes.probedata.keys()):
+            xdata.append(probes._client_xml(client))
         mock_parse.return_value = xdata.getroottree()
+        mock_exists.return_value = False
         probes.probedata = dict()
         probes.cgroups = dict()
 
@@ -437,6 +580,23 @@ text
         self.assertItemsEqual(probes.probedata, self.get_test_probedata())
         self.assertItemsEqual(probes.cgroups, self.get_test_cgroups())
 
+        # records in the journal supersede probed.xml
+        mock_exists.return_value = True
+        mock_open.return_value = \
+            ['<Client name="foo.example.com" timestamp="1">'
+             '<Probe name="text" value="new"/><Group name="new"/></Client>\n',
+             '<Client name="baz.example.com" timestamp="1"></Client>\n',
+             '<Client name="torn']
+        probes._load_data_xml()
+        mock_open.assert_called_with(probes.journal)
+        self.assertItemsEqual(probes.probedata.keys(),
+                              ["foo.example.com", "bar.example.com",
+                               "baz.example.com"])
+        self.assertEqual(probes.probedata["foo.example.com"],
+                         dict(text="new"))
+        self.assertEqual(probes.cgroups["foo.example.com"], ["new"])
+        self.assertEqual(probes.journal_records, 3)
+
     @skipUnless(HAS_DJANGO, "Django not found, skipping")
     def test__load_data_db(self):
         syncdb(TestProbesDB)
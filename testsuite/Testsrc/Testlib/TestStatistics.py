@@ -0,0 +1,98 @@
+import os
+import sys
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+from Bcfg2.Statistics import *
+
+
+class TestHistogram(Bcfg2TestCase):
+    def test_percentile(self):
+        hist = Histogram()
+        self.assertIsNone(hist.percentile(50))
+        self.assertIsNone(hist.mean())
+
+        for val in range(1, 101):
+            hist.add_value(val / 100.0)
+        self.assertEqual(hist.count, 100)
+        self.assertEqual(hist.min, 0.01)
+        self.assertEqual(hist.max, 1.0)
+        self.assertAlmostEqual(hist.mean(), 0.505)
+        for pct in [1, 50, 95, 99, 100]:
+            self.assertAlmostEqual(hist.percentile(pct), pct / 100.0,
+                                   delta=pct / 100.0 * 0.05)
+
+        # memory use is bounded no matter how many values are added
+        for val in range(10000):
+            hist.add_value(val * 10)
+        self.assertLessEqual(len(hist.counts), Histogram.buckets)
+
+    def test_update(self):
+        hist1 = Histogram()
+        hist1.add_value(1)
+        hist1.add_value(2)
+        hist2 = Histogram()
+        hist2.add_value(4)
+        hist1.update(hist2)
+        self.assertEqual(hist1.count, 3)
+        self.assertEqual(hist1.min, 1)
+        self.assertEqual(hist1.max, 4)
+        self.assertAlmostEqual(hist1.mean(), 7 / 3.0)
+
+
+class TestStatistic(Bcfg2TestCase):
+    def test_add_value(self):
+        stat = Statistic("foo", 1.0)
+        stat.add_value(2.0)
+        stat.add_value(6.0)
+        self.assertEqual(stat.min, 1.0)
+        self.assertEqual(stat.max, 6.0)
+        self.assertAlmostEqual(stat.ave, 3.0)
+        self.assertEqual(stat.count, 3)
+
+        name, value = stat.get_value()
+        self.assertEqual(name, "foo")
+        self.assertEqual(len(value), 7)
+        self.assertEqual(value[:3], (1.0, 6.0, 3.0))
+        self.assertEqual(value[-1], 3)
+
+    def test_window(self):
+        stat = Statistic("foo")
+        now = 100000.0
+        stat.add_value(10.0, now=now - 30 * 60)
+        stat.add_value(1.0, now=now - 90)
+        stat.add_value(2.0, now=now)
+        self.assertEqual(stat.get_histogram(window=5, now=now).count, 2)
+        self.assertEqual(stat.get_value(window=5, now=now)[1][1], 2.0)
+        self.assertEqual(stat.get_histogram(window=60, now=now).count, 3)
+        self.assertEqual(stat.get_histogram(now=now).count, 3)
+
+        # old values are forgotten by windowed views, but not overall
+        later = now + 2 * 60 * 60
+        self.assertEqual(stat.get_histogram(window=60, now=later).count, 0)
+        self.assertEqual(stat.get_value(window=60, now=later),
+                         ("foo", None))
+        self.assertEqual(stat.count, 3)
+
+
+class TestStatistics(Bcfg2TestCase):
+    def test_display(self):
+        stats = Statistics()
+        stats.add_value("foo", 1.0)
+        stats.add_value("foo", 3.0)
+        stats.add_value("bar", 2.0)
+        data = stats.display()
+        self.assertItemsEqual(data.keys(), ["foo", "bar"])
+        self.assertEqual(data["foo"][:3], (1.0, 3.0, 2.0))
+        self.assertEqual(data["foo"][-1], 2)
+        self.assertEqual(data["bar"][-1], 1)
+        self.assertItemsEqual(stats.display(window=5).keys(),
+                              ["foo", "bar"])
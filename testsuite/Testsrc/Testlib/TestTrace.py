@@ -0,0 +1,77 @@
+import os
+import sys
+import threading
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+import Bcfg2.Trace
+from Bcfg2.Trace import *
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+class TestTrace(Bcfg2TestCase):
+    def test_disabled(self):
+        self.assertIsNone(current())
+        span = start("foo")
+        self.assertIsNone(span)
+        end(span)
+        self.assertIsNone(current())
+
+    def test_trace(self):
+        root = start_trace("root", client="foo.example.com")
+        self.assertEqual(current(), root)
+        child1 = start("child1", name="/etc/motd")
+        grandchild = start("grandchild")
+        self.assertEqual(current(), grandchild)
+        end(grandchild)
+        end(child1)
+        self.assertEqual(current(), root)
+
+        # spans started in other threads only join the trace if the
+        # thread continues it explicitly
+        def work():
+            self.assertIsNone(start("ignored"))
+            old = set_current(root)
+            end(start("child2"))
+            set_current(old)
+
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+        end(root)
+        self.assertIsNone(current())
+
+        self.assertEqual([c.name for c in root.children],
+                         ["child1", "child2"])
+        self.assertEqual(root.children[0].children, [grandchild])
+        self.assertNotEqual(root.children[0].thread,
+                            root.children[1].thread)
+        self.assertGreaterEqual(root.duration, child1.duration)
+        self.assertGreaterEqual(child1.duration, grandchild.duration)
+
+        data = json.loads(dump(root))
+        self.assertEqual(data['name'], "root")
+        self.assertEqual(data['attrs'], dict(client="foo.example.com"))
+        self.assertEqual(data['children'][0]['attrs'],
+                         dict(name="/etc/motd"))
+        self.assertEqual(data['children'][0]['children'][0]['name'],
+                         "grandchild")
+
+        events = json.loads(dump(root, chrome=True))['traceEvents']
+        spans = [e for e in events if e['ph'] == 'X']
+        self.assertItemsEqual([e['name'] for e in spans],
+                              ["root", "child1", "grandchild", "child2"])
+        self.assertEqual(len([e for e in events if e['ph'] == 'M']), 2)
+        self.assertEqual(spans[0]['ts'], 0)
@@ -0,0 +1,113 @@
+import os
+import sys
+import time
+from mock import Mock, MagicMock, patch
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+from Bcfg2.Utils import *
+
+
+class TestWorkerPool(Bcfg2TestCase):
+    def test_map(self):
+        pool = WorkerPool(4)
+        self.assertEqual(pool.threads, [])
+
+        # results come back in order, even if they finish out of order
+        def work(val):
+            time.sleep(0.01 * (5 - val))
+            return val * 2
+
+        self.assertEqual(pool.map(work, range(5)), [0, 2, 4, 6, 8])
+        self.assertEqual(len(pool.threads), 4)
+        self.assertEqual(pool.map(work, []), [])
+
+        # exceptions are re-raised after all jobs are done
+        done = []
+
+        def fail(val):
+            if val == 1:
+                raise ValueError(val)
+            done.append(val)
+
+        self.assertRaises(ValueError, pool.map, fail, range(5))
+        self.assertItemsEqual(done, [0, 2, 3, 4])
+
+        pool.shutdown()
+        self.assertEqual(pool.threads, [])
+
+
+class TestRunWithTimeout(Bcfg2TestCase):
+    def test_run_with_timeout(self):
+        rv, stdout, stderr, timed_out = \
+            run_with_timeout(["/bin/sh", "-c", "echo foo; echo bar >&2; "
+                              "exit 3"], timeout=30)
+        self.assertEqual(rv, 3)
+        self.assertEqual(stdout.decode('UTF-8'), "foo\n")
+        self.assertEqual(stderr.decode('UTF-8'), "bar\n")
+        self.assertFalse(timed_out)
+
+    @patch("Bcfg2.Utils.Popen")
+    def test_popen_args(self, mock_Popen):
+        mock_Popen.return_value.communicate.return_value = ("", "")
+        mock_Popen.return_value.wait.return_value = 0
+        self.assertEqual(run_with_timeout(["/bin/true"]),
+                         (0, "", "", False))
+        args, kwargs = mock_Popen.call_args
+        # other commands' pipes must not be inherited, and
+        # preexec_fn isn't safe to use with threads
+        self.assertTrue(kwargs['close_fds'])
+        self.assertNotIn('preexec_fn', kwargs)
+        # commands without a timeout are run as they are
+        self.assertEqual(args[0], ["/bin/true"])
+
+        run_with_timeout(["/bin/true"], timeout=30)
+        args, kwargs = mock_Popen.call_args
+        self.assertTrue(kwargs['close_fds'])
+        if SETSID:
+            self.assertEqual(args[0], [SETSID, "/bin/true"])
+        else:
+            self.assertEqual(args[0], ["/bin/true"])
+
+    def test_timeout(self):
+        # the command starts a child that holds stdout open, so the
+        # call can only return once the child has been killed too
+        start = time.time()
+        rv, stdout, stderr, timed_out = \
+            run_with_timeout(["/bin/sh", "-c", "sleep 30 & sleep 30"],
+                             timeout=1)
+        self.assertTrue(timed_out)
+        self.assertNotEqual(rv, 0)
+        if SETSID:
+            self.assertLess(time.time() - start, 10)
+
+    def test_parallel(self):
+        """ commands run at once in several threads don't wait for
+        each other, and results come back in order """
+        pool = WorkerPool(4)
+        start = time.time()
+        commands = [["/bin/sh", "-c", "sleep 2; echo 0"]] + \
+            [["/bin/sh", "-c", "echo %d" % i] for i in range(1, 6)]
+        finished = dict()
+
+        def run(command):
+            rv = run_with_timeout(command)
+            finished[rv[1].decode('UTF-8').strip()] = time.time() - start
+            return rv
+
+        results = pool.map(run, commands)
+        pool.shutdown()
+        self.assertEqual([r[1].decode('UTF-8').strip() for r in results],
+                         ["0", "1", "2", "3", "4", "5"])
+        # the quick commands weren't held up by the slow one
+        for i in range(1, 6):
+            self.assertLess(finished[str(i)], 1.5)
+        self.assertGreaterEqual(finished["0"], 2)